@@ -0,0 +1,220 @@
+#!/QOpenSys/pkgs/bin/python3
+######!/usr/bin/python3
+##### IBM i Specific
+#####!/QOpenSys/pkgs/bin/python3
+#------------------------------------------------
+# Script name: pyarchivewal.py
+#
+# Description:
+# This script will archive PostgreSQL WAL files for point-in-time recovery.
+# It is the archive_command and restore_command for a WAL archive used with
+# physical backups from pybackuppostgres.py --format=physical. Each WAL file is
+# compressed into the archive and recorded in a SQLite index in the archive
+# directory. Segments are stored 256 per sub directory.
+#
+# Server setup in postgresql.conf. Needs a server restart for archive_mode:
+# wal_level = replica
+# archive_mode = on
+# archive_command = 'python3 /scripts/pyarchivewal.py --action=archive --archivedir=/backup/wal --compress=zstd --walpath=%p --walfile=%f'
+# pyrestorepostgres.py --action=pitr writes the matching restore_command.
+#
+# Links:
+# https://www.postgresql.org/docs/current/continuous-archiving.html
+#
+# Pip packages needed:
+#
+# Parameters:
+# --action=archive - Compress a WAL file into the archive. Used in archive_command.
+#   restore - Decompress a WAL file from the archive. Used in restore_command.
+#   Exits with return code 1 when the file is not in the archive.
+#   prune - Delete archived segments older than a backup.
+# --archivedir=WAL archive directory. Created if it does not exist.
+# --walpath=WAL file path. Pass %p. Used for archive and restore.
+# --walfile=WAL file name. Pass %f. Used for archive and restore.
+# --compress=Compression codec for archive. none, gzip, zstd or lz4. Default=none
+#   A segment is the same size compressed or not, so compression saves most of the archive space.
+# --compresslevel=Compression level. 0=Codec default. Default=0
+# --compressmode=auto - Use the Python module for the codec when installed, otherwise
+#   pipeline through the codec command line program. inprocess or pipeline force a mode. Default=auto
+# --before=Prune segments older than this WAL segment name or the start segment of this
+#   physical backup directory. Pass the oldest physical backup kept.
+# --dryrun=True=List the segments prune would delete without deleting anything.
+#   False=Delete the segments (default).
+#------------------------------------------------
+
+#------------------------------------------------
+# Imports and Environment setup
+#------------------------------------------------
+import sys
+from sys import platform
+import os
+import os.path
+import time
+import traceback
+import argparse
+import pypostgresstream
+import pypostgreswal
+
+#------------------------------------------------
+# Script initialization
+#------------------------------------------------
+
+# Initialize or set variables
+exitcode=0 #Init exitcode
+exitmessage=''
+dashes="-------------------------------------------------------------------------------"
+
+#Output messages to STDOUT for logging
+print(dashes)
+print("PostgreSQL WAL Archive")
+print(f"Start of Main Processing -  {time.strftime('%H:%M:%S')}")
+print("OS:" + platform)
+
+#------------------------------------------------
+# Define some useful functions
+#------------------------------------------------
+
+def str2bool(strval):
+    #-------------------------------------------------------
+    # Function: str2bool
+    # Desc: Constructor
+    # :strval: String value for true or false
+    # :return: Return True if string value is" yes, true, t or 1
+    #-------------------------------------------------------
+    return strval.lower() in ("yes", "true", "t", "1")
+
+#------------------------------------------------
+# Main script logic
+#------------------------------------------------
+try: # Try to perform main logic
+
+      # Set up the command line argument parsing.
+      # If the parse_args function fails, the program will
+      # exit with an error 2. In Python 3.9, there is
+      # an argument to prevent an auto-exit
+      # Each argument has a long and short version
+      parser = argparse.ArgumentParser()
+      parser.add_argument('-a','--action', required=True,help="archive, restore or prune")
+      parser.add_argument('-o','--archivedir', required=True,help="WAL archive directory")
+      parser.add_argument('-p','--walpath', required=False,default="",help="WAL file path. Pass %%p. Default=blank")
+      parser.add_argument('-f','--walfile', required=False,default="",help="WAL file name. Pass %%f. Default=blank")
+      parser.add_argument('-c','--compress', required=False,default="none",help="Compression codec: none, gzip, zstd or lz4. Default=none")
+      parser.add_argument('-l','--compresslevel', required=False,default="0",help="Compression level. 0=Codec default. Default=0")
+      parser.add_argument('-m','--compressmode', required=False,default="auto",help="auto, inprocess or pipeline. Default=auto")
+      parser.add_argument('-b','--before', required=False,default="",help="Prune segments older than this WAL segment or physical backup directory. Default=blank")
+      parser.add_argument('-n','--dryrun', required=False,default="False",help="True=List segments without deleting,False=Delete segments. Default=False")
+
+      # Parse the command line arguments
+      args = parser.parse_args()
+
+      # Set parameter work variables from command line args
+      parmscriptname = sys.argv[0]
+      parmaction=args.action.strip().lower()
+      parmarchivedir=args.archivedir.strip()
+      parmwalpath=args.walpath.strip()
+      parmwalfile=args.walfile.strip()
+      parmcompress=args.compress.strip().lower()
+      parmcompresslevel=int(args.compresslevel)
+      parmcompressmode=args.compressmode.strip().lower()
+      parmbefore=args.before.strip()
+      parmdryrun=str2bool(args.dryrun)
+      print(f"Python script: {parmscriptname}")
+      print(f"Action: {parmaction}")
+      print(f"Archive directory: {parmarchivedir}")
+      print(f"WAL path: {parmwalpath}")
+      print(f"WAL file: {parmwalfile}")
+      print(f"Compress: {parmcompress}")
+      print(f"Compress level: {parmcompresslevel}")
+      print(f"Compress mode: {parmcompressmode}")
+      print(f"Before: {parmbefore}")
+      print(f"Dry run: {parmdryrun}")
+
+      # Bail if action is invalid
+      if (parmaction not in ("archive","restore","prune")):
+            raise Exception(f"Action {parmaction} is invalid. Use archive, restore or prune")
+
+      # Bail if compression options are invalid
+      if (parmcompress!="none" and parmcompress not in pypostgresstream.CODECS):
+            raise Exception(f"Compress {parmcompress} is invalid. Use none, gzip, zstd or lz4")
+      if (parmcompressmode not in ("auto","inprocess","pipeline")):
+            raise Exception(f"Compress mode {parmcompressmode} is invalid. Use auto, inprocess or pipeline")
+
+      # Bail if the WAL file is missing for archive and restore
+      if (parmaction in ("archive","restore") and (parmwalpath=="" or parmwalfile=="")):
+            raise Exception(f"--walpath and --walfile are required for {parmaction}")
+
+      if (parmaction=="archive"):
+         os.makedirs(parmarchivedir,exist_ok=True)
+         print(f"INFO: Starting archive of {parmwalfile} - {time.strftime('%H:%M:%S')}")
+         row=pypostgreswal.archivewal(parmwalpath,parmwalfile,parmarchivedir,parmcompress,parmcompresslevel,parmcompressmode)
+         print(f"INFO: Completed archive of {parmwalfile} to {row['path']} - {time.strftime('%H:%M:%S')}")
+         exitcode=0
+         exitmessage=f"WAL file {parmwalfile} archived. {row['bytes']} bytes stored in {row['archivedbytes']} bytes"
+
+      elif (parmaction=="restore"):
+         if (os.path.isdir(parmarchivedir)==False):
+               raise Exception(f"Archive directory {parmarchivedir} does not exist")
+         # A missing file is normal at the end of the archive so it
+         # returns 1 without a traceback to end recovery
+         if (pypostgreswal.restorewal(parmwalfile,parmwalpath,parmarchivedir,parmcompressmode)):
+            exitcode=0
+            exitmessage=f"WAL file {parmwalfile} restored to {parmwalpath}"
+         else:
+            exitcode=1
+            exitmessage=f"WAL file {parmwalfile} is not in the archive"
+
+      else:
+         if (os.path.isdir(parmarchivedir)==False):
+               raise Exception(f"Archive directory {parmarchivedir} does not exist")
+         # Prune before the start segment of a physical backup or a segment name
+         if (os.path.isdir(parmbefore)):
+            info=pypostgreswal.readphysical(parmbefore)
+            if info is None or "startsegment" not in info:
+                  raise Exception(f"{parmbefore} is not a physical backup directory")
+            parmbefore=info["startsegment"]
+         if (pypostgreswal.walfiletype(parmbefore)!="segment"):
+               raise Exception("--before must be a WAL segment name or physical backup directory for prune")
+         print(f"INFO: Starting prune of segments before {parmbefore} - {time.strftime('%H:%M:%S')}")
+         pruned=pypostgreswal.prunewal(parmarchivedir,parmbefore,parmdryrun)
+         for (walfile,size) in pruned:
+            print(f"{'Would delete' if parmdryrun else 'Deleted'} {walfile}")
+         print(f"INFO: Completed prune of segments before {parmbefore} - {time.strftime('%H:%M:%S')}")
+         exitcode=0
+         exitmessage=f"Prune completed successfully. {len(pruned)} files {'would be ' if parmdryrun else ''}deleted with {sum(size for (walfile,size) in pruned)/1024/1024:.1f} MB"
+
+#------------------------------------------------
+# Handle Exceptions
+#------------------------------------------------
+# System Exit occurred. Most likely from argument parser
+except SystemExit as ex:
+     exitcode=ex.code # set return code for stdout
+     exitmessage=str(ex) # set exit message for stdout
+
+except argparse.ArgumentError as exc:
+     exitcode=99 # set return code for stdout
+     exitmessage=str(exc) # set exit message for stdout
+     print('Traceback Info') # output traceback info for stdout
+     traceback.print_exc()
+     sys.exit(99)
+
+except Exception as ex: # Catch and handle exceptions
+     exitcode=99 # set return code for stdout
+     exitmessage=str(ex) # set exit message for stdout
+     print('Traceback Info') # output traceback info for stdout
+     traceback.print_exc()
+     sys.exit(99)
+#------------------------------------------------
+# Always perform final processing
+#------------------------------------------------
+finally: # Final processing
+     # Do any final code and exit now
+     # We log as much relevent info to STDOUT as needed
+     print("")
+     print(dashes)
+     print('ExitCode:' + str(exitcode))
+     print('ExitMessage:' + exitmessage)
+     print(f"End of Main Processing -  {time.strftime('%H:%M:%S')}")
+     print(dashes)
+
+     # Exit the script now
+     sys.exit(exitcode)
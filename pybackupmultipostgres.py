@@ -0,0 +1,389 @@
+#!/QOpenSys/pkgs/bin/python3
+######!/usr/bin/python3
+##### IBM i Specific
+#####!/QOpenSys/pkgs/bin/python3
+#------------------------------------------------
+# Script name: pybackupmultipostgres.py
+#
+# Description:
+# This script will back up a list of PostgreSQL databases or every database
+# found in pg_database by running pybackuppostgres.py for each database
+# through a bounded pool of workers.
+#
+# Links:
+# https://www.postgresql.org/docs/current/catalog-pg-database.html
+#
+# Pip packages needed:
+#
+# Parameters:
+# --dbnames=Comma separated list of database names to back up. Use *ALL to back up
+#   every database in pg_database that allows connections and is not a template.
+# --exclude=Comma separated list of database names to skip when --dbnames=*ALL. Default=postgres
+# --dbhost=PostgreSQL host name to connect to. Leave blank or omit this parm to use local sockets.
+# --dbport=PostgreSQL TCP port connect to. Omit this parm to default to port: 5432.
+# --dbuser=PostgreSQL user to connect as. Omit this parm to use "postgres" user as default user.
+# --dbpass=PostgreSQL password to use. Omit this parm or pass empty parm if host is blank to use local socket connection.
+# --outputfile=Output file name template. Must contain @@dbdatetime or @@DBDATETIME so
+#   each database gets its own file. Ex: /tmp/@@dbdatetime.tar
+#   An s3://bucket/key template uploads each backup to object storage. Ex: s3://backups/pg/@@dbdatetime.tar
+# --replace=True=Replace output files. False=Halt database backup if output file already exists.
+# --workers=Number of databases to back up at the same time. Default=2
+# --maxmbps=Maximum total MB/s written by all workers together. Each worker gets an equal
+#   share. 0=No limit (default). Only used with tar format. Time of day windows are shared
+#   the same way. Ex: 100,01:00-05:00=600
+# --maxload, --maxlag, --nice, --ionice=Passed to each pybackuppostgres.py run. Each backup
+#   checks the load average and replication lag and backs off its own share. --maxload and
+#   --maxlag are only used with tar format.
+# --format=Backup format passed to pybackuppostgres.py. tar, directory or shards. Default=tar
+# --jobs=Number of parallel pg_dump jobs per database for directory and shards format. Default=1
+# --logdir=Directory to write each database backup log to. Blank=Print each database
+#   backup log when it completes. Default=blank
+# --catalog=SQLite backup catalog file passed to pybackuppostgres.py. Every database backup
+#   is recorded in the same catalog. Blank=No catalog (default).
+# --endpoint, --partsize, --uploads=Object storage settings passed to each pybackuppostgres.py run.
+#   Each running backup holds about uploads+1 parts in memory.
+# --stats, --samplerows=Table stats for restore verification passed to each pybackuppostgres.py run.
+#   none, count, sample or full. Default=none
+#------------------------------------------------
+
+#------------------------------------------------
+# Imports and Environment setup
+#------------------------------------------------
+import sys
+from sys import platform
+import os
+import os.path
+import time
+import traceback
+import argparse
+import subprocess
+import concurrent.futures
+import pypostgresthrottle
+
+#------------------------------------------------
+# Script initialization
+#------------------------------------------------
+
+# Initialize or set variables
+exitcode=0 #Init exitcode
+exitmessage=''
+dashes="-------------------------------------------------------------------------------"
+backupscript=os.path.join(os.path.dirname(os.path.abspath(__file__)),"pybackuppostgres.py")
+
+#Output messages to STDOUT for logging
+print(dashes)
+print("PostgreSQL Multiple Database Backup")
+print(f"Start of Main Processing -  {time.strftime('%H:%M:%S')}")
+print("OS:" + platform)
+
+#------------------------------------------------
+# Define some useful functions
+#------------------------------------------------
+
+def str2bool(strval):
+    #-------------------------------------------------------
+    # Function: str2bool
+    # Desc: Constructor
+    # :strval: String value for true or false
+    # :return: Return True if string value is" yes, true, t or 1
+    #-------------------------------------------------------
+    return strval.lower() in ("yes", "true", "t", "1")
+
+def trim(strval):
+    #-------------------------------------------------------
+    # Function: trim
+    # Desc: Alternate name for strip
+    # :strval: String value to trim.
+    # :return: Trimmed value
+    #-------------------------------------------------------
+    return strval.strip()
+
+def getsize(path):
+    #-------------------------------------------------------
+    # Function: getsize
+    # Desc: Get size of a backup file or directory
+    # :path: Backup file or directory
+    # :return: Size in bytes or 0 if not found
+    #-------------------------------------------------------
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    totalsize=0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            totalsize+=os.path.getsize(os.path.join(root,name))
+    return totalsize
+
+def listdatabases(hostswitch,dbport,dbuser,dbpass):
+    #-------------------------------------------------------
+    # Function: listdatabases
+    # Desc: List databases from pg_database that allow connections
+    #       and are not templates. Largest databases are listed
+    #       first so the longest backups start first.
+    # :hostswitch: -h host switch or blank for local sockets
+    # :dbport: Database port
+    # :dbuser: Database user
+    # :dbpass: Database password
+    # :return: List of database names
+    #-------------------------------------------------------
+    cmd_listdb=f"psql -At -d postgres {hostswitch} -p {dbport} -U {dbuser} -c \"select datname from pg_database where datallowconn and not datistemplate order by pg_database_size(oid) desc\""
+    print(cmd_listdb)
+    result=subprocess.run(cmd_listdb,shell=True,capture_output=True,text=True,env=dict(os.environ,PGPASSWORD=dbpass))
+    if (result.returncode != 0):
+        raise Exception(f"Error {result.returncode} occurred while listing databases. {result.stderr.strip()}")
+    return [trim(line) for line in result.stdout.splitlines() if trim(line)!=""]
+
+def backupdatabase(dbname,backupargs,logdir):
+    #-------------------------------------------------------
+    # Function: backupdatabase
+    # Desc: Run pybackuppostgres.py for a single database
+    # :dbname: Database name to back up
+    # :backupargs: List of common pybackuppostgres.py arguments
+    # :logdir: Directory to write backup log to. Blank=Keep log in memory
+    # :return: Dictionary with database backup results
+    #-------------------------------------------------------
+    starttime=time.monotonic()
+    result=subprocess.run([sys.executable,backupscript,f"--dbname={dbname}"] + backupargs,
+                          stdout=subprocess.PIPE,stderr=subprocess.STDOUT,text=True)
+    duration=time.monotonic() - starttime
+    dbresult={"dbname":dbname,"exitcode":result.returncode,"exitmessage":"",
+              "outputfile":"","size":0,"duration":duration,"log":""}
+    # Pick the output file and exit message out of the backup log
+    for line in result.stdout.splitlines():
+        if line.startswith("Output file: "):
+            dbresult["outputfile"]=line[len("Output file: "):]
+        elif line.startswith("ExitMessage:"):
+            dbresult["exitmessage"]=line[len("ExitMessage:"):]
+        elif (line.startswith("INFO: SHA-256 ") and line.endswith(" bytes written")):
+            # Object storage backups have no local file to measure
+            dbresult["size"]=int(line.split(" for ")[-1].split()[0])
+    # Packaged directory backups end up in <outputfile>.tar
+    if (result.returncode==0 and os.path.exists(dbresult["outputfile"] + ".tar")):
+        dbresult["outputfile"]=dbresult["outputfile"] + ".tar"
+    if (dbresult["outputfile"]!="" and os.path.exists(dbresult["outputfile"])):
+        dbresult["size"]=getsize(dbresult["outputfile"])
+    if (logdir!=""):
+        with open(os.path.join(logdir,f"{dbname}-{time.strftime('%Y%m%d-%H%M%S')}.log"),"w") as logfile:
+            logfile.write(result.stdout)
+    else:
+        dbresult["log"]=result.stdout
+    return dbresult
+
+#------------------------------------------------
+# Main script logic
+#------------------------------------------------
+try: # Try to perform main logic
+
+      # Set up the command line argument parsing.
+      # If the parse_args function fails, the program will
+      # exit with an error 2. In Python 3.9, there is
+      # an argument to prevent an auto-exit
+      # Each argument has a long and short version
+      parser = argparse.ArgumentParser()
+      parser.add_argument('-d','--dbnames', required=True,help="Comma separated database names or *ALL for every database")
+      parser.add_argument('-x','--exclude', required=False,default="postgres",help="Comma separated database names to skip for *ALL. Default=postgres")
+      parser.add_argument('-H','--dbhost', required=False,default="",help="Database host. Blank=use local domain socket")
+      parser.add_argument('-p','--dbport', required=False,default=5432,help="Database port")
+      parser.add_argument('-U','--dbuser', required=False,default="postgres",help="Database user")
+      parser.add_argument('-P','--dbpass', required=False,default="",help="Database pass")
+      parser.add_argument('-o','--outputfile', required=True,help="Output file template containing @@dbdatetime")
+      parser.add_argument('-r','--replace',default="False",required=False,help="True=Replace output files,False=Halt database backup if output file exists. Default=False")
+      parser.add_argument('-w','--workers',default=2,required=False,help="Number of databases to back up at the same time. Default=2")
+      parser.add_argument('-m','--maxmbps',default="0",required=False,help="Maximum total MB/s for all workers with optional HH:MM-HH:MM=MB/s windows. 0=No limit. Default=0")
+      parser.add_argument('-L','--maxload',default=0,required=False,help="Back off while the 1 minute load average is over this value. 0=No check. Default=0")
+      parser.add_argument('-a','--maxlag',default=0,required=False,help="Back off while the standby replay lag is over this many seconds. 0=No check. Default=0")
+      parser.add_argument('-n','--nice',default=0,required=False,help="Nice increment 0-19 for the backup processes. 0=Unchanged. Default=0")
+      parser.add_argument('-i','--ionice',default="none",required=False,help="I/O priority for the backup processes: none, idle, besteffort:0-7 or realtime:0-7. Default=none")
+      parser.add_argument('-F','--format',default="tar",required=False,help="Backup format: tar, directory or shards. Default=tar")
+      parser.add_argument('-j','--jobs',default=1,required=False,help="Number of parallel pg_dump jobs per database for directory and shards format. Default=1")
+      parser.add_argument('-l','--logdir',default="",required=False,help="Directory for per database backup logs. Blank=print logs. Default=blank")
+      parser.add_argument('-C','--catalog',default="",required=False,help="SQLite backup catalog file to record the backups in. Blank=No catalog. Default=blank")
+      parser.add_argument('-E','--endpoint',default="",required=False,help="Object storage endpoint for s3:// output. file:///dir=Filesystem fake. Blank=AWS_ENDPOINT_URL or AWS S3. Default=blank")
+      parser.add_argument('-z','--partsize',default=16,required=False,help="Object storage upload part size in MB. Default=16")
+      parser.add_argument('-u','--uploads',default=4,required=False,help="Number of object storage parts uploaded at the same time per backup. Default=4")
+      parser.add_argument('-S','--stats',default="none",required=False,help="Table stats for restore verification: none, count, sample or full. Default=none")
+      parser.add_argument('-N','--samplerows',default=1000,required=False,help="Rows read from each end of a table for sample stats. Default=1000")
+
+      # Parse the command line arguments
+      args = parser.parse_args()
+
+      # Set parameter work variables from command line args
+      parmscriptname = sys.argv[0]
+      parmdbnames=args.dbnames.strip()
+      parmexclude=[trim(name) for name in args.exclude.split(",") if trim(name)!=""]
+      parmdbport =args.dbport
+      parmdbhost =args.dbhost.strip()
+      parmdbuser =args.dbuser.strip()
+      parmdbpass =args.dbpass.strip()
+      # Remove forward slash from password if found
+      # This is in case exclamation in password
+      parmdbpass=parmdbpass.replace("\\!","!")
+      parmoutputfile = args.outputfile.strip()
+      parmreplace=str2bool(args.replace)
+      parmworkers=int(args.workers)
+      parmmaxmbps=str(args.maxmbps).strip()
+      parmmaxload=float(args.maxload)
+      parmmaxlag=float(args.maxlag)
+      parmnice=int(args.nice)
+      parmionice=args.ionice.strip().lower()
+      parmformat=args.format.strip().lower()
+      parmjobs=int(args.jobs)
+      parmlogdir=args.logdir.strip()
+      parmcatalog=args.catalog.strip()
+      parmendpoint=args.endpoint.strip()
+      parmpartsize=float(args.partsize)
+      parmuploads=int(args.uploads)
+      parmstats=args.stats.strip().lower()
+      parmsamplerows=int(args.samplerows)
+      print(f"Python script: {parmscriptname}")
+      print(f"Database host: {parmdbhost}")
+      print(f"Database port: {parmdbport}")
+      print(f"Database names: {parmdbnames}")
+      print(f"Exclude: {','.join(parmexclude)}")
+      print(f"Database user: {parmdbuser}")
+      print(f"Output file: {parmoutputfile}")
+      print(f"Replace: {parmreplace}")
+      print(f"Workers: {parmworkers}")
+      print(f"Max MB/s: {parmmaxmbps}")
+      print(f"Max load: {parmmaxload}")
+      print(f"Max lag seconds: {parmmaxlag}")
+      print(f"Nice: {parmnice}")
+      print(f"I/O priority: {parmionice}")
+      print(f"Format: {parmformat}")
+      print(f"Jobs: {parmjobs}")
+      print(f"Log dir: {parmlogdir}")
+      print(f"Catalog: {parmcatalog}")
+      print(f"Object storage endpoint: {parmendpoint}")
+      print(f"Part size MB: {parmpartsize}")
+      print(f"Uploads: {parmuploads}")
+      print(f"Stats: {parmstats}")
+      print(f"Sample rows: {parmsamplerows}")
+
+      # Bail if output file template would give every database the same file
+      if ("@@dbdatetime" not in parmoutputfile and "@@DBDATETIME" not in parmoutputfile):
+            raise Exception("Output file must contain @@dbdatetime or @@DBDATETIME")
+
+      # Bail if workers is invalid
+      if (parmworkers < 1):
+            raise Exception("Workers must be 1 or greater")
+
+      # Bail if format is invalid. A physical backup is the whole server
+      # and is run once with pybackuppostgres.py instead of per database.
+      if (parmformat != "tar" and 
+          parmformat != "directory" and
+          parmformat != "shards"):
+            raise Exception("Format must be: tar, directory or shards")
+
+      # Bail if jobs is invalid
+      if (parmjobs < 1):
+            raise Exception("Jobs must be 1 or greater")
+
+      # Bail if max MB/s or backoff used with a format that cannot throttle.
+      # Checked here so the backups do not each fail on their own.
+      if (pypostgresthrottle.scheduled(pypostgresthrottle.parseschedule(parmmaxmbps)) and parmformat != "tar"):
+            raise Exception("Max MB/s can only be used with tar format")
+      if ((parmmaxload > 0 or parmmaxlag > 0) and parmformat != "tar"):
+            raise Exception("Max load and max lag can only be used with tar format")
+
+      # Make sure log directory exists
+      if (parmlogdir!="" and os.path.isdir(parmlogdir)==False):
+            raise Exception(f"Log directory {parmlogdir} does not exist. Backup cancelled.")
+
+      hostswitch=""
+      if (trim(parmdbhost)!=""):
+         hostswitch=f"-h '{parmdbhost}'"
+
+      # Build list of databases to back up
+      if (parmdbnames.upper()=="*ALL"):
+         print("")
+         print(f"INFO: Listing databases from pg_database - {time.strftime('%H:%M:%S')}")
+         dblist=[name for name in listdatabases(hostswitch,parmdbport,parmdbuser,parmdbpass) if name not in parmexclude]
+      else:
+         dblist=[trim(name) for name in parmdbnames.split(",") if trim(name)!=""]
+      print(f"INFO: {len(dblist)} databases to back up: {','.join(dblist)}")
+
+      if (len(dblist)==0):
+            raise Exception("No databases found to back up")
+
+      # Each worker gets an equal share of the total MB/s cap so the
+      # running backups together never write faster than the cap.
+      workermaxmbps=pypostgresthrottle.formatschedule(pypostgresthrottle.parseschedule(parmmaxmbps),min(parmworkers,len(dblist)))
+
+      # Common arguments for each pybackuppostgres.py run
+      backupargs=[f"--dbhost={parmdbhost}",f"--dbport={parmdbport}",f"--dbuser={parmdbuser}",
+                  f"--dbpass={parmdbpass}",f"--outputfile={parmoutputfile}",f"--replace={parmreplace}",
+                  f"--format={parmformat}",f"--jobs={parmjobs}",f"--maxmbps={workermaxmbps}",
+                  f"--maxload={parmmaxload}",f"--maxlag={parmmaxlag}",f"--nice={parmnice}",f"--ionice={parmionice}",
+                  f"--catalog={parmcatalog}",f"--endpoint={parmendpoint}",f"--partsize={parmpartsize}",
+                  f"--uploads={parmuploads}",f"--stats={parmstats}",f"--samplerows={parmsamplerows}"]
+
+      # Run the backups through the bounded worker pool
+      print("")
+      print(f"INFO: Starting backup of {len(dblist)} databases with {parmworkers} workers - {time.strftime('%H:%M:%S')}")
+      dbresults=[]
+      with concurrent.futures.ThreadPoolExecutor(max_workers=parmworkers) as executor:
+         futures=[executor.submit(backupdatabase,dbname,backupargs,parmlogdir) for dbname in dblist]
+         for future in concurrent.futures.as_completed(futures):
+            dbresult=future.result()
+            dbresults.append(dbresult)
+            print(f"INFO: Completed backup of database {dbresult['dbname']} with exit code {dbresult['exitcode']} - {time.strftime('%H:%M:%S')}")
+            if (dbresult["log"]!=""):
+               print(dbresult["log"])
+      print(f"INFO: Completed backup of {len(dblist)} databases - {time.strftime('%H:%M:%S')}")
+
+      # Print per database summary in the original database order
+      dbresults.sort(key=lambda dbresult: dblist.index(dbresult["dbname"]))
+      print("")
+      print(dashes)
+      print(f"{'Database':<30} {'ExitCode':>8} {'Seconds':>9} {'MB':>10} {'MB/s':>8}  Output")
+      for dbresult in dbresults:
+         sizemb=dbresult["size"]/1024/1024
+         mbps=sizemb/dbresult["duration"] if dbresult["duration"] > 0 else 0
+         print(f"{dbresult['dbname']:<30} {dbresult['exitcode']:>8} {dbresult['duration']:>9.1f} {sizemb:>10.1f} {mbps:>8.1f}  {dbresult['outputfile']}")
+         if (dbresult["exitcode"]!=0):
+            print(f"{'':<30} {dbresult['exitmessage']}")
+
+      # Set exit info
+      failed=[dbresult["dbname"] for dbresult in dbresults if dbresult["exitcode"]!=0]
+      if (len(failed) > 0):
+         raise Exception(f"Backup of {len(failed)} of {len(dbresults)} databases failed: {','.join(failed)}")
+
+      # Set success info
+      exitcode=0
+      exitmessage=f"Backup of {len(dbresults)} databases completed successfully"
+
+#------------------------------------------------
+# Handle Exceptions
+#------------------------------------------------
+# System Exit occurred. Most likely from argument parser
+except SystemExit as ex:
+     exitcode=ex.code # set return code for stdout
+     exitmessage=str(ex) # set exit message for stdout
+
+except argparse.ArgumentError as exc:
+     exitcode=99 # set return code for stdout
+     exitmessage=str(exc) # set exit message for stdout
+     print('Traceback Info') # output traceback info for stdout
+     traceback.print_exc()
+     sys.exit(99)
+
+except Exception as ex: # Catch and handle exceptions
+     exitcode=99 # set return code for stdout
+     exitmessage=str(ex) # set exit message for stdout
+     print('Traceback Info') # output traceback info for stdout
+     traceback.print_exc()
+     sys.exit(99)
+#------------------------------------------------
+# Always perform final processing
+#------------------------------------------------
+finally: # Final processing
+     # Do any final code and exit now
+     # We log as much relevent info to STDOUT as needed
+     print("")
+     print(dashes)
+     print('ExitCode:' + str(exitcode))
+     print('ExitMessage:' + exitmessage)
+     print(f"End of Main Processing -  {time.strftime('%H:%M:%S')}")
+     print(dashes)
+
+     # Exit the script now
+     sys.exit(exitcode)
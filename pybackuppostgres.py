@@ -25,7 +25,95 @@
 #   Ex backup of --dbname mydb: /tmp/mydb-@@datetime.tar = /tmp/mydb-yyyymmdd-hhmmss.tar 
 #   @@dbdatetime or @@DBDATETIME - Replace with database name and current date/time. 
 #   Ex backup of --dbname mydb: /tmp/@@dbdatetime.tar = /tmp/mydb-yyyymmdd-hhmmss.tar 
+#   An s3://bucket/key output file uploads the tar backup straight to S3-compatible object storage
+#   as a multipart upload while pg_dump runs, with no local file. Only tar format with stream or
+#   none verify. The stream verify manifest is uploaded as <key>.manifest.json. Credentials come
+#   from AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY and AWS_SESSION_TOKEN and the region from
+#   AWS_REGION. Ex: s3://backups/pg/@@dbdatetime.tar.zst
 # --replace=True=Replace output file. False=Halt if output file already exists.
+# --format=Backup format. tar=Single pg_dump tar file (default). directory=pg_dump directory 
+#   format written to the --outputfile directory. Directory format can be dumped in parallel.
+#   shards=Backup set directory with one custom format pg_dump per table shard, all dumped
+#   from one exported snapshot on a worker pool with the largest shards first.
+#   physical=pg_basebackup of the whole server written to the --outputfile directory with one
+#   tar per tablespace plus the WAL needed to make it consistent, for point-in-time recovery
+#   with WAL archived by pyarchivewal.py. --dbname is only used to connect and to name the backup
+#   in the catalog. The user needs the REPLICATION attribute and a pg_hba.conf replication entry.
+#   pg_basebackup compresses each tar while it streams. zstd uses --jobs threads. zstd and lz4
+#   need pg_basebackup 15 or later built with the codec. --maxmbps is passed to --max-rate and
+#   must be a single MB/s. The backup start and end WAL positions and the earliest recovery
+#   time are written to physical.json in the backup directory.
+# --jobs=Number of parallel pg_dump jobs for directory and shards format. Default=number of CPU cores.
+# --package=True=Package directory format output into a single tar file named <outputfile>.tar
+#   and remove the directory after it has been verified. False=Leave the directory. Default=False
+# --maxmbps=Maximum MB/s to write to the tar output file. 0=No limit (default).
+#   The output stream is rate limited by a token bucket. The cap can change with the time of day
+#   with comma separated HH:MM-HH:MM=MB/s windows in local time after the default MB/s.
+#   Ex: 50,01:00-05:00=300 is 50 MB/s except 300 MB/s from 1 to 5 AM.
+# --maxload=Back off the tar output rate while the 1 minute load average is over this value.
+#   0=No load check (default). Ex: number of CPU cores
+# --maxlag=Back off the tar output rate while the replay lag of the slowest standby in
+#   pg_stat_replication is over this many seconds. 0=No lag check (default).
+#   While backing off the rate is halved every 5 seconds down to 5% and grows back by 10% every
+#   5 seconds under the limits. Without --maxmbps the rate before the backoff is the cap.
+# --nice=Nice increment 0-19 for this script and its child processes (pg_dump, compressors,
+#   tar). 0=Unchanged (default).
+# --ionice=I/O priority for this script and its child processes. none (default), idle,
+#   besteffort:0-7 or realtime:0-7. Set with the Linux ionice command.
+# --compress=Compression codec. none, gzip, zstd or lz4. Default=none
+#   Tar format output is streamed from pg_dump through the compressor straight into the 
+#   output file with no intermediate file. The codec extension (.gz, .zst, .lz4) is added to
+#   the output file name if missing. Directory format passes the codec to pg_dump -Z instead.
+# --compresslevel=Compression level. 0=Codec default (gzip 6, zstd 3, lz4 1). Default=0
+# --compressmode=auto=In-process if the Python module is available otherwise pipeline (default).
+#   inprocess=Compress in this Python process. pipeline=Pipe through the gzip/zstd/lz4 program.
+# --verify=Backup verify method. stream=Parse tar headers and compute the SHA-256 checksum while
+#   the tar backup is being written and write a <outputfile>.manifest.json sidecar file (default). 
+#   tar=Read the backup again with tar -tvf after it is written. none=Skip verify.
+#   Directory format is always verified with pg_restore -l unless none is selected.
+#   Physical format tars are read with tar -t by --jobs workers unless none is selected.
+# --repository=Deduplicated backup repository directory. Blank=Write a backup file (default).
+#   When set, the tar stream is split into content-defined chunks and only chunks not already
+#   in the repository are stored. --outputfile is the backup name and the backup is recorded as
+#   <repository>/manifests/<backupname>.json. Ex: --outputfile=@@dbdatetime
+#   Chunks are zlib compressed with --compress=gzip. Only tar format with stream or none verify.
+# --shardsize=Target shard size in MB for shards format. Tables this size or larger get their own
+#   pg_dump and smaller tables are batched into shards of up to this size. Default=1024
+# --resume=Resume policy for shards format. Completed dump files are journaled in the backup set
+#   and a rerun with the same --outputfile dumps only the missing ones when the policy allows it.
+#   none=Halt or replace an existing backup set like other formats (default).
+#   snapshot=Resume only from the original snapshot, which is kept for --snapshotlease minutes
+#   after a failed run. Otherwise dump the backup set again from scratch.
+#   schema=Also resume from a new snapshot when the tables, columns and types are unchanged.
+#   Shards dumped before and after the resume are not consistent with each other, so only use
+#   it when the tables are not changed together. Ex: append-only history tables.
+# --retries=Number of times a failed shard dump is retried in the same run from the same
+#   snapshot. Shards format only. Default=0
+# --snapshotlease=Minutes the exported snapshot is kept by a detached keeper process after the
+#   backup stops, so a rerun can resume from it. Only used with --resume. The kept snapshot holds
+#   back VACUUM cleanup on the server until it ends. 0=No keeper. Default=60
+# --metricsfile=JSON lines file to append timing and throughput metrics to for each phase
+#   (dump, verify, package). Blank=No metrics file (default).
+# --promfile=Prometheus node_exporter textfile to write the phase metrics and exit code to.
+#   Blank=No Prometheus file (default). Ex: /var/lib/node_exporter/textfile/pgbackup_mydb.prom
+# --progress=Seconds between PROGRESS lines while pg_dump runs. pg_dump --verbose output is read
+#   line by line to track objects processed and the current table, and the ETA is based on table
+#   sizes from the catalog. 0=Only a final PROGRESS line and no catalog query. Default=30
+# --catalog=SQLite backup catalog file to record the backup in. The database, path, size, duration,
+#   SHA-256 checksum and status of each backup are recorded for pyretainpostgres.py and for
+#   restore lookups by database and time. Blank=No catalog (default). Ex: /backup/catalog.db
+# --endpoint=Object storage endpoint for an s3:// output file. https://host[:port] or http://host[:port]
+#   for an S3-compatible server or file:///directory for the filesystem fake.
+#   Blank=AWS_ENDPOINT_URL environment variable or AWS S3 (default).
+# --partsize=Object storage multipart upload part size in MB. At least 5. Default=16
+# --stats=Table stats captured for restore verification by pyrestorepostgres.py --action=verify.
+#   The stats are read from the same snapshot as the dump and written to <outputfile>.stats.json.
+#   none=No stats (default). count=Exact row count per table. sample=Row count plus a checksum
+#   of the first and last --samplerows rows in primary key order. full=Row count plus a checksum
+#   of every row. Tables are read by --jobs workers after the dump.
+# --samplerows=Rows read from each end of a table for --stats=sample. Default=1000
+# --uploads=Number of parts uploaded at the same time. The backup holds about uploads+1 parts
+#   in memory and pg_dump waits while every upload is busy. Default=4
 #------------------------------------------------
 
 #------------------------------------------------
@@ -41,9 +129,23 @@ import time
 import traceback
 import argparse
 import re
+import shutil
 from pathlib import Path
 from datetime import date
 import datetime
+import subprocess
+import contextlib
+import json
+import pypostgresstream
+import pypostgreschunkstore
+import pypostgresshards
+import pypostgresmetrics
+import pypostgresprogress
+import pypostgrescatalog
+import pypostgresthrottle
+import pypostgresobjectstore
+import pypostgresverify
+import pypostgreswal
 
 #------------------------------------------------
 # Script initialization
@@ -55,6 +157,15 @@ exitmessage=''
 parmsexpected=5;
 dashes="-------------------------------------------------------------------------------"
 outputtype=""
+metrics=None
+catalog=None
+catalogid=0
+backupsha256=""
+backoff=None
+objectstore=None
+upload=None
+statsholder=None
+stats=None
 
 #Output messages to STDOUT for logging
 print(dashes)
@@ -102,6 +213,22 @@ def ltrim(strval):
     #-------------------------------------------------------
     return strval.lstrip()
 
+def capturestats(snapshot):
+    #-------------------------------------------------------
+    # Function: capturestats
+    # Desc: Capture the table stats for restore verification
+    #       while the dump snapshot is still held
+    # :snapshot: Exported snapshot id pg_dump read from
+    #-------------------------------------------------------
+    global stats
+    print("")
+    print(f"INFO: Starting {parmstats} stats of database {parmdbname} - {time.strftime('%H:%M:%S')}")
+    phase=metrics.startphase("stats")
+    stats=pypostgresverify.collectstats(parmdbname,pypostgresshards.connectionargs(parmdbhost,parmdbport,parmdbuser),
+                                        dict(os.environ,PGPASSWORD=parmdbpass),parmstats,parmsamplerows,parmjobs,snapshot)
+    metrics.endphase(phase,0,0)
+    print(f"INFO: Completed {parmstats} stats of {len(stats['tables'])} tables - {time.strftime('%H:%M:%S')}")
+
 #------------------------------------------------
 # Main script logic
 #------------------------------------------------
@@ -120,6 +247,32 @@ try: # Try to perform main logic
       parser.add_argument('-P','--dbpass', required=False,default="",help="Database pass")
       parser.add_argument('-o','--outputfile', required=True,help="Output TAR file")
       parser.add_argument('-r','--replace',default="False",required=False,help="True=Replace output file,False=Append if --haltexists=False or Halt if --haltexists=True. Default=False")
+      parser.add_argument('-F','--format',default="tar",required=False,help="Backup format: tar=single tar file,directory=parallel directory format,shards=per table shard backup set,physical=pg_basebackup of the server. Default=tar")
+      parser.add_argument('-j','--jobs',default=os.cpu_count(),required=False,help="Number of parallel pg_dump jobs for directory and shards format. Default=number of CPU cores")
+      parser.add_argument('-s','--shardsize',default=1024,required=False,help="Target shard size in MB for shards format. Default=1024")
+      parser.add_argument('-b','--resume',default="none",required=False,help="Resume policy for an incomplete shards backup set: none, snapshot or schema. Default=none")
+      parser.add_argument('-t','--retries',default=0,required=False,help="Retries of a failed shard dump in the same run. Default=0")
+      parser.add_argument('-w','--snapshotlease',default=60,required=False,help="Minutes to keep the snapshot after a failed shards backup for a resume. 0=No keeper. Default=60")
+      parser.add_argument('-m','--maxmbps',default="0",required=False,help="Maximum MB/s to write to the tar output file with optional HH:MM-HH:MM=MB/s windows. Ex: 50,01:00-05:00=300. 0=No limit. Default=0")
+      parser.add_argument('-l','--maxload',default=0,required=False,help="Back off the output rate while the 1 minute load average is over this value. 0=No check. Default=0")
+      parser.add_argument('-a','--maxlag',default=0,required=False,help="Back off the output rate while the standby replay lag is over this many seconds. 0=No check. Default=0")
+      parser.add_argument('-n','--nice',default=0,required=False,help="Nice increment 0-19 for the backup processes. 0=Unchanged. Default=0")
+      parser.add_argument('-i','--ionice',default="none",required=False,help="I/O priority for the backup processes: none, idle, besteffort:0-7 or realtime:0-7. Default=none")
+      parser.add_argument('-c','--compress',default="none",required=False,help="Compression codec: none, gzip, zstd or lz4. Default=none")
+      parser.add_argument('-L','--compresslevel',default=0,required=False,help="Compression level. 0=Codec default. Default=0")
+      parser.add_argument('-M','--compressmode',default="auto",required=False,help="Compression mode: auto, inprocess or pipeline. Default=auto")
+      parser.add_argument('-v','--verify',default="stream",required=False,help="Verify method: stream=verify while writing and write manifest,tar=tar -tvf after writing,none=skip. Default=stream")
+      parser.add_argument('-R','--repository',default="",required=False,help="Deduplicated backup repository directory. Blank=write backup file. Default=blank")
+      parser.add_argument('-k','--package',default="False",required=False,help="True=Package directory format output into <outputfile>.tar,False=Leave directory. Default=False")
+      parser.add_argument('-e','--metricsfile',default="",required=False,help="JSON lines file to append phase metrics to. Blank=No metrics file. Default=blank")
+      parser.add_argument('-x','--promfile',default="",required=False,help="Prometheus textfile to write phase metrics to. Blank=No Prometheus file. Default=blank")
+      parser.add_argument('-g','--progress',default=30,required=False,help="Seconds between progress lines. 0=Final progress line only. Default=30")
+      parser.add_argument('-C','--catalog',default="",required=False,help="SQLite backup catalog file to record the backup in. Blank=No catalog. Default=blank")
+      parser.add_argument('-E','--endpoint',default="",required=False,help="Object storage endpoint for s3:// output. file:///dir=Filesystem fake. Blank=AWS_ENDPOINT_URL or AWS S3. Default=blank")
+      parser.add_argument('-z','--partsize',default=16,required=False,help="Object storage upload part size in MB. Default=16")
+      parser.add_argument('-u','--uploads',default=4,required=False,help="Number of object storage parts uploaded at the same time. Default=4")
+      parser.add_argument('-S','--stats',default="none",required=False,help="Table stats for restore verification: none, count, sample or full. Default=none")
+      parser.add_argument('-N','--samplerows',default=pypostgresverify.SAMPLEROWS,required=False,help=f"Rows read from each end of a table for sample stats. Default={pypostgresverify.SAMPLEROWS}")
       
       # Parse the command line arguments 
       args = parser.parse_args()
@@ -136,11 +289,41 @@ try: # Try to perform main logic
       parmdbpass=parmdbpass.replace("\!","!")   
       parmoutputfile = args.outputfile.strip()
       parmreplace=str2bool(args.replace)
+      parmformat=args.format.strip().lower()
+      parmjobs=int(args.jobs)
+      parmshardsize=float(args.shardsize)
+      parmresume=args.resume.strip().lower()
+      parmretries=int(args.retries)
+      parmsnapshotlease=float(args.snapshotlease)
+      parmpackage=str2bool(args.package)
+      parmmaxmbps=str(args.maxmbps).strip()
+      parmmaxload=float(args.maxload)
+      parmmaxlag=float(args.maxlag)
+      parmnice=int(args.nice)
+      parmionice=args.ionice.strip().lower()
+      parmcompress=args.compress.strip().lower()
+      parmcompresslevel=int(args.compresslevel)
+      parmcompressmode=args.compressmode.strip().lower()
+      parmverify=args.verify.strip().lower()
+      parmrepository=args.repository.strip()
+      parmmetricsfile=args.metricsfile.strip()
+      parmpromfile=args.promfile.strip()
+      parmprogress=float(args.progress)
+      parmcatalog=args.catalog.strip()
+      parmendpoint=args.endpoint.strip()
+      parmpartsize=float(args.partsize)
+      parmuploads=int(args.uploads)
+      parmstats=args.stats.strip().lower()
+      parmsamplerows=int(args.samplerows)
       # Add special values to output file name if specified
       parmoutputfile=parmoutputfile.replace("@@datetime",time.strftime('%Y%m%d-%H%M%S'))
       parmoutputfile=parmoutputfile.replace("@@DATETIME",time.strftime('%Y%m%d-%H%M%S'))
       parmoutputfile=parmoutputfile.replace("@@dbdatetime",parmdbname + "-" + time.strftime('%Y%m%d-%H%M%S'))
       parmoutputfile=parmoutputfile.replace("@@DBDATETIME",parmdbname + "_" + time.strftime('%Y%m%d-%H%M%S'))
+      # Add compression codec extension to tar output file name if missing
+      if (parmformat=="tar" and parmcompress in pypostgresstream.CODECS and parmrepository==""):
+         if (parmoutputfile.endswith(pypostgresstream.CODECS[parmcompress]["extension"])==False):
+            parmoutputfile=parmoutputfile + pypostgresstream.CODECS[parmcompress]["extension"]
       print(f"Python script: {parmscriptname}")
       #print(f"Connection string: {parmconnstring}")
       print(f"Database host: {parmdbhost}")
@@ -150,18 +333,196 @@ try: # Try to perform main logic
       print(f"Database pass: {parmdbpass}")
       print(f"Output file: {parmoutputfile}")
       print(f"Replace: {parmreplace}")
+      print(f"Format: {parmformat}")
+      print(f"Jobs: {parmjobs}")
+      print(f"Shard size MB: {parmshardsize}")
+      print(f"Resume: {parmresume}")
+      print(f"Retries: {parmretries}")
+      print(f"Snapshot lease minutes: {parmsnapshotlease}")
+      print(f"Package: {parmpackage}")
+      print(f"Max MB/s: {parmmaxmbps}")
+      print(f"Max load: {parmmaxload}")
+      print(f"Max lag seconds: {parmmaxlag}")
+      print(f"Nice: {parmnice}")
+      print(f"I/O priority: {parmionice}")
+      print(f"Compress: {parmcompress}")
+      print(f"Compress level: {parmcompresslevel}")
+      print(f"Compress mode: {parmcompressmode}")
+      print(f"Verify: {parmverify}")
+      print(f"Repository: {parmrepository}")
+      print(f"Metrics file: {parmmetricsfile}")
+      print(f"Prometheus file: {parmpromfile}")
+      print(f"Progress seconds: {parmprogress}")
+      print(f"Catalog: {parmcatalog}")
+      print(f"Object storage endpoint: {parmendpoint}")
+      print(f"Part size MB: {parmpartsize}")
+      print(f"Uploads: {parmuploads}")
+      print(f"Stats: {parmstats}")
+      print(f"Sample rows: {parmsamplerows}")
       filealreadyexists=False
 
-      # Replace file
+      # Collect phase timings from here on
+      metrics=pypostgresmetrics.Metrics("backup",parmdbname,parmmetricsfile,parmpromfile)
+
+      # Bail if format is invalid
+      if (parmformat != "tar" and 
+          parmformat != "directory" and
+          parmformat != "shards" and
+          parmformat != "physical"):
+            raise Exception("Format must be: tar, directory, shards or physical")
+
+      # Bail if jobs is invalid
+      if (parmjobs < 1):
+            raise Exception("Jobs must be 1 or greater")
+
+      # Bail if resume options are invalid
+      if parmresume not in pypostgresshards.RESUMEPOLICIES:
+            raise Exception("Resume must be: none, snapshot or schema")
+      if ((parmresume!="none" or parmretries > 0) and parmformat != "shards"):
+            raise Exception("Resume and retries can only be used with shards format")
+      if (parmretries < 0 or parmsnapshotlease < 0):
+            raise Exception("Retries and snapshot lease must be 0 or greater")
+
+      # Bail if stats options are invalid
+      if parmstats not in pypostgresverify.STATSLEVELS:
+            raise Exception("Stats must be: none, count, sample or full")
+      if (parmsamplerows < 1):
+            raise Exception("Sample rows must be 1 or greater")
+
+      # Bail if physical format options are invalid. A physical backup is the
+      # whole server so stats and packaging do not apply.
+      if (parmformat=="physical"):
+         if (parmstats!="none"):
+            raise Exception("Stats cannot be used with physical format")
+         if (parmpackage==True):
+            raise Exception("Package cannot be used with physical format")
+
+      # Bail if max MB/s or backoff used with directory format
+      rateschedule=pypostgresthrottle.parseschedule(parmmaxmbps)
+      if (pypostgresthrottle.scheduled(rateschedule) and parmformat != "tar" and parmformat != "physical"):
+            raise Exception("Max MB/s can only be used with tar and physical format")
+      if (parmformat=="physical" and len(rateschedule["windows"]) > 0):
+            raise Exception("Max MB/s must be a single MB/s for physical format")
+      if ((parmmaxload > 0 or parmmaxlag > 0) and parmformat != "tar"):
+            raise Exception("Max load and max lag can only be used with tar format")
+
+      # Bail if priority settings are invalid
+      if (parmnice < 0 or parmnice > 19):
+            raise Exception("Nice must be 0-19")
+      if (pypostgresthrottle.checkionice(parmionice)==False):
+            raise Exception("I/O priority must be: none, idle, besteffort:0-7 or realtime:0-7")
+
+      # Lower the priority of this script. pg_dump and the other child processes inherit it.
+      pypostgresthrottle.setpriority(parmnice,parmionice)
+
+      # Bail if compression codec or mode is invalid
+      if (parmcompress != "none" and parmcompress not in pypostgresstream.CODECS):
+            raise Exception("Compress must be: none, gzip, zstd or lz4")
+      if (parmcompressmode != "auto" and 
+          parmcompressmode != "inprocess" and
+          parmcompressmode != "pipeline"):
+            raise Exception("Compress mode must be: auto, inprocess or pipeline")
+
+      # Bail if verify method is invalid
+      if (parmverify != "stream" and 
+          parmverify != "tar" and
+          parmverify != "none"):
+            raise Exception("Verify must be: stream, tar or none")
+
+      # Bail if repository options are invalid
+      if (parmrepository!=""):
+         if (parmformat != "tar"):
+            raise Exception("Repository can only be used with tar format")
+         if (parmverify=="tar"):
+            raise Exception("Repository can only be used with stream or none verify")
+         if (parmcompress != "none" and parmcompress != "gzip"):
+            raise Exception("Repository chunks can only be compressed with gzip")
+
+      # Bail if object storage options are invalid
+      if pypostgresobjectstore.isobjecturl(parmoutputfile):
+         if (parmformat != "tar"):
+            raise Exception("Object storage output can only be used with tar format")
+         if (parmrepository!=""):
+            raise Exception("Object storage output cannot be used with a repository")
+         if (parmverify=="tar"):
+            raise Exception("Object storage output can only be used with stream or none verify")
+         if (parmpartsize*1024*1024 < pypostgresobjectstore.MINPARTSIZE):
+            raise Exception(f"Part size must be at least {pypostgresobjectstore.MINPARTSIZE//1024//1024} MB")
+         if (parmuploads < 1):
+            raise Exception("Uploads must be 1 or greater")
+         objectstore=pypostgresobjectstore.openstore(parmendpoint)
+
+      # Repository backups are written as chunks and a manifest named
+      # after the output file instead of a backup file
+      chunkstore=None
+      parmbackupname=""
+      if (parmrepository!=""):
+         chunkstore=pypostgreschunkstore.ChunkStore(parmrepository)
+         parmbackupname=os.path.basename(parmoutputfile)
+         parmoutputfile=chunkstore.manifestpath(parmbackupname)
+         outputtype="repository backup"
+         print(f"Repository manifest: {parmoutputfile}")
+
+      # Sidecar manifest written by the stream verify
+      parmmanifestfile=""
+      if (parmformat=="tar" and parmverify=="stream" and parmrepository==""):
+         parmmanifestfile=f"{parmoutputfile}.manifest.json"
+
+      # Package file name used when directory output gets packaged
+      parmpackagefile=""
+      if (parmformat!="tar" and parmpackage==True):
+         parmpackagefile=f"{parmoutputfile}.tar"
+
+      # Replace file. An existing object is replaced when the upload completes.
       filealreadyexists=False  
-      if os.path.isfile(parmoutputfile):
+      if (objectstore is not None):
+         if (objectstore.headobject(*pypostgresobjectstore.parseurl(parmoutputfile)) is not None):
+            if parmreplace==True:
+               print(f"INFO:Existing backup {parmoutputfile} will be replaced when the upload completes.")
+            else:
+               # Object exists, exit program
+               raise Exception(f'Output file {parmoutputfile} already exists and replace not selected. Process cancelled.')
+      elif (parmresume!="none" and (pypostgresshards.readbackupset(parmoutputfile) or {}).get("status") in ("running","failed")):
+         # Incomplete backup set. Resumed or dumped again by the resume policy.
+         print(f"INFO:Incomplete backup set {parmoutputfile} found. Resume policy: {parmresume}")
+      elif os.path.isfile(parmoutputfile) or os.path.isdir(parmoutputfile):
          if parmreplace==True:
-            os.remove(parmoutputfile)
-            print(f"INFO:Existing backup file {parmoutputfile} deleted before processing.")
+            if os.path.isdir(parmoutputfile):
+               shutil.rmtree(parmoutputfile)
+            else:
+               os.remove(parmoutputfile)
+            print(f"INFO:Existing backup {parmoutputfile} deleted before processing.")
          else:
             # File exists, exit program
             raise Exception(f'Output file {parmoutputfile} already exists and replace not selected. Process cancelled.')
 
+      # Remove manifest left over from a replaced backup
+      if (parmmanifestfile!="" and os.path.isfile(parmmanifestfile) and parmreplace==True):
+         os.remove(parmmanifestfile)
+
+      # Remove stats left over from a replaced backup. They no longer match.
+      parmstatsfile=pypostgresverify.statspath(parmbackupname,parmrepository) if parmrepository!="" else pypostgresverify.statspath(parmpackagefile or parmoutputfile)
+      if (objectstore is None and os.path.isfile(parmstatsfile)):
+         os.remove(parmstatsfile)
+
+      # Replace package file
+      if (parmpackagefile!="" and os.path.isfile(parmpackagefile)):
+         if parmreplace==True:
+            os.remove(parmpackagefile)
+            print(f"INFO:Existing package file {parmpackagefile} deleted before processing.")
+         else:
+            # File exists, exit program
+            raise Exception(f'Package file {parmpackagefile} already exists and replace not selected. Process cancelled.')
+
+      # Record the backup as running in the catalog
+      if (parmcatalog!=""):
+         catalog=pypostgrescatalog.Catalog(parmcatalog)
+         if (parmrepository!=""):
+            catalogid=catalog.startbackup(parmdbname,parmdbhost,parmformat,parmbackupname,os.path.abspath(parmrepository))
+         else:
+            catalogid=catalog.startbackup(parmdbname,parmdbhost,parmformat,pypostgrescatalog.catalogpath(parmoutputfile))
+         print(f"INFO: Backup recorded in catalog {parmcatalog} as backup id {catalogid}")
+
       # pg_dump example
       # pg_dump -F t -d mydatabase -p 5432 -U postgres --verbose > /tmp/mydatabase.tar      
       # Build pg_dump command line
@@ -169,19 +530,162 @@ try: # Try to perform main logic
       hostswitch=""
       if (trim(parmdbhost)!=""):
          hostswitch=f"-h '{parmdbhost}'"
+      backuptool="pg_dump"
           
-      cmd_pgdump=f"pg_dump -F t -d {parmdbname}  {hostswitch} -p {parmdbport} -U {parmdbuser} --verbose > {parmoutputfile}"
-      # Build tar verify command line
-      cmd_verifytar=f"tar -tvf {parmoutputfile}"
+      # Directory and shards format compress each table file inside pg_dump.
+      # gzip works with every pg_dump version. zstd and lz4 need pg_dump 16 or later.
+      compressswitch=""
+      if (parmformat=="physical"):
+         compressswitch=" ".join(pypostgreswal.basebackupargs(parmcompress,parmcompresslevel,parmjobs,rateschedule["default"]))
+      elif (parmformat!="tar" and parmcompress=="gzip"):
+         compressswitch=f"-Z {parmcompresslevel if parmcompresslevel > 0 else pypostgresstream.CODECS['gzip']['level']}"
+      elif (parmformat!="tar" and parmcompress!="none"):
+         compressswitch=f"--compress={parmcompress}:{parmcompresslevel if parmcompresslevel > 0 else pypostgresstream.CODECS[parmcompress]['level']}"
+
+      # Directory format example. Tables are dumped in parallel by --jobs workers.
+      # pg_dump -F d -j 8 -d mydatabase -p 5432 -U postgres --verbose -f /tmp/mydatabase.dir
+      if (parmformat=="directory"):
+         outputtype="directory"
+         cmd_pgdump=f"pg_dump -F d -j {parmjobs} {compressswitch} -d {parmdbname}  {hostswitch} -p {parmdbport} -U {parmdbuser} --verbose -f {parmoutputfile}"
+         # Build directory verify command line. pg_restore -l reads and validates
+         # the toc.dat table of contents without restoring anything.
+         cmd_verifytar=f"pg_restore -l {parmoutputfile}"
+      # Shards format example. Schema first and then one data only pg_dump per shard.
+      # pg_dump -F c --schema-only --snapshot=00000003-0000001B-1 -d mydatabase -p 5432 -U postgres -f /tmp/mydatabase.set/schema.dump
+      # pg_dump -F c --data-only --snapshot=00000003-0000001B-1 -d mydatabase -p 5432 -U postgres -t '"public"."big"' -f /tmp/mydatabase.set/shards/0001.dump
+      elif (parmformat=="shards"):
+         outputtype="backup set"
+         cmd_pgdump=f"pg_dump -F c --snapshot=<exported> per shard with {parmjobs} workers -d {parmdbname}  {hostswitch} -p {parmdbport} -U {parmdbuser} {compressswitch} -f {parmoutputfile}/shards/NNNN.dump"
+         # Build backup set verify command line after the shard files are known
+         cmd_verifytar=""
+      # Physical format example. One tar per tablespace plus pg_wal.tar with the
+      # WAL streamed during the backup, each compressed by pg_basebackup.
+      # pg_basebackup -F t -X stream -c fast -Z 6 -p 5432 -U postgres --verbose -D /tmp/cluster.base
+      elif (parmformat=="physical"):
+         outputtype="physical backup"
+         backuptool="pg_basebackup"
+         cmd_pgdump=f"pg_basebackup -F t -X stream -c fast {compressswitch} -l pybackuppostgres {hostswitch} -p {parmdbport} -U {parmdbuser} --verbose -D {parmoutputfile}"
+         # Each tar is read through tar -t after the backup
+         cmd_verifytar=f"tar -tf <each tar> with {parmjobs} workers"
+         # Recovery past the end of the backup needs archived WAL
+         archivemode=pypostgresshards.psqlquery("show archive_mode",parmdbname,pypostgresshards.connectionargs(parmdbhost,parmdbport,parmdbuser),
+                                                dict(os.environ,PGPASSWORD=parmdbpass))[0][0]
+         if (archivemode=="off"):
+            print("INFO: archive_mode is off on the server. The backup can only be restored to its end without a WAL archive.")
+      elif (parmrepository!=""):
+         # pg_dump writes to stdout. The output gets split into chunks by this script.
+         cmd_pgdump=f"pg_dump -F t -d {parmdbname}  {hostswitch} -p {parmdbport} -U {parmdbuser} --verbose"
+      else:
+         outputtype="tar file"
+         # pg_dump writes to stdout. The output gets streamed through the 
+         # compressor and written to the output file by this script.
+         cmd_pgdump=f"pg_dump -F t -d {parmdbname}  {hostswitch} -p {parmdbport} -U {parmdbuser} --verbose"
+         if (objectstore is not None):
+            outputtype="tar object"
+         # Build tar verify command line
+         if (parmcompress!="none"):
+            outputtype=f"{parmcompress} {outputtype}"
+            cmd_verifytar=f"{pypostgresstream.CODECS[parmcompress]['command']} -dc {parmoutputfile} | tar -tvf -"
+         else:
+            cmd_verifytar=f"tar -tvf {parmoutputfile}"
+
+      # Stats are read from the snapshot pg_dump reads so they match the backup.
+      # pg_dump -F t --snapshot=00000003-0000001B-1 -d mydatabase -p 5432 -U postgres --verbose
+      if (parmstats!="none" and parmformat!="shards"):
+         statsholder=pypostgresshards.SnapshotHolder(parmdbname,pypostgresshards.connectionargs(parmdbhost,parmdbport,parmdbuser),
+                                                     dict(os.environ,PGPASSWORD=parmdbpass))
+         cmd_pgdump=cmd_pgdump.replace("pg_dump ",f"pg_dump --snapshot={statsholder.snapshot} ",1)
 
       # Run the pg_dump backup command
       print("")
-      print(f"INFO: Starting pg_dump PostgreSQL backup to {parmoutputfile} - {time.strftime('%H:%M:%S')}")
+      phase=metrics.startphase("dump")
+      print(f"INFO: Starting {backuptool} PostgreSQL backup to {parmoutputfile} - {time.strftime('%H:%M:%S')}")
       # Set password env var and pg_dump command line.
-      print(cmd_pgdump) 
+      if (parmrepository!=""):
+         print(f"{cmd_pgdump} | chunk store {parmrepository}")
+      elif (objectstore is not None):
+         print(f"{cmd_pgdump} | {parmcompress} ({pypostgresstream.resolvecompressmode(parmcompress,parmcompressmode) if parmcompress!='none' else 'no compression'}) | multipart upload {parmoutputfile} with {parmuploads} x {parmpartsize:g} MB parts")
+      elif (parmformat=="tar"):
+         print(f"{cmd_pgdump} | {parmcompress} ({pypostgresstream.resolvecompressmode(parmcompress,parmcompressmode) if parmcompress!='none' else 'no compression'}) > {parmoutputfile}")
+      else:
+         print(cmd_pgdump) 
+      # Track progress from the pg_dump --verbose output. The ETA is based on
+      # catalog table sizes and bytes moved is the tar stream or output size.
+      tablesizes={}
+      if (parmprogress > 0 and parmformat!="physical"):
+         tablesizes=pypostgresprogress.catalogtablesizes(parmdbname,pypostgresshards.connectionargs(parmdbhost,parmdbport,parmdbuser),
+                                                         dict(os.environ,PGPASSWORD=parmdbpass))
+      if (parmformat=="tar"):
+         monitor=pypostgresprogress.ProgressMonitor("dump",parmprogress,tablesizes)
+      else:
+         monitor=pypostgresprogress.ProgressMonitor("dump",parmprogress,tablesizes,
+                                                    bytesfunction=lambda: pypostgresmetrics.pathsize(parmoutputfile),parallel=True)
+      # Token bucket for the output stream with the load and lag backoff
+      backoff=pypostgresthrottle.Backoff(parmmaxload,parmmaxlag,
+                                         lambda: pypostgresthrottle.replicationlag(pypostgresshards.connectionargs(parmdbhost,parmdbport,parmdbuser),
+                                                                                   dict(os.environ,PGPASSWORD=parmdbpass))).start()
+      limiter=pypostgresthrottle.TokenBucket(rateschedule,backoff)
       # Run the command
-      rtncmd=os.system(f"export PGPASSWORD={parmdbpass};{cmd_pgdump}")
-      print(f"INFO: Completed pg_dump PostgreSQL backup to {parmoutputfile} - {time.strftime('%H:%M:%S')}")
+      if (parmrepository!=""):
+         # Split the pg_dump output into chunks and store the new ones
+         procdump=subprocess.Popen(cmd_pgdump,shell=True,stdout=subprocess.PIPE,stderr=subprocess.PIPE,env=dict(os.environ,PGPASSWORD=parmdbpass))
+         monitor.watch(procdump.stderr)
+         verifier=pypostgresstream.TarStreamVerifier()
+         # Chunks get zlib compressed at the gzip level when gzip is selected
+         chunklevel=0
+         if (parmcompress=="gzip"):
+            chunklevel=parmcompresslevel if parmcompresslevel > 0 else pypostgresstream.CODECS["gzip"]["level"]
+         chunkwriter=pypostgreschunkstore.ChunkWriter(chunkstore,parmbackupname,chunklevel)
+         if (parmverify=="stream"):
+            pypostgresstream.copystream(monitor.countreader(procdump.stdout),pypostgresstream.TeeWriter(verifier,chunkwriter),limiter=limiter)
+         else:
+            pypostgresstream.copystream(monitor.countreader(procdump.stdout),chunkwriter,limiter=limiter)
+         rtncmd=procdump.wait()
+      elif (parmformat=="tar"):
+         # Stream pg_dump output through the compressor into the output file
+         # The tar verifier sees the uncompressed stream and the checksum 
+         # is computed over the bytes written to the output file.
+         # Object storage output is uploaded in parts as it is written.
+         if (objectstore is not None):
+            upload=pypostgresobjectstore.MultipartWriter(objectstore,parmoutputfile,int(parmpartsize*1024*1024),parmuploads)
+         with (open(parmoutputfile,"wb") if upload is None else contextlib.nullcontext(upload)) as outfile:
+            procdump=subprocess.Popen(cmd_pgdump,shell=True,stdout=subprocess.PIPE,stderr=subprocess.PIPE,env=dict(os.environ,PGPASSWORD=parmdbpass))
+            monitor.watch(procdump.stderr)
+            hashingwriter=pypostgresstream.HashingWriter(outfile)
+            verifier=pypostgresstream.TarStreamVerifier()
+            writer=hashingwriter
+            if (parmcompress!="none"):
+               writer=pypostgresstream.opencompressor(parmcompress,parmcompresslevel,parmcompressmode,hashingwriter)
+            if (parmverify=="stream"):
+               pypostgresstream.copystream(monitor.countreader(procdump.stdout),pypostgresstream.TeeWriter(verifier,writer),limiter=limiter)
+            else:
+               pypostgresstream.copystream(monitor.countreader(procdump.stdout),writer,limiter=limiter)
+            if (parmcompress!="none"):
+               writer.close()
+            rtncmd=procdump.wait()
+         backupsha256=hashingwriter.sha256.hexdigest()
+      elif (parmformat=="shards"):
+         # Dump the backup set from one exported snapshot on the worker pool
+         (rtncmd,backupset)=pypostgresshards.dumpbackupset(parmoutputfile,parmdbname,
+                                  pypostgresshards.connectionargs(parmdbhost,parmdbport,parmdbuser),
+                                  dict(os.environ,PGPASSWORD=parmdbpass),parmjobs,int(parmshardsize*1024*1024),
+                                  compressswitch.split(),parmresume,parmretries,parmsnapshotlease*60,
+                                  capturestats if parmstats!="none" else None)
+         # pg_restore -l reads and validates the table of contents of each dump
+         cmd_verifytar=" && ".join(f"pg_restore -l {os.path.join(parmoutputfile,dumpfile)} > /dev/null"
+                                   for dumpfile in [backupset["schema"]] + [shard["file"] for shard in backupset["shards"]])
+      else:
+         rtncmd=pypostgresprogress.runcommand(cmd_pgdump,monitor,env=dict(os.environ,PGPASSWORD=parmdbpass))
+      monitor.close()
+      backoff.stop()
+      print(f"INFO: Completed {backuptool} PostgreSQL backup to {parmoutputfile} - {time.strftime('%H:%M:%S')}")
+      # Bytes written by the dump. Repository backups count the tar stream bytes.
+      if (parmrepository!=""):
+         metrics.endphase(phase,chunkwriter.bytes,rtncmd)
+      elif (parmformat=="tar"):
+         metrics.endphase(phase,hashingwriter.byteswritten,rtncmd)
+      else:
+         metrics.endphase(phase,pypostgresmetrics.pathsize(parmoutputfile),rtncmd)
    
       # Check return code
       if (rtncmd != 0):
@@ -193,23 +697,167 @@ try: # Try to perform main logic
                os.remove(parmoutputfile)
                print(f"INFO:Removed 0 byte backup file {parmoutputfile} after processing.")
 
-         raise Exception(f"Error {rtncmd} occurred while running pg_dump")
+         # If output directory was created without a table of contents. Remove it
+         if (os.path.isdir(parmoutputfile) and parmformat=="directory"):
+            if (os.path.isfile(os.path.join(parmoutputfile,"toc.dat"))==False):
+               shutil.rmtree(parmoutputfile)
+               print(f"INFO:Removed incomplete backup directory {parmoutputfile} after processing.")
+
+         # pg_basebackup writes backup_manifest last
+         if (os.path.isdir(parmoutputfile) and parmformat=="physical"):
+            if (os.path.isfile(os.path.join(parmoutputfile,"backup_manifest"))==False):
+               shutil.rmtree(parmoutputfile)
+               print(f"INFO:Removed incomplete physical backup {parmoutputfile} after processing.")
+
+         raise Exception(f"Error {rtncmd} occurred while running {backuptool}")
+
+      # WAL range of a physical backup. The server time right after the backup
+      # is the earliest time it can be recovered to.
+      if (parmformat=="physical"):
+         physicalinfo=pypostgreswal.physicalinfo(parmoutputfile,parmdbname,pypostgresshards.connectionargs(parmdbhost,parmdbport,parmdbuser),
+                                                 dict(os.environ,PGPASSWORD=parmdbpass),parmcompress,time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(metrics.starttime)))
+
+      # Shards format captured the stats before releasing its snapshot
+      if (statsholder is not None):
+         capturestats(statsholder.snapshot)
+         statsholder.close()
+         statsholder=None
+
+      # Complete the object upload once the dump and the stream verify are good.
+      # The object only appears when the upload completes. A failed backup
+      # aborts the upload so no partial object is left behind.
+      if (upload is not None):
+         if (parmverify=="stream"):
+            verifyerrors=verifier.verify()
+            if (len(verifyerrors) > 0):
+               raise Exception(f"Stream verify failed for backup {outputtype} {parmoutputfile}: {'; '.join(verifyerrors)}")
+         parts=upload.close()
+         print(f"INFO: Completed multipart upload of {parmoutputfile} in {parts} parts - {time.strftime('%H:%M:%S')}")
+
+      # Check the stream verify results and write the repository manifest
+      if (parmrepository!=""):
+         manifestextra={"dbname":parmdbname}
+         if (parmverify=="stream"):
+            verifyerrors=verifier.verify()
+            if (len(verifyerrors) > 0):
+               raise Exception(f"Stream verify failed for backup {parmbackupname}: {'; '.join(verifyerrors)}")
+            manifestextra["entries"]=verifier.entries
+         manifest=chunkwriter.close(manifestextra)
+         backupsha256=manifest["sha256"]
+         print("")
+         if (parmverify=="stream"):
+            print(f"INFO: Stream verify of {parmbackupname} found {len(verifier.entries)} tar entries")
+         print(f"INFO: SHA-256 {manifest['sha256']} for {manifest['bytes']} bytes")
+         print(f"INFO: {len(manifest['chunks'])} chunks. {manifest['newchunks']} new chunks stored in {manifest['newbytes']} bytes")
+         print(f"INFO: Manifest written to {parmoutputfile}")
+         chunkstore.close()
+
+      # Check the stream verify results and write the manifest
+      elif (parmmanifestfile!=""):
+         verifyerrors=verifier.verify()
+         if (len(verifyerrors) > 0):
+            raise Exception(f"Stream verify failed for backup {outputtype} {parmoutputfile}: {'; '.join(verifyerrors)}")
+         if (objectstore is not None):
+            manifest=pypostgresstream.streammanifest(parmoutputfile,hashingwriter,verifier,parmcompress)
+            objectstore.putobject(*pypostgresobjectstore.parseurl(parmmanifestfile),json.dumps(manifest,indent=1).encode())
+         else:
+            manifest=pypostgresstream.writemanifest(parmmanifestfile,parmoutputfile,hashingwriter,verifier,parmcompress)
+         print("")
+         print(f"INFO: Stream verify of {parmoutputfile} found {len(manifest['entries'])} tar entries in {manifest['tarbytes']} bytes")
+         print(f"INFO: SHA-256 {manifest['sha256']} for {manifest['bytes']} bytes written")
+         print(f"INFO: Manifest written to {parmmanifestfile}")
+
+      # Read each physical backup tar on the worker pool. Tablespace tars are
+      # independent so they are checked at the same time.
+      elif (parmformat=="physical" and parmverify!="none"):
+         print("")
+         print(f"INFO: Starting {outputtype} verify for {parmoutputfile} - {time.strftime('%H:%M:%S')}")
+         print(cmd_verifytar)
+         phase=metrics.startphase("verify")
+         results=pypostgresshards.runpool(pypostgreswal.backupfiles(parmoutputfile),parmjobs,
+                                          lambda tarfile: pypostgreswal.verifytar(os.path.join(parmoutputfile,tarfile),parmcompressmode))
+         failed=[result for result in results if result[1]!=0]
+         metrics.endphase(phase,pypostgresmetrics.pathsize(parmoutputfile),failed[0][1] if len(failed) > 0 else 0)
+         print(f"INFO: Completed {outputtype} verify of {len(results)} tar files for {parmoutputfile} - {time.strftime('%H:%M:%S')}")
+
+         # Check return codes
+         if (len(failed) > 0):
+            raise Exception(f"Error {failed[0][1]} occurred while verifying {failed[0][0]} in backup {outputtype} {parmoutputfile}")
 
       # Run the tar verify command
-      print("")
-      print(f"INFO: Starting tar file verify for {parmoutputfile} - {time.strftime('%H:%M:%S')}")
-      print(cmd_verifytar)
-      # Run the command
-      rtnverify=os.system(cmd_verifytar)
-      print(f"INFO: Completed tar file verify for {parmoutputfile} - {time.strftime('%H:%M:%S')}")
+      elif (parmverify!="none"):
+         print("")
+         print(f"INFO: Starting {outputtype} verify for {parmoutputfile} - {time.strftime('%H:%M:%S')}")
+         print(cmd_verifytar)
+         # Run the command
+         phase=metrics.startphase("verify")
+         rtnverify=os.system(cmd_verifytar)
+         metrics.endphase(phase,pypostgresmetrics.pathsize(parmoutputfile),rtnverify)
+         print(f"INFO: Completed {outputtype} verify for {parmoutputfile} - {time.strftime('%H:%M:%S')}")
    
-      # Check return code
-      if (rtnverify != 0):
-         raise Exception(f"Error {rtnverify} occurred while verifying backup tar file {parmoutputfile}")
+         # Check return code
+         if (rtnverify != 0):
+            raise Exception(f"Error {rtnverify} occurred while verifying backup {outputtype} {parmoutputfile}")
+
+      # Package the verified directory into a single tar file if selected
+      if (parmpackagefile!=""):
+         # Build package and package verify command lines
+         # The tar stream is hashed while it is written so the catalog checksum needs no second read
+         cmd_package=f"tar -cf - -C {os.path.dirname(os.path.abspath(parmoutputfile))} {os.path.basename(os.path.abspath(parmoutputfile))}"
+         cmd_verifypackage=f"tar -tvf {parmpackagefile}"
+
+         print("")
+         print(f"INFO: Starting package of {parmoutputfile} to {parmpackagefile} - {time.strftime('%H:%M:%S')}")
+         print(f"{cmd_package} > {parmpackagefile}")
+         # Run the command
+         phase=metrics.startphase("package")
+         with open(parmpackagefile,"wb") as outfile:
+            procpackage=subprocess.Popen(cmd_package,shell=True,stdout=subprocess.PIPE)
+            packagewriter=pypostgresstream.HashingWriter(outfile)
+            pypostgresstream.copystream(procpackage.stdout,packagewriter)
+            rtncmd=procpackage.wait()
+         metrics.endphase(phase,packagewriter.byteswritten,rtncmd)
+         print(f"INFO: Completed package of {parmoutputfile} to {parmpackagefile} - {time.strftime('%H:%M:%S')}")
+
+         # Check return code
+         if (rtncmd != 0):
+            raise Exception(f"Error {rtncmd} occurred while packaging backup directory {parmoutputfile}")
+
+         # Run the package verify command
+         print("")
+         print(f"INFO: Starting tar file verify for {parmpackagefile} - {time.strftime('%H:%M:%S')}")
+         print(cmd_verifypackage)
+         # Run the command
+         phase=metrics.startphase("packageverify")
+         rtnverify=os.system(cmd_verifypackage)
+         metrics.endphase(phase,pypostgresmetrics.pathsize(parmpackagefile),rtnverify)
+         print(f"INFO: Completed tar file verify for {parmpackagefile} - {time.strftime('%H:%M:%S')}")
+
+         # Check return code
+         if (rtnverify != 0):
+            raise Exception(f"Error {rtnverify} occurred while verifying package tar file {parmpackagefile}")
+
+         # Package is good. Remove the directory
+         shutil.rmtree(parmoutputfile)
+         print(f"INFO:Removed backup directory {parmoutputfile} after packaging.")
+         parmoutputfile=parmpackagefile
+         outputtype="tar file"
+         backupsha256=packagewriter.sha256.hexdigest()
+
+      # Record the physical backup info once it is verified. pyrestorepostgres.py
+      # only restores a physical backup directory that has it.
+      if (parmformat=="physical"):
+         pypostgreswal.writephysical(parmoutputfile,physicalinfo)
+         print(f"INFO: Physical backup WAL {physicalinfo.get('startlsn','')} to {physicalinfo.get('endlsn','')} on timeline {physicalinfo.get('timeline','')}. Earliest recovery time {physicalinfo['consistent']}")
+
+      # Write the stats once the backup is complete
+      if stats is not None:
+         pypostgresverify.writestats(parmstatsfile,stats,objectstore)
+         print(f"INFO: Stats written to {parmstatsfile}")
 
       # Set success info
       exitcode=0
-      exitmessage=f"Backup of database {parmdbname} completed successfully to output tar file {parmoutputfile}"
+      exitmessage=f"Backup of database {parmdbname} completed successfully to output {outputtype} {parmoutputfile}"
 
 #------------------------------------------------
 # Handle Exceptions
@@ -236,6 +884,44 @@ except Exception as ex: # Catch and handle exceptions
 # Always perform final processing
 #------------------------------------------------
 finally: # Final processing
+     # Stop the backoff checks if the dump failed
+     if backoff is not None:
+        backoff.stop()
+
+     # End the dump snapshot if the stats were not captured
+     if statsholder is not None:
+        statsholder.close()
+
+     # Drop the parts of an object upload that did not complete
+     if (upload is not None and upload.completed==False):
+        try:
+           upload.abort()
+           print(f"INFO:Aborted multipart upload of {parmoutputfile} after processing.")
+        except Exception as ex:
+           print(f"INFO:Multipart upload of {parmoutputfile} could not be aborted. {ex}")
+
+     # Record the end of the backup in the catalog. Directory backups get their
+     # checksum from the files written, shards and physical backups from the
+     # checksums they already have.
+     if (catalog is not None and catalogid > 0):
+        try:
+           if (exitcode==0):
+              if (parmrepository!=""):
+                 catalog.endbackup(catalogid,"complete",parmbackupname,manifest["bytes"],time.time()-metrics.starttime,backupsha256,exitmessage)
+              else:
+                 if (backupsha256==""):
+                    backupsha256=pypostgrescatalog.backupchecksum(parmoutputfile,parmjobs)
+                 catalog.endbackup(catalogid,"complete",pypostgrescatalog.catalogpath(parmoutputfile),
+                                   hashingwriter.byteswritten if objectstore is not None else pypostgresmetrics.pathsize(parmoutputfile),
+                                   time.time()-metrics.starttime,backupsha256,exitmessage)
+           else:
+              catalog.endbackup(catalogid,"failed",parmbackupname if parmrepository!="" else pypostgrescatalog.catalogpath(parmoutputfile),
+                                0,time.time()-metrics.starttime,"",exitmessage)
+           catalog.close()
+        except Exception as ex:
+           exitcode=99
+           exitmessage=f"Backup could not be recorded in catalog {parmcatalog}. {ex}"
+
      # Do any final code and exit now
      # We log as much relevent info to STDOUT as needed
      print("")
@@ -245,6 +931,14 @@ finally: # Final processing
      print(f"End of Main Processing -  {time.strftime('%H:%M:%S')}")
      print(dashes)
 
+     # Write the metrics files. Phases still open failed with the script.
+     # A failing metrics write must not replace the exit code and message.
+     if metrics is not None:
+        try:
+           metrics.finish(exitcode)
+        except Exception as ex:
+           print(f"INFO:Metrics files could not be written. {ex}")
+
      # Exit the script now
      sys.exit(exitcode) 
 
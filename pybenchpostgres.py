@@ -0,0 +1,494 @@
+#!/QOpenSys/pkgs/bin/python3
+######!/usr/bin/python3
+##### IBM i Specific
+#####!/QOpenSys/pkgs/bin/python3
+#------------------------------------------------
+# Script name: pybenchpostgres.py
+#
+# Description:
+# This script will benchmark the backup and restore modes of pybackuppostgres.py
+# and pyrestorepostgres.py. A synthetic database of the selected size and shape
+# is created, then each mode is backed up and restored end to end and the
+# seconds, MB/s and peak memory of every run are printed in one table.
+#
+# The benchmark runs against a throwaway database on a local PostgreSQL cluster
+# (--target=local) or against stub pg_dump, pg_restore and psql programs that
+# emit realistic byte streams (--target=stub). The stub target measures the
+# work done by the scripts themselves: streaming, compression, checksums and
+# verify. The local target also includes the PostgreSQL server.
+#
+# MB/s is the database table data size divided by the seconds of the run, so
+# modes are compared on the same amount of data. Peak memory is the largest
+# resident set of the backup or restore script and the programs it ran.
+#
+# Pip packages needed:
+#
+# Parameters:
+# --target=stub=Stub pg_dump/pg_restore/psql programs (default). local=Local PostgreSQL cluster.
+# --dbname=Benchmark database name. Restores go to <dbname>_restore. Both are dropped and
+#   created again by the benchmark so never point this at a real database. Default=pybench
+# --dbhost=PostgreSQL host name to connect to. Leave blank or omit this parm to use local sockets.
+# --dbport=PostgreSQL TCP port connect to. Omit this parm to default to port: 5432.
+# --dbuser=PostgreSQL user to connect as. Omit this parm to use "postgres" user as default user.
+# --dbpass=PostgreSQL password to use. Omit this parm or pass empty parm if host is blank to use local socket connection.
+# --sizemb=Comma separated synthetic database sizes in MB of table data. Default=64
+# --shape=Comma separated database shapes. small=200 narrow tables, wide=4 tables with
+#   24 text columns, mixed=20 tables of 8 columns. Default=mixed
+# --modes=Comma separated modes to run. Each mode is format[+codec][/verify].
+#   Ex: tar, tar+zstd, tar/none, directory+gzip, shards
+#   Default=tar,tar/tar,tar/none,tar+gzip,tar+zstd,tar+lz4,directory,directory+gzip,shards
+# --jobs=Number of parallel jobs for directory and shards backups and for restores. Default=2
+# --restore=True=Restore each backup after it is made (default). False=Backups only.
+# --repeat=Number of times to run each mode. The median run is reported. Default=1
+# --workdir=Work directory for backups and logs. Default=temporary directory.
+# --keep=True=Keep the work directory and benchmark databases. False=Remove them (default).
+# --resultsfile=JSON lines file to append the results to. Blank=No results file (default).
+#------------------------------------------------
+
+#------------------------------------------------
+# Imports and Environment setup
+#------------------------------------------------
+import sys
+from sys import platform
+import os
+import os.path
+import time
+import traceback
+import argparse
+import json
+import shutil
+import subprocess
+import tempfile
+import pypostgresmetrics
+import pypostgresprogress
+import pypostgresshards
+
+#------------------------------------------------
+# Script initialization
+#------------------------------------------------
+
+# Initialize or set variables
+exitcode=0 #Init exitcode
+exitmessage=''
+dashes="-------------------------------------------------------------------------------"
+scriptdir=os.path.dirname(os.path.abspath(__file__))
+backupscript=os.path.join(scriptdir,"pybackuppostgres.py")
+restorescript=os.path.join(scriptdir,"pyrestorepostgres.py")
+stubscript=os.path.join(scriptdir,"pypostgresbenchstub.py")
+workdir=""
+workdircreated=False
+keepworkdir=False
+
+# Database shapes. Number of tables and text columns per table.
+SHAPES={
+    "small":{"tables":200,"columns":3},
+    "wide":{"tables":4,"columns":24},
+    "mixed":{"tables":20,"columns":8},
+}
+
+# Client programs replaced by the stubs
+STUBPROGRAMS=["pg_dump","pg_restore","psql","createdb","dropdb"]
+
+#Output messages to STDOUT for logging
+print(dashes)
+print("PostgreSQL Backup and Restore Benchmark")
+print(f"Start of Main Processing -  {time.strftime('%H:%M:%S')}")
+print("OS:" + platform)
+
+#------------------------------------------------
+# Define some useful functions
+#------------------------------------------------
+
+def str2bool(strval):
+    #-------------------------------------------------------
+    # Function: str2bool
+    # Desc: Constructor
+    # :strval: String value for true or false
+    # :return: Return True if string value is" yes, true, t or 1
+    #-------------------------------------------------------
+    return strval.lower() in ("yes", "true", "t", "1")
+
+def trim(strval):
+    #-------------------------------------------------------
+    # Function: trim
+    # Desc: Alternate name for strip
+    # :strval: String value to trim.
+    # :return: Trimmed value
+    #-------------------------------------------------------
+    return strval.strip()
+
+def parsemode(mode):
+    #-------------------------------------------------------
+    # Function: parsemode
+    # Desc: Split a mode into backup format, codec and verify
+    # :mode: format[+codec][/verify]. Ex: tar+zstd/stream
+    # :return: (format,codec,verify)
+    #-------------------------------------------------------
+    (formatcodec,_,verify)=mode.partition("/")
+    (backupformat,_,codec)=formatcodec.partition("+")
+    if (backupformat not in ("tar","directory","shards")):
+        raise Exception(f"Mode {mode} format must be: tar, directory or shards")
+    return (backupformat,codec if codec!="" else "none",verify if verify!="" else "stream")
+
+def plantables(sizemb,shape):
+    #-------------------------------------------------------
+    # Function: plantables
+    # Desc: Plan the synthetic tables for a size and shape.
+    #       Every table gets the same number of rows.
+    # :sizemb: Table data size in MB
+    # :shape: small, wide or mixed
+    # :return: List of table dictionaries
+    #-------------------------------------------------------
+    tablecount=SHAPES[shape]["tables"]
+    columns=SHAPES[shape]["columns"]
+    # bigint id plus 32 character text columns in COPY text
+    rowbytes=8 + columns * 33
+    rows=max(int(sizemb*1024*1024 / tablecount / rowbytes),1)
+    return [{"schema":"public","name":f"t{index + 1:04d}","rows":rows,"columns":columns} for index in range(tablecount)]
+
+def runpsql(sql,dbname,connargs,env):
+    #-------------------------------------------------------
+    # Function: runpsql
+    # Desc: Run SQL statements with psql
+    # :sql: SQL statements
+    # :dbname: Database name
+    # :connargs: Connection arguments from pypostgresshards.connectionargs
+    # :env: Environment with PGPASSWORD
+    #-------------------------------------------------------
+    result=subprocess.run(["psql","-X","-q","-v","ON_ERROR_STOP=1","-d",dbname] + connargs,
+                          input=sql,capture_output=True,text=True,env=env)
+    if (result.returncode != 0):
+        raise Exception(f"Error {result.returncode} occurred while running psql. {result.stderr.strip()}")
+
+def createdatabase(dbname,tables,connargs,env):
+    #-------------------------------------------------------
+    # Function: createdatabase
+    # Desc: Create the synthetic database on the cluster. The
+    #       text columns hold md5() values like the stub data.
+    # :dbname: Database name
+    # :tables: Table dictionaries from plantables
+    # :connargs: Connection arguments from pypostgresshards.connectionargs
+    # :env: Environment with PGPASSWORD
+    #-------------------------------------------------------
+    subprocess.run(["dropdb","--if-exists",dbname] + connargs,env=env,check=True)
+    subprocess.run(["createdb",dbname] + connargs,env=env,check=True)
+    for table in tables:
+        columns=", ".join(f"c{column + 1} text" for column in range(table["columns"]))
+        values=", ".join(f"md5((g*{column + 1})::text)" for column in range(table["columns"]))
+        runpsql(f"create table {table['schema']}.{table['name']} (id bigint primary key, {columns});\n"
+                f"insert into {table['schema']}.{table['name']} select g, {values} from generate_series(1,{table['rows']}) g;\n",
+                dbname,connargs,env)
+    runpsql("analyze;\n",dbname,connargs,env)
+
+def writestubs(bindir,configfile):
+    #-------------------------------------------------------
+    # Function: writestubs
+    # Desc: Write the stub client program wrappers. The stub
+    #       directory goes first on PATH for the benchmark runs.
+    # :bindir: Directory for the wrappers
+    # :configfile: Synthetic database JSON file for the stubs
+    #-------------------------------------------------------
+    os.makedirs(bindir,exist_ok=True)
+    for program in STUBPROGRAMS:
+        wrapper=os.path.join(bindir,program)
+        with open(wrapper,"w") as outfile:
+            outfile.write(f"#!/bin/sh\nBENCHSTUBCONFIG=\"{configfile}\" exec \"{sys.executable}\" \"{stubscript}\" {program} \"$@\"\n")
+        os.chmod(wrapper,0o755)
+
+def runscript(script,scriptargs,env,logfile):
+    #-------------------------------------------------------
+    # Function: runscript
+    # Desc: Run a backup or restore script and measure it
+    # :script: Script to run
+    # :scriptargs: Script arguments
+    # :env: Environment for the script
+    # :logfile: File to write the script output to
+    # :return: (exit code,seconds,peak RSS bytes)
+    #-------------------------------------------------------
+    starttime=time.monotonic()
+    with open(logfile,"w") as log:
+        proc=subprocess.Popen([sys.executable,script] + scriptargs,stdout=log,stderr=subprocess.STDOUT,env=env)
+        # wait4 reports the peak RSS of the script and the programs it waited for
+        (pid,status,rusage)=os.wait4(proc.pid,0)
+        proc.returncode=os.waitstatus_to_exitcode(status)
+    seconds=time.monotonic() - starttime
+    # Linux reports KB and macOS reports bytes
+    peakrss=rusage.ru_maxrss if sys.platform=="darwin" else rusage.ru_maxrss*1024
+    return (proc.returncode,seconds,peakrss)
+
+def logvalue(logfile,prefix):
+    #-------------------------------------------------------
+    # Function: logvalue
+    # Desc: Get the last value of a line from a script log
+    # :logfile: Script log file
+    # :prefix: Line prefix. Ex: Output file:
+    # :return: Value after the prefix or blank if not found
+    #-------------------------------------------------------
+    value=""
+    with open(logfile,"r",errors="replace") as log:
+        for line in log:
+            if line.startswith(prefix):
+                value=line[len(prefix):].rstrip("\n")
+    return value
+
+def benchmode(mode,run,datadir,logdir,commonargs,connargs,env,dbname,jobs,restore):
+    #-------------------------------------------------------
+    # Function: benchmode
+    # Desc: Back up and restore the benchmark database once
+    #       with one mode
+    # :mode: format[+codec][/verify]
+    # :run: Run number
+    # :datadir: Directory for the backup output
+    # :logdir: Directory for the script logs
+    # :commonargs: Connection arguments for the scripts
+    # :connargs: Connection arguments from pypostgresshards.connectionargs
+    # :env: Environment for the scripts
+    # :dbname: Benchmark database name
+    # :jobs: Parallel jobs for the scripts
+    # :restore: True=Restore the backup after it is made
+    # :return: Result dictionary
+    #-------------------------------------------------------
+    (backupformat,codec,verify)=parsemode(mode)
+    name=mode.replace("+","-").replace("/","-") + f"-{run}"
+    extension={"tar":".tar","directory":".dir","shards":".set"}[backupformat]
+    result={"mode":mode,"run":run,"backupexitcode":-1,"backupseconds":0,"backuppeakrss":0,"outputbytes":0,
+            "restoreexitcode":-1,"restoreseconds":0,"restorepeakrss":0,"exitmessage":""}
+
+    backuplog=os.path.join(logdir,f"{name}-backup.log")
+    (rtncmd,seconds,peakrss)=runscript(backupscript,[f"--dbname={dbname}",f"--outputfile={os.path.join(datadir,name + extension)}",
+                                                    "--replace=True",f"--format={backupformat}",f"--compress={codec}",
+                                                    f"--verify={verify}",f"--jobs={jobs}","--progress=0"] + commonargs,env,backuplog)
+    result.update({"backupexitcode":rtncmd,"backupseconds":seconds,"backuppeakrss":peakrss})
+    outputfile=logvalue(backuplog,"Output file: ")
+    if (rtncmd != 0):
+        result["exitmessage"]=logvalue(backuplog,"ExitMessage:")
+        return result
+    result["outputbytes"]=pypostgresmetrics.pathsize(outputfile)
+    # Stream verify manifest is part of the backup
+    if os.path.isfile(outputfile + ".manifest.json"):
+        result["outputbytes"]+=os.path.getsize(outputfile + ".manifest.json")
+
+    if (restore==True):
+        restorelog=os.path.join(logdir,f"{name}-restore.log")
+        restoredb=f"{dbname}_restore"
+        subprocess.run(["dropdb","--if-exists",restoredb] + connargs,env=env)
+        (rtncmd,seconds,peakrss)=runscript(restorescript,["--action=restoreasdb",f"--dbname={restoredb}",f"--inputfile={outputfile}",
+                                                         f"--jobs={jobs}","--progress=0"] + commonargs,env,restorelog)
+        result.update({"restoreexitcode":rtncmd,"restoreseconds":seconds,"restorepeakrss":peakrss})
+        if (rtncmd != 0):
+            result["exitmessage"]=logvalue(restorelog,"ExitMessage:")
+    # Free the space for the next mode
+    if os.path.isdir(outputfile):
+        shutil.rmtree(outputfile)
+    elif os.path.isfile(outputfile):
+        os.remove(outputfile)
+    if os.path.isfile(outputfile + ".manifest.json"):
+        os.remove(outputfile + ".manifest.json")
+    return result
+
+#------------------------------------------------
+# Main script logic
+#------------------------------------------------
+try: # Try to perform main logic
+
+      # Set up the command line argument parsing.
+      # If the parse_args function fails, the program will
+      # exit with an error 2. In Python 3.9, there is
+      # an argument to prevent an auto-exit
+      # Each argument has a long and short version
+      parser = argparse.ArgumentParser()
+      parser.add_argument('-t','--target', required=False,default="stub",help="Benchmark target: stub=stub client programs,local=local PostgreSQL cluster. Default=stub")
+      parser.add_argument('-d','--dbname', required=False,default="pybench",help="Benchmark database name. Dropped and created again. Default=pybench")
+      parser.add_argument('-H','--dbhost', required=False,default="",help="Database host. Blank=use local domain socket")
+      parser.add_argument('-p','--dbport', required=False,default=5432,help="Database port")
+      parser.add_argument('-U','--dbuser', required=False,default="postgres",help="Database user")
+      parser.add_argument('-P','--dbpass', required=False,default="",help="Database pass")
+      parser.add_argument('-s','--sizemb', required=False,default="64",help="Comma separated database sizes in MB. Default=64")
+      parser.add_argument('-S','--shape', required=False,default="mixed",help="Comma separated database shapes: small, wide or mixed. Default=mixed")
+      parser.add_argument('-m','--modes', required=False,default="tar,tar/tar,tar/none,tar+gzip,tar+zstd,tar+lz4,directory,directory+gzip,shards",help="Comma separated modes. format[+codec][/verify]")
+      parser.add_argument('-j','--jobs', required=False,default=2,help="Number of parallel jobs for directory, shards and restores. Default=2")
+      parser.add_argument('-r','--restore', required=False,default="True",help="True=Restore each backup,False=Backups only. Default=True")
+      parser.add_argument('-n','--repeat', required=False,default=1,help="Number of runs per mode. The median run is reported. Default=1")
+      parser.add_argument('-w','--workdir', required=False,default="",help="Work directory for backups and logs. Default=temporary directory")
+      parser.add_argument('-k','--keep', required=False,default="False",help="True=Keep work directory and benchmark databases. Default=False")
+      parser.add_argument('-o','--resultsfile', required=False,default="",help="JSON lines file to append results to. Blank=No results file. Default=blank")
+
+      # Parse the command line arguments
+      args = parser.parse_args()
+
+      # Set parameter work variables from command line args
+      parmscriptname = sys.argv[0]
+      parmtarget=args.target.strip().lower()
+      parmdbname=args.dbname.strip()
+      parmdbport =args.dbport
+      parmdbhost =args.dbhost.strip()
+      parmdbuser =args.dbuser.strip()
+      parmdbpass =args.dbpass.strip()
+      parmsizemb=[float(size) for size in args.sizemb.split(",") if trim(size)!=""]
+      parmshape=[trim(shape).lower() for shape in args.shape.split(",") if trim(shape)!=""]
+      parmmodes=[trim(mode).lower() for mode in args.modes.split(",") if trim(mode)!=""]
+      parmjobs=int(args.jobs)
+      parmrestore=str2bool(args.restore)
+      parmrepeat=int(args.repeat)
+      parmworkdir=args.workdir.strip()
+      parmkeep=str2bool(args.keep)
+      keepworkdir=parmkeep
+      parmresultsfile=args.resultsfile.strip()
+      print(f"Python script: {parmscriptname}")
+      print(f"Target: {parmtarget}")
+      print(f"Database host: {parmdbhost}")
+      print(f"Database port: {parmdbport}")
+      print(f"Database name: {parmdbname}")
+      print(f"Database user: {parmdbuser}")
+      print(f"Size MB: {','.join(str(size) for size in parmsizemb)}")
+      print(f"Shape: {','.join(parmshape)}")
+      print(f"Modes: {','.join(parmmodes)}")
+      print(f"Jobs: {parmjobs}")
+      print(f"Restore: {parmrestore}")
+      print(f"Repeat: {parmrepeat}")
+      print(f"Work dir: {parmworkdir}")
+      print(f"Keep: {parmkeep}")
+      print(f"Results file: {parmresultsfile}")
+
+      # Bail if target, shapes or modes are invalid
+      if (parmtarget != "stub" and parmtarget != "local"):
+            raise Exception("Target must be: stub or local")
+      for shape in parmshape:
+         if (shape not in SHAPES):
+            raise Exception("Shape must be: small, wide or mixed")
+      for mode in parmmodes:
+         parsemode(mode)
+      if (parmrepeat < 1):
+            raise Exception("Repeat must be 1 or greater")
+
+      # Work directory for backups, logs and the stub programs
+      if (parmworkdir==""):
+         workdir=tempfile.mkdtemp(prefix="pybench-")
+         workdircreated=True
+      else:
+         workdir=parmworkdir
+         if (os.path.isdir(workdir)==False):
+            os.makedirs(workdir)
+            workdircreated=True
+      datadir=os.path.join(workdir,"data")
+      logdir=os.path.join(workdir,"logs")
+      os.makedirs(datadir,exist_ok=True)
+      os.makedirs(logdir,exist_ok=True)
+
+      env=dict(os.environ,PGPASSWORD=parmdbpass)
+      connargs=pypostgresshards.connectionargs(parmdbhost,parmdbport,parmdbuser)
+      commonargs=[f"--dbhost={parmdbhost}",f"--dbport={parmdbport}",f"--dbuser={parmdbuser}",f"--dbpass={parmdbpass}"]
+      configfile=os.path.join(workdir,"stubconfig.json")
+      if (parmtarget=="stub"):
+         # Stub programs go first on PATH for the scripts
+         writestubs(os.path.join(workdir,"bin"),configfile)
+         env["PATH"]=os.path.join(workdir,"bin") + os.pathsep + env.get("PATH","")
+
+      # Run every mode for every size and shape
+      results=[]
+      for sizemb in parmsizemb:
+         for shape in parmshape:
+            tables=plantables(sizemb,shape)
+            print("")
+            print(f"INFO: Creating {shape} database {parmdbname} with {len(tables)} tables of {tables[0]['rows']} rows - {time.strftime('%H:%M:%S')}")
+            if (parmtarget=="stub"):
+               # Table data is generated in its own process. Memory used here would
+               # be counted in the peak RSS of every script started afterwards.
+               with open(configfile,"w") as outfile:
+                  json.dump({"tables":tables,"datadir":os.path.join(workdir,"stubdata")},outfile)
+               subprocess.run([sys.executable,stubscript,"generate"],env=dict(env,BENCHSTUBCONFIG=configfile),check=True)
+            else:
+               createdatabase(parmdbname,tables,connargs,env)
+            # Table data size from the catalog is the MB/s base for every mode
+            databytes=sum(pypostgresprogress.catalogtablesizes(parmdbname,connargs,env).values())
+            print(f"INFO: Created database {parmdbname} with {databytes/1024/1024:.1f} MB of table data - {time.strftime('%H:%M:%S')}")
+
+            for mode in parmmodes:
+               runs=[]
+               for run in range(1,parmrepeat + 1):
+                  print(f"INFO: Starting {mode} run {run} - {time.strftime('%H:%M:%S')}")
+                  result=benchmode(mode,run,datadir,logdir,commonargs,connargs,env,parmdbname,parmjobs,parmrestore)
+                  result.update({"target":parmtarget,"shape":shape,"sizemb":sizemb,"databytes":databytes,
+                                 "time":time.strftime('%Y-%m-%d %H:%M:%S')})
+                  print(f"INFO: Completed {mode} run {run} with backup exit code {result['backupexitcode']} "
+                        f"in {result['backupseconds']:.1f} seconds - {time.strftime('%H:%M:%S')}")
+                  runs.append(result)
+               # Report the median run by backup seconds
+               runs.sort(key=lambda result: result["backupseconds"])
+               results.append(runs[len(runs) // 2])
+               if (parmresultsfile!=""):
+                  with open(parmresultsfile,"a") as outfile:
+                     for result in runs:
+                        outfile.write(json.dumps(result) + "\n")
+
+      # Print the results table
+      print("")
+      print(dashes)
+      print(f"{'Shape':<6} {'MB':>7} {'Mode':<18} {'Bkup s':>7} {'MB/s':>7} {'PeakMB':>7} {'OutMB':>8} {'Ratio':>6} {'Rest s':>7} {'MB/s':>7} {'PeakMB':>7}  Exit")
+      for result in results:
+         datamb=result["databytes"]/1024/1024
+         backupmbps=datamb/result["backupseconds"] if result["backupseconds"] > 0 else 0
+         restorembps=datamb/result["restoreseconds"] if result["restoreseconds"] > 0 else 0
+         ratio=result["databytes"]/result["outputbytes"] if result["outputbytes"] > 0 else 0
+         print(f"{result['shape']:<6} {datamb:>7.1f} {result['mode']:<18} {result['backupseconds']:>7.2f} {backupmbps:>7.1f} "
+               f"{result['backuppeakrss']/1024/1024:>7.1f} {result['outputbytes']/1024/1024:>8.1f} {ratio:>6.2f} "
+               f"{result['restoreseconds']:>7.2f} {restorembps:>7.1f} {result['restorepeakrss']/1024/1024:>7.1f}  "
+               f"{result['backupexitcode']}/{result['restoreexitcode'] if parmrestore else '-'}")
+         if (result["exitmessage"]!=""):
+            print(f"{'':<6} {result['exitmessage']}")
+
+      # Drop the benchmark databases
+      if (parmtarget=="local" and parmkeep==False):
+         subprocess.run(["dropdb","--if-exists",parmdbname] + connargs,env=env)
+         subprocess.run(["dropdb","--if-exists",f"{parmdbname}_restore"] + connargs,env=env)
+
+      # Set exit info
+      failed=[result["mode"] for result in results if result["backupexitcode"]!=0 or (parmrestore and result["restoreexitcode"]!=0)]
+      if (len(failed) > 0):
+         raise Exception(f"{len(failed)} of {len(results)} benchmark runs failed: {','.join(failed)}. Logs are in {logdir}")
+
+      # Set success info
+      exitcode=0
+      exitmessage=f"Benchmark of {len(results)} runs completed successfully"
+
+#------------------------------------------------
+# Handle Exceptions
+#------------------------------------------------
+# System Exit occurred. Most likely from argument parser
+except SystemExit as ex:
+     exitcode=ex.code # set return code for stdout
+     exitmessage=str(ex) # set exit message for stdout
+
+except argparse.ArgumentError as exc:
+     exitcode=99 # set return code for stdout
+     exitmessage=str(exc) # set exit message for stdout
+     print('Traceback Info') # output traceback info for stdout
+     traceback.print_exc()
+     sys.exit(99)
+
+except Exception as ex: # Catch and handle exceptions
+     exitcode=99 # set return code for stdout
+     exitmessage=str(ex) # set exit message for stdout
+     print('Traceback Info') # output traceback info for stdout
+     traceback.print_exc()
+     sys.exit(99)
+#------------------------------------------------
+# Always perform final processing
+#------------------------------------------------
+finally: # Final processing
+     # Remove work directory if we created one. Failed runs keep their logs.
+     if (workdircreated==True and keepworkdir==False and exitcode==0 and os.path.isdir(workdir)):
+        shutil.rmtree(workdir,ignore_errors=True)
+        print(f"INFO:Removed work directory {workdir} after processing.")
+
+     # Do any final code and exit now
+     # We log as much relevent info to STDOUT as needed
+     print("")
+     print(dashes)
+     print('ExitCode:' + str(exitcode))
+     print('ExitMessage:' + exitmessage)
+     print(f"End of Main Processing -  {time.strftime('%H:%M:%S')}")
+     print(dashes)
+
+     # Exit the script now
+     sys.exit(exitcode)
@@ -0,0 +1,324 @@
+#!/QOpenSys/pkgs/bin/python3
+######!/usr/bin/python3
+##### IBM i Specific
+#####!/QOpenSys/pkgs/bin/python3
+#------------------------------------------------
+# Script name: pyclonepostgres.py
+#
+# Description:
+# This script will clone a live PostgreSQL database to a new database without
+# writing a dump file. On the same cluster the database is copied inside the
+# server with CREATE DATABASE ... TEMPLATE. Across clusters pg_dump is piped
+# straight into pg_restore, with the table data piped in parallel shards from
+# one exported snapshot when --jobs is greater than 1.
+#
+# Links:
+# https://www.postgresql.org/docs/current/manage-ag-templatedbs.html
+#
+# Pip packages needed:
+#
+# Parameters:
+# --fromdb=Source database name to clone.
+# --dbname=New database name. The database must not exist yet unless --replace=True.
+# --dbhost=PostgreSQL host name of the new database. Leave blank or omit this parm to use local sockets.
+# --dbport=PostgreSQL TCP port of the new database. Omit this parm to default to port: 5432.
+# --dbuser=PostgreSQL user to connect as. Omit this parm to use "postgres" user as default user.
+# --dbpass=PostgreSQL password to use. Omit this parm or pass empty parm if host is blank to use local socket connection.
+# --fromhost=PostgreSQL host name of the source database. Blank=Same as --dbhost (default).
+# --fromport=PostgreSQL TCP port of the source database. Blank=Same as --dbport (default).
+# --fromuser=PostgreSQL user to connect to the source as. Blank=Same as --dbuser (default).
+# --frompass=PostgreSQL password for the source. Blank=Same as --dbpass (default).
+# --mode=Clone mode. auto=template when the source and new database are on the same cluster,
+#   otherwise stream (default). template=CREATE DATABASE ... TEMPLATE. The source must have no
+#   other sessions while it is copied. stream=Pipe pg_dump into pg_restore. Other sessions can
+#   keep working on the source.
+# --terminate=True=Block new connections to the source and terminate its other sessions for a
+#   template clone. Connections are allowed again when the copy is done. False=Fail if the
+#   source has other sessions (default).
+# --strategy=CREATE DATABASE strategy for a template clone on PostgreSQL 15 or later.
+#   wal_log=Copy block by block through the WAL. file_copy=Copy the files after a checkpoint,
+#   faster for large databases. Blank=Server default (default).
+# --jobs=Number of data shards piped at the same time for a stream clone. 1=One pg_dump piped
+#   into one pg_restore (default).
+# --shardsize=Target shard size in MB for a stream clone with --jobs. Default=256
+# --replace=True=Drop the new database first if it exists. False=Halt if it exists (default).
+# --metricsfile=JSON lines file to append timing metrics to for each phase. Blank=No metrics file (default).
+# --promfile=Prometheus node_exporter textfile to write the phase metrics and exit code to.
+#   Blank=No Prometheus file (default).
+#------------------------------------------------
+
+#------------------------------------------------
+# Imports and Environment setup
+#------------------------------------------------
+import sys
+from sys import platform
+import os
+import os.path
+import time
+import traceback
+import argparse
+import pypostgresshards
+import pypostgresmetrics
+import pypostgresclone
+
+#------------------------------------------------
+# Script initialization
+#------------------------------------------------
+
+# Initialize or set variables
+exitcode=0 #Init exitcode
+exitmessage=''
+dashes="-------------------------------------------------------------------------------"
+metrics=None
+clonecreated=False
+
+#Output messages to STDOUT for logging
+print(dashes)
+print("PostgreSQL Database Clone")
+print(f"Start of Main Processing -  {time.strftime('%H:%M:%S')}")
+print("OS:" + platform)
+
+#------------------------------------------------
+# Define some useful functions
+#------------------------------------------------
+
+def str2bool(strval):
+    #-------------------------------------------------------
+    # Function: str2bool
+    # Desc: Constructor
+    # :strval: String value for true or false
+    # :return: Return True if string value is" yes, true, t or 1
+    #-------------------------------------------------------
+    return strval.lower() in ("yes", "true", "t", "1")
+
+def trim(strval):
+    #-------------------------------------------------------
+    # Function: trim
+    # Desc: Alternate name for strip
+    # :strval: String value to trim.
+    # :return: Trimmed value
+    #-------------------------------------------------------
+    return strval.strip()
+
+def databaseexists(dbname,connargs,env):
+    #-------------------------------------------------------
+    # Function: databaseexists
+    # Desc: Check if a database exists
+    # :return: True if the database exists
+    #-------------------------------------------------------
+    return len(pypostgresshards.psqlquery(f"select 1 from pg_database where datname={pypostgresclone.quoteliteral(dbname)}",
+                                          "postgres",connargs,env)) > 0
+
+def databasesize(dbname,connargs,env):
+    #-------------------------------------------------------
+    # Function: databasesize
+    # Desc: Get the size of a database
+    # :return: Size in bytes or 0 if not found
+    #-------------------------------------------------------
+    rows=pypostgresshards.psqlquery(f"select pg_database_size(oid) from pg_database where datname={pypostgresclone.quoteliteral(dbname)}",
+                                    "postgres",connargs,env)
+    return int(rows[0][0]) if len(rows) > 0 else 0
+
+#------------------------------------------------
+# Main script logic
+#------------------------------------------------
+try: # Try to perform main logic
+
+      # Set up the command line argument parsing.
+      # If the parse_args function fails, the program will
+      # exit with an error 2. In Python 3.9, there is
+      # an argument to prevent an auto-exit
+      # Each argument has a long and short version
+      parser = argparse.ArgumentParser()
+      parser.add_argument('-f','--fromdb', required=True,help="Source database name")
+      parser.add_argument('-d','--dbname', required=True,help="New database name")
+      parser.add_argument('-H','--dbhost', required=False,default="",help="Database host. Blank=use local domain socket")
+      parser.add_argument('-p','--dbport', required=False,default=5432,help="Database port")
+      parser.add_argument('-U','--dbuser', required=False,default="postgres",help="Database user")
+      parser.add_argument('-P','--dbpass', required=False,default="",help="Database pass")
+      parser.add_argument('-S','--fromhost', required=False,default="",help="Source database host. Blank=Same as --dbhost. Default=blank")
+      parser.add_argument('-o','--fromport', required=False,default="",help="Source database port. Blank=Same as --dbport. Default=blank")
+      parser.add_argument('-u','--fromuser', required=False,default="",help="Source database user. Blank=Same as --dbuser. Default=blank")
+      parser.add_argument('-w','--frompass', required=False,default="",help="Source database pass. Blank=Same as --dbpass. Default=blank")
+      parser.add_argument('-m','--mode', required=False,default="auto",help="Clone mode: auto, template=CREATE DATABASE TEMPLATE, stream=pg_dump piped into pg_restore. Default=auto")
+      parser.add_argument('-t','--terminate', required=False,default="False",help="True=Terminate other sessions on the source for a template clone,False=Fail if there are other sessions. Default=False")
+      parser.add_argument('-s','--strategy', required=False,default="",help="CREATE DATABASE strategy for a template clone: wal_log or file_copy. Blank=Server default. Default=blank")
+      parser.add_argument('-j','--jobs', required=False,default=1,help="Number of data shards piped at the same time for a stream clone. Default=1")
+      parser.add_argument('-z','--shardsize', required=False,default=256,help="Target shard size in MB for a stream clone with --jobs. Default=256")
+      parser.add_argument('-r','--replace', required=False,default="False",help="True=Drop the new database first if it exists,False=Halt if it exists. Default=False")
+      parser.add_argument('-e','--metricsfile', required=False,default="",help="JSON lines file to append phase metrics to. Blank=No metrics file. Default=blank")
+      parser.add_argument('-x','--promfile', required=False,default="",help="Prometheus textfile to write phase metrics to. Blank=No Prometheus file. Default=blank")
+
+      # Parse the command line arguments
+      args = parser.parse_args()
+
+      # Set parameter work variables from command line args
+      parmscriptname = sys.argv[0]
+      parmfromdb=args.fromdb.strip()
+      parmdbname=args.dbname.strip()
+      parmdbport=args.dbport
+      parmdbhost=args.dbhost.strip()
+      parmdbuser=args.dbuser.strip()
+      parmdbpass=args.dbpass.strip()
+      # Remove forward slash from password if found
+      # This is in case exclamation in password
+      parmdbpass=parmdbpass.replace("\\!","!")
+      # Source connection defaults to the new database connection
+      parmfromhost=args.fromhost.strip() if args.fromhost.strip()!="" else parmdbhost
+      parmfromport=str(args.fromport).strip() if str(args.fromport).strip()!="" else parmdbport
+      parmfromuser=args.fromuser.strip() if args.fromuser.strip()!="" else parmdbuser
+      parmfrompass=args.frompass.strip().replace("\\!","!") if args.frompass.strip()!="" else parmdbpass
+      parmmode=args.mode.strip().lower()
+      parmterminate=str2bool(args.terminate)
+      parmstrategy=args.strategy.strip().lower()
+      parmjobs=int(args.jobs)
+      parmshardsize=float(args.shardsize)
+      parmreplace=str2bool(args.replace)
+      parmmetricsfile=args.metricsfile.strip()
+      parmpromfile=args.promfile.strip()
+      print(f"Python script: {parmscriptname}")
+      print(f"Source database: {parmfromdb}")
+      print(f"Source host: {parmfromhost}")
+      print(f"Source port: {parmfromport}")
+      print(f"Source user: {parmfromuser}")
+      print(f"Database host: {parmdbhost}")
+      print(f"Database port: {parmdbport}")
+      print(f"Database name: {parmdbname}")
+      print(f"Database user: {parmdbuser}")
+      print(f"Mode: {parmmode}")
+      print(f"Terminate: {parmterminate}")
+      print(f"Strategy: {parmstrategy}")
+      print(f"Jobs: {parmjobs}")
+      print(f"Shard size MB: {parmshardsize}")
+      print(f"Replace: {parmreplace}")
+      print(f"Metrics file: {parmmetricsfile}")
+      print(f"Prometheus file: {parmpromfile}")
+
+      # Collect phase timings from here on
+      metrics=pypostgresmetrics.Metrics("clone",parmdbname,parmmetricsfile,parmpromfile)
+
+      # Bail if mode, strategy or jobs is invalid
+      if (parmmode not in pypostgresclone.CLONEMODES):
+            raise Exception("Mode must be: auto, template or stream")
+      if (parmstrategy not in pypostgresclone.STRATEGIES):
+            raise Exception("Strategy must be: wal_log or file_copy")
+      if (parmjobs < 1):
+            raise Exception("Jobs must be 1 or greater")
+
+      # Source and new database connections
+      connargs=pypostgresshards.connectionargs(parmdbhost,parmdbport,parmdbuser)
+      fromargs=pypostgresshards.connectionargs(parmfromhost,parmfromport,parmfromuser)
+      cloneenv=dict(os.environ,PGPASSWORD=parmdbpass)
+      fromenv=dict(os.environ,PGPASSWORD=parmfrompass)
+      samecluster=pypostgresclone.samecluster(fromargs,fromenv,connargs,cloneenv)
+
+      # Bail if the source and new database are the same database
+      if (samecluster==True and parmfromdb==parmdbname):
+            raise Exception("New database name must differ from the source database name")
+
+      # Pick the clone mode
+      clonemode=parmmode
+      if (parmmode=="auto"):
+         clonemode="template" if samecluster else "stream"
+      elif (parmmode=="template" and samecluster==False):
+            raise Exception("Template clone needs the source and new database on the same cluster. Use --mode=stream")
+      print(f"INFO: Clone mode: {clonemode}")
+
+      # Make sure source database exists. otherwise bail out
+      if (databaseexists(parmfromdb,fromargs,fromenv)==False):
+            raise Exception(f"Source database {parmfromdb} does not exist. Clone cancelled.")
+
+      # Replace database
+      if (databaseexists(parmdbname,connargs,cloneenv)==True):
+         if (parmreplace==True):
+            print("")
+            print(f"INFO: Starting drop of existing database {parmdbname} - {time.strftime('%H:%M:%S')}")
+            phase=metrics.startphase("dropdb")
+            forceclause=" with (force)" if parmterminate==True else ""
+            pypostgresclone.runsql(f"drop database {pypostgresclone.quoteident(parmdbname)}{forceclause}",connargs,cloneenv)
+            metrics.endphase(phase,0,0)
+            print(f"INFO: Completed drop of existing database {parmdbname} - {time.strftime('%H:%M:%S')}")
+         else:
+            # Database exists, exit program
+            raise Exception(f"Database {parmdbname} already exists and replace not selected. Clone cancelled.")
+
+      print("")
+      print(f"INFO: Starting {clonemode} clone of database {parmfromdb} to {parmdbname} - {time.strftime('%H:%M:%S')}")
+      if (clonemode=="template"):
+         # Copy the database files inside the server
+         phase=metrics.startphase("clone")
+         pypostgresclone.clonetemplate(parmfromdb,parmdbname,connargs,cloneenv,parmterminate,parmstrategy)
+         rtncmd=0
+      else:
+         # Create the new database and pipe the source into it
+         phase=metrics.startphase("createdb")
+         pypostgresclone.runsql(f"create database {pypostgresclone.quoteident(parmdbname)}",connargs,cloneenv)
+         clonecreated=True
+         metrics.endphase(phase,0,0)
+         phase=metrics.startphase("clone")
+         rtncmd=pypostgresclone.clonestream(parmfromdb,parmdbname,fromargs,fromenv,connargs,cloneenv,parmjobs,int(parmshardsize*1024*1024))
+      clonebytes=databasesize(parmdbname,connargs,cloneenv) if rtncmd==0 else 0
+      metrics.endphase(phase,clonebytes,rtncmd)
+      print(f"INFO: Completed {clonemode} clone of database {parmfromdb} to {parmdbname} - {time.strftime('%H:%M:%S')}")
+
+      # Check return code
+      if (rtncmd != 0):
+         raise Exception(f"Error {rtncmd} occurred while cloning database {parmfromdb}")
+
+      # Set success info
+      clonecreated=False
+      exitcode=0
+      exitmessage=f"Clone of database {parmfromdb} completed successfully to database {parmdbname} with {clonebytes/1024/1024:.1f} MB"
+
+#------------------------------------------------
+# Handle Exceptions
+#------------------------------------------------
+# System Exit occurred. Most likely from argument parser
+except SystemExit as ex:
+     exitcode=ex.code # set return code for stdout
+     exitmessage=str(ex) # set exit message for stdout
+
+except argparse.ArgumentError as exc:
+     exitcode=99 # set return code for stdout
+     exitmessage=str(exc) # set exit message for stdout
+     print('Traceback Info') # output traceback info for stdout
+     traceback.print_exc()
+     sys.exit(99)
+
+except Exception as ex: # Catch and handle exceptions
+     exitcode=99 # set return code for stdout
+     exitmessage=str(ex) # set exit message for stdout
+     print('Traceback Info') # output traceback info for stdout
+     traceback.print_exc()
+     sys.exit(99)
+#------------------------------------------------
+# Always perform final processing
+#------------------------------------------------
+finally: # Final processing
+     # A partly cloned database is dropped so the clone can run again
+     if (clonecreated==True):
+        try:
+           pypostgresclone.runsql(f"drop database if exists {pypostgresclone.quoteident(parmdbname)}",connargs,cloneenv)
+           print(f"INFO:Removed partly cloned database {parmdbname} after processing.")
+        except Exception as ex:
+           print(f"ERROR: Partly cloned database {parmdbname} could not be removed. {ex}")
+
+     # Do any final code and exit now
+     # We log as much relevent info to STDOUT as needed
+     print("")
+     print(dashes)
+     print('ExitCode:' + str(exitcode))
+     print('ExitMessage:' + exitmessage)
+     print(f"End of Main Processing -  {time.strftime('%H:%M:%S')}")
+     print(dashes)
+
+     # Write the metrics files. Phases still open failed with the script.
+     # A failing metrics write must not replace the exit code and message.
+     if metrics is not None:
+        try:
+           metrics.finish(exitcode)
+        except Exception as ex:
+           print(f"INFO:Metrics files could not be written. {ex}")
+
+     # Exit the script now
+     sys.exit(exitcode)
@@ -0,0 +1,443 @@
+#------------------------------------------------
+# Script name: pypostgresapi.py
+#
+# Description:
+# Importable asyncio API for PostgreSQL backups and restores. The same backups
+# and restores as pybackuppostgres.py and pyrestorepostgres.py can be run from
+# one long running Python process, such as pyschedulepostgres.py, without
+# starting a Python interpreter for each job. pg_dump, pg_restore, createdb
+# and tar are started with asyncio.create_subprocess_exec and many jobs can
+# run on one event loop. Blocking work (file writes, compression, tar header
+# checks) runs in worker threads so the event loop stays responsive.
+#
+# Supported:
+# backup - tar format streamed through gzip/zstd/lz4 with stream or tar verify,
+#   and directory format with parallel pg_dump jobs.
+# restore - newdb, overwritedb and restoreasdb actions from tar files, compressed
+#   tar files and directory format backups, with parallel pg_restore jobs and
+#   the fast restore settings of pypostgresfast.py.
+# Repository, shards and object storage backups are only available from the scripts.
+# Backups are recorded in the pypostgrescatalog.py backup catalog with catalog=.
+# Tar backups are rate limited with a pypostgresthrottle.py MB/s schedule in
+# maxmbps= and back off with maxload= and maxlag=. Directory backups reject them.
+#
+# Example:
+# import asyncio, pypostgresapi
+# result=asyncio.run(pypostgresapi.backup("mydb","/backup/@@dbdatetime.tar",compress="zstd"))
+# print(result["exitcode"],result["exitmessage"])
+#
+# Every function returns a result dictionary with exitcode (0=Success, 99=Error)
+# and exitmessage like the ExitCode and ExitMessage lines of the scripts.
+#
+# Pip packages needed:
+#------------------------------------------------
+
+#------------------------------------------------
+# Imports and Environment setup
+#------------------------------------------------
+import asyncio
+import os
+import os.path
+import shutil
+import tempfile
+import time
+import pypostgrescatalog
+import pypostgresfast
+import pypostgresshards
+import pypostgresstream
+import pypostgresthrottle
+import pypostgrestoc
+
+# Number of pg_dump/pg_restore stderr lines kept for error messages
+STDERRLINES=20
+
+#------------------------------------------------
+# Define some useful functions
+#------------------------------------------------
+
+def expandoutputfile(outputfile,dbname):
+    #-------------------------------------------------------
+    # Function: expandoutputfile
+    # Desc: Replace the special output file name keywords
+    # :outputfile: Output file name. Ex: /tmp/@@dbdatetime.tar
+    # :dbname: Database name
+    # :return: Output file name
+    #-------------------------------------------------------
+    outputfile=outputfile.replace("@@datetime",time.strftime('%Y%m%d-%H%M%S'))
+    outputfile=outputfile.replace("@@DATETIME",time.strftime('%Y%m%d-%H%M%S'))
+    outputfile=outputfile.replace("@@dbdatetime",dbname + "-" + time.strftime('%Y%m%d-%H%M%S'))
+    outputfile=outputfile.replace("@@DBDATETIME",dbname + "_" + time.strftime('%Y%m%d-%H%M%S'))
+    return outputfile
+
+async def readstderr(stream,lines):
+    #-------------------------------------------------------
+    # Function: readstderr
+    # Desc: Read a child process stderr and keep the last lines
+    # :stream: asyncio stderr stream
+    # :lines: List to keep the last STDERRLINES lines in
+    #-------------------------------------------------------
+    while True:
+        line=await stream.readline()
+        if not line:
+            break
+        lines.append(line.decode(errors="replace").rstrip())
+        if (len(lines) > STDERRLINES):
+            del lines[0]
+
+async def runcommand(args,env,src=None):
+    #-------------------------------------------------------
+    # Function: runcommand
+    # Desc: Run a command and optionally feed a readable
+    #       stream to its stdin
+    # :args: Command argument list
+    # :env: Environment for the command
+    # :src: Readable binary stream to send to stdin. None=No stdin
+    # :return: (return code,last stderr lines)
+    #-------------------------------------------------------
+    proc=await asyncio.create_subprocess_exec(*args,stdin=asyncio.subprocess.PIPE if src is not None else asyncio.subprocess.DEVNULL,
+                                              stdout=asyncio.subprocess.DEVNULL,stderr=asyncio.subprocess.PIPE,env=env)
+    lines=[]
+    stderrtask=asyncio.create_task(readstderr(proc.stderr,lines))
+    try:
+        if src is not None:
+            try:
+                while True:
+                    data=await asyncio.to_thread(src.read,pypostgresstream.BUFFERSIZE)
+                    if not data:
+                        break
+                    proc.stdin.write(data)
+                    await proc.stdin.drain()
+            except (BrokenPipeError,ConnectionResetError):
+                # Command quit early. Its return code tells why.
+                pass
+            finally:
+                proc.stdin.close()
+        await stderrtask
+        return (await proc.wait(),lines)
+    finally:
+        await stopprocess(proc,stderrtask)
+
+async def stopprocess(proc,stderrtask):
+    #-------------------------------------------------------
+    # Function: stopprocess
+    # Desc: Kill a command left running by an error or a
+    #       cancelled job and wait for it and its stderr reader
+    #       so no process or task is left behind
+    # :proc: asyncio subprocess
+    # :stderrtask: Task reading the command stderr
+    #-------------------------------------------------------
+    if (proc.returncode is None):
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+        # wait() only returns when the pipes are closed too, so unread output
+        # of the killed command is drained
+        if proc.stdout is not None:
+            while await proc.stdout.read(pypostgresstream.BUFFERSIZE):
+                pass
+        await proc.wait()
+    if not stderrtask.done():
+        await stderrtask
+
+def failure(result,message,lines=None):
+    #-------------------------------------------------------
+    # Function: failure
+    # Desc: Set the error exit code and message of a result
+    # :result: Result dictionary
+    # :message: Error message
+    # :lines: Last stderr lines of the failed command
+    # :return: Result dictionary
+    #-------------------------------------------------------
+    result["exitcode"]=99
+    result["exitmessage"]=message
+    if lines:
+        result["exitmessage"]+=". " + " | ".join(lines[-3:])
+    return result
+
+async def backup(dbname,outputfile,dbhost="",dbport=5432,dbuser="postgres",dbpass="",format="tar",jobs=1,
+                 compress="none",compresslevel=0,compressmode="auto",verify="stream",replace=False,maxmbps=0,catalog="",
+                 maxload=0,maxlag=0):
+    #-------------------------------------------------------
+    # Function: backup
+    # Desc: Back up a database with pg_dump. Parameters are the
+    #       same as the pybackuppostgres.py parameters.
+    # :dbname: Database name
+    # :outputfile: Output file or directory. Special keywords
+    #              like @@dbdatetime are replaced.
+    # :format: tar or directory
+    # :verify: stream, tar or none
+    # :maxmbps: MB/s or MB/s schedule. Ex: 50,01:00-05:00=300. Tar format only
+    # :maxload: Load average to back off the rate at. 0=None. Tar format only
+    # :maxlag: Replication lag seconds to back off at. 0=None. Tar format only
+    # :catalog: SQLite backup catalog file to record the backup
+    #           in. Blank=No catalog
+    # :return: Result dictionary with exitcode, exitmessage,
+    #          outputfile, bytes, seconds and sha256
+    #-------------------------------------------------------
+    result=await backupfile(dbname,outputfile,dbhost,dbport,dbuser,dbpass,format,jobs,
+                            compress,compresslevel,compressmode,verify,replace,maxmbps,catalog,maxload,maxlag)
+    if (catalog!="" and result.get("catalogid",0) > 0):
+        try:
+            await asyncio.to_thread(endcatalogbackup,catalog,result)
+        except Exception as ex:
+            failure(result,f"Backup could not be recorded in catalog {catalog}. {ex}")
+    return result
+
+def endcatalogbackup(catalog,result):
+    #-------------------------------------------------------
+    # Function: endcatalogbackup
+    # Desc: Record the end of a backup in the catalog
+    # :catalog: SQLite backup catalog file
+    # :result: Backup result dictionary
+    #-------------------------------------------------------
+    backupcatalog=pypostgrescatalog.Catalog(catalog)
+    if (result["exitcode"]==0):
+        if (result["sha256"]==""):
+            result["sha256"]=pypostgrescatalog.backupchecksum(result["outputfile"])
+        backupcatalog.endbackup(result["catalogid"],"complete",os.path.abspath(result["outputfile"]),result["bytes"],
+                                result["seconds"],result["sha256"],result["exitmessage"])
+    else:
+        backupcatalog.endbackup(result["catalogid"],"failed",os.path.abspath(result["outputfile"]),0,
+                                result["seconds"],"",result["exitmessage"])
+    backupcatalog.close()
+
+def startcatalogbackup(catalog,dbname,dbhost,format,outputfile):
+    #-------------------------------------------------------
+    # Function: startcatalogbackup
+    # Desc: Record a backup as running in the catalog
+    # :return: Backup id
+    #-------------------------------------------------------
+    backupcatalog=pypostgrescatalog.Catalog(catalog)
+    backupid=backupcatalog.startbackup(dbname,dbhost,format,os.path.abspath(outputfile))
+    backupcatalog.close()
+    return backupid
+
+async def backupfile(dbname,outputfile,dbhost,dbport,dbuser,dbpass,format,jobs,
+                     compress,compresslevel,compressmode,verify,replace,maxmbps,catalog,maxload=0,maxlag=0):
+    #-------------------------------------------------------
+    # Function: backupfile
+    # Desc: Back up a database with pg_dump for backup. The
+    #       catalog records are written by backup.
+    # :return: Result dictionary
+    #-------------------------------------------------------
+    starttime=time.monotonic()
+    outputfile=expandoutputfile(outputfile,dbname)
+    if (format=="tar" and compress in pypostgresstream.CODECS and outputfile.endswith(pypostgresstream.CODECS[compress]["extension"])==False):
+        outputfile=outputfile + pypostgresstream.CODECS[compress]["extension"]
+    result={"action":"backup","dbname":dbname,"dbhost":dbhost,"exitcode":0,"exitmessage":"",
+            "outputfile":outputfile,"bytes":0,"seconds":0,"sha256":""}
+    backoff=None
+    try:
+        if (format != "tar" and format != "directory"):
+            return failure(result,"Format must be: tar or directory")
+        if (compress != "none" and compress not in pypostgresstream.CODECS):
+            return failure(result,"Compress must be: none, gzip, zstd or lz4")
+        # pg_dump writes directory format files itself so nothing can be throttled
+        if (format=="directory" and pypostgresthrottle.scheduled(pypostgresthrottle.parseschedule(maxmbps))):
+            return failure(result,"Max MB/s can only be used with tar format")
+        if ((float(maxload) > 0 or float(maxlag) > 0) and format != "tar"):
+            return failure(result,"Max load and max lag can only be used with tar format")
+        if os.path.exists(outputfile):
+            if (replace==False):
+                return failure(result,f"Output file {outputfile} already exists and replace not selected. Process cancelled.")
+            if os.path.isdir(outputfile):
+                shutil.rmtree(outputfile)
+            else:
+                os.remove(outputfile)
+        if (catalog!=""):
+            result["catalogid"]=await asyncio.to_thread(startcatalogbackup,catalog,dbname,dbhost,format,outputfile)
+        env=dict(os.environ,PGPASSWORD=dbpass)
+        connargs=pypostgresshards.connectionargs(dbhost,dbport,dbuser)
+
+        if (format=="directory"):
+            compressargs=[]
+            if (compress=="gzip"):
+                compressargs=["-Z",str(compresslevel if compresslevel > 0 else pypostgresstream.CODECS["gzip"]["level"])]
+            elif (compress!="none"):
+                compressargs=[f"--compress={compress}:{compresslevel if compresslevel > 0 else pypostgresstream.CODECS[compress]['level']}"]
+            (rtncmd,lines)=await runcommand(["pg_dump","-F","d","-j",str(jobs),"-d",dbname] + connargs + compressargs +
+                                            ["--verbose","-f",outputfile],env)
+            if (rtncmd != 0):
+                return failure(result,f"Error {rtncmd} occurred while running pg_dump",lines)
+            if (verify!="none"):
+                (rtncmd,verifylines)=await runcommand(["pg_restore","-l",outputfile],env)
+                if (rtncmd != 0):
+                    return failure(result,f"Error {rtncmd} occurred while verifying backup directory {outputfile}",verifylines)
+            result["bytes"]=sum(os.path.getsize(os.path.join(root,name)) for root, dirs, files in os.walk(outputfile) for name in files)
+        else:
+            # Stream pg_dump output through the compressor into the output file.
+            # Writes, compression and tar header checks run in a worker thread.
+            proc=await asyncio.create_subprocess_exec("pg_dump","-F","t","-d",dbname,*connargs,"--verbose",
+                                                      stdout=asyncio.subprocess.PIPE,stderr=asyncio.subprocess.PIPE,env=env)
+            lines=[]
+            stderrtask=asyncio.create_task(readstderr(proc.stderr,lines))
+            # A failed write or compressor stops reading pg_dump output. pg_dump
+            # is killed then so it does not keep its snapshot and connection open.
+            try:
+                verifier=pypostgresstream.TarStreamVerifier()
+                # The backoff checks run in their own thread. The limiter only
+                # returns the wait so the event loop is not blocked.
+                backoff=pypostgresthrottle.Backoff(float(maxload),float(maxlag),
+                                                   lambda: pypostgresthrottle.replicationlag(connargs,env)).start()
+                limiter=pypostgresthrottle.TokenBucket(pypostgresthrottle.parseschedule(maxmbps),backoff)
+                with open(outputfile,"wb") as outfile:
+                    hashingwriter=pypostgresstream.HashingWriter(outfile)
+                    writer=hashingwriter
+                    compressor=None
+                    if (compress!="none"):
+                        compressor=await asyncio.to_thread(pypostgresstream.opencompressor,compress,compresslevel,compressmode,hashingwriter)
+                        writer=compressor
+                    if (verify=="stream"):
+                        writer=pypostgresstream.TeeWriter(verifier,writer)
+                    while True:
+                        data=await proc.stdout.read(pypostgresstream.BUFFERSIZE)
+                        if not data:
+                            break
+                        await asyncio.to_thread(writer.write,data)
+                        if limiter.enabled():
+                            await asyncio.sleep(limiter.reserve(len(data)))
+                    if compressor is not None:
+                        await asyncio.to_thread(compressor.close)
+                await stderrtask
+                rtncmd=await proc.wait()
+            finally:
+                await stopprocess(proc,stderrtask)
+            if (rtncmd != 0):
+                if (os.path.isfile(outputfile) and os.path.getsize(outputfile)==0):
+                    os.remove(outputfile)
+                return failure(result,f"Error {rtncmd} occurred while running pg_dump",lines)
+            result["bytes"]=hashingwriter.byteswritten
+            result["sha256"]=hashingwriter.sha256.hexdigest()
+            if (verify=="stream"):
+                verifyerrors=verifier.verify()
+                if (len(verifyerrors) > 0):
+                    return failure(result,f"Stream verify failed for backup {outputfile}: {'; '.join(verifyerrors)}")
+                await asyncio.to_thread(pypostgresstream.writemanifest,f"{outputfile}.manifest.json",outputfile,hashingwriter,verifier,compress)
+            elif (verify=="tar"):
+                with open(outputfile,"rb") as infile:
+                    (rtncmd,verifylines)=await runcommand(["tar","-tf","-"],env,pypostgresstream.opendecompressor(compress,compressmode,infile))
+                if (rtncmd != 0):
+                    return failure(result,f"Error {rtncmd} occurred while verifying backup {outputfile}",verifylines)
+        result["exitmessage"]=f"Backup of database {dbname} completed successfully to output {outputfile}"
+        return result
+    except Exception as ex:
+        return failure(result,str(ex))
+    finally:
+        if backoff is not None:
+            await asyncio.to_thread(backoff.stop)
+        result["seconds"]=round(time.monotonic()-starttime,3)
+
+async def restore(action,dbname,inputfile,dbhost="",dbport=5432,dbuser="postgres",dbpass="",jobs=1,
+                  compressmode="auto",workdir="",fast=False,unlogged="none",maintmem="1GB"):
+    #-------------------------------------------------------
+    # Function: restore
+    # Desc: Restore a database with pg_restore. Parameters are
+    #       the same as the pyrestorepostgres.py parameters.
+    # :action: newdb, overwritedb or restoreasdb
+    # :dbname: Database name to restore into
+    # :inputfile: Tar file, compressed tar file or directory backup
+    # :jobs: Parallel pg_restore jobs. Tar files are unpacked
+    #        into workdir first when greater than 1.
+    # :fast: True=Fast restore with bulk load settings, each
+    #        section by itself and an analyze at the end
+    # :unlogged: none, load or keep. load needs wal_level=minimal. See pypostgresfast.py
+    # :return: Result dictionary with exitcode, exitmessage,
+    #          inputfile and seconds
+    #-------------------------------------------------------
+    starttime=time.monotonic()
+    result={"action":"restore","dbname":dbname,"dbhost":dbhost,"exitcode":0,"exitmessage":"",
+            "inputfile":inputfile,"seconds":0}
+    unpackdir=""
+    try:
+        if (action != "newdb" and action != "overwritedb" and action != "restoreasdb"):
+            return failure(result,"Action must be: newdb, overwritedb or restoreasdb")
+        if (os.path.exists(inputfile)==False):
+            return failure(result,f"Input file {inputfile} not found. Restore cancelled.")
+        if (unlogged not in pypostgresfast.UNLOGGEDMODES):
+            return failure(result,"Unlogged must be: none, load or keep")
+        if (fast==True and action=="overwritedb"):
+            return failure(result,"Fast restore is only for newdb and restoreasdb actions")
+        if (fast==False and unlogged!="none"):
+            return failure(result,"Unlogged needs fast restore")
+        env=dict(os.environ,PGPASSWORD=dbpass)
+        if (fast==True):
+            env=pypostgresfast.sessionenv(env,maintmem)
+        connargs=pypostgresshards.connectionargs(dbhost,dbport,dbuser)
+        unloggederror=await asyncio.to_thread(pypostgresfast.checkunlogged,unlogged,connargs,env)
+        if (unloggederror!=""):
+            return failure(result,unloggederror)
+        inputcodec=pypostgresstream.codecfromfilename(inputfile) if os.path.isfile(inputfile) else "none"
+        restoreinput=inputfile
+        restorestream=(inputcodec!="none")
+
+        # Unpack tar files for a parallel restore
+        if (jobs > 1 and os.path.isfile(inputfile)):
+            unpackdir=tempfile.mkdtemp(prefix="pyrestore-",dir=workdir if workdir!="" else os.path.dirname(os.path.abspath(inputfile)))
+            with open(inputfile,"rb") as infile:
+                (rtncmd,lines)=await runcommand(["tar","-xf","-","-C",unpackdir],env,pypostgresstream.opendecompressor(inputcodec,compressmode,infile))
+            if (rtncmd != 0):
+                return failure(result,f"Error {rtncmd} occurred while unpacking backup file {inputfile}",lines)
+            restoreinput=""
+            for root, dirs, files in os.walk(unpackdir):
+                if "toc.dat" in files:
+                    restoreinput=root
+                    break
+            if (restoreinput==""):
+                return failure(result,f"No toc.dat found after unpacking backup file {inputfile}. Restore cancelled.")
+            restorestream=False
+
+        if (action!="overwritedb"):
+            (rtncmd,lines)=await runcommand(["createdb"] + connargs + [dbname],env)
+            if (rtncmd != 0):
+                return failure(result,f"Error {rtncmd} occurred while running createdb command",lines)
+
+        cleanargs=["--clean"] if action=="overwritedb" else []
+        inputargs=["-F","t"] if restorestream else [restoreinput]
+        restorebase=["pg_restore","-d",dbname] + connargs + ["--verbose"]
+        if (fast==True):
+            jobsargs=["-j",str(jobs)] if (restorestream==False and os.path.isdir(restoreinput) and jobs > 1) else []
+            sections=[("pre-data",restorebase + ["--section=pre-data"] + inputargs),
+                      ("data",restorebase + ["--section=data"] + jobsargs + inputargs),
+                      ("post-data",restorebase + ["--section=post-data"] + jobsargs + inputargs)]
+        elif (jobs==1):
+            sections=[("all sections",restorebase + cleanargs + inputargs)]
+        else:
+            sections=[("pre-data",restorebase + ["--section=pre-data"] + inputargs),
+                      ("data and post-data",restorebase + ["--section=data","--section=post-data","-j",str(jobs)] + inputargs)]
+            # --clean on the pre-data run alone cannot drop tables the post-data
+            # foreign keys and indexes depend on. Drop every archive object first.
+            if (action=="overwritedb"):
+                (rtncmd,lines)=await asyncio.to_thread(pypostgrestoc.dropobjects,restoreinput,dbname,connargs,env)
+                if (rtncmd != 0):
+                    return failure(result,f"Error {rtncmd} occurred while dropping existing objects in database {dbname}",lines)
+        for (section,args) in sections:
+            # Tables are logged again before the indexes get built
+            if (section=="post-data" and unlogged=="load"):
+                rtncmd=await asyncio.to_thread(pypostgresfast.setpersistence,dbname,connargs,env,True,jobs)
+                if (rtncmd != 0):
+                    return failure(result,f"Error {rtncmd} occurred while setting tables logged")
+            if restorestream:
+                with open(inputfile,"rb") as infile:
+                    (rtncmd,lines)=await runcommand(args,env,pypostgresstream.opendecompressor(inputcodec,compressmode,infile))
+            else:
+                (rtncmd,lines)=await runcommand(args,env)
+            if (rtncmd != 0):
+                return failure(result,f"Error {rtncmd} occurred while running pg_restore command for {section}",lines)
+            # Tables are unlogged once created so the data loads without WAL
+            if (section=="pre-data" and unlogged!="none"):
+                rtncmd=await asyncio.to_thread(pypostgresfast.setpersistence,dbname,connargs,env,False,jobs)
+                if (rtncmd != 0):
+                    return failure(result,f"Error {rtncmd} occurred while setting tables unlogged")
+        if (fast==True):
+            (rtncmd,lines)=await runcommand(["vacuumdb","--analyze-only","-j",str(jobs),"-d",dbname] + connargs,env)
+            if (rtncmd != 0):
+                return failure(result,f"Error {rtncmd} occurred while running vacuumdb analyze",lines)
+        result["exitmessage"]=f"Restore completed successfully to database {dbname} from file {inputfile}"
+        return result
+    except Exception as ex:
+        return failure(result,str(ex))
+    finally:
+        if (unpackdir!=""):
+            shutil.rmtree(unpackdir,ignore_errors=True)
+        result["seconds"]=round(time.monotonic()-starttime,3)
@@ -0,0 +1,326 @@
+#------------------------------------------------
+# Script name: pypostgresbenchstub.py
+#
+# Description:
+# Stub PostgreSQL client programs used by pybenchpostgres.py when no local
+# PostgreSQL cluster is available. pybenchpostgres.py writes small pg_dump,
+# pg_restore, psql, createdb and dropdb wrapper scripts that run this file with
+# the program name as the first argument. The stubs produce realistic byte
+# streams so the backup and restore scripts can be measured end to end:
+#
+# pg_dump -F t writes a tar archive to stdout with toc.dat, one <dumpid>.dat
+#   COPY text member per table and restore.sql, like a real pg_dump tar file.
+# pg_dump -F d writes a directory archive with <dumpid>.dat or .dat.gz files.
+# pg_dump -F c writes one file with the data of the selected tables.
+# pg_restore reads the whole archive from stdin, a file or a directory and
+#   writes --verbose lines as it goes. pg_restore -l lists the table data items.
+# psql answers the catalog table size, sequence and pg_export_snapshot queries.
+# createdb and dropdb do nothing.
+# generate writes the table data files for the pg_dump stub.
+#
+# The synthetic database is described by the JSON file named in the
+# BENCHSTUBCONFIG environment variable:
+# {"tables":[{"schema":"public","name":"t0001","rows":1000,"columns":4}],
+#  "datadir":"/tmp/pybench/stubdata"}
+# Table data is generated from a fixed seed per table so every dump of the
+# same table gives the same bytes. The generate program writes it once into
+# the datadir so the stub pg_dump only reads files and does not slow the runs.
+#
+# Pip packages needed:
+#------------------------------------------------
+
+#------------------------------------------------
+# Imports and Environment setup
+#------------------------------------------------
+import gzip
+import hashlib
+import io
+import json
+import os
+import os.path
+import random
+import sys
+import tarfile
+import time
+
+# First dump id used for table data members. Ex: 3000.dat
+FIRSTDUMPID=3000
+
+# Size of each read of the archive by pg_restore
+READSIZE=1024*1024
+
+#------------------------------------------------
+# Define some useful functions
+#------------------------------------------------
+
+def readconfig():
+    #-------------------------------------------------------
+    # Function: readconfig
+    # Desc: Read the synthetic database description
+    # :return: Config dictionary
+    #-------------------------------------------------------
+    with open(os.environ["BENCHSTUBCONFIG"],"r") as infile:
+        return json.load(infile)
+
+def tabledata(table,index):
+    #-------------------------------------------------------
+    # Function: tabledata
+    # Desc: Generate COPY text for a table. A bigint id and
+    #       32 character hex text columns like md5() values.
+    # :table: Table dictionary from the config
+    # :index: Table index used as the random seed
+    # :return: COPY data bytes ending with the \. marker
+    #-------------------------------------------------------
+    rand=random.Random(index)
+    lines=[]
+    for row in range(1,table["rows"] + 1):
+        lines.append(str(row) + "\t" + "\t".join(f"{rand.getrandbits(128):032x}" for column in range(table["columns"])))
+    return ("\n".join(lines) + "\n\\.\n").encode()
+
+def readtabledata(config,table,index):
+    #-------------------------------------------------------
+    # Function: readtabledata
+    # Desc: Get COPY text for a table from the datadir or
+    #       generate it if writedata was not run
+    # :config: Config dictionary
+    # :table: Table dictionary from the config
+    # :index: Table index
+    # :return: COPY data bytes
+    #-------------------------------------------------------
+    datafile=os.path.join(config.get("datadir",""),f"{index}.dat")
+    if (config.get("datadir","")!="" and os.path.isfile(datafile)):
+        with open(datafile,"rb") as infile:
+            return infile.read()
+    return tabledata(table,index)
+
+def generate():
+    #-------------------------------------------------------
+    # Function: generate
+    # Desc: Generate the table data files into the datadir
+    # :return: Return code
+    #-------------------------------------------------------
+    config=readconfig()
+    datadir=config["datadir"]
+    if os.path.isdir(datadir):
+        for name in os.listdir(datadir):
+            os.remove(os.path.join(datadir,name))
+    os.makedirs(datadir,exist_ok=True)
+    for (index,table) in enumerate(config["tables"]):
+        with open(os.path.join(datadir,f"{index}.dat"),"wb") as outfile:
+            outfile.write(tabledata(table,index))
+    return 0
+
+def tablesize(table):
+    #-------------------------------------------------------
+    # Function: tablesize
+    # Desc: COPY text size of a table without generating it
+    # :table: Table dictionary from the config
+    # :return: Bytes
+    #-------------------------------------------------------
+    rows=table["rows"]
+    digits=0
+    width=1
+    while (10 ** (width - 1) <= rows):
+        digits+=(min(rows,10 ** width - 1) - 10 ** (width - 1) + 1) * width
+        width+=1
+    return digits + rows * (table["columns"] * 33 + 1) + 3
+
+def optionvalue(args,short,long):
+    #-------------------------------------------------------
+    # Function: optionvalue
+    # Desc: Get a command line option value. Accepts -F t,
+    #       -Ft, --format t and --format=t styles.
+    # :args: Command line arguments
+    # :short: Short option. Ex: -F
+    # :long: Long option. Ex: --format
+    # :return: List of values in command line order
+    #-------------------------------------------------------
+    values=[]
+    for (pos,arg) in enumerate(args):
+        if (arg==short or arg==long) and pos + 1 < len(args):
+            values.append(args[pos + 1])
+        elif arg.startswith(long + "="):
+            values.append(arg[len(long) + 1:])
+        elif arg.startswith(short) and arg!=short and not arg.startswith("--"):
+            values.append(arg[len(short):])
+    return values
+
+def selectedtables(config,args):
+    #-------------------------------------------------------
+    # Function: selectedtables
+    # Desc: Tables selected with pg_dump -t or all tables
+    # :return: List of (index,table) tuples
+    #-------------------------------------------------------
+    patterns=[pattern.replace('"','') for pattern in optionvalue(args,"-t","--table")]
+    tables=list(enumerate(config["tables"]))
+    if (len(patterns)==0):
+        return tables
+    return [(index,table) for (index,table) in tables if f"{table['schema']}.{table['name']}" in patterns]
+
+def verbose(program,message):
+    sys.stderr.write(f"{program}: {message}\n")
+    sys.stderr.flush()
+
+def pgdump(args):
+    #-------------------------------------------------------
+    # Function: pgdump
+    # Desc: Stub pg_dump
+    # :args: Command line arguments
+    # :return: Return code
+    #-------------------------------------------------------
+    config=readconfig()
+    dumpformat=(optionvalue(args,"-F","--format") or ["p"])[0][0]
+    outputfile=(optionvalue(args,"-f","--file") or [""])[0]
+    tables=[] if "--schema-only" in args else selectedtables(config,args)
+    # gzip is the only codec the stub applies. zstd and lz4 level data is written uncompressed.
+    level=0
+    for value in optionvalue(args,"-Z","--compress"):
+        if value.isdigit():
+            level=int(value)
+        elif value.startswith("gzip"):
+            level=int(value.split(":")[1]) if ":" in value else 6
+    parallel=int((optionvalue(args,"-j","--jobs") or ["1"])[0]) > 1
+    toc=b"PGDMP" + json.dumps([f"{table['schema']}.{table['name']}" for (index,table) in tables]).encode()
+    if (dumpformat=="t"):
+        with tarfile.open(fileobj=sys.stdout.buffer,mode="w|",format=tarfile.USTAR_FORMAT) as tar:
+            def addmember(name,data):
+                info=tarfile.TarInfo(name)
+                info.size=len(data)
+                info.mtime=int(time.time())
+                tar.addfile(info,io.BytesIO(data))
+            addmember("toc.dat",toc)
+            for (index,table) in tables:
+                verbose("pg_dump",f'dumping contents of table "{table["schema"]}.{table["name"]}"')
+                addmember(f"{FIRSTDUMPID + index}.dat",readtabledata(config,table,index))
+            addmember("restore.sql",b"-- restore script\n")
+    elif (dumpformat=="d"):
+        os.makedirs(outputfile)
+        with open(os.path.join(outputfile,"toc.dat"),"wb") as outfile:
+            outfile.write(toc)
+        for (index,table) in tables:
+            verbose("pg_dump",f'dumping contents of table "{table["schema"]}.{table["name"]}"')
+            data=readtabledata(config,table,index)
+            datafile=os.path.join(outputfile,f"{FIRSTDUMPID + index}.dat")
+            if (level > 0):
+                with gzip.open(datafile + ".gz","wb",compresslevel=level) as outfile:
+                    outfile.write(data)
+            else:
+                with open(datafile,"wb") as outfile:
+                    outfile.write(data)
+            if parallel:
+                verbose("pg_dump",f"finished item {FIRSTDUMPID + index} TABLE DATA {table['name']}")
+    else:
+        outfile=open(outputfile,"wb") if outputfile!="" else sys.stdout.buffer
+        writer=gzip.GzipFile(fileobj=outfile,mode="wb",compresslevel=level) if level > 0 else outfile
+        writer.write(toc)
+        for (index,table) in tables:
+            verbose("pg_dump",f'dumping contents of table "{table["schema"]}.{table["name"]}"')
+            writer.write(readtabledata(config,table,index))
+        if (level > 0):
+            writer.close()
+        outfile.close()
+    return 0
+
+def pgrestore(args):
+    #-------------------------------------------------------
+    # Function: pgrestore
+    # Desc: Stub pg_restore
+    # :args: Command line arguments
+    # :return: Return code
+    #-------------------------------------------------------
+    config=readconfig()
+    # Archive file or directory is the last argument. Tar archives come in on stdin with -F t.
+    inputpath=args[-1] if len(args) > 0 and os.path.exists(args[-1]) and args[-2:-1]!=["-F"] else ""
+    if ("-l" in args or "--list" in args):
+        for (index,table) in enumerate(config["tables"]):
+            print(f"{FIRSTDUMPID + index}; 0 {16384 + index} TABLE DATA {table['schema']} {table['name']} postgres")
+        return 0
+    sections=optionvalue(args,"--section","--section") or ["pre-data","data","post-data"]
+    if ("--data-only" in args or "-a" in args):
+        sections=["data"]
+    parallel=int((optionvalue(args,"-j","--jobs") or ["1"])[0]) > 1
+    # Read the whole archive like pg_restore does
+    if (inputpath!="" and os.path.isdir(inputpath)):
+        streams=[open(os.path.join(inputpath,name),"rb") for name in sorted(os.listdir(inputpath))]
+    elif (inputpath!=""):
+        streams=[open(inputpath,"rb")]
+    else:
+        streams=[sys.stdin.buffer]
+    if "pre-data" in sections:
+        for table in config["tables"]:
+            verbose("pg_restore",f'creating TABLE "{table["schema"]}.{table["name"]}"')
+    # Report each table as the bytes read pass its share of the archive
+    tables=list(enumerate(config["tables"]))
+    tablestarts=[]
+    tablestart=0
+    for (index,table) in tables:
+        tablestarts.append(tablestart)
+        tablestart+=tablesize(table)
+    bytesread=0
+    nexttable=0
+    for stream in streams:
+        while True:
+            data=stream.read(READSIZE)
+            if not data:
+                break
+            bytesread+=len(data)
+            while ("data" in sections and nexttable < len(tables) and tablestarts[nexttable] <= bytesread):
+                (index,table)=tables[nexttable]
+                verbose("pg_restore",f'processing data for table "{table["schema"]}.{table["name"]}"')
+                if parallel:
+                    verbose("pg_restore",f"finished item {FIRSTDUMPID + index} TABLE DATA {table['schema']} {table['name']}")
+                nexttable+=1
+        stream.close()
+    if "post-data" in sections:
+        for table in config["tables"]:
+            verbose("pg_restore",f'creating CONSTRAINT "{table["schema"]}.{table["name"]} {table["name"]}_pkey"')
+    return 0
+
+def psql(args):
+    #-------------------------------------------------------
+    # Function: psql
+    # Desc: Stub psql. Answers the queries used by the backup
+    #       scripts and ignores everything else.
+    # :args: Command line arguments
+    # :return: Return code
+    #-------------------------------------------------------
+    config=readconfig()
+    commands=optionvalue(args,"-c","--command")
+    if (len(commands) > 0):
+        sql=commands[0]
+    else:
+        # The snapshot session keeps stdin open so stop reading at the export
+        sql=""
+        for line in sys.stdin:
+            sql+=line
+            if "pg_export_snapshot" in line:
+                break
+    if "pg_export_snapshot" in sql:
+        print("00000003-0000001B-1",flush=True)
+        # Hold the snapshot until the session is closed
+        sys.stdin.read()
+    elif "relkind='r'" in sql:
+        for table in config["tables"]:
+            print(f"{table['schema']}\t{table['name']}\t{tablesize(table)}")
+    elif "pg_database" in sql:
+        print(os.environ.get("BENCHSTUBDBNAME","pybench"))
+    elif "md5(" in sql:
+        # Schema fingerprint of the shards backup set
+        print(hashlib.md5(",".join(f"{table['schema']}.{table['name']}" for table in config["tables"]).encode()).hexdigest())
+    return 0
+
+#------------------------------------------------
+# Main script logic
+#------------------------------------------------
+if __name__=="__main__":
+    program=sys.argv[1]
+    if (program=="pg_dump"):
+        sys.exit(pgdump(sys.argv[2:]))
+    elif (program=="pg_restore"):
+        sys.exit(pgrestore(sys.argv[2:]))
+    elif (program=="psql"):
+        sys.exit(psql(sys.argv[2:]))
+    elif (program=="generate"):
+        sys.exit(generate())
+    # createdb and dropdb
+    sys.exit(0)
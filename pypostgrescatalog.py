@@ -0,0 +1,331 @@
+#------------------------------------------------
+# Script name: pypostgrescatalog.py
+#
+# Description:
+# Backup catalog for the PostgreSQL backup, restore and retention scripts.
+# Every backup written with --catalog is recorded in a local SQLite database
+# with its database name, path, size, duration, SHA-256 checksum and status,
+# so cleanup and restore lookups are indexed queries instead of directory
+# scans over thousands of backup files.
+#
+# Catalog table backups:
+# id - Backup id
+# dbname, dbhost - Database backed up and the host it was backed up from
+# format - tar, directory, shards or physical
+# path - Backup file or directory. Backup name for a repository backup.
+#   s3://bucket/key object URL for an object storage backup.
+# repository - Backup repository directory or blank
+# status - running, complete, failed or deleted
+# started, ended - Local time. Ex: 2024-07-07 01:02:03
+# seconds, bytes, sha256 - Duration, backup size and checksum. Shards backup sets
+#   use the dump file checksums in their journal and physical backups the SHA-256
+#   of backup_manifest, which has a checksum of every file in the backup.
+# message - Exit message of the backup
+#
+# A backup is recorded as running when it starts and set to complete or
+# failed when it ends. Records left running by a killed backup are treated
+# like failed backups by the retention. Records of backups that were deleted,
+# or replaced by a newer backup written to the same path, are kept as deleted.
+#
+# Grandfather-father-son retention:
+# The newest complete backup of each of the last --daily days, --weekly ISO
+# weeks, --monthly months and --yearly years is kept, plus the last --keeplast
+# backups. Periods without a backup do not count, so a database that was not
+# backed up for a while keeps its older backups. Everything else is deleted.
+# Logical and physical backups are kept apart, each by its own run of the
+# policy, so a physical backup never expires a logical one or the other way
+# around. They restore differently and are not substitutes for each other.
+#
+# Pip packages needed:
+#------------------------------------------------
+
+#------------------------------------------------
+# Imports and Environment setup
+#------------------------------------------------
+import datetime
+import hashlib
+import os
+import os.path
+import shutil
+import sqlite3
+import time
+import pypostgreschunkstore
+import pypostgresobjectstore
+import pypostgresshards
+import pypostgresstream
+import pypostgrestoc
+import pypostgresverify
+import pypostgreswal
+
+# Retention periods. SQL expression for the period of a started timestamp.
+# isoweek is the ISO year and week so a week never gets split at new year.
+PERIODS=(("daily","substr(started,1,10)"),("weekly","isoweek(started)"),
+         ("monthly","substr(started,1,7)"),("yearly","substr(started,1,4)"))
+
+# Seconds to wait for another backup writing to the catalog
+BUSYTIMEOUT=30
+
+#------------------------------------------------
+# Define some useful functions
+#------------------------------------------------
+
+def catalogpath(path):
+    #-------------------------------------------------------
+    # Function: catalogpath
+    # Desc: Get the path to record for a backup. Object URLs
+    #       are kept as they are.
+    # :path: Backup file, directory or object URL
+    # :return: Absolute path or object URL
+    #-------------------------------------------------------
+    if pypostgresobjectstore.isobjecturl(path):
+        return path
+    return os.path.abspath(path)
+
+def pathchecksum(path,jobs=1):
+    #-------------------------------------------------------
+    # Function: pathchecksum
+    # Desc: Get the SHA-256 checksum of a backup file. For a
+    #       directory the checksum covers the relative name
+    #       and SHA-256 of every file in name order.
+    # :path: Backup file or directory
+    # :jobs: Number of directory files hashed at the same time
+    # :return: SHA-256 hex digest or blank if not found
+    #-------------------------------------------------------
+    if os.path.isfile(path):
+        return pypostgresstream.filechecksum(path)
+    if os.path.isdir(path)==False:
+        return ""
+    names=[]
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            names.append(os.path.relpath(os.path.join(root,name),path))
+    checksums=dict(pypostgresshards.runpool(names,max(jobs,1),lambda name: pypostgresstream.filechecksum(os.path.join(path,name))))
+    sha256=hashlib.sha256()
+    for name in sorted(names):
+        sha256.update(f"{checksums[name]}  {name}\n".encode())
+    return sha256.hexdigest()
+
+def backupchecksum(path,jobs=1):
+    #-------------------------------------------------------
+    # Function: backupchecksum
+    # Desc: Get the checksum to record for a backup. Shards
+    #       backup sets and physical backups already have
+    #       checksums of their files so they are not read again.
+    # :path: Backup file or directory
+    # :jobs: Number of directory files hashed at the same time
+    # :return: SHA-256 hex digest or blank if not found
+    #-------------------------------------------------------
+    if os.path.isdir(path):
+        checksum=pypostgresshards.setchecksum(path)
+        if (checksum!=""):
+            return checksum
+        manifestfile=os.path.join(path,"backup_manifest")
+        if (os.path.isfile(manifestfile) and os.path.isfile(os.path.join(path,pypostgreswal.PHYSICALFILE))):
+            return pypostgresstream.filechecksum(manifestfile)
+    return pathchecksum(path,jobs)
+
+def isoweek(started):
+    #-------------------------------------------------------
+    # Function: isoweek
+    # Desc: ISO year and week of a catalog timestamp. SQLite
+    #       strftime only has %G and %V from 3.46.
+    # :started: Local time. Ex: 2024-12-30 01:02:03
+    # :return: ISO year and week. Ex: 2025-01
+    #-------------------------------------------------------
+    (year,week,weekday)=datetime.date.fromisoformat(started[:10]).isocalendar()
+    return f"{year}-{week:02d}"
+
+def removebackup(record,endpoint=""):
+    #-------------------------------------------------------
+    # Function: removebackup
+    # Desc: Delete the files of a cataloged backup with its
+    #       manifest, table of contents index and stats sidecars.
+    #       Repository backups drop their manifest and the
+    #       chunks stay in the repository.
+    # :record: Catalog backup record
+    # :endpoint: Object storage endpoint for object URLs.
+    #            Blank=AWS_ENDPOINT_URL or AWS S3
+    # :return: True if anything was deleted
+    #-------------------------------------------------------
+    removed=False
+    path=record["path"]
+    repository=record["repository"] or ""
+    if (path==""):
+        return False
+    if pypostgresobjectstore.isobjecturl(path):
+        store=pypostgresobjectstore.openstore(endpoint)
+        for url in (path,f"{path}.manifest.json",pypostgresverify.statspath(path)):
+            if store.deleteobject(*pypostgresobjectstore.parseurl(url)):
+                removed=True
+        return removed
+    if (repository!=""):
+        if os.path.isdir(repository)==False:
+            return False
+        removed=pypostgreschunkstore.ChunkStore(repository).deletebackup(path)
+        sidecars=[pypostgrestoc.indexpath(path,repository),pypostgresverify.statspath(path,repository)]
+    else:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+            removed=True
+        elif os.path.isfile(path):
+            os.remove(path)
+            removed=True
+        sidecars=[f"{path}.manifest.json",pypostgrestoc.indexpath(path),pypostgresverify.statspath(path)]
+    for sidecar in sidecars:
+        if os.path.isfile(sidecar):
+            os.remove(sidecar)
+            removed=True
+    return removed
+
+class Catalog:
+    #-------------------------------------------------------
+    # Class: Catalog
+    # Desc: SQLite backup catalog. Creates the catalog on
+    #       first use. Parallel backups can share a catalog.
+    #-------------------------------------------------------
+
+    def __init__(self,catalogfile):
+        self.catalogfile=catalogfile
+        if (os.path.dirname(os.path.abspath(catalogfile))!=""):
+            os.makedirs(os.path.dirname(os.path.abspath(catalogfile)),exist_ok=True)
+        self.db=sqlite3.connect(catalogfile,timeout=BUSYTIMEOUT)
+        self.db.row_factory=sqlite3.Row
+        self.db.create_function("isoweek",1,isoweek)
+        # WAL lets restores and reports read while a backup writes
+        self.db.execute("pragma journal_mode=wal")
+        self.db.execute("""create table if not exists backups (id integer primary key autoincrement,
+                           dbname text not null, dbhost text, format text, path text, repository text,
+                           status text not null, started text not null, ended text,
+                           seconds real, bytes integer, sha256 text, message text)""")
+        self.db.execute("create index if not exists backups_dbname on backups (dbname, status, started)")
+        self.db.execute("create index if not exists backups_status on backups (status, started)")
+        self.db.execute("create index if not exists backups_path on backups (path)")
+        self.db.commit()
+
+    def startbackup(self,dbname,dbhost,format,path,repository=""):
+        #-------------------------------------------------------
+        # Function: startbackup
+        # Desc: Record a backup as running
+        # :dbname: Database name
+        # :dbhost: Database host. Blank=local sockets
+        # :format: tar, directory or shards
+        # :path: Backup file, directory or repository backup name
+        # :repository: Backup repository directory or blank
+        # :return: Backup id
+        #-------------------------------------------------------
+        cursor=self.db.execute("insert into backups (dbname,dbhost,format,path,repository,status,started) values (?,?,?,?,?,?,?)",
+                               (dbname,dbhost,format,path,repository,"running",time.strftime('%Y-%m-%d %H:%M:%S')))
+        # A backup written to the same path replaced the older backup. The retention
+        # must never delete the new backup for an old record of the same path.
+        self.db.execute("update backups set status='deleted', message=? where path=? and repository=? and id<? and status!='deleted'",
+                        (f"Replaced by backup id {cursor.lastrowid}",path,repository,cursor.lastrowid))
+        self.db.commit()
+        return cursor.lastrowid
+
+    def endbackup(self,backupid,status,path,bytes=0,seconds=0,sha256="",message=""):
+        #-------------------------------------------------------
+        # Function: endbackup
+        # Desc: Record the end of a backup
+        # :backupid: Backup id from startbackup
+        # :status: complete or failed
+        # :path: Final backup path. Ex: package file
+        # :bytes: Backup size
+        # :seconds: Backup duration
+        # :sha256: Backup checksum
+        # :message: Exit message
+        #-------------------------------------------------------
+        self.db.execute("update backups set status=?, path=?, bytes=?, seconds=?, sha256=?, message=?, ended=? where id=?",
+                        (status,path,bytes,round(seconds,3),sha256,message,time.strftime('%Y-%m-%d %H:%M:%S'),backupid))
+        self.db.commit()
+
+    def findbackup(self,dbname,backuptime="latest",physical=False):
+        #-------------------------------------------------------
+        # Function: findbackup
+        # Desc: Find the newest complete backup of a database
+        #       started at or before a time. Physical backups
+        #       must have ended by the time to recover to it.
+        # :dbname: Database name
+        # :backuptime: latest or a local time. A partial time
+        #              covers the whole period.
+        #              Ex: 2024-07-07 or 2024-07-07 01:00
+        # :physical: True=Find a physical backup. False=Find a
+        #            tar, directory or shards backup
+        # :return: Backup record or None if not found
+        #-------------------------------------------------------
+        formatfilter="format='physical'" if physical else "format<>'physical'"
+        if (backuptime.strip().lower() in ("","latest")):
+            return self.db.execute(f"select * from backups where dbname=? and status='complete' and {formatfilter} order by started desc limit 1",
+                                   (dbname,)).fetchone()
+        # ~ sorts after every digit so 2024-07-07~ is past the whole day.
+        # A recovery target is a point in time so it is not widened.
+        if physical:
+            return self.db.execute(f"select * from backups where dbname=? and status='complete' and {formatfilter} and ended<=? order by started desc limit 1",
+                                   (dbname,backuptime.strip().replace("T"," "))).fetchone()
+        return self.db.execute(f"select * from backups where dbname=? and status='complete' and {formatfilter} and started<=? order by started desc limit 1",
+                               (dbname,backuptime.strip().replace("T"," ") + "~")).fetchone()
+
+    def getbackup(self,backupid):
+        return self.db.execute("select * from backups where id=?",(backupid,)).fetchone()
+
+    def dbnames(self):
+        #-------------------------------------------------------
+        # Function: dbnames
+        # Desc: List the databases with cataloged backups
+        # :return: List of database names
+        #-------------------------------------------------------
+        return [row[0] for row in self.db.execute("select distinct dbname from backups where status!='deleted' order by dbname")]
+
+    def retention(self,dbname,keeplast=1,daily=7,weekly=4,monthly=12,yearly=0):
+        #-------------------------------------------------------
+        # Function: retention
+        # Desc: Apply a grandfather-father-son policy to the
+        #       complete backups of a database. The logical and
+        #       physical backups each get the whole policy.
+        # :dbname: Database name
+        # :keeplast: Number of newest backups to keep
+        # :daily,weekly,monthly,yearly: Number of periods to keep
+        #       the newest backup of. 0=None
+        # :return: Tuple of (keep,expired). keep maps backup id
+        #          to the list of reasons it is kept. expired is
+        #          the list of backup records to delete.
+        #-------------------------------------------------------
+        keep={}
+        counts={"daily":daily,"weekly":weekly,"monthly":monthly,"yearly":yearly}
+        for formatfilter in ("format<>'physical'","format='physical'"):
+            for row in self.db.execute(f"select id from backups where dbname=? and status='complete' and {formatfilter} order by started desc limit ?",
+                                       (dbname,keeplast)):
+                keep.setdefault(row[0],[]).append("last")
+            for (name,period) in PERIODS:
+                if (counts[name] <= 0):
+                    continue
+                # Newest backup of each period, for the newest periods that have a backup
+                for row in self.db.execute(f"""select id from (select id, {period} as period,
+                                               row_number() over (partition by {period} order by started desc) as newest
+                                               from backups where dbname=? and status='complete' and {formatfilter})
+                                               where newest=1 order by period desc limit ?""",
+                                           (dbname,counts[name])):
+                    keep.setdefault(row[0],[]).append(name)
+        expired=[row for row in self.db.execute("select * from backups where dbname=? and status='complete' order by started",(dbname,))
+                 if row["id"] not in keep]
+        return (keep,expired)
+
+    def stalebackups(self,dbname,days):
+        #-------------------------------------------------------
+        # Function: stalebackups
+        # Desc: List failed backups and backups left running
+        #       that started more than a number of days ago
+        # :dbname: Database name
+        # :days: Age in days
+        # :return: List of backup records
+        #-------------------------------------------------------
+        cutoff=(datetime.datetime.now()-datetime.timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+        return self.db.execute("select * from backups where dbname=? and status in ('failed','running') and started<? order by started",
+                               (dbname,cutoff)).fetchall()
+
+    def markdeleted(self,backupid):
+        self.db.execute("update backups set status='deleted' where id=?",(backupid,))
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,286 @@
+#------------------------------------------------
+# Script name: pypostgreschunkstore.py
+#
+# Description:
+# Deduplicated backup repository used by the PostgreSQL backup and restore
+# scripts. The pg_dump tar stream is split into content-defined chunks, each
+# unique chunk is stored once in the chunk store and every backup is recorded
+# as a manifest listing its chunk hashes in order.
+#
+# Repository layout:
+# <repository>/index.db - SQLite index of stored chunks and backups
+# <repository>/chunks/ab/abcdef... - Chunk files named by SHA-256 hash
+# <repository>/manifests/<backupname>.json - Backup manifests
+#
+# Chunking:
+# Chunk boundaries are only considered at newlines, which is where COPY rows
+# end in pg_dump table data. A boundary is cut when the CRC-32 of the bytes
+# leading up to the newline matches the boundary mask, so boundaries depend on
+# the content around them and not on the offset in the stream. A table that
+# has not changed since the last backup gives the same chunks again even when
+# tables before it grew or shrank. Data without newlines is cut at the maximum
+# chunk size.
+#
+# Pip packages needed:
+#------------------------------------------------
+
+#------------------------------------------------
+# Imports and Environment setup
+#------------------------------------------------
+import hashlib
+import json
+import os
+import os.path
+import sqlite3
+import tempfile
+import time
+import zlib
+
+# Chunk size limits in bytes
+MINCHUNKSIZE=64*1024
+MAXCHUNKSIZE=4*1024*1024
+# Bytes before a newline used for the boundary hash
+WINDOWSIZE=64
+# 1 in BOUNDARYDIVISOR newlines past the minimum chunk size is a boundary.
+# About 400 KB chunks for 100 byte rows.
+BOUNDARYDIVISOR=4096
+
+# Seconds to wait for another backup writing to the index
+BUSYTIMEOUT=60
+
+#------------------------------------------------
+# Define some useful functions
+#------------------------------------------------
+
+def findboundary(buf,start):
+    #-------------------------------------------------------
+    # Function: findboundary
+    # Desc: Find the end of the next content-defined chunk
+    # :buf: Buffered stream data starting at the chunk start
+    # :start: Offset to resume searching from
+    # :return: Chunk end offset or -1 if more data is needed
+    #-------------------------------------------------------
+    pos=max(start,MINCHUNKSIZE)
+    limit=min(len(buf),MAXCHUNKSIZE)
+    while pos < limit:
+        pos=buf.find(b"\n",pos,limit)
+        if (pos < 0):
+            break
+        pos+=1
+        if (zlib.crc32(buf[pos-WINDOWSIZE:pos]) % BOUNDARYDIVISOR==0):
+            return pos
+    if (len(buf) >= MAXCHUNKSIZE):
+        return MAXCHUNKSIZE
+    return -1
+
+class ChunkStore:
+    #-------------------------------------------------------
+    # Class: ChunkStore
+    # Desc: Local chunk store with a SQLite index. Creates
+    #       the repository on first use. Each chunk is committed
+    #       as it is stored so several backups can write to the
+    #       same repository at the same time.
+    #-------------------------------------------------------
+
+    def __init__(self,repository):
+        self.repository=repository
+        self.chunkdir=os.path.join(repository,"chunks")
+        self.manifestdir=os.path.join(repository,"manifests")
+        os.makedirs(self.chunkdir,exist_ok=True)
+        os.makedirs(self.manifestdir,exist_ok=True)
+        self.db=sqlite3.connect(os.path.join(repository,"index.db"),timeout=BUSYTIMEOUT)
+        self.db.execute("create table if not exists chunks (hash text primary key, size integer, storedsize integer, compressed integer, created text)")
+        self.db.execute("create table if not exists backups (name text primary key, created text, bytes integer, chunks integer, newchunks integer, newbytes integer)")
+        self.db.commit()
+
+    def chunkpath(self,chunkhash):
+        return os.path.join(self.chunkdir,chunkhash[:2],chunkhash)
+
+    def manifestpath(self,name):
+        #-------------------------------------------------------
+        # Function: manifestpath
+        # Desc: Get manifest file for a backup name. A full path
+        #       to a manifest file is also accepted.
+        # :name: Backup name or manifest file
+        # :return: Manifest file path
+        #-------------------------------------------------------
+        if (name.endswith(".json") and os.path.isfile(name)):
+            return name
+        return os.path.join(self.manifestdir,os.path.basename(name) + ".json")
+
+    def haschunk(self,chunkhash):
+        return self.db.execute("select 1 from chunks where hash=?",(chunkhash,)).fetchone() is not None
+
+    def putchunk(self,chunkhash,data,compresslevel):
+        #-------------------------------------------------------
+        # Function: putchunk
+        # Desc: Store a chunk if it is not stored yet
+        # :chunkhash: SHA-256 hex digest of the chunk data
+        # :data: Chunk data
+        # :compresslevel: zlib level. 0=Store uncompressed
+        # :return: Bytes stored. 0=Chunk was already stored
+        #-------------------------------------------------------
+        if self.haschunk(chunkhash):
+            return 0
+        stored=zlib.compress(data,compresslevel) if compresslevel > 0 else data
+        path=self.chunkpath(chunkhash)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        # Write to a temp file first so a crash never leaves a partial chunk.
+        # The temp file is unique since another backup may store the same chunk.
+        (handle,tmppath)=tempfile.mkstemp(prefix=chunkhash + ".",suffix=".tmp",dir=os.path.dirname(path))
+        with os.fdopen(handle,"wb") as chunkfile:
+            chunkfile.write(stored)
+        # Take the index write lock before the rename so a chunk stored by another
+        # backup in the meantime, maybe with other compression, is never replaced
+        self.db.execute("begin immediate")
+        try:
+            if self.haschunk(chunkhash):
+                os.remove(tmppath)
+                return 0
+            os.replace(tmppath,path)
+            self.db.execute("insert or ignore into chunks values (?,?,?,?,?)",
+                            (chunkhash,len(data),len(stored),1 if compresslevel > 0 else 0,time.strftime('%Y-%m-%d %H:%M:%S')))
+        finally:
+            self.db.commit()
+        return len(stored)
+
+    def getchunk(self,chunkhash):
+        #-------------------------------------------------------
+        # Function: getchunk
+        # Desc: Read a chunk and check its hash
+        # :chunkhash: SHA-256 hex digest of the chunk data
+        # :return: Chunk data
+        #-------------------------------------------------------
+        row=self.db.execute("select compressed from chunks where hash=?",(chunkhash,)).fetchone()
+        if row is None:
+            raise Exception(f"Chunk {chunkhash} not found in repository {self.repository}")
+        with open(self.chunkpath(chunkhash),"rb") as chunkfile:
+            data=chunkfile.read()
+        if (row[0]==1):
+            data=zlib.decompress(data)
+        if (hashlib.sha256(data).hexdigest()!=chunkhash):
+            raise Exception(f"Chunk {chunkhash} in repository {self.repository} is corrupt")
+        return data
+
+    def deletebackup(self,name):
+        #-------------------------------------------------------
+        # Function: deletebackup
+        # Desc: Delete a backup manifest and its index record.
+        #       Its chunks stay in the chunk store since other
+        #       backups may use them.
+        # :name: Backup name or manifest file
+        # :return: True if the manifest was deleted
+        #-------------------------------------------------------
+        manifestfile=self.manifestpath(name)
+        self.db.execute("delete from backups where name=?",(os.path.basename(manifestfile)[:-len(".json")],))
+        self.db.commit()
+        if os.path.isfile(manifestfile):
+            os.remove(manifestfile)
+            return True
+        return False
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+class ChunkWriter:
+    #-------------------------------------------------------
+    # Class: ChunkWriter
+    # Desc: Writable stream that splits the backup stream into
+    #       chunks and stores the new ones. close() writes the
+    #       backup manifest.
+    #-------------------------------------------------------
+
+    def __init__(self,store,name,compresslevel=0):
+        self.store=store
+        self.name=name
+        self.compresslevel=compresslevel
+        self.buf=bytearray()
+        self.searchpos=0
+        self.chunks=[]
+        self.bytes=0
+        self.newchunks=0
+        self.newbytes=0
+        self.sha256=hashlib.sha256()
+
+    def write(self,data):
+        self.buf+=data
+        self.sha256.update(data)
+        self.bytes+=len(data)
+        while True:
+            end=findboundary(self.buf,self.searchpos)
+            if (end < 0):
+                # Resume after the data already searched next time
+                self.searchpos=max(len(self.buf)-WINDOWSIZE,0)
+                break
+            self.storechunk(bytes(self.buf[:end]))
+            del self.buf[:end]
+            self.searchpos=0
+        return len(data)
+
+    def storechunk(self,data):
+        chunkhash=hashlib.sha256(data).hexdigest()
+        storedbytes=self.store.putchunk(chunkhash,data,self.compresslevel)
+        if (storedbytes > 0):
+            self.newchunks+=1
+            self.newbytes+=storedbytes
+        self.chunks.append([chunkhash,len(data)])
+
+    def close(self,extra=None):
+        #-------------------------------------------------------
+        # Function: close
+        # Desc: Store the last chunk and write the manifest
+        # :extra: Dictionary of extra manifest values. Ex: dbname
+        # :return: Manifest dictionary
+        #-------------------------------------------------------
+        if (len(self.buf) > 0):
+            self.storechunk(bytes(self.buf))
+            self.buf=bytearray()
+        manifest={
+            "name":self.name,
+            "created":time.strftime('%Y-%m-%d %H:%M:%S'),
+            "sha256":self.sha256.hexdigest(),
+            "bytes":self.bytes,
+            "newchunks":self.newchunks,
+            "newbytes":self.newbytes,
+            "chunks":self.chunks,
+        }
+        if extra:
+            manifest.update(extra)
+        manifestfile=self.store.manifestpath(self.name)
+        with open(manifestfile + ".tmp","w") as outfile:
+            json.dump(manifest,outfile)
+        os.replace(manifestfile + ".tmp",manifestfile)
+        self.store.db.execute("insert or replace into backups values (?,?,?,?,?,?)",
+                              (self.name,manifest["created"],self.bytes,len(self.chunks),self.newchunks,self.newbytes))
+        self.store.db.commit()
+        return manifest
+
+class ChunkReader:
+    #-------------------------------------------------------
+    # Class: ChunkReader
+    # Desc: Readable stream that rebuilds a backup stream from
+    #       its manifest one chunk at a time.
+    #-------------------------------------------------------
+
+    def __init__(self,store,name):
+        self.store=store
+        with open(store.manifestpath(name),"r") as infile:
+            self.manifest=json.load(infile)
+        self.chunkindex=0
+        self.buf=b""
+        self.sha256=hashlib.sha256()
+
+    def read(self,size=-1):
+        while (size < 0 or len(self.buf) < size) and self.chunkindex < len(self.manifest["chunks"]):
+            data=self.store.getchunk(self.manifest["chunks"][self.chunkindex][0])
+            self.sha256.update(data)
+            self.buf+=data
+            self.chunkindex+=1
+            if (self.chunkindex==len(self.manifest["chunks"]) and self.sha256.hexdigest()!=self.manifest["sha256"]):
+                raise Exception(f"Backup {self.manifest['name']} does not match its manifest checksum")
+        if (size < 0):
+            size=len(self.buf)
+        data=self.buf[:size]
+        self.buf=self.buf[size:]
+        return data
@@ -0,0 +1,239 @@
+#------------------------------------------------
+# Script name: pypostgresclone.py
+#
+# Description:
+# Database clone helpers for the PostgreSQL clone script. A clone copies a
+# live database to a new database without writing a dump file.
+#
+# Clone modes:
+# template - Same cluster. CREATE DATABASE ... TEMPLATE copies the database
+#   files inside the server. The source database must have no other sessions
+#   while it is copied, so they are terminated first when selected and new
+#   connections are blocked until the copy is done.
+# stream - Any two clusters. pg_dump is piped straight into pg_restore. With
+#   more than one job, pre-data is piped first, then the table data is piped
+#   in shards by a worker pool, largest first, all from one exported snapshot,
+#   and then post-data. Foreign keys and indexes are post-data so the shards
+#   load in any order. Large objects are left out of pre-data and piped as a
+#   shard of their own with their comments and privileges.
+#
+# Pip packages needed:
+#------------------------------------------------
+
+#------------------------------------------------
+# Imports and Environment setup
+#------------------------------------------------
+import os.path
+import shlex
+import subprocess
+import time
+import pypostgresshards
+
+# Clone modes. auto=template on the same cluster otherwise stream.
+CLONEMODES=("auto","template","stream")
+
+# CREATE DATABASE strategy for a template clone. PostgreSQL 15 or later.
+# Blank=Server default (wal_log).
+STRATEGIES=("","wal_log","file_copy")
+
+# Other sessions connected to a database
+SESSIONSQL="""select pid, usename, coalesce(application_name,''), state
+from pg_stat_activity where datname='{dbname}' and pid<>pg_backend_pid()"""
+
+# Seconds to wait for terminated sessions to end
+TERMINATEWAIT=30
+
+#------------------------------------------------
+# Define some useful functions
+#------------------------------------------------
+
+def quoteident(name):
+    #-------------------------------------------------------
+    # Function: quoteident
+    # Desc: Quote an SQL identifier
+    # :name: Identifier. Ex: my"db
+    # :return: Quoted identifier. Ex: "my""db"
+    #-------------------------------------------------------
+    return '"' + name.replace('"','""') + '"'
+
+def quoteliteral(value):
+    return "'" + value.replace("'","''") + "'"
+
+def clusterid(connargs,env):
+    #-------------------------------------------------------
+    # Function: clusterid
+    # Desc: Get the system identifier of a cluster and
+    #       whether it is a standby
+    # :connargs: Connection arguments from pypostgresshards.connectionargs
+    # :env: Environment with PGPASSWORD
+    # :return: Tuple of (system identifier,in recovery). The
+    #          identifier is blank if it cannot be read.
+    #-------------------------------------------------------
+    try:
+        row=pypostgresshards.psqlquery("select system_identifier, pg_is_in_recovery() from pg_control_system()","postgres",connargs,env)[0]
+        return (row[0],row[1]=="t")
+    except Exception:
+        return ("",False)
+
+def samecluster(sourceargs,sourceenv,targetargs,targetenv):
+    #-------------------------------------------------------
+    # Function: samecluster
+    # Desc: Check if the source and target connections reach
+    #       the same cluster so a template clone is possible.
+    #       A standby has the system identifier of its primary
+    #       but a template clone has to read the primary.
+    # :return: True if the same cluster
+    #-------------------------------------------------------
+    if (sourceargs==targetargs):
+        return True
+    (sourceid,sourcerecovery)=clusterid(sourceargs,sourceenv)
+    (targetid,targetrecovery)=clusterid(targetargs,targetenv)
+    return (sourceid!="" and sourceid==targetid and sourcerecovery==False and targetrecovery==False)
+
+def sessions(dbname,connargs,env):
+    #-------------------------------------------------------
+    # Function: sessions
+    # Desc: List the other sessions connected to a database
+    # :return: List of rows with pid, user, application and state
+    #-------------------------------------------------------
+    return pypostgresshards.psqlquery(SESSIONSQL.format(dbname=dbname.replace("'","''")),"postgres",connargs,env)
+
+def runsql(sql,connargs,env):
+    #-------------------------------------------------------
+    # Function: runsql
+    # Desc: Print and run an SQL statement in the postgres
+    #       database
+    # :return: List of rows
+    #-------------------------------------------------------
+    print(sql,flush=True)
+    return pypostgresshards.psqlquery(sql,"postgres",connargs,env)
+
+def clonetemplate(source,target,connargs,env,terminate=False,strategy=""):
+    #-------------------------------------------------------
+    # Function: clonetemplate
+    # Desc: Clone a database with CREATE DATABASE ... TEMPLATE.
+    #       New connections to the source are blocked while its
+    #       sessions are terminated and the copy runs, and are
+    #       allowed again afterwards.
+    # :source: Source database name
+    # :target: New database name
+    # :connargs: Connection arguments from pypostgresshards.connectionargs
+    # :env: Environment with PGPASSWORD
+    # :terminate: True=Terminate other sessions on the source.
+    #             False=Fail if the source has other sessions.
+    # :strategy: CREATE DATABASE strategy. Blank=Server default
+    #-------------------------------------------------------
+    rows=pypostgresshards.psqlquery(f"select datallowconn from pg_database where datname={quoteliteral(source)}","postgres",connargs,env)
+    if (len(rows)==0):
+        raise Exception(f"Source database {source} does not exist")
+    blocked=False
+    try:
+        if (terminate==True):
+            if (rows[0][0]=="t"):
+                runsql(f"alter database {quoteident(source)} allow_connections false",connargs,env)
+                blocked=True
+            runsql(f"select pg_terminate_backend(pid) from pg_stat_activity where datname={quoteliteral(source)} and pid<>pg_backend_pid()",connargs,env)
+            # Terminated backends take a moment to exit
+            waituntil=time.monotonic() + TERMINATEWAIT
+            while (len(sessions(source,connargs,env)) > 0 and time.monotonic() < waituntil):
+                time.sleep(0.5)
+        others=sessions(source,connargs,env)
+        if (len(others) > 0):
+            raise Exception(f"Source database {source} has {len(others)} other sessions: " +
+                            ", ".join(f"pid {row[0]} user {row[1]} application {row[2]}" for row in others) +
+                            ". Use --terminate=True or clone with --mode=stream")
+        strategyclause=f" strategy {strategy}" if strategy!="" else ""
+        runsql(f"create database {quoteident(target)} template {quoteident(source)}{strategyclause}",connargs,env)
+    finally:
+        if (blocked==True):
+            runsql(f"alter database {quoteident(source)} allow_connections true",connargs,env)
+
+def runpipe(dumpcmd,restorecmd,dumpenv,restoreenv):
+    #-------------------------------------------------------
+    # Function: runpipe
+    # Desc: Print and run pg_dump piped into pg_restore
+    # :dumpcmd: pg_dump argument list writing to stdout
+    # :restorecmd: pg_restore argument list reading stdin
+    # :dumpenv: Environment with the source PGPASSWORD
+    # :restoreenv: Environment with the target PGPASSWORD
+    # :return: First failed return code or 0
+    #-------------------------------------------------------
+    print(f"{shlex.join(dumpcmd)} | {shlex.join(restorecmd)}",flush=True)
+    procdump=subprocess.Popen(dumpcmd,stdout=subprocess.PIPE,env=dumpenv)
+    procrestore=subprocess.Popen(restorecmd,stdin=procdump.stdout,env=restoreenv)
+    # Only pg_restore holds the pipe so pg_dump sees it close if pg_restore quits
+    procdump.stdout.close()
+    rtnrestore=procrestore.wait()
+    rtndump=procdump.wait()
+    return rtndump if rtndump!=0 else rtnrestore
+
+def clonestream(source,target,sourceargs,sourceenv,targetargs,targetenv,jobs=1,shardsize=256*1024*1024):
+    #-------------------------------------------------------
+    # Function: clonestream
+    # Desc: Clone a database by piping pg_dump into pg_restore.
+    #       The target database must already exist.
+    # :source: Source database name
+    # :target: Target database name
+    # :sourceargs: Source connection arguments
+    # :sourceenv: Environment with the source PGPASSWORD
+    # :targetargs: Target connection arguments
+    # :targetenv: Environment with the target PGPASSWORD
+    # :jobs: Number of data shards piped at the same time
+    # :shardsize: Target shard size in bytes
+    # :return: Return code of the first failed pipe or 0
+    #-------------------------------------------------------
+    restorecmd=["pg_restore","-d",target] + targetargs
+    if (jobs <= 1):
+        return runpipe(["pg_dump","-F","c","-Z","0","-d",source] + sourceargs,restorecmd,sourceenv,targetenv)
+    holder=pypostgresshards.SnapshotHolder(source,sourceargs,sourceenv)
+    try:
+        print(f"INFO: Exported snapshot {holder.snapshot} - {time.strftime('%H:%M:%S')}",flush=True)
+        dumpcmd=["pg_dump","-F","c","-Z","0","--snapshot",holder.snapshot,"-d",source] + sourceargs
+        tables=[(row[0],row[1],int(row[2])) for row in pypostgresshards.psqlquery(pypostgresshards.TABLESQL,source,sourceargs,sourceenv,holder.snapshot)]
+        sequences=[[row[0],row[1]] for row in pypostgresshards.psqlquery(pypostgresshards.SEQUENCESQL,source,sourceargs,sourceenv,holder.snapshot)]
+        shards=pypostgresshards.planshards(tables,shardsize)
+        # Shards are piped and not written so they get a name instead of a file
+        for shard in shards:
+            shard["file"]=os.path.splitext(os.path.basename(shard["file"]))[0]
+        # Data only per table dumps leave out the large object contents so they get a shard of their own
+        largeobjects=pypostgresshards.psqlquery(pypostgresshards.LARGEOBJECTSQL,source,sourceargs,sourceenv,holder.snapshot)
+        largeobjectcount=int(largeobjects[0][0]) if len(largeobjects) > 0 else 0
+        if (largeobjectcount > 0):
+            shards.append({"tables":[],"bytes":int(largeobjects[0][1]),"file":"largeobjects","largeobjects":largeobjectcount})
+            shards.sort(key=lambda shard: shard["bytes"],reverse=True)
+        if (len(sequences) > 0):
+            shards.append({"tables":sequences,"bytes":0,"file":"sequences"})
+        print(f"INFO: Planned {len(shards)} shards for {len(tables)} tables, {len(sequences)} sequences and {largeobjectcount} large objects",flush=True)
+
+        # The large objects shard creates the large objects, so pre-data leaves them out
+        print(f"INFO: Starting pre-data clone - {time.strftime('%H:%M:%S')}",flush=True)
+        rtncmd=runpipe(dumpcmd + ["--section=pre-data","-B"],restorecmd,sourceenv,targetenv)
+        if (rtncmd != 0):
+            return rtncmd
+
+        def cloneshard(shard):
+            cmd=dumpcmd + ["--data-only"]
+            if (shard.get("largeobjects",0) > 0):
+                # Large objects only. -b adds them with their comments and privileges
+                # and the table data of every table is left out.
+                cmd+=["-b","--exclude-table-data","*.*"]
+                description=f"{shard['largeobjects']} large objects"
+            else:
+                for (schema,name) in shard["tables"]:
+                    cmd+=["-t",pypostgresshards.tablepattern(schema,name)]
+                description=f"{len(shard['tables'])} tables"
+            print(f"INFO: Starting data shard {shard['file']} with {description} and {shard['bytes']} bytes - {time.strftime('%H:%M:%S')}",flush=True)
+            rtnshard=runpipe(cmd,restorecmd,sourceenv,targetenv)
+            print(f"INFO: Completed data shard {shard['file']} with return code {rtnshard} - {time.strftime('%H:%M:%S')}",flush=True)
+            return rtnshard
+
+        results=pypostgresshards.runpool(shards,jobs,cloneshard)
+        failed=[result for result in results if result[1]!=0]
+        if (len(failed) > 0):
+            print(f"INFO: {len(failed)} of {len(shards)} shards failed: {','.join(result[0]['file'] for result in failed)}",flush=True)
+            return failed[0][1]
+
+        print(f"INFO: Starting post-data clone - {time.strftime('%H:%M:%S')}",flush=True)
+        return runpipe(dumpcmd + ["--section=post-data"],restorecmd,sourceenv,targetenv)
+    finally:
+        holder.close()
@@ -0,0 +1,114 @@
+#------------------------------------------------
+# Script name: pypostgresfast.py
+#
+# Description:
+# Fast restore helpers for the PostgreSQL restore script. A fast restore loads
+# the sections one at a time with bulk load session settings passed to every
+# pg_restore session through PGOPTIONS:
+# synchronous_commit=off - COPY commits do not wait for the WAL flush.
+# maintenance_work_mem - Larger sort memory for the index and constraint builds
+#   in post-data. Each pg_restore --jobs worker can use this much.
+# Tables can be switched to unlogged after pre-data so the data section writes
+# no WAL. They are switched back to logged before post-data so the indexes
+# are built logged, or kept unlogged for throw away staging databases.
+# Switching back only pays off with wal_level=minimal. At replica or logical
+# SET LOGGED writes the whole table into the WAL, which is the WAL the
+# unlogged load saved plus a table rewrite, so load is refused there.
+# The restore ends with vacuumdb --analyze-only so the planner has statistics.
+#
+# Fast restore order:
+# pre-data, set unlogged, data, set logged, post-data (--jobs), analyze (--jobs)
+#
+# Pip packages needed:
+#------------------------------------------------
+
+#------------------------------------------------
+# Imports and Environment setup
+#------------------------------------------------
+import pypostgresshards
+
+# Unlogged table modes
+# none=Tables stay logged. load=Unlogged while the data loads then logged.
+# Only with wal_level=minimal. keep=Tables stay unlogged. Not crash safe
+# and not replicated.
+UNLOGGEDMODES=("none","load","keep")
+
+# wal_level that SET LOGGED skips the WAL at
+LOADWALLEVEL="minimal"
+
+# User tables to switch, largest first. relpersistence p=logged, u=unlogged.
+PERSISTENCESQL="""select n.nspname, c.relname, pg_table_size(c.oid)
+from pg_class c join pg_namespace n on n.oid=c.relnamespace
+where c.relkind='r' and c.relpersistence='{relpersistence}'
+and n.nspname not in ('pg_catalog','information_schema') and n.nspname not like 'pg_toast%'
+order by 3 desc"""
+
+#------------------------------------------------
+# Define some useful functions
+#------------------------------------------------
+
+def sessionenv(env,maintmem):
+    #-------------------------------------------------------
+    # Function: sessionenv
+    # Desc: Add the bulk load session settings to PGOPTIONS.
+    #       Settings already in PGOPTIONS are kept first.
+    # :env: Environment with PGPASSWORD
+    # :maintmem: maintenance_work_mem setting. Ex: 1GB
+    # :return: Environment for the restore sessions
+    #-------------------------------------------------------
+    options=f"-c synchronous_commit=off -c maintenance_work_mem={maintmem}"
+    if (env.get("PGOPTIONS","").strip()!=""):
+        options=env["PGOPTIONS"].strip() + " " + options
+    return dict(env,PGOPTIONS=options)
+
+def setpersistence(dbname,connargs,env,logged,jobs):
+    #-------------------------------------------------------
+    # Function: setpersistence
+    # Desc: Switch all user tables to logged or unlogged with
+    #       --jobs workers, largest table first. SET LOGGED
+    #       rewrites the table into the WAL so it runs one
+    #       table per worker.
+    # :dbname: Database name
+    # :connargs: Connection arguments from pypostgresshards.connectionargs
+    # :env: Environment with PGPASSWORD
+    # :logged: True=SET LOGGED. False=SET UNLOGGED
+    # :jobs: Number of workers
+    # :return: Return code of the first failed table or 0
+    #-------------------------------------------------------
+    persistence="logged" if logged else "unlogged"
+    tables=[(row[0],row[1]) for row in pypostgresshards.psqlquery(PERSISTENCESQL.format(relpersistence="u" if logged else "p"),dbname,connargs,env)]
+    print(f"Setting {len(tables)} tables {persistence}",flush=True)
+    results=pypostgresshards.runpool(tables,jobs,
+                                     lambda table: pypostgresshards.runcommand(["psql","-X","-q","-v","ON_ERROR_STOP=1","-d",dbname] + connargs +
+                                                                               ["-c",f"alter table {pypostgresshards.tablepattern(table[0],table[1])} set {persistence}"],env))
+    failed=[result for result in results if result[1]!=0]
+    return failed[0][1] if len(failed) > 0 else 0
+
+def checkunlogged(unlogged,connargs,env):
+    #-------------------------------------------------------
+    # Function: checkunlogged
+    # Desc: Check the server wal_level allows an unlogged mode
+    # :unlogged: none, load or keep
+    # :connargs: Connection arguments from pypostgresshards.connectionargs
+    # :env: Environment with PGPASSWORD
+    # :return: Error message or blank if the mode can be used
+    #-------------------------------------------------------
+    if (unlogged!="load"):
+        return ""
+    wallevel=pypostgresshards.psqlquery("show wal_level","postgres",connargs,env)[0][0]
+    if (wallevel!=LOADWALLEVEL):
+        return (f"Unlogged load needs wal_level={LOADWALLEVEL}. The server has wal_level={wallevel} where SET LOGGED "
+                f"writes every table into the WAL. Use --unlogged=none, or keep for throw away databases")
+    return ""
+
+def analyzedb(dbname,connargs,env,jobs):
+    #-------------------------------------------------------
+    # Function: analyzedb
+    # Desc: Analyze all tables with vacuumdb --jobs workers
+    # :dbname: Database name
+    # :connargs: Connection arguments from pypostgresshards.connectionargs
+    # :env: Environment with PGPASSWORD
+    # :jobs: Number of vacuumdb jobs
+    # :return: vacuumdb return code
+    #-------------------------------------------------------
+    return pypostgresshards.runcommand(["vacuumdb","--analyze-only","-j",str(jobs),"-d",dbname] + connargs,env)
@@ -0,0 +1,185 @@
+#------------------------------------------------
+# Script name: pypostgresmetrics.py
+#
+# Description:
+# Timing and throughput metrics for the PostgreSQL backup and restore scripts.
+# Each phase (createdb, dump, verify, restore...) records wall time, CPU time
+# of this process and its child processes, bytes and MB/s and the peak RSS of
+# the child processes so far. Phases are appended to a JSON lines file as they end
+# and can also be written as a Prometheus node_exporter textfile.
+#
+# JSON lines record example:
+# {"time": "2024-07-07 01:02:03", "script": "backup", "dbname": "mydb", "phase": "dump",
+#  "status": 0, "wallseconds": 12.3, "cpuseconds": 4.5, "bytes": 1048576, "mbps": 0.08,
+#  "runpeakrssbytes": 52428800}
+#
+# Run peak RSS is a running maximum. It is the largest resident set of any child
+# process waited for since the script started, as reported by
+# getrusage(RUSAGE_CHILDREN), and not the peak of that phase alone. A phase
+# that only ran small programs reports the peak of an earlier larger phase.
+#
+# Pip packages needed:
+#------------------------------------------------
+
+#------------------------------------------------
+# Imports and Environment setup
+#------------------------------------------------
+import json
+import os
+import os.path
+import sys
+import time
+
+# resource is not available on every platform
+try:
+    import resource
+except ImportError:
+    resource=None
+
+#------------------------------------------------
+# Define some useful functions
+#------------------------------------------------
+
+def pathsize(path):
+    #-------------------------------------------------------
+    # Function: pathsize
+    # Desc: Get size of a file or all files in a directory
+    # :path: File or directory
+    # :return: Size in bytes or 0 if not found
+    #-------------------------------------------------------
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    totalsize=0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            totalsize+=os.path.getsize(os.path.join(root,name))
+    return totalsize
+
+def cpuseconds():
+    #-------------------------------------------------------
+    # Function: cpuseconds
+    # Desc: User plus system CPU seconds of this process and
+    #       all child processes waited for so far
+    # :return: CPU seconds
+    #-------------------------------------------------------
+    times=os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+def promlabel(value):
+    #-------------------------------------------------------
+    # Function: promlabel
+    # Desc: Escape a Prometheus label value
+    # :value: Label value
+    # :return: Value with backslash, double quote and newline escaped
+    #-------------------------------------------------------
+    return str(value).replace("\\","\\\\").replace('"','\\"').replace("\n","\\n")
+
+def childpeakrss():
+    #-------------------------------------------------------
+    # Function: childpeakrss
+    # Desc: Peak RSS of the child processes waited for so far
+    # :return: Bytes or 0 if not available
+    #-------------------------------------------------------
+    if resource is None:
+        return 0
+    maxrss=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # Linux reports KB and macOS reports bytes
+    return maxrss if sys.platform=="darwin" else maxrss*1024
+
+class Metrics:
+    #-------------------------------------------------------
+    # Class: Metrics
+    # Desc: Collect phase metrics for one backup or restore run
+    #-------------------------------------------------------
+
+    def __init__(self,script,dbname,metricsfile="",promfile=""):
+        self.script=script
+        self.dbname=dbname
+        self.metricsfile=metricsfile
+        self.promfile=promfile
+        self.phases=[]
+        self.openphases=[]
+        self.starttime=time.time()
+
+    def startphase(self,name):
+        #-------------------------------------------------------
+        # Function: startphase
+        # Desc: Start timing a phase
+        # :name: Phase name. Ex: dump
+        # :return: Phase record dictionary to pass to endphase
+        #-------------------------------------------------------
+        record={"time":time.strftime('%Y-%m-%d %H:%M:%S'),"script":self.script,"dbname":self.dbname,
+                "phase":name,"status":0,"bytes":0,
+                "wallstart":time.monotonic(),"cpustart":cpuseconds()}
+        self.openphases.append(record)
+        return record
+
+    def endphase(self,record,bytes=0,status=0):
+        #-------------------------------------------------------
+        # Function: endphase
+        # Desc: End a phase and append it to the JSON lines file
+        # :record: Phase record from startphase
+        # :bytes: Bytes written or read by the phase
+        # :status: Phase return code. 0=Success
+        #-------------------------------------------------------
+        self.openphases.remove(record)
+        record["status"]=status
+        record["bytes"]=bytes
+        record["wallseconds"]=round(time.monotonic()-record.pop("wallstart"),3)
+        record["cpuseconds"]=round(cpuseconds()-record.pop("cpustart"),3)
+        record["mbps"]=round(bytes/1024/1024/record["wallseconds"],3) if record["wallseconds"] > 0 else 0
+        record["runpeakrssbytes"]=childpeakrss()
+        self.phases.append(record)
+        self.writejsonline(record)
+
+    def writejsonline(self,record):
+        #-------------------------------------------------------
+        # Function: writejsonline
+        # Desc: Append a phase record to the JSON lines file
+        # :record: Phase record
+        #-------------------------------------------------------
+        if (self.metricsfile==""):
+            return
+        # Metrics never fail the backup or restore they measure
+        try:
+            with open(self.metricsfile,"a") as outfile:
+                outfile.write(json.dumps(record) + "\n")
+        except OSError as ex:
+            print(f"INFO:Metrics file {self.metricsfile} could not be written. {ex}",flush=True)
+
+    def finish(self,exitcode):
+        #-------------------------------------------------------
+        # Function: finish
+        # Desc: End phases left open by an error as failed and write
+        #       the Prometheus textfile for the run. The file is
+        #       replaced in one step so the collector never reads
+        #       a partial file.
+        # :exitcode: Script exit code
+        #-------------------------------------------------------
+        for record in list(self.openphases):
+            self.endphase(record,record["bytes"],exitcode if exitcode else 99)
+        if (self.promfile==""):
+            return
+        labels=f'script="{promlabel(self.script)}",dbname="{promlabel(self.dbname)}"'
+        lines=[]
+        for (metric,key,helptext) in [("pgbackup_phase_wall_seconds","wallseconds","Phase wall clock seconds"),
+                                  ("pgbackup_phase_cpu_seconds","cpuseconds","Phase CPU seconds of the script and its child processes"),
+                                  ("pgbackup_phase_bytes","bytes","Phase bytes written or read"),
+                                  ("pgbackup_phase_mbps","mbps","Phase throughput in MB/s"),
+                                  ("pgbackup_phase_status","status","Phase return code. 0=Success")]:
+            lines.append(f"# HELP {metric} {helptext}")
+            lines.append(f"# TYPE {metric} gauge")
+            for record in self.phases:
+                lines.append(f'{metric}{{{labels},phase="{promlabel(record["phase"])}"}} {record[key]}')
+        lines.append("# HELP pgbackup_run_peak_rss_bytes Peak RSS of any child process of the run")
+        lines.append("# TYPE pgbackup_run_peak_rss_bytes gauge")
+        lines.append(f"pgbackup_run_peak_rss_bytes{{{labels}}} {childpeakrss()}")
+        lines.append("# HELP pgbackup_exit_code Script exit code. 0=Success")
+        lines.append("# TYPE pgbackup_exit_code gauge")
+        lines.append(f"pgbackup_exit_code{{{labels}}} {exitcode}")
+        lines.append("# HELP pgbackup_last_run_timestamp_seconds Start time of the last run")
+        lines.append("# TYPE pgbackup_last_run_timestamp_seconds gauge")
+        lines.append(f"pgbackup_last_run_timestamp_seconds{{{labels}}} {int(self.starttime)}")
+        with open(self.promfile + ".tmp","w") as outfile:
+            outfile.write("\n".join(lines) + "\n")
+        os.replace(self.promfile + ".tmp",self.promfile)
@@ -0,0 +1,500 @@
+#------------------------------------------------
+# Script name: pypostgresobjectstore.py
+#
+# Description:
+# S3-compatible object storage used by the PostgreSQL backup and restore
+# scripts. Backups are uploaded as multipart uploads while pg_dump is still
+# writing, with several parts uploading at the same time, and restores read
+# the object back with ranged GETs running ahead of pg_restore. No local copy
+# of the backup is written either way.
+#
+# Object URLs:
+# s3://bucket/key Ex: s3://backups/pg/mydb-20240707-010000.tar.zst
+#
+# Endpoints:
+# https://host[:port] or http://host[:port] - S3-compatible server such as AWS
+#   S3, MinIO or Ceph. Requests use path style URLs and are signed with AWS
+#   Signature Version 4.
+# file:///directory - Filesystem fake for tests and for local disks. Objects
+#   are files in <directory>/<bucket>/<key> and multipart uploads are staged
+#   in <directory>/.uploads until they are completed.
+# Blank endpoint=AWS_ENDPOINT_URL environment variable, or AWS S3 in the region.
+#
+# Credentials and region come from the standard environment variables:
+# AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_SESSION_TOKEN (optional) and
+# AWS_REGION or AWS_DEFAULT_REGION (default us-east-1).
+#
+# Memory:
+# An upload holds at most uploads+1 parts in memory. The part being filled
+# waits while all the upload slots are busy, which slows pg_dump down to the
+# upload rate. A download holds at most downloads+1 parts.
+#
+# Pip packages needed:
+#------------------------------------------------
+
+#------------------------------------------------
+# Imports and Environment setup
+#------------------------------------------------
+import concurrent.futures
+import hashlib
+import hmac
+import http.client
+import os
+import os.path
+import shutil
+import threading
+import time
+import urllib.parse
+import uuid
+import xml.etree.ElementTree
+
+# Part size limits in bytes. S3 needs 5 MB parts except the last one and
+# allows up to 10000 parts.
+PARTSIZE=16*1024*1024
+MINPARTSIZE=5*1024*1024
+MAXPARTS=10000
+# Parts transferred at the same time
+TRANSFERS=4
+# Attempts for each request. Waits 1, 2, 4 ... seconds between attempts.
+ATTEMPTS=4
+# Seconds to wait for an object storage server to answer
+TIMEOUT=300
+
+# S3 XML namespace
+S3NS="{http://s3.amazonaws.com/doc/2006-03-01/}"
+
+#------------------------------------------------
+# Define some useful functions
+#------------------------------------------------
+
+def isobjecturl(path):
+    #-------------------------------------------------------
+    # Function: isobjecturl
+    # Desc: Check if a backup path is an object URL
+    # :path: Backup path. Ex: s3://backups/mydb.tar
+    # :return: True if an object URL
+    #-------------------------------------------------------
+    return str(path).startswith("s3://")
+
+def parseurl(url):
+    #-------------------------------------------------------
+    # Function: parseurl
+    # Desc: Split an object URL into bucket and key
+    # :url: Object URL. Ex: s3://backups/pg/mydb.tar
+    # :return: Tuple of (bucket,key). Ex: ("backups","pg/mydb.tar")
+    #-------------------------------------------------------
+    (bucket,slash,key)=url[len("s3://"):].partition("/")
+    if (bucket=="" or key=="" or key.endswith("/")):
+        raise Exception(f"Object URL {url} must be s3://bucket/key")
+    return (bucket,key)
+
+def openstore(endpoint=""):
+    #-------------------------------------------------------
+    # Function: openstore
+    # Desc: Open the object store for an endpoint
+    # :endpoint: https://host, http://host or file:///directory.
+    #            Blank=AWS_ENDPOINT_URL or AWS S3
+    # :return: S3Client or FileObjectStore
+    #-------------------------------------------------------
+    region=os.environ.get("AWS_REGION",os.environ.get("AWS_DEFAULT_REGION","us-east-1"))
+    if (endpoint==""):
+        endpoint=os.environ.get("AWS_ENDPOINT_URL",f"https://s3.{region}.amazonaws.com")
+    if endpoint.startswith("file://"):
+        return FileObjectStore(endpoint[len("file://"):])
+    if (endpoint.startswith("https://")==False and endpoint.startswith("http://")==False):
+        raise Exception(f"Object storage endpoint {endpoint} must start with https://, http:// or file://")
+    accesskey=os.environ.get("AWS_ACCESS_KEY_ID","")
+    secretkey=os.environ.get("AWS_SECRET_ACCESS_KEY","")
+    if (accesskey=="" or secretkey==""):
+        raise Exception("Object storage credentials must be set in AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY")
+    return S3Client(endpoint,region,accesskey,secretkey,os.environ.get("AWS_SESSION_TOKEN",""))
+
+def retry(function,description):
+    #-------------------------------------------------------
+    # Function: retry
+    # Desc: Run a request again after a failure
+    # :function: Function running the request
+    # :description: Request description for messages
+    # :return: Function result
+    #-------------------------------------------------------
+    for attempt in range(ATTEMPTS):
+        try:
+            return function()
+        except (OSError,http.client.HTTPException,ObjectStoreError) as ex:
+            if (attempt==ATTEMPTS-1 or getattr(ex,"status",500) < 500):
+                raise
+            print(f"INFO: {description} failed and will be retried. {ex}",flush=True)
+            time.sleep(2**attempt)
+
+def signature(method,host,path,query,headers,payloadhash,amzdate,region,accesskey,secretkey):
+    #-------------------------------------------------------
+    # Function: signature
+    # Desc: Build the AWS Signature Version 4 Authorization
+    #       header for an S3 request
+    # :method: HTTP method
+    # :host: Host header value
+    # :path: URL encoded path. Ex: /backups/pg/mydb.tar
+    # :query: Dictionary of query parameters
+    # :headers: Dictionary of x-amz-* and other signed headers
+    # :payloadhash: SHA-256 hex digest of the request body
+    # :amzdate: Request time. Ex: 20240707T010000Z
+    # :return: Authorization header value
+    #-------------------------------------------------------
+    signed=dict((name.lower(),str(value).strip()) for (name,value) in headers.items())
+    signed["host"]=host
+    signedheaders=";".join(sorted(signed))
+    canonicalquery="&".join(f"{urllib.parse.quote(name,safe='-_.~')}={urllib.parse.quote(str(value),safe='-_.~')}"
+                            for (name,value) in sorted(query.items()))
+    canonicalrequest="\n".join([method,path,canonicalquery,
+                                "".join(f"{name}:{signed[name]}\n" for name in sorted(signed)),
+                                signedheaders,payloadhash])
+    scope=f"{amzdate[:8]}/{region}/s3/aws4_request"
+    stringtosign="\n".join(["AWS4-HMAC-SHA256",amzdate,scope,hashlib.sha256(canonicalrequest.encode()).hexdigest()])
+    key=("AWS4" + secretkey).encode()
+    for part in (amzdate[:8],region,"s3","aws4_request"):
+        key=hmac.new(key,part.encode(),hashlib.sha256).digest()
+    return (f"AWS4-HMAC-SHA256 Credential={accesskey}/{scope}, SignedHeaders={signedheaders}, "
+            f"Signature={hmac.new(key,stringtosign.encode(),hashlib.sha256).hexdigest()}")
+
+class ObjectStoreError(Exception):
+    #-------------------------------------------------------
+    # Class: ObjectStoreError
+    # Desc: Error response from the object store with its
+    #       HTTP status
+    #-------------------------------------------------------
+
+    def __init__(self,status,message):
+        super().__init__(message)
+        self.status=status
+
+class S3Client:
+    #-------------------------------------------------------
+    # Class: S3Client
+    # Desc: Minimal S3 REST client with Signature Version 4.
+    #       Every request uses its own connection so parts can
+    #       be sent from worker threads.
+    #-------------------------------------------------------
+
+    def __init__(self,endpoint,region,accesskey,secretkey,sessiontoken=""):
+        url=urllib.parse.urlsplit(endpoint)
+        self.secure=(url.scheme=="https")
+        self.host=url.netloc
+        self.basepath=url.path.rstrip("/")
+        self.region=region
+        self.accesskey=accesskey
+        self.secretkey=secretkey
+        self.sessiontoken=sessiontoken
+
+    def request(self,method,bucket,key="",query=None,body=b"",headers=None):
+        #-------------------------------------------------------
+        # Function: request
+        # Desc: Send a signed request and read the response
+        # :return: Tuple of (status,response headers,response body)
+        #-------------------------------------------------------
+        query=query or {}
+        headers=dict(headers or {})
+        path=urllib.parse.quote(f"{self.basepath}/{bucket}" + (f"/{key}" if key!="" else ""),safe="/-_.~")
+        payloadhash=hashlib.sha256(body).hexdigest()
+        amzdate=time.strftime("%Y%m%dT%H%M%SZ",time.gmtime())
+        headers["x-amz-content-sha256"]=payloadhash
+        headers["x-amz-date"]=amzdate
+        if (self.sessiontoken!=""):
+            headers["x-amz-security-token"]=self.sessiontoken
+        headers["Authorization"]=signature(method,self.host,path,query,headers,payloadhash,amzdate,
+                                           self.region,self.accesskey,self.secretkey)
+        headers["Host"]=self.host
+        if (len(query) > 0):
+            path+="?" + "&".join(f"{urllib.parse.quote(name,safe='-_.~')}={urllib.parse.quote(str(value),safe='-_.~')}"
+                                 for (name,value) in sorted(query.items()))
+        if self.secure:
+            connection=http.client.HTTPSConnection(self.host,timeout=TIMEOUT)
+        else:
+            connection=http.client.HTTPConnection(self.host,timeout=TIMEOUT)
+        try:
+            connection.request(method,path,body=body,headers=headers)
+            response=connection.getresponse()
+            data=response.read()
+        finally:
+            connection.close()
+        # HEAD answers 404 for a missing object. Anything else failed.
+        if (response.status >= 300 and (method!="HEAD" or response.status!=404)):
+            message=data.decode(errors="replace")
+            try:
+                error=xml.etree.ElementTree.fromstring(data)
+                message=f"{error.findtext('Code')}: {error.findtext('Message')}"
+            except xml.etree.ElementTree.ParseError:
+                pass
+            raise ObjectStoreError(response.status,f"{method} s3://{bucket}/{key} failed with HTTP {response.status}. {message}")
+        return (response.status,dict((name.lower(),value) for (name,value) in response.getheaders()),data)
+
+    def headobject(self,bucket,key):
+        #-------------------------------------------------------
+        # Function: headobject
+        # Desc: Get the size of an object
+        # :return: Size in bytes or None if there is no object
+        #-------------------------------------------------------
+        (status,headers,data)=retry(lambda: self.request("HEAD",bucket,key),f"HEAD s3://{bucket}/{key}")
+        return None if status==404 else int(headers.get("content-length",0))
+
+    def getrange(self,bucket,key,start,end):
+        #-------------------------------------------------------
+        # Function: getrange
+        # Desc: Read part of an object
+        # :start: First byte offset
+        # :end: Offset after the last byte
+        # :return: Bytes
+        #-------------------------------------------------------
+        (status,headers,data)=retry(lambda: self.request("GET",bucket,key,headers={"Range":f"bytes={start}-{end-1}"}),
+                                    f"GET s3://{bucket}/{key} bytes {start}-{end-1}")
+        return data
+
+    def putobject(self,bucket,key,data):
+        retry(lambda: self.request("PUT",bucket,key,body=data),f"PUT s3://{bucket}/{key}")
+
+    def deleteobject(self,bucket,key):
+        #-------------------------------------------------------
+        # Function: deleteobject
+        # Desc: Delete an object
+        # :return: True if the object was there
+        #-------------------------------------------------------
+        if self.headobject(bucket,key) is None:
+            return False
+        retry(lambda: self.request("DELETE",bucket,key),f"DELETE s3://{bucket}/{key}")
+        return True
+
+    def createupload(self,bucket,key):
+        #-------------------------------------------------------
+        # Function: createupload
+        # Desc: Start a multipart upload
+        # :return: Upload id
+        #-------------------------------------------------------
+        (status,headers,data)=retry(lambda: self.request("POST",bucket,key,{"uploads":""}),f"Create upload s3://{bucket}/{key}")
+        return xml.etree.ElementTree.fromstring(data).findtext(f"{S3NS}UploadId")
+
+    def uploadpart(self,bucket,key,uploadid,partnumber,data):
+        #-------------------------------------------------------
+        # Function: uploadpart
+        # Desc: Upload one part of a multipart upload
+        # :partnumber: Part number 1-10000
+        # :return: Part ETag
+        #-------------------------------------------------------
+        (status,headers,response)=retry(lambda: self.request("PUT",bucket,key,{"partNumber":partnumber,"uploadId":uploadid},data),
+                                        f"Upload part {partnumber} of s3://{bucket}/{key}")
+        return headers.get("etag","")
+
+    def completeupload(self,bucket,key,uploadid,parts):
+        #-------------------------------------------------------
+        # Function: completeupload
+        # Desc: Complete a multipart upload. The object appears
+        #       in one step.
+        # :parts: List of (part number,ETag) in part order
+        #-------------------------------------------------------
+        body=("<CompleteMultipartUpload>" +
+              "".join(f"<Part><PartNumber>{partnumber}</PartNumber><ETag>{etag}</ETag></Part>" for (partnumber,etag) in parts) +
+              "</CompleteMultipartUpload>").encode()
+        (status,headers,data)=retry(lambda: self.request("POST",bucket,key,{"uploadId":uploadid},body),
+                                    f"Complete upload s3://{bucket}/{key}")
+        # S3 can report a failed completion in a 200 response
+        if (b"<Error>" in data):
+            error=xml.etree.ElementTree.fromstring(data)
+            raise ObjectStoreError(500,f"Complete upload s3://{bucket}/{key} failed. {error.findtext('Code')}: {error.findtext('Message')}")
+
+    def abortupload(self,bucket,key,uploadid):
+        retry(lambda: self.request("DELETE",bucket,key,{"uploadId":uploadid}),f"Abort upload s3://{bucket}/{key}")
+
+class FileObjectStore:
+    #-------------------------------------------------------
+    # Class: FileObjectStore
+    # Desc: Filesystem fake with the S3Client functions.
+    #       Completed objects are moved into place in one
+    #       step like S3 objects.
+    #-------------------------------------------------------
+
+    def __init__(self,root):
+        self.root=root
+        self.uploaddir=os.path.join(root,".uploads")
+
+    def objectpath(self,bucket,key):
+        return os.path.join(self.root,bucket,*key.split("/"))
+
+    def headobject(self,bucket,key):
+        path=self.objectpath(bucket,key)
+        return os.path.getsize(path) if os.path.isfile(path) else None
+
+    def getrange(self,bucket,key,start,end):
+        path=self.objectpath(bucket,key)
+        if (os.path.isfile(path)==False):
+            raise ObjectStoreError(404,f"Object s3://{bucket}/{key} does not exist")
+        with open(path,"rb") as infile:
+            infile.seek(start)
+            return infile.read(end-start)
+
+    def putobject(self,bucket,key,data):
+        path=self.objectpath(bucket,key)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        with open(path + ".tmp","wb") as outfile:
+            outfile.write(data)
+        os.replace(path + ".tmp",path)
+
+    def deleteobject(self,bucket,key):
+        path=self.objectpath(bucket,key)
+        if os.path.isfile(path):
+            os.remove(path)
+            return True
+        return False
+
+    def createupload(self,bucket,key):
+        if (os.path.isdir(os.path.join(self.root,bucket))==False):
+            raise ObjectStoreError(404,f"Bucket {bucket} does not exist in {self.root}")
+        uploadid=uuid.uuid4().hex
+        os.makedirs(os.path.join(self.uploaddir,uploadid))
+        return uploadid
+
+    def uploadpart(self,bucket,key,uploadid,partnumber,data):
+        with open(os.path.join(self.uploaddir,uploadid,f"{partnumber:05d}"),"wb") as outfile:
+            outfile.write(data)
+        return hashlib.md5(data).hexdigest()
+
+    def completeupload(self,bucket,key,uploadid,parts):
+        path=self.objectpath(bucket,key)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        with open(path + ".tmp","wb") as outfile:
+            for (partnumber,etag) in parts:
+                with open(os.path.join(self.uploaddir,uploadid,f"{partnumber:05d}"),"rb") as partfile:
+                    shutil.copyfileobj(partfile,outfile)
+        os.replace(path + ".tmp",path)
+        shutil.rmtree(os.path.join(self.uploaddir,uploadid))
+
+    def abortupload(self,bucket,key,uploadid):
+        shutil.rmtree(os.path.join(self.uploaddir,uploadid),ignore_errors=True)
+
+class MultipartWriter:
+    #-------------------------------------------------------
+    # Class: MultipartWriter
+    # Desc: Writable stream that uploads an object in parts
+    #       while it is written. close() completes the upload
+    #       and abort() drops it so no partial object is left.
+    #-------------------------------------------------------
+
+    def __init__(self,store,url,partsize=PARTSIZE,uploads=TRANSFERS):
+        if (partsize < MINPARTSIZE):
+            raise Exception(f"Part size must be at least {MINPARTSIZE//1024//1024} MB")
+        self.store=store
+        self.url=url
+        (self.bucket,self.key)=parseurl(url)
+        self.partsize=partsize
+        self.uploadid=store.createupload(self.bucket,self.key)
+        self.executor=concurrent.futures.ThreadPoolExecutor(max_workers=uploads)
+        # Free upload slots. write() waits for one before sending a part.
+        self.slots=threading.BoundedSemaphore(uploads)
+        self.futures=[]
+        self.buf=bytearray()
+        self.partnumber=0
+        self.completed=False
+
+    def write(self,data):
+        self.buf+=data
+        while (len(self.buf) >= self.partsize):
+            part=bytes(self.buf[:self.partsize])
+            del self.buf[:self.partsize]
+            self.sendpart(part)
+        return len(data)
+
+    def sendpart(self,data):
+        #-------------------------------------------------------
+        # Function: sendpart
+        # Desc: Queue a part for upload once an upload slot is
+        #       free. A failed part stops the writer.
+        # :data: Part data
+        #-------------------------------------------------------
+        self.slots.acquire()
+        for future in self.futures:
+            if (future.done() and future.exception() is not None):
+                self.slots.release()
+                raise future.exception()
+        self.partnumber+=1
+        if (self.partnumber > MAXPARTS):
+            self.slots.release()
+            raise Exception(f"Object {self.url} needs more than {MAXPARTS} parts. Use a larger part size.")
+        partnumber=self.partnumber
+        def upload():
+            try:
+                return (partnumber,self.store.uploadpart(self.bucket,self.key,self.uploadid,partnumber,data))
+            finally:
+                self.slots.release()
+        self.futures.append(self.executor.submit(upload))
+
+    def close(self):
+        #-------------------------------------------------------
+        # Function: close
+        # Desc: Upload the last part and complete the upload
+        # :return: Number of parts
+        #-------------------------------------------------------
+        if (len(self.buf) > 0 or self.partnumber==0):
+            self.sendpart(bytes(self.buf))
+            self.buf=bytearray()
+        parts=[future.result() for future in self.futures]
+        self.executor.shutdown()
+        self.store.completeupload(self.bucket,self.key,self.uploadid,parts)
+        self.completed=True
+        return len(parts)
+
+    def abort(self):
+        #-------------------------------------------------------
+        # Function: abort
+        # Desc: Stop the upload and drop the parts sent so far
+        #-------------------------------------------------------
+        if self.completed:
+            return
+        self.executor.shutdown(cancel_futures=True)
+        self.store.abortupload(self.bucket,self.key,self.uploadid)
+        self.completed=True
+
+class ObjectReader:
+    #-------------------------------------------------------
+    # Class: ObjectReader
+    # Desc: Readable stream of an object. Ranged GETs of up
+    #       to downloads parts run ahead of the reader.
+    #-------------------------------------------------------
+
+    def __init__(self,store,url,partsize=PARTSIZE,downloads=TRANSFERS):
+        self.store=store
+        self.url=url
+        (self.bucket,self.key)=parseurl(url)
+        self.size=store.headobject(self.bucket,self.key)
+        if self.size is None:
+            raise ObjectStoreError(404,f"Object {url} does not exist")
+        self.partsize=partsize
+        self.downloads=downloads
+        self.executor=concurrent.futures.ThreadPoolExecutor(max_workers=downloads)
+        self.futures=[]
+        self.nextoffset=0
+        self.buf=b""
+        self.pos=0
+
+    def fetchahead(self):
+        while (len(self.futures) < self.downloads and self.nextoffset < self.size):
+            end=min(self.nextoffset + self.partsize,self.size)
+            self.futures.append(self.executor.submit(self.store.getrange,self.bucket,self.key,self.nextoffset,end))
+            self.nextoffset=end
+
+    def read(self,size=-1):
+        data=[]
+        while (size < 0 or size > 0):
+            if (self.pos >= len(self.buf)):
+                self.fetchahead()
+                if (len(self.futures)==0):
+                    break
+                self.buf=self.futures.pop(0).result()
+                self.pos=0
+                # Start the next range while this one is read
+                self.fetchahead()
+            count=len(self.buf)-self.pos if size < 0 else min(size,len(self.buf)-self.pos)
+            data.append(self.buf[self.pos:self.pos+count])
+            self.pos+=count
+            if (size > 0):
+                size-=count
+        return b"".join(data)
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
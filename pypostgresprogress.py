@@ -0,0 +1,291 @@
+#------------------------------------------------
+# Script name: pypostgresprogress.py
+#
+# Description:
+# Live progress reporting for the PostgreSQL backup and restore scripts.
+# pg_dump and pg_restore run with --verbose and their stderr is read line by
+# line. Each line is still shown, and the table being dumped or restored, the
+# number of objects processed and the tables finished are tracked from it. A
+# PROGRESS line with bytes moved, MB/s and an ETA is printed at the selected
+# interval. The ETA is based on table sizes from the database catalog for a
+# backup and from the archive data files for a restore.
+#
+# Progress line example:
+# PROGRESS: dump 57 objects, 12/40 tables, current table public.orders,
+#  1234.5 MB of 5000.0 MB (24.7%), 45.2 MB/s, elapsed 00:00:27, ETA 00:01:23
+#
+# Pip packages needed:
+#------------------------------------------------
+
+#------------------------------------------------
+# Imports and Environment setup
+#------------------------------------------------
+import os
+import os.path
+import re
+import subprocess
+import sys
+import threading
+import time
+import pypostgresshards
+
+# pg_dump and pg_restore --verbose lines that start on a table's data
+# pg_dump: dumping contents of table "public.orders"
+# pg_restore: processing data for table "public.orders"
+TABLESTARTLINE=re.compile(r'(?:dumping contents of table|processing data for table) "?(.+?)"?\s*$')
+# Parallel pg_dump and pg_restore report each finished item
+# pg_dump: finished item 3345 TABLE DATA orders
+# pg_restore: finished item 3345 TABLE DATA public orders
+TABLEDONELINE=re.compile(r'finished item \d+ TABLE DATA (.+?)\s*$')
+# Lines that count as one object processed
+OBJECTLINE=re.compile(r'(?:dumping contents of table|processing data for table|creating [A-Z]|processing item)')
+# pg_restore -l table of contents data line
+# 3345; 0 16390 TABLE DATA public orders postgres
+TOCDATALINE=re.compile(r'^(\d+); \d+ \d+ TABLE DATA (\S+) (\S+) ')
+
+#------------------------------------------------
+# Define some useful functions
+#------------------------------------------------
+
+def formatseconds(seconds):
+    #-------------------------------------------------------
+    # Function: formatseconds
+    # Desc: Format seconds as hh:mm:ss
+    # :seconds: Seconds
+    # :return: Formatted time
+    #-------------------------------------------------------
+    seconds=int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+def catalogtablesizes(dbname,connargs,env):
+    #-------------------------------------------------------
+    # Function: catalogtablesizes
+    # Desc: Read table sizes from the database catalog
+    # :dbname: Database name
+    # :connargs: Connection arguments from pypostgresshards.connectionargs
+    # :env: Environment with PGPASSWORD
+    # :return: Dictionary of schema.table to bytes. Empty if
+    #          the catalog could not be read.
+    #-------------------------------------------------------
+    try:
+        return {f"{row[0]}.{row[1]}":int(row[2]) for row in pypostgresshards.psqlquery(pypostgresshards.TABLESQL,dbname,connargs,env)}
+    except Exception as ex:
+        print(f"INFO: Table sizes not available for progress ETA. {ex}",flush=True)
+        return {}
+
+def archivetablesizes(archivedir):
+    #-------------------------------------------------------
+    # Function: archivetablesizes
+    # Desc: Read table data sizes from a directory format archive.
+    #       pg_restore -l maps each TABLE DATA item to its dump id
+    #       and the data is in <dumpid>.dat (.gz, .zst, .lz4).
+    # :archivedir: Directory format archive
+    # :return: Dictionary of schema.table to bytes. Empty if
+    #          the table of contents could not be read.
+    #-------------------------------------------------------
+    result=subprocess.run(["pg_restore","-l",archivedir],capture_output=True,text=True)
+    if (result.returncode != 0):
+        return {}
+    sizes={}
+    for line in result.stdout.splitlines():
+        match=TOCDATALINE.match(line)
+        if match is None:
+            continue
+        size=0
+        for extension in (".dat",".dat.gz",".dat.zst",".dat.lz4"):
+            datafile=os.path.join(archivedir,match.group(1) + extension)
+            if os.path.isfile(datafile):
+                size+=os.path.getsize(datafile)
+        sizes[f"{match.group(2)}.{match.group(3)}"]=size
+    return sizes
+
+def runcommand(cmd,monitor,env=None):
+    #-------------------------------------------------------
+    # Function: runcommand
+    # Desc: Run a shell command line with its stderr read by
+    #       the progress monitor
+    # :cmd: Shell command line to run
+    # :monitor: ProgressMonitor
+    # :env: Environment for the command. None=Inherit
+    # :return: Command return code
+    #-------------------------------------------------------
+    proc=subprocess.Popen(cmd,shell=True,stderr=subprocess.PIPE,env=env)
+    monitor.watch(proc.stderr)
+    return proc.wait()
+
+class CountingReader:
+    #-------------------------------------------------------
+    # Class: CountingReader
+    # Desc: Readable stream that counts the bytes read from src
+    #-------------------------------------------------------
+
+    def __init__(self,src):
+        self.src=src
+        self.bytesread=0
+
+    def read(self,size=-1):
+        data=self.src.read(size)
+        self.bytesread+=len(data)
+        return data
+
+class ProgressMonitor:
+    #-------------------------------------------------------
+    # Class: ProgressMonitor
+    # Desc: Track pg_dump or pg_restore progress from their
+    #       --verbose stderr lines and print a PROGRESS line
+    #       every interval seconds from a timer thread.
+    #-------------------------------------------------------
+
+    def __init__(self,label,interval,tablesizes=None,totalbytes=0,bytesfunction=None,parallel=False):
+        #-------------------------------------------------------
+        # :label: Phase shown on the progress line. Ex: dump
+        # :interval: Seconds between progress lines. 0=Only the
+        #            final progress line
+        # :tablesizes: Dictionary of schema.table to bytes
+        # :totalbytes: Total bytes expected. 0=Sum of table sizes
+        # :bytesfunction: Function returning the bytes moved so far.
+        #                 None=Sizes of the tables finished so far
+        # :parallel: True=Several tables run at the same time and
+        #            finish with a finished item line
+        #-------------------------------------------------------
+        self.label=label
+        self.interval=interval
+        self.tablesizes=tablesizes if tablesizes is not None else {}
+        self.totalbytes=totalbytes if totalbytes > 0 else sum(self.tablesizes.values())
+        self.bytesfunction=bytesfunction
+        self.parallel=parallel
+        self.objects=0
+        self.currenttables=[]
+        self.donetables=set()
+        self.donebytes=0
+        self.starttime=time.monotonic()
+        self.lock=threading.Lock()
+        self.watchers=[]
+        self.stopped=threading.Event()
+        self.timer=None
+        if (interval > 0):
+            self.timer=threading.Thread(target=self.run,daemon=True)
+            self.timer.start()
+
+    def countreader(self,src):
+        #-------------------------------------------------------
+        # Function: countreader
+        # Desc: Count the bytes read from src as the bytes moved
+        # :src: Readable binary stream
+        # :return: Readable binary stream
+        #-------------------------------------------------------
+        reader=CountingReader(src)
+        self.bytesfunction=lambda: reader.bytesread
+        return reader
+
+    def watch(self,stream):
+        #-------------------------------------------------------
+        # Function: watch
+        # Desc: Read --verbose lines from a child process stderr
+        #       pipe on a thread. Lines are passed on to stderr.
+        # :stream: Binary stderr pipe
+        #-------------------------------------------------------
+        def readlines():
+            for line in stream:
+                sys.stderr.write(line.decode(errors="replace"))
+                sys.stderr.flush()
+                self.feedline(line.decode(errors="replace"))
+        thread=threading.Thread(target=readlines,daemon=True)
+        thread.start()
+        self.watchers.append(thread)
+
+    def feedline(self,line):
+        #-------------------------------------------------------
+        # Function: feedline
+        # Desc: Update progress from one --verbose line
+        # :line: Line of pg_dump or pg_restore stderr
+        #-------------------------------------------------------
+        with self.lock:
+            if OBJECTLINE.search(line):
+                self.objects+=1
+            match=TABLESTARTLINE.search(line)
+            if match is not None:
+                # Serial runs handle one table at a time so the previous one is done
+                if (len(self.currenttables) > 0 and self.parallel==False):
+                    self.tabledone(self.currenttables.pop())
+                self.currenttables.append(match.group(1))
+                return
+            match=TABLEDONELINE.search(line)
+            if match is not None:
+                # pg_restore names schema and table, pg_dump only the table
+                self.tabledone(match.group(1).replace(" ","."))
+
+    def tabledone(self,table):
+        #-------------------------------------------------------
+        # Function: tabledone
+        # Desc: Mark a table finished. Called with the lock held.
+        # :table: schema.table or table name
+        #-------------------------------------------------------
+        if (table not in self.tablesizes):
+            for name in self.tablesizes:
+                if name.endswith("." + table):
+                    table=name
+                    break
+        if table in self.currenttables:
+            self.currenttables.remove(table)
+        # Only tables with a known size count towards the finished tables
+        if (table not in self.donetables and (table in self.tablesizes or len(self.tablesizes)==0)):
+            self.donetables.add(table)
+            self.donebytes+=self.tablesizes.get(table,0)
+
+    def addbytes(self,bytes):
+        #-------------------------------------------------------
+        # Function: addbytes
+        # Desc: Count bytes finished outside of the --verbose
+        #       lines. Ex: A restored shard.
+        # :bytes: Bytes finished
+        #-------------------------------------------------------
+        with self.lock:
+            self.donebytes+=bytes
+
+    def report(self,final=False):
+        #-------------------------------------------------------
+        # Function: report
+        # Desc: Print a PROGRESS line
+        # :final: True=Phase ended. No ETA is shown.
+        #-------------------------------------------------------
+        with self.lock:
+            elapsed=time.monotonic()-self.starttime
+            movedbytes=self.bytesfunction() if self.bytesfunction is not None else self.donebytes
+            fraction=0
+            if (self.totalbytes > 0):
+                # Dump text is not the same size as the table on disk so
+                # finished tables and bytes moved are both estimates
+                fraction=min(max(movedbytes,self.donebytes)/self.totalbytes,0.999)
+            line=f"PROGRESS: {self.label} {self.objects} objects"
+            if (len(self.tablesizes) > 0):
+                line+=f", {len(self.donetables)}/{len(self.tablesizes)} tables"
+            if (len(self.currenttables) > 0 and final==False):
+                line+=f", current table {self.currenttables[-1]}"
+            line+=f", {movedbytes/1024/1024:.1f} MB"
+            if (self.totalbytes > 0 and final==False):
+                line+=f" of {self.totalbytes/1024/1024:.1f} MB ({fraction*100:.1f}%)"
+            line+=f", {movedbytes/1024/1024/elapsed if elapsed > 0 else 0:.1f} MB/s, elapsed {formatseconds(elapsed)}"
+            if (final==False):
+                line+=f", ETA {formatseconds(elapsed*(1-fraction)/fraction) if fraction > 0 else 'unknown'}"
+        print(line,flush=True)
+
+    def run(self):
+        while (self.stopped.wait(self.interval)==False):
+            self.report()
+
+    def close(self):
+        #-------------------------------------------------------
+        # Function: close
+        # Desc: Wait for the stderr readers, stop the timer and
+        #       print the final PROGRESS line
+        #-------------------------------------------------------
+        for thread in self.watchers:
+            thread.join()
+        self.stopped.set()
+        if self.timer is not None:
+            self.timer.join()
+        with self.lock:
+            for table in list(self.currenttables):
+                self.tabledone(table)
+        self.report(final=True)
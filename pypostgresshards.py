@@ -0,0 +1,652 @@
+#------------------------------------------------
+# Script name: pypostgresshards.py
+#
+# Description:
+# Per-table sharded backup sets used by the PostgreSQL backup and restore
+# scripts. Table sizes are read from the catalog and the tables are planned
+# into shards. Each large table gets its own shard and small tables are
+# batched together. Every shard is dumped by its own pg_dump on a worker pool,
+# largest shard first, all from one exported snapshot so the backup set is
+# consistent like a single pg_dump.
+#
+# Backup set layout:
+# <outputdir>/backupset.json - Backup set manifest with the shard plan
+# <outputdir>/schema.dump - Custom format schema only dump (pre-data and post-data)
+# <outputdir>/shards/NNNN.dump - Custom format data only dump per shard
+# <outputdir>/shards/largeobjects.dump - Custom format dump of the large objects
+# <outputdir>/journal.jsonl - One line per completed dump file for resumes
+# <outputdir>/snapshot.lease - Lease file of a kept snapshot while it is held
+#
+# Checkpoints and resume:
+# Each dump is written to a .partial file and renamed when pg_dump succeeds,
+# then journaled with its size and SHA-256 by the worker that dumped it. The
+# backup set checksum is built from the journal so the set is not read again. Failed shards can be retried in the same run
+# from the same snapshot. A rerun against an incomplete backup set dumps only
+# the units missing from the journal when the resume policy allows it:
+#   snapshot=Only resume from the original snapshot. The snapshot is kept by a
+#   detached keeper process for the lease time after the last heartbeat of the
+#   backup, so a rerun within the lease sees the same data as the first run.
+#   schema=Also resume from a new snapshot when the schema fingerprint (tables,
+#   columns and types) is unchanged. Shards dumped before and after the resume
+#   are each consistent but not with each other. Only use it for tables that
+#   are not changed together (Ex: append-only or partitioned history tables).
+# Otherwise the incomplete backup set is removed and dumped again from scratch.
+# A kept snapshot holds back VACUUM cleanup on the server until it ends.
+#
+# Restore order:
+# pre-data from schema.dump, then data shards in parallel, then post-data
+# (indexes, constraints) from schema.dump with pg_restore --jobs.
+#
+# Pip packages needed:
+#------------------------------------------------
+
+#------------------------------------------------
+# Imports and Environment setup
+#------------------------------------------------
+import concurrent.futures
+import hashlib
+import json
+import os
+import os.path
+import shlex
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import pypostgresstream
+from pathlib import Path
+
+# Backup set manifest, journal and snapshot lease file names
+BACKUPSETFILE="backupset.json"
+JOURNALFILE="journal.jsonl"
+LEASEFILE="snapshot.lease"
+
+# Resume policies
+RESUMEPOLICIES=("none","snapshot","schema")
+
+# Seconds between snapshot lease heartbeats
+LEASEINTERVAL=10
+
+# Tables with data dumped by shards. Partitioned parents hold no data and
+# materialized views get refreshed in post-data.
+TABLESQL="""select n.nspname, c.relname, pg_table_size(c.oid)
+from pg_class c join pg_namespace n on n.oid=c.relnamespace
+where c.relkind='r' and c.relpersistence<>'t'
+and n.nspname not in ('pg_catalog','information_schema') and n.nspname not like 'pg_toast%'
+order by 3 desc"""
+
+# Sequences get their values restored from the sequence shard
+SEQUENCESQL="""select n.nspname, c.relname, 0
+from pg_class c join pg_namespace n on n.oid=c.relnamespace
+where c.relkind='S' and n.nspname not in ('pg_catalog','information_schema')
+order by 1,2"""
+
+# Large objects get their own shard. pg_largeobject size orders it with the table shards.
+LARGEOBJECTSQL="""select count(*), pg_total_relation_size('pg_catalog.pg_largeobject') from pg_catalog.pg_largeobject_metadata"""
+
+# Schema fingerprint of the tables, columns and types. A resume from a new
+# snapshot needs the same fingerprint as the backup set.
+FINGERPRINTSQL="""select md5(coalesce(string_agg(format('%I.%I:%s:%s:%s',n.nspname,c.relname,c.relkind,
+  coalesce(a.attname,''),coalesce(format_type(a.atttypid,a.atttypmod),'')),',' order by n.nspname,c.relname,a.attnum),''))
+from pg_class c join pg_namespace n on n.oid=c.relnamespace
+left join pg_attribute a on a.attrelid=c.oid and a.attnum>0 and not a.attisdropped
+where c.relkind in ('r','p','S','v','m') and c.relpersistence<>'t'
+and n.nspname not in ('pg_catalog','information_schema') and n.nspname not like 'pg_toast%'"""
+
+#------------------------------------------------
+# Define some useful functions
+#------------------------------------------------
+
+def connectionargs(dbhost,dbport,dbuser):
+    #-------------------------------------------------------
+    # Function: connectionargs
+    # Desc: Build PostgreSQL client connection arguments
+    # :dbhost: Database host. Blank=use local domain socket
+    # :dbport: Database port
+    # :dbuser: Database user
+    # :return: List of command line arguments
+    #-------------------------------------------------------
+    connargs=[]
+    if (dbhost.strip()!=""):
+        connargs+=["-h",dbhost]
+    return connargs + ["-p",str(dbport),"-U",dbuser]
+
+def tablepattern(schema,name):
+    #-------------------------------------------------------
+    # Function: tablepattern
+    # Desc: Quote a table name as an exact pg_dump -t pattern
+    # :schema: Schema name
+    # :name: Table name
+    # :return: Pattern. Ex: "public"."mytable"
+    #-------------------------------------------------------
+    return '"' + schema.replace('"','""') + '"."' + name.replace('"','""') + '"'
+
+def psqlquery(sql,dbname,connargs,env,snapshot=""):
+    #-------------------------------------------------------
+    # Function: psqlquery
+    # Desc: Run a query with psql and return the rows. The query
+    #       runs in the exported snapshot when one is passed.
+    # :sql: Query to run
+    # :dbname: Database name
+    # :connargs: Connection arguments from connectionargs
+    # :env: Environment with PGPASSWORD
+    # :snapshot: Exported snapshot id. Blank=No snapshot
+    # :return: List of rows. Each row is a list of column strings
+    #-------------------------------------------------------
+    script=sql + ";\n"
+    if (snapshot!=""):
+        script=f"begin isolation level repeatable read read only;\nset transaction snapshot '{snapshot}';\n{sql};\ncommit;\n"
+    result=subprocess.run(["psql","-X","-q","-A","-t","-F","\t","-v","ON_ERROR_STOP=1","-d",dbname] + connargs,
+                          input=script,capture_output=True,text=True,env=env)
+    if (result.returncode != 0):
+        raise Exception(f"Error {result.returncode} occurred while running psql query. {result.stderr.strip()}")
+    return [line.split("\t") for line in result.stdout.splitlines() if line!=""]
+
+class SnapshotHolder:
+    #-------------------------------------------------------
+    # Class: SnapshotHolder
+    # Desc: Keep a psql session open in a repeatable read
+    #       transaction that exported its snapshot. Other
+    #       sessions can use the snapshot until close().
+    #-------------------------------------------------------
+
+    def __init__(self,dbname,connargs,env):
+        self.proc=subprocess.Popen(["psql","-X","-q","-A","-t","-v","ON_ERROR_STOP=1","-d",dbname] + connargs,
+                                   stdin=subprocess.PIPE,stdout=subprocess.PIPE,text=True,env=env)
+        self.proc.stdin.write("begin isolation level repeatable read read only;\nselect pg_export_snapshot();\n")
+        self.proc.stdin.flush()
+        self.snapshot=self.proc.stdout.readline().strip()
+        if (self.snapshot==""):
+            self.proc.wait()
+            raise Exception(f"Error {self.proc.returncode} occurred while exporting snapshot for database {dbname}")
+
+    def close(self,release=True):
+        # The session always ends with this process so release is ignored
+        if (self.proc.poll() is None):
+            self.proc.stdin.write("commit;\n")
+            self.proc.stdin.close()
+            self.proc.wait()
+
+class SnapshotKeeper:
+    #-------------------------------------------------------
+    # Class: SnapshotKeeper
+    # Desc: Keep an exported snapshot in a detached keeper
+    #       process that outlives this process. A heartbeat
+    #       thread touches the lease file and the keeper ends
+    #       the snapshot when the lease file is removed or has
+    #       not been touched for the lease seconds.
+    # :leasefile: Lease file path
+    # :lease: Seconds the snapshot is kept after the last heartbeat
+    # :snapshot: Snapshot id of a running keeper to adopt. Blank=Start a keeper
+    #-------------------------------------------------------
+
+    def __init__(self,dbname,connargs,env,leasefile,lease,snapshot=""):
+        self.leasefile=leasefile
+        self.snapshot=snapshot
+        self.stopevent=threading.Event()
+        if (self.snapshot==""):
+            Path(leasefile).touch()
+            proc=subprocess.Popen([sys.executable,os.path.abspath(__file__),"keepsnapshot",leasefile,str(lease),dbname] + connargs,
+                                  stdin=subprocess.DEVNULL,stdout=subprocess.PIPE,text=True,env=env,start_new_session=True)
+            self.snapshot=proc.stdout.readline().strip()
+            proc.stdout.close()
+            if (self.snapshot==""):
+                proc.wait()
+                raise Exception(f"Error {proc.returncode} occurred while exporting snapshot for database {dbname}")
+        self.thread=threading.Thread(target=self.heartbeat,daemon=True)
+        self.thread.start()
+
+    def heartbeat(self):
+        while not self.stopevent.wait(LEASEINTERVAL):
+            try:
+                os.utime(self.leasefile)
+            except OSError:
+                pass
+
+    def close(self,release=True):
+        #-------------------------------------------------------
+        # Function: close
+        # Desc: Stop the heartbeat
+        # :release: True=End the snapshot now. False=Keep it for
+        #           the lease seconds so a rerun can resume from it
+        #-------------------------------------------------------
+        self.stopevent.set()
+        self.thread.join()
+        if (release and os.path.isfile(self.leasefile)):
+            os.remove(self.leasefile)
+
+def keepsnapshot(leasefile,lease,dbname,connargs):
+    #-------------------------------------------------------
+    # Function: keepsnapshot
+    # Desc: Keeper process started by SnapshotKeeper. Exports a
+    #       snapshot, prints its id and holds the transaction open
+    #       while the lease file is fresh.
+    # :leasefile: Lease file path
+    # :lease: Seconds without a heartbeat before the snapshot ends
+    # :return: psql return code
+    #-------------------------------------------------------
+    proc=subprocess.Popen(["psql","-X","-q","-A","-t","-v","ON_ERROR_STOP=1","-d",dbname] + connargs,
+                          stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=subprocess.PIPE,text=True)
+    # An idle in transaction timeout on the server would end the snapshot early
+    proc.stdin.write("set idle_in_transaction_session_timeout=0;\nbegin isolation level repeatable read read only;\nselect pg_export_snapshot();\n")
+    proc.stdin.flush()
+    snapshot=proc.stdout.readline().strip()
+    if (snapshot==""):
+        sys.stderr.write(proc.stderr.read())
+    print(snapshot,flush=True)
+    # Let go of the backup output so a pipe reading it isn't held open
+    sys.stdout.close()
+    os.dup2(os.open(os.devnull,os.O_WRONLY),2)
+    while (snapshot!="" and proc.poll() is None):
+        time.sleep(LEASEINTERVAL/2)
+        try:
+            if (time.time() - os.path.getmtime(leasefile) > lease):
+                break
+        except OSError:
+            break
+    if (proc.poll() is None):
+        proc.stdin.write("commit;\n")
+        proc.stdin.close()
+    return proc.wait()
+
+def snapshotvalid(snapshot,dbname,connargs,env):
+    #-------------------------------------------------------
+    # Function: snapshotvalid
+    # Desc: Check if an exported snapshot can still be imported
+    # :snapshot: Exported snapshot id
+    # :return: True if the snapshot is still held
+    #-------------------------------------------------------
+    try:
+        psqlquery("select 1",dbname,connargs,env,snapshot)
+        return True
+    except Exception:
+        return False
+
+def planshards(tables,shardsize):
+    #-------------------------------------------------------
+    # Function: planshards
+    # Desc: Plan tables into shards. Tables at least shardsize
+    #       bytes get their own shard. Smaller tables are packed
+    #       into shards of up to shardsize bytes, largest first.
+    # :tables: List of (schema,name,size) sorted by size descending
+    # :shardsize: Target shard size in bytes
+    # :return: List of shards sorted largest first. Each shard
+    #          is a dictionary with tables and bytes.
+    #-------------------------------------------------------
+    shards=[]
+    openshards=[]
+    for (schema,name,size) in sorted(tables,key=lambda table: table[2],reverse=True):
+        if (size >= shardsize):
+            shards.append({"tables":[[schema,name]],"bytes":size})
+            continue
+        # First fit decreasing into the open batch shards
+        for shard in openshards:
+            if (shard["bytes"] + size <= shardsize):
+                shard["tables"].append([schema,name])
+                shard["bytes"]+=size
+                break
+        else:
+            shard={"tables":[[schema,name]],"bytes":size}
+            openshards.append(shard)
+            shards.append(shard)
+    shards.sort(key=lambda shard: shard["bytes"],reverse=True)
+    for (index,shard) in enumerate(shards):
+        shard["file"]=os.path.join("shards",f"{index+1:04d}.dump")
+    return shards
+
+def runpool(tasks,workers,function):
+    #-------------------------------------------------------
+    # Function: runpool
+    # Desc: Run tasks on a bounded worker pool in list order.
+    #       Pass tasks largest first so the longest run first.
+    # :tasks: List of task arguments
+    # :workers: Number of workers
+    # :function: Function called with each task. Returns a
+    #            return code. 0=Success
+    # :return: List of (task,return code) in completion order
+    #-------------------------------------------------------
+    results=[]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures={executor.submit(function,task):task for task in tasks}
+        for future in concurrent.futures.as_completed(futures):
+            results.append((futures[future],future.result()))
+    return results
+
+def runcommand(cmd,env):
+    #-------------------------------------------------------
+    # Function: runcommand
+    # Desc: Print and run a command argument list
+    # :cmd: Command argument list
+    # :env: Environment with PGPASSWORD
+    # :return: Command return code
+    #-------------------------------------------------------
+    print(shlex.join(cmd),flush=True)
+    return subprocess.run(cmd,env=env).returncode
+
+def dumpshard(shard,dbname,connargs,env,outputdir,snapshot,compressargs):
+    #-------------------------------------------------------
+    # Function: dumpshard
+    # Desc: Dump the data of the tables in one shard to a
+    #       .partial file renamed to the shard file on success
+    # :shard: Shard dictionary from planshards
+    # :return: pg_dump return code
+    #-------------------------------------------------------
+    shardfile=os.path.join(outputdir,shard["file"])
+    cmd=["pg_dump","-F","c","--data-only","--snapshot",snapshot,"-d",dbname] + connargs + compressargs
+    if (shard.get("largeobjects",0) > 0):
+        # Large objects only. -b adds them and the table data of every table is left out.
+        cmd+=["-b","--exclude-table-data","*.*"]
+        description=f"{shard['largeobjects']} large objects"
+    else:
+        for (schema,name) in shard["tables"]:
+            cmd+=["-t",tablepattern(schema,name)]
+        description=f"{len(shard['tables'])} tables"
+    cmd+=["-f",shardfile + ".partial"]
+    starttime=time.monotonic()
+    print(f"INFO: Starting shard {shard['file']} with {description} and {shard['bytes']} bytes - {time.strftime('%H:%M:%S')}",flush=True)
+    rtncmd=runcommand(cmd,env)
+    shard["seconds"]=round(time.monotonic()-starttime,3)
+    if (rtncmd==0):
+        os.replace(shardfile + ".partial",shardfile)
+        shard["size"]=os.path.getsize(shardfile)
+        shard["snapshot"]=snapshot
+    print(f"INFO: Completed shard {shard['file']} with return code {rtncmd} - {time.strftime('%H:%M:%S')}",flush=True)
+    return rtncmd
+
+def dumpschema(schemafile,dbname,connargs,env,outputdir,snapshot):
+    #-------------------------------------------------------
+    # Function: dumpschema
+    # Desc: Dump the schema of the backup set to a .partial
+    #       file renamed to the schema file on success
+    # :schemafile: Schema file name in the backup set
+    # :return: pg_dump return code
+    #-------------------------------------------------------
+    schemapath=os.path.join(outputdir,schemafile)
+    rtncmd=runcommand(["pg_dump","-F","c","--schema-only","--snapshot",snapshot,"-d",dbname] + connargs +
+                      ["--verbose","-f",schemapath + ".partial"],env)
+    if (rtncmd==0):
+        os.replace(schemapath + ".partial",schemapath)
+    return rtncmd
+
+def retry(function,name,retries):
+    #-------------------------------------------------------
+    # Function: retry
+    # Desc: Run a dump until it succeeds or the retries are used
+    # :function: Function returning a return code. 0=Success
+    # :name: Dump file name for messages
+    # :retries: Number of retries after the first attempt
+    # :return: Last return code
+    #-------------------------------------------------------
+    rtncmd=function()
+    for attempt in range(retries):
+        if (rtncmd==0):
+            break
+        print(f"INFO: Retrying {name} after return code {rtncmd}. Retry {attempt+1} of {retries} - {time.strftime('%H:%M:%S')}",flush=True)
+        rtncmd=function()
+    return rtncmd
+
+journallock=threading.Lock()
+
+def appendjournal(outputdir,dumpfile,snapshot):
+    #-------------------------------------------------------
+    # Function: appendjournal
+    # Desc: Record a completed dump file in the journal. The
+    #       line is synced to disk before the dump counts as done.
+    # :outputdir: Backup set directory
+    # :dumpfile: Dump file name in the backup set
+    # :snapshot: Snapshot the file was dumped from
+    #-------------------------------------------------------
+    dumppath=os.path.join(outputdir,dumpfile)
+    entry={"file":dumpfile,"size":os.path.getsize(dumppath),"sha256":pypostgresstream.filechecksum(dumppath),
+           "snapshot":snapshot,"completed":time.strftime('%Y-%m-%d %H:%M:%S')}
+    with journallock:
+        with open(os.path.join(outputdir,JOURNALFILE),"a") as outfile:
+            outfile.write(json.dumps(entry) + "\n")
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+def readjournal(outputdir):
+    #-------------------------------------------------------
+    # Function: readjournal
+    # Desc: Read the completed dump files of a backup set. Files
+    #       missing or with a different size than journaled are
+    #       left out. A torn last line from a crash is skipped.
+    # :outputdir: Backup set directory
+    # :return: Dictionary of dump file name to journal entry
+    #-------------------------------------------------------
+    completed={}
+    journalfile=os.path.join(outputdir,JOURNALFILE)
+    if (os.path.isfile(journalfile)==False):
+        return completed
+    with open(journalfile,"r") as infile:
+        for line in infile:
+            try:
+                entry=json.loads(line)
+            except ValueError:
+                continue
+            dumppath=os.path.join(outputdir,entry["file"])
+            if (os.path.isfile(dumppath) and os.path.getsize(dumppath)==entry["size"]):
+                completed[entry["file"]]=entry
+    return completed
+
+def setchecksum(outputdir):
+    #-------------------------------------------------------
+    # Function: setchecksum
+    # Desc: Get the checksum of a backup set from the journaled
+    #       SHA-256 of its dump files. It covers the relative
+    #       name and SHA-256 of every dump file in name order.
+    # :outputdir: Backup set directory
+    # :return: SHA-256 hex digest or blank if a dump file has no
+    #          journaled checksum
+    #-------------------------------------------------------
+    backupset=readbackupset(outputdir)
+    if backupset is None:
+        return ""
+    completed=readjournal(outputdir)
+    names=[backupset["schema"]] + [shard["file"] for shard in backupset["shards"]]
+    if any(completed.get(name,{}).get("sha256","")=="" for name in names):
+        return ""
+    sha256=hashlib.sha256()
+    for name in sorted(names):
+        sha256.update(f"{completed[name]['sha256']}  {name}\n".encode())
+    return sha256.hexdigest()
+
+def schemafingerprint(dbname,connargs,env,snapshot):
+    #-------------------------------------------------------
+    # Function: schemafingerprint
+    # Desc: Get the schema fingerprint of a snapshot
+    # :snapshot: Exported snapshot
+    # :return: Fingerprint or blank if the server returned none
+    #-------------------------------------------------------
+    rows=psqlquery(FINGERPRINTSQL,dbname,connargs,env,snapshot)
+    return rows[0][0] if len(rows) > 0 else ""
+
+def resumesnapshot(backupset,outputdir,dbname,connargs,env,resume,lease):
+    #-------------------------------------------------------
+    # Function: resumesnapshot
+    # Desc: Get a snapshot to resume an incomplete backup set
+    #       from as allowed by the resume policy
+    # :backupset: Backup set dictionary of the incomplete backup set
+    # :resume: Resume policy. snapshot or schema
+    # :lease: Seconds to keep a new snapshot after the last heartbeat. 0=No keeper
+    # :return: (SnapshotKeeper or SnapshotHolder or None,reason)
+    #-------------------------------------------------------
+    leasefile=os.path.join(outputdir,LEASEFILE)
+    snapshot=backupset.get("snapshots",[backupset["snapshot"]])[-1]
+    # Touch the lease first so the keeper doesn't expire during the check
+    if os.path.isfile(leasefile):
+        if (time.time() - os.path.getmtime(leasefile) < LEASEINTERVAL*2):
+            raise Exception(f"Backup set {outputdir} is still being dumped by another backup. Retry in {LEASEINTERVAL*2} seconds.")
+        os.utime(leasefile)
+        if snapshotvalid(snapshot,dbname,connargs,env):
+            return (SnapshotKeeper(dbname,connargs,env,leasefile,lease,snapshot),f"Snapshot {snapshot} is still held")
+    if (resume!="schema"):
+        return (None,f"Snapshot {snapshot} is no longer held")
+    holder=newsnapshot(outputdir,dbname,connargs,env,lease)
+    # A blank fingerprint cannot show the schema is unchanged
+    fingerprint=schemafingerprint(dbname,connargs,env,holder.snapshot)
+    if (fingerprint=="" or fingerprint!=backupset.get("fingerprint")):
+        holder.close()
+        return (None,f"Snapshot {snapshot} is no longer held and the schema has changed")
+    return (holder,f"Snapshot {snapshot} is no longer held and the schema is unchanged. Resuming from new snapshot {holder.snapshot}")
+
+def newsnapshot(outputdir,dbname,connargs,env,lease):
+    #-------------------------------------------------------
+    # Function: newsnapshot
+    # Desc: Export a new snapshot for a backup set
+    # :lease: Seconds to keep the snapshot after the last heartbeat. 0=No keeper
+    # :return: SnapshotKeeper or SnapshotHolder
+    #-------------------------------------------------------
+    if (lease > 0):
+        return SnapshotKeeper(dbname,connargs,env,os.path.join(outputdir,LEASEFILE),lease)
+    return SnapshotHolder(dbname,connargs,env)
+
+def writebackupset(outputdir,backupset):
+    #-------------------------------------------------------
+    # Function: writebackupset
+    # Desc: Write the backup set manifest
+    # :outputdir: Backup set directory
+    # :backupset: Backup set dictionary
+    #-------------------------------------------------------
+    backupsetfile=os.path.join(outputdir,BACKUPSETFILE)
+    with open(backupsetfile + ".tmp","w") as outfile:
+        json.dump(backupset,outfile,indent=1)
+    os.replace(backupsetfile + ".tmp",backupsetfile)
+
+def readbackupset(inputdir):
+    #-------------------------------------------------------
+    # Function: readbackupset
+    # Desc: Read the backup set manifest if the input is a
+    #       sharded backup set directory
+    # :inputdir: Backup input file or directory
+    # :return: Backup set dictionary or None if not a backup set
+    #-------------------------------------------------------
+    backupsetfile=os.path.join(inputdir,BACKUPSETFILE)
+    if (os.path.isfile(backupsetfile)==False):
+        return None
+    with open(backupsetfile,"r") as infile:
+        return json.load(infile)
+
+def restoreshard(shard,dbname,connargs,env,inputdir,monitor=None):
+    #-------------------------------------------------------
+    # Function: restoreshard
+    # Desc: Restore the data of one shard
+    # :shard: Shard dictionary from the backup set
+    # :monitor: Progress monitor to add the shard size to. None=No progress
+    # :return: pg_restore return code
+    #-------------------------------------------------------
+    cmd=["pg_restore","--data-only","-d",dbname] + connargs + ["--verbose",os.path.join(inputdir,shard["file"])]
+    print(f"INFO: Starting restore of shard {shard['file']} - {time.strftime('%H:%M:%S')}",flush=True)
+    rtncmd=runcommand(cmd,env)
+    print(f"INFO: Completed restore of shard {shard['file']} with return code {rtncmd} - {time.strftime('%H:%M:%S')}",flush=True)
+    if (monitor is not None and rtncmd==0):
+        monitor.addbytes(shard.get("size",0))
+    return rtncmd
+
+def dumpbackupset(outputdir,dbname,connargs,env,jobs,shardsize,compressargs,resume="none",retries=0,lease=0,statsfunction=None):
+    #-------------------------------------------------------
+    # Function: dumpbackupset
+    # Desc: Dump a sharded backup set. Exports a snapshot, plans
+    #       the shards from catalog table sizes, dumps the schema
+    #       and then the shards on the worker pool. An incomplete
+    #       backup set is resumed when the resume policy allows it.
+    # :outputdir: Backup set directory to create or resume
+    # :dbname: Database name
+    # :connargs: Connection arguments from connectionargs
+    # :env: Environment with PGPASSWORD
+    # :jobs: Number of shards to dump at the same time
+    # :shardsize: Target shard size in bytes
+    # :compressargs: pg_dump compression arguments. Ex: ["-Z","6"]
+    # :resume: Resume policy. none, snapshot or schema
+    # :retries: Number of retries of a failed dump in the same run
+    # :lease: Seconds to keep the snapshot after a failed run. 0=No keeper
+    # :statsfunction: Function called with the snapshot after the dumps
+    #                 succeed, while it is still held. None=No call
+    # :return: (return code,backup set dictionary)
+    #-------------------------------------------------------
+    holder=None
+    rtncmd=-1
+    backupset=None
+    if (resume!="none"):
+        backupset=readbackupset(outputdir)
+    try:
+        if (backupset is not None):
+            (holder,reason)=resumesnapshot(backupset,outputdir,dbname,connargs,env,resume,lease)
+            if (holder is None):
+                print(f"INFO: Backup set {outputdir} cannot be resumed. {reason}. Dumping it again from scratch.",flush=True)
+                shutil.rmtree(outputdir)
+                backupset=None
+            else:
+                print(f"INFO: Resuming backup set {outputdir}. {reason} - {time.strftime('%H:%M:%S')}",flush=True)
+                backupset.setdefault("snapshots",[backupset["snapshot"]])
+                if (holder.snapshot not in backupset["snapshots"]):
+                    backupset["snapshots"].append(holder.snapshot)
+                backupset["resumes"]=backupset.get("resumes",0) + 1
+        if (backupset is None):
+            os.makedirs(os.path.join(outputdir,"shards"))
+            holder=newsnapshot(outputdir,dbname,connargs,env,lease if resume!="none" else 0)
+            print(f"INFO: Exported snapshot {holder.snapshot} - {time.strftime('%H:%M:%S')}",flush=True)
+            tables=[(row[0],row[1],int(row[2])) for row in psqlquery(TABLESQL,dbname,connargs,env,holder.snapshot)]
+            sequences=[[row[0],row[1]] for row in psqlquery(SEQUENCESQL,dbname,connargs,env,holder.snapshot)]
+            shards=planshards(tables,shardsize)
+            # Schema only and per table dumps leave out large objects so they get a shard of their own
+            largeobjects=psqlquery(LARGEOBJECTSQL,dbname,connargs,env,holder.snapshot)
+            if (len(largeobjects) > 0 and int(largeobjects[0][0]) > 0):
+                shards.append({"tables":[],"bytes":int(largeobjects[0][1]),"file":os.path.join("shards","largeobjects.dump"),
+                               "largeobjects":int(largeobjects[0][0])})
+                shards.sort(key=lambda shard: shard["bytes"],reverse=True)
+            if (len(sequences) > 0):
+                shards.append({"tables":sequences,"bytes":0,"file":os.path.join("shards","sequences.dump")})
+            print(f"INFO: Planned {len(shards)} shards for {len(tables)} tables, {len(sequences)} sequences and "
+                  f"{int(largeobjects[0][0]) if len(largeobjects) > 0 else 0} large objects",flush=True)
+            backupset={"format":"shards","dbname":dbname,"snapshot":holder.snapshot,"snapshots":[holder.snapshot],
+                       "fingerprint":schemafingerprint(dbname,connargs,env,holder.snapshot),
+                       "created":time.strftime('%Y-%m-%d %H:%M:%S'),"status":"running",
+                       "schema":"schema.dump","shardsize":shardsize,"shards":shards}
+        backupset["status"]="running"
+        writebackupset(outputdir,backupset)
+
+        # Only dump the files missing from the journal
+        completed=readjournal(outputdir)
+        for shard in backupset["shards"]:
+            if shard["file"] in completed:
+                shard["size"]=completed[shard["file"]]["size"]
+                shard["snapshot"]=completed[shard["file"]]["snapshot"]
+        pending=[shard for shard in backupset["shards"] if shard["file"] not in completed]
+        if (len(completed) > 0):
+            print(f"INFO: {len(completed)} dump files already completed. {len(pending)} of {len(backupset['shards'])} shards to dump",flush=True)
+
+        # Schema first so a failed schema dump doesn't wait for the shards
+        rtncmd=0
+        if backupset["schema"] not in completed:
+            rtncmd=retry(lambda: dumpschema(backupset["schema"],dbname,connargs,env,outputdir,holder.snapshot),backupset["schema"],retries)
+            if (rtncmd==0):
+                appendjournal(outputdir,backupset["schema"],holder.snapshot)
+        if (rtncmd==0):
+            def dumpunit(shard):
+                unitrtncmd=retry(lambda: dumpshard(shard,dbname,connargs,env,outputdir,holder.snapshot,compressargs),shard["file"],retries)
+                if (unitrtncmd==0):
+                    appendjournal(outputdir,shard["file"],holder.snapshot)
+                return unitrtncmd
+            results=runpool(pending,jobs,dumpunit)
+            failed=[result for result in results if result[1]!=0]
+            if (len(failed) > 0):
+                rtncmd=failed[0][1]
+                print(f"INFO: {len(failed)} of {len(backupset['shards'])} shards failed: {','.join(result[0]['file'] for result in failed)}",flush=True)
+        if (rtncmd==0 and statsfunction is not None):
+            statsfunction(holder.snapshot)
+        backupset["status"]="complete" if rtncmd==0 else "failed"
+        writebackupset(outputdir,backupset)
+        return (rtncmd,backupset)
+    finally:
+        # Keep the snapshot of a failed resumable run for the lease time
+        if (holder is not None):
+            holder.close(rtncmd==0 or resume=="none")
+            if (rtncmd!=0 and resume!="none" and isinstance(holder,SnapshotKeeper)):
+                print(f"INFO: Snapshot {holder.snapshot} is kept for {lease:g} seconds to resume backup set {outputdir}",flush=True)
+
+if __name__=="__main__":
+    if (len(sys.argv) > 5 and sys.argv[1]=="keepsnapshot"):
+        sys.exit(keepsnapshot(sys.argv[2],float(sys.argv[3]),sys.argv[4],sys.argv[5:]))
+    sys.exit(f"Usage: {sys.argv[0]} keepsnapshot <leasefile> <seconds> <dbname> [connection arguments]")
@@ -0,0 +1,494 @@
+#------------------------------------------------
+# Script name: pypostgresstream.py
+#
+# Description:
+# Stream helper functions shared by the PostgreSQL backup and restore scripts.
+# The backup scripts pipe pg_dump output through these functions instead of
+# letting the shell redirect it straight into the output file.
+#
+# Compression codecs:
+# gzip=Python gzip module in-process or gzip command pipeline.
+# zstd=zstandard pip package in-process or zstd command pipeline.
+# lz4=lz4 pip package in-process or lz4 command pipeline.
+#
+# Pip packages needed:
+# zstandard - Optional. Only needed for in-process zstd compression.
+# lz4 - Optional. Only needed for in-process lz4 compression.
+#------------------------------------------------
+
+#------------------------------------------------
+# Imports and Environment setup
+#------------------------------------------------
+import gzip
+import hashlib
+import json
+import subprocess
+import threading
+import time
+
+# zstd and lz4 are optional. The command pipeline is used when they are missing.
+try:
+    import zstandard
+except ImportError:
+    zstandard=None
+try:
+    import lz4.frame
+except ImportError:
+    lz4=None
+
+# Size of each read from the child process pipe
+BUFFERSIZE=1024*1024
+
+# Tar block size
+TARBLOCKSIZE=512
+
+# Compression codecs. File extension, default level and command line program.
+CODECS={
+    "gzip":{"extension":".gz","level":6,"command":"gzip"},
+    "zstd":{"extension":".zst","level":3,"command":"zstd"},
+    "lz4":{"extension":".lz4","level":1,"command":"lz4"},
+}
+
+#------------------------------------------------
+# Define some useful functions
+#------------------------------------------------
+
+def throttle(bytescopied,starttime,maxmbps):
+    #-------------------------------------------------------
+    # Function: throttle
+    # Desc: Sleep long enough to keep the average copy rate
+    #       at or below the selected MB/s cap.
+    # :bytescopied: Bytes copied since starttime
+    # :starttime: time.monotonic() value when the copy started
+    # :maxmbps: Maximum MB/s. 0=No limit
+    # :return: Seconds slept
+    #-------------------------------------------------------
+    if (maxmbps <= 0):
+        return 0
+    # Time the copy should have taken at the capped rate
+    expected=bytescopied / (maxmbps*1024*1024)
+    elapsed=time.monotonic() - starttime
+    if (expected > elapsed):
+        time.sleep(expected - elapsed)
+        return expected - elapsed
+    return 0
+
+def filechecksum(path):
+    #-------------------------------------------------------
+    # Function: filechecksum
+    # Desc: Get the SHA-256 checksum of a file
+    # :path: File path
+    # :return: SHA-256 hex digest
+    #-------------------------------------------------------
+    sha256=hashlib.sha256()
+    with open(path,"rb") as infile:
+        while True:
+            data=infile.read(BUFFERSIZE)
+            if not data:
+                break
+            sha256.update(data)
+    return sha256.hexdigest()
+
+def copystream(src,dst,maxmbps=0,limiter=None):
+    #-------------------------------------------------------
+    # Function: copystream
+    # Desc: Copy a binary stream to another stream in BUFFERSIZE
+    #       blocks with an optional MB/s cap.
+    # :src: Readable binary stream. Ex: pg_dump stdout pipe
+    # :dst: Writable binary stream. Ex: Output tar file
+    # :maxmbps: Maximum MB/s to write. 0=No limit
+    # :limiter: Rate limiter with a consume(bytes) method used
+    #           instead of maxmbps. Ex: pypostgresthrottle.TokenBucket
+    # :return: Number of bytes copied
+    #-------------------------------------------------------
+    bytescopied=0
+    starttime=time.monotonic()
+    while True:
+        data=src.read(BUFFERSIZE)
+        if not data:
+            break
+        dst.write(data)
+        bytescopied+=len(data)
+        if limiter is not None:
+            limiter.consume(len(data))
+        else:
+            throttle(bytescopied,starttime,maxmbps)
+    return bytescopied
+
+def codecfromfilename(filename):
+    #-------------------------------------------------------
+    # Function: codecfromfilename
+    # Desc: Get compression codec from the file extension
+    # :filename: Backup file name. Ex: /tmp/mydb.tar.zst
+    # :return: Codec name or "none" if not compressed
+    #-------------------------------------------------------
+    for codec in CODECS:
+        if filename.endswith(CODECS[codec]["extension"]):
+            return codec
+    return "none"
+
+def resolvecompressmode(codec,mode):
+    #-------------------------------------------------------
+    # Function: resolvecompressmode
+    # Desc: Resolve auto compress mode to inprocess when the
+    #       Python module for the codec is available, otherwise
+    #       pipeline through the codec command line program.
+    # :codec: gzip, zstd or lz4
+    # :mode: auto, inprocess or pipeline
+    # :return: inprocess or pipeline
+    #-------------------------------------------------------
+    if (mode != "auto"):
+        if (mode=="inprocess" and codec=="zstd" and zstandard is None):
+            raise Exception("In-process zstd compression needs the zstandard pip package")
+        if (mode=="inprocess" and codec=="lz4" and lz4 is None):
+            raise Exception("In-process lz4 compression needs the lz4 pip package")
+        return mode
+    if (codec=="zstd" and zstandard is None):
+        return "pipeline"
+    if (codec=="lz4" and lz4 is None):
+        return "pipeline"
+    return "inprocess"
+
+class PipelineCompressor:
+    #-------------------------------------------------------
+    # Class: PipelineCompressor
+    # Desc: Writable stream that runs data through a codec
+    #       command line program. Ex: zstd -3 -c
+    #       Compressed output is copied to dst by a thread.
+    #       A failed copy kills the codec program and is
+    #       raised again by write and close.
+    #-------------------------------------------------------
+
+    def __init__(self,cmd,dst):
+        self.proc=subprocess.Popen(cmd,stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+        self.error=None
+        self.thread=threading.Thread(target=self.copyoutput,args=(dst,),daemon=True)
+        self.thread.start()
+
+    def copyoutput(self,dst):
+        try:
+            copystream(self.proc.stdout,dst)
+        except Exception as ex:
+            # Ex: No space left on device. Unblocks a write waiting on stdin.
+            self.error=ex
+            self.proc.kill()
+
+    def checkerror(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self,data):
+        self.checkerror()
+        try:
+            self.proc.stdin.write(data)
+        except BrokenPipeError:
+            self.thread.join()
+            self.checkerror()
+            raise Exception(f"Error {self.proc.wait()} occurred while running compression command {self.proc.args[0]}")
+        return len(data)
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.thread.join()
+        self.checkerror()
+        rtncmd=self.proc.wait()
+        if (rtncmd != 0):
+            raise Exception(f"Error {rtncmd} occurred while running compression command {self.proc.args[0]}")
+
+class PipelineDecompressor:
+    #-------------------------------------------------------
+    # Class: PipelineDecompressor
+    # Desc: Readable stream of a codec command line program.
+    #       Ex: zstd -dc
+    #       src is fed to the program by a thread so it can be
+    #       any stream. At the end of the output a failed read
+    #       of src or a failed program is raised instead of
+    #       ending the stream early.
+    #-------------------------------------------------------
+
+    def __init__(self,cmd,src):
+        self.proc=subprocess.Popen(cmd,stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+        self.error=None
+        self.thread=threading.Thread(target=self.feed,args=(src,),daemon=True)
+        self.thread.start()
+
+    def feed(self,src):
+        try:
+            copystream(src,self.proc.stdin)
+        except BrokenPipeError:
+            pass
+        except Exception as ex:
+            # Ex: Chunk checksum mismatch or failed ranged GET.
+            # Killed so a partial input never looks like the end.
+            self.error=ex
+            self.proc.kill()
+        finally:
+            try:
+                self.proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def read(self,size=-1):
+        data=self.proc.stdout.read(size)
+        if (not data and size != 0):
+            self.thread.join()
+            if self.error is not None:
+                raise self.error
+            rtncmd=self.proc.wait()
+            if (rtncmd != 0):
+                raise Exception(f"Error {rtncmd} occurred while running decompression command {self.proc.args[0]}")
+        return data
+
+    def close(self):
+        self.proc.stdout.close()
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        self.thread.join()
+
+class InProcessCompressor:
+    #-------------------------------------------------------
+    # Class: InProcessCompressor
+    # Desc: Writable stream wrapper that closes the codec
+    #       writer without closing the underlying dst stream.
+    #-------------------------------------------------------
+
+    def __init__(self,writer):
+        self.writer=writer
+
+    def write(self,data):
+        return self.writer.write(data)
+
+    def close(self):
+        self.writer.close()
+
+def opencompressor(codec,level,mode,dst):
+    #-------------------------------------------------------
+    # Function: opencompressor
+    # Desc: Open a writable stream that compresses into dst
+    # :codec: gzip, zstd or lz4
+    # :level: Compression level. 0=Codec default
+    # :mode: auto, inprocess or pipeline
+    # :dst: Writable binary stream for the compressed output
+    # :return: Writable stream with write and close methods
+    #-------------------------------------------------------
+    if (level <= 0):
+        level=CODECS[codec]["level"]
+    mode=resolvecompressmode(codec,mode)
+    if (mode=="pipeline"):
+        return PipelineCompressor([CODECS[codec]["command"],f"-{level}","-c"],dst)
+    if (codec=="gzip"):
+        return InProcessCompressor(gzip.GzipFile(fileobj=dst,mode="wb",compresslevel=level,mtime=0))
+    if (codec=="zstd"):
+        return InProcessCompressor(zstandard.ZstdCompressor(level=level).stream_writer(dst,closefd=False))
+    return InProcessCompressor(lz4.frame.LZ4FrameFile(dst,mode="wb",compression_level=level))
+
+def opendecompressor(codec,mode,src):
+    #-------------------------------------------------------
+    # Function: opendecompressor
+    # Desc: Open a readable stream that decompresses src
+    # :codec: gzip, zstd, lz4 or none
+    # :mode: auto, inprocess or pipeline
+    # :src: Readable binary stream for the compressed input
+    # :return: Readable binary stream
+    #-------------------------------------------------------
+    if (codec=="none"):
+        return src
+    mode=resolvecompressmode(codec,mode)
+    if (mode=="pipeline"):
+        return PipelineDecompressor([CODECS[codec]["command"],"-dc"],src)
+    if (codec=="gzip"):
+        return gzip.GzipFile(fileobj=src,mode="rb")
+    if (codec=="zstd"):
+        return zstandard.ZstdDecompressor().stream_reader(src,closefd=False)
+    return lz4.frame.LZ4FrameFile(src,mode="rb")
+
+def pipetocommand(cmd,src,env=None,maxmbps=0,stderrfunction=None):
+    #-------------------------------------------------------
+    # Function: pipetocommand
+    # Desc: Run a shell command line and feed src to its stdin.
+    #       Ex: Decompressed backup stream into pg_restore.
+    # :cmd: Shell command line to run
+    # :src: Readable binary stream to send to the command
+    # :env: Environment for the command. None=Inherit
+    # :maxmbps: Maximum MB/s to send. 0=No limit
+    # :stderrfunction: Function called with the stderr pipe of
+    #                  the command. None=Inherit stderr
+    # :return: Command return code
+    #-------------------------------------------------------
+    proc=subprocess.Popen(cmd,shell=True,stdin=subprocess.PIPE,env=env,
+                          stderr=subprocess.PIPE if stderrfunction is not None else None)
+    if stderrfunction is not None:
+        stderrfunction(proc.stderr)
+    try:
+        copystream(src,proc.stdin,maxmbps)
+    except BrokenPipeError:
+        # Command quit early. Its return code tells why.
+        pass
+    finally:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+    return proc.wait()
+
+class TeeWriter:
+    #-------------------------------------------------------
+    # Class: TeeWriter
+    # Desc: Writable stream that writes each block to several
+    #       streams. Ex: Tar verifier and compressor in one pass.
+    #-------------------------------------------------------
+
+    def __init__(self,*writers):
+        self.writers=writers
+
+    def write(self,data):
+        for writer in self.writers:
+            writer.write(data)
+        return len(data)
+
+class HashingWriter:
+    #-------------------------------------------------------
+    # Class: HashingWriter
+    # Desc: Writable stream that computes the SHA-256 checksum
+    #       and byte count of everything written to dst.
+    #-------------------------------------------------------
+
+    def __init__(self,dst):
+        self.dst=dst
+        self.sha256=hashlib.sha256()
+        self.byteswritten=0
+
+    def write(self,data):
+        self.sha256.update(data)
+        self.byteswritten+=len(data)
+        return self.dst.write(data)
+
+class TarStreamVerifier:
+    #-------------------------------------------------------
+    # Class: TarStreamVerifier
+    # Desc: Writable stream that parses tar headers on the fly
+    #       while the backup is being written. Header checksums
+    #       are checked, entry names and sizes are recorded and
+    #       entry data is skipped without being copied.
+    #       Replaces a second tar -tvf read of the backup file.
+    #-------------------------------------------------------
+
+    def __init__(self):
+        self.entries=[]
+        self.errors=[]
+        self.bytesread=0
+        self.header=b""
+        self.skipbytes=0
+        self.zeroblocks=0
+
+    def write(self,data):
+        view=memoryview(data)
+        pos=0
+        while pos < len(view):
+            # Skip entry data and padding
+            if (self.skipbytes > 0):
+                skip=min(self.skipbytes,len(view)-pos)
+                self.skipbytes-=skip
+                pos+=skip
+                continue
+            # Collect a full header block
+            take=min(TARBLOCKSIZE-len(self.header),len(view)-pos)
+            self.header+=bytes(view[pos:pos+take])
+            pos+=take
+            if (len(self.header)==TARBLOCKSIZE):
+                self.parseheader(self.header,self.bytesread+pos-TARBLOCKSIZE)
+                self.header=b""
+        self.bytesread+=len(view)
+        return len(data)
+
+    def parseheader(self,block,offset):
+        #-------------------------------------------------------
+        # Function: parseheader
+        # Desc: Parse one tar header block and set up skipping
+        #       of the entry data that follows it.
+        # :block: 512 byte header block
+        # :offset: Offset of the header block in the tar stream
+        #-------------------------------------------------------
+        if (block==bytes(TARBLOCKSIZE)):
+            self.zeroblocks+=1
+            return
+        if (self.zeroblocks > 0):
+            self.errors.append(f"Tar header found after end of archive marker at offset {offset}")
+            self.zeroblocks=0
+        # Header checksum is the sum of all bytes with the checksum field as spaces
+        try:
+            checksum=int(block[148:156].split(b"\0")[0].strip() or b"0",8)
+        except ValueError:
+            self.errors.append(f"Invalid tar header checksum field at offset {offset}")
+            return
+        if (checksum != sum(block[:148]) + 8*32 + sum(block[156:])):
+            self.errors.append(f"Tar header checksum mismatch at offset {offset}")
+            return
+        name=block[0:100].split(b"\0")[0].decode("utf-8","replace")
+        prefix=block[345:500].split(b"\0")[0].decode("utf-8","replace")
+        if (block[257:262]==b"ustar" and prefix!=""):
+            name=prefix + "/" + name
+        # Size is octal text or base-256 for entries of 8 GB and larger
+        sizefield=block[124:136]
+        if (sizefield[0] & 0x80):
+            size=int.from_bytes(sizefield[1:],"big")
+        else:
+            size=int(sizefield.split(b"\0")[0].strip() or b"0",8)
+        self.entries.append({"name":name,"size":size,"offset":offset,"type":chr(block[156]) if block[156] else "0"})
+        self.skipbytes=(size + TARBLOCKSIZE - 1) // TARBLOCKSIZE * TARBLOCKSIZE
+
+    def verify(self):
+        #-------------------------------------------------------
+        # Function: verify
+        # Desc: Check the tar stream parsed cleanly to the end
+        # :return: List of error messages. Empty=tar stream is good
+        #-------------------------------------------------------
+        errors=list(self.errors)
+        if (len(self.entries)==0):
+            errors.append("Tar stream has no entries")
+        if (self.header!=b"" or self.skipbytes > 0):
+            errors.append(f"Tar stream truncated after {self.bytesread} bytes")
+        elif (self.zeroblocks < 2):
+            errors.append("Tar stream has no end of archive marker")
+        return errors
+
+def streammanifest(outputfile,hashingwriter,verifier,compress):
+    #-------------------------------------------------------
+    # Function: streammanifest
+    # Desc: Build the sidecar manifest for a streamed backup
+    # :outputfile: Backup file or object URL the manifest describes
+    # :hashingwriter: HashingWriter that wrote the backup
+    # :verifier: TarStreamVerifier that parsed the tar stream
+    # :compress: Compression codec used for the backup
+    # :return: Manifest dictionary
+    #-------------------------------------------------------
+    return {
+        "file":outputfile,
+        "created":time.strftime('%Y-%m-%d %H:%M:%S'),
+        "sha256":hashingwriter.sha256.hexdigest(),
+        "bytes":hashingwriter.byteswritten,
+        "tarbytes":verifier.bytesread,
+        "compress":compress,
+        "entries":verifier.entries,
+    }
+
+def writemanifest(manifestfile,outputfile,hashingwriter,verifier,compress):
+    #-------------------------------------------------------
+    # Function: writemanifest
+    # Desc: Write the sidecar manifest for a streamed backup
+    #       so later checks don't need to re-read the archive.
+    # :manifestfile: Manifest file to write. Ex: /tmp/mydb.tar.manifest.json
+    # :outputfile: Backup file the manifest describes
+    # :hashingwriter: HashingWriter that wrote the backup file
+    # :verifier: TarStreamVerifier that parsed the tar stream
+    # :compress: Compression codec used for the backup file
+    # :return: Manifest dictionary
+    #-------------------------------------------------------
+    manifest=streammanifest(outputfile,hashingwriter,verifier,compress)
+    with open(manifestfile,"w") as outfile:
+        json.dump(manifest,outfile,indent=1)
+    return manifest
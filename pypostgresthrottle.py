@@ -0,0 +1,325 @@
+#------------------------------------------------
+# Script name: pypostgresthrottle.py
+#
+# Description:
+# I/O throttling and priority controls for backups on shared production
+# hosts. The backup stream is rate limited by a token bucket with a MB/s cap
+# that can change with the time of day, and the cap backs off while the load
+# average or the replication lag is too high. The backup script and its child
+# processes (pg_dump, compressors, tar) can run with a lower CPU and I/O
+# priority. The server backend reading the tables for pg_dump is not a child
+# process, so its reads are only slowed by the rate limit.
+#
+# MB/s schedule:
+# Comma separated default MB/s and HH:MM-HH:MM=MB/s time of day windows in
+# local time. The first matching window wins. Windows can wrap midnight.
+# Hours are 00-23. 24:00 is only allowed as a window end.
+# 0=No limit. Ex: 50,01:00-05:00=300 is 50 MB/s except 300 MB/s from 1 to 5 AM.
+#
+# Backoff:
+# The load average and replication lag are checked every BACKOFFINTERVAL
+# seconds. While either is over its limit the rate is halved down to
+# MINFACTOR of the cap, and it grows back by RECOVERSTEP of the cap for each
+# check under the limits. Without a cap the rate measured before the first
+# backoff is used as the cap.
+#
+# Pip packages needed:
+#------------------------------------------------
+
+#------------------------------------------------
+# Imports and Environment setup
+#------------------------------------------------
+import os
+import shutil
+import subprocess
+import threading
+import time
+import pypostgresshards
+
+# Seconds between load average and replication lag checks
+BACKOFFINTERVAL=5
+# Lowest rate factor while backing off and rate factor regained per check
+MINFACTOR=0.05
+RECOVERSTEP=0.1
+# Seconds of transfer the token bucket can burst
+BURSTSECONDS=1.0
+
+# ionice classes. besteffort takes a level 0-7 after a colon. Ex: besteffort:7
+IONICECLASSES={"none":"","realtime":"1","besteffort":"2","idle":"3"}
+
+# Replication lag in seconds of the slowest standby. 0 without standbys.
+LAGSQL="select coalesce(max(extract(epoch from replay_lag)),0) from pg_stat_replication"
+
+#------------------------------------------------
+# Define some useful functions
+#------------------------------------------------
+
+def parseclock(clock,end=False):
+    #-------------------------------------------------------
+    # Function: parseclock
+    # Desc: Convert HH:MM to minutes after midnight
+    # :clock: Time of day. Ex: 01:30
+    # :end: True=Window end where 24:00 is allowed for midnight
+    # :return: Minutes after midnight
+    #-------------------------------------------------------
+    (hours,minutes)=clock.strip().split(":")
+    if (end==True and int(hours)==24 and int(minutes)==0):
+        return 24*60
+    if (int(hours) < 0 or int(hours) > 23 or int(minutes) < 0 or int(minutes) > 59):
+        raise ValueError(clock)
+    return int(hours)*60 + int(minutes)
+
+def parseschedule(spec):
+    #-------------------------------------------------------
+    # Function: parseschedule
+    # Desc: Parse a MB/s schedule
+    # :spec: Schedule. Ex: 50,01:00-05:00=300
+    # :return: Dictionary with default MB/s and windows list
+    #          of (start minute,end minute,MB/s)
+    #-------------------------------------------------------
+    schedule={"default":0.0,"windows":[]}
+    for part in str(spec).split(","):
+        part=part.strip()
+        if (part==""):
+            continue
+        try:
+            if ("=" in part):
+                (window,mbps)=part.split("=",1)
+                (start,end)=window.split("-",1)
+                schedule["windows"].append((parseclock(start),parseclock(end,end=True),float(mbps)))
+            else:
+                schedule["default"]=float(part)
+        except ValueError:
+            raise Exception(f"Max MB/s schedule entry {part} must be MB/s or HH:MM-HH:MM=MB/s")
+    if (schedule["default"] < 0 or any(window[2] < 0 for window in schedule["windows"])):
+        raise Exception("Max MB/s must be 0 or greater")
+    return schedule
+
+def formatschedule(schedule,divisor=1):
+    #-------------------------------------------------------
+    # Function: formatschedule
+    # Desc: Format a MB/s schedule with every rate divided.
+    #       Ex: A share of the schedule for each worker.
+    # :schedule: Schedule from parseschedule
+    # :divisor: Number to divide each MB/s by
+    # :return: Schedule string
+    #-------------------------------------------------------
+    parts=[f"{schedule['default']/divisor:g}"]
+    for (start,end,mbps) in schedule["windows"]:
+        parts.append(f"{start//60:02d}:{start%60:02d}-{end//60:02d}:{end%60:02d}={mbps/divisor:g}")
+    return ",".join(parts)
+
+def schedulembps(schedule,now=None):
+    #-------------------------------------------------------
+    # Function: schedulembps
+    # Desc: Get the MB/s cap of a schedule at a time of day
+    # :schedule: Schedule from parseschedule
+    # :now: time.struct_time. None=Current local time
+    # :return: MB/s. 0=No limit
+    #-------------------------------------------------------
+    now=now or time.localtime()
+    minute=now.tm_hour*60 + now.tm_min
+    for (start,end,mbps) in schedule["windows"]:
+        if (start <= end and start <= minute < end) or (start > end and (minute >= start or minute < end)):
+            return mbps
+    return schedule["default"]
+
+def scheduled(schedule):
+    #-------------------------------------------------------
+    # Function: scheduled
+    # Desc: Check if a schedule ever limits the rate
+    # :return: True if any MB/s is set
+    #-------------------------------------------------------
+    return schedule["default"] > 0 or any(window[2] > 0 for window in schedule["windows"])
+
+def setpriority(nice=0,ionice="none"):
+    #-------------------------------------------------------
+    # Function: setpriority
+    # Desc: Lower the CPU and I/O priority of this process.
+    #       Child processes started afterwards inherit them.
+    #       ionice is set with the util-linux ionice command
+    #       and is skipped where it is not available.
+    # :nice: Nice increment 0-19. 0=Unchanged
+    # :ionice: none, idle, besteffort:0-7 or realtime:0-7
+    #-------------------------------------------------------
+    if (nice > 0):
+        if hasattr(os,"nice"):
+            os.nice(nice)
+            print(f"INFO: Nice level set to {os.nice(0)}")
+        else:
+            print("INFO: Nice is not available on this platform")
+    (ioclass,level)=(ionice.split(":",1) + [""])[:2]
+    if (IONICECLASSES.get(ioclass,"")==""):
+        return
+    if shutil.which("ionice") is None:
+        print("INFO: ionice is not available on this platform")
+        return
+    cmd=["ionice","-c",IONICECLASSES[ioclass]]
+    if (level!="" and ioclass!="idle"):
+        cmd+=["-n",level]
+    result=subprocess.run(cmd + ["-p",str(os.getpid())],capture_output=True,text=True)
+    if (result.returncode != 0):
+        raise Exception(f"Error {result.returncode} occurred while setting ionice {ionice}. {result.stderr.strip()}")
+    print(f"INFO: I/O priority set to {ionice}")
+
+def checkionice(ionice):
+    #-------------------------------------------------------
+    # Function: checkionice
+    # Desc: Check an ionice setting
+    # :ionice: none, idle, besteffort:0-7 or realtime:0-7
+    # :return: True if valid
+    #-------------------------------------------------------
+    (ioclass,level)=(ionice.split(":",1) + [""])[:2]
+    if ioclass not in IONICECLASSES:
+        return False
+    return level=="" or (ioclass in ("besteffort","realtime") and level.isdigit() and int(level) <= 7)
+
+def replicationlag(connargs,env):
+    #-------------------------------------------------------
+    # Function: replicationlag
+    # Desc: Get the replay lag of the slowest standby
+    # :connargs: Connection arguments from pypostgresshards.connectionargs
+    # :env: Environment with PGPASSWORD
+    # :return: Lag in seconds
+    #-------------------------------------------------------
+    return float(pypostgresshards.psqlquery(LAGSQL,"postgres",connargs,env)[0][0])
+
+class Backoff:
+    #-------------------------------------------------------
+    # Class: Backoff
+    # Desc: Background check of the load average and the
+    #       replication lag that sets the rate factor for
+    #       a TokenBucket
+    #-------------------------------------------------------
+
+    def __init__(self,maxload=0,maxlag=0,lagfunction=None,interval=BACKOFFINTERVAL):
+        self.maxload=maxload
+        self.maxlag=maxlag
+        self.lagfunction=lagfunction
+        self.interval=interval
+        self.factor=1.0
+        self.lagerror=""
+        self.stopevent=threading.Event()
+        self.thread=None
+
+    def enabled(self):
+        return self.maxload > 0 or self.maxlag > 0
+
+    def start(self):
+        if self.enabled():
+            self.thread=threading.Thread(target=self.run,daemon=True)
+            self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopevent.wait(self.interval):
+            self.check()
+
+    def check(self):
+        #-------------------------------------------------------
+        # Function: check
+        # Desc: Halve the rate factor while the load average or
+        #       replication lag is over its limit and raise it
+        #       step by step while both are under their limits
+        #-------------------------------------------------------
+        reasons=[]
+        if (self.maxload > 0 and hasattr(os,"getloadavg")):
+            load=os.getloadavg()[0]
+            if (load > self.maxload):
+                reasons.append(f"load {load:.2f} over {self.maxload:g}")
+        if (self.maxlag > 0 and self.lagfunction is not None):
+            try:
+                lag=self.lagfunction()
+                if (lag > self.maxlag):
+                    reasons.append(f"replication lag {lag:.1f}s over {self.maxlag:g}s")
+            except Exception as ex:
+                # Report a failing lag check once and keep the backup running
+                if (str(ex)!=self.lagerror):
+                    self.lagerror=str(ex)
+                    print(f"THROTTLE: replication lag check failed. {ex}",flush=True)
+        if (len(reasons) > 0):
+            self.factor=max(self.factor/2,MINFACTOR)
+            print(f"THROTTLE: {', '.join(reasons)}. Rate factor {self.factor:.2f}",flush=True)
+        elif (self.factor < 1.0):
+            self.factor=min(self.factor+RECOVERSTEP,1.0)
+            print(f"THROTTLE: under limits. Rate factor {self.factor:.2f}",flush=True)
+
+    def stop(self):
+        self.stopevent.set()
+        if self.thread is not None:
+            self.thread.join()
+
+class TokenBucket:
+    #-------------------------------------------------------
+    # Class: TokenBucket
+    # Desc: Token bucket rate limiter for a byte stream. The
+    #       rate follows the MB/s schedule times the backoff
+    #       rate factor. Tokens are bytes and up to
+    #       BURSTSECONDS of tokens can be saved up.
+    #-------------------------------------------------------
+
+    def __init__(self,schedule,backoff=None):
+        self.schedule=schedule
+        self.backoff=backoff
+        self.tokens=0.0
+        self.last=time.monotonic()
+        # Measured rate used as the cap when backing off without one
+        self.baserate=0.0
+        self.measured=0.0
+        self.windowstart=self.last
+        self.windowbytes=0
+
+    def enabled(self):
+        return scheduled(self.schedule) or (self.backoff is not None and self.backoff.enabled())
+
+    def rate(self):
+        #-------------------------------------------------------
+        # Function: rate
+        # Desc: Get the current rate
+        # :return: Bytes per second. 0=No limit
+        #-------------------------------------------------------
+        rate=schedulembps(self.schedule)*1024*1024
+        factor=self.backoff.factor if self.backoff is not None else 1.0
+        if (factor >= 1.0):
+            self.baserate=0.0
+            return rate
+        if (rate <= 0):
+            if (self.baserate <= 0):
+                self.baserate=self.measured
+            rate=self.baserate
+        return rate*factor
+
+    def reserve(self,nbytes):
+        #-------------------------------------------------------
+        # Function: reserve
+        # Desc: Take tokens for bytes about to be written
+        # :nbytes: Number of bytes
+        # :return: Seconds to wait before writing them
+        #-------------------------------------------------------
+        now=time.monotonic()
+        self.windowbytes+=nbytes
+        if (now - self.windowstart >= 1.0):
+            self.measured=self.windowbytes/(now - self.windowstart)
+            self.windowstart=now
+            self.windowbytes=0
+        rate=self.rate()
+        if (rate <= 0):
+            self.tokens=0.0
+            self.last=now
+            return 0
+        self.tokens=min(self.tokens + (now - self.last)*rate,rate*BURSTSECONDS)
+        self.last=now
+        self.tokens-=nbytes
+        return -self.tokens/rate if self.tokens < 0 else 0
+
+    def consume(self,nbytes):
+        #-------------------------------------------------------
+        # Function: consume
+        # Desc: Wait until bytes can be written at the rate
+        # :nbytes: Number of bytes
+        # :return: Seconds slept
+        #-------------------------------------------------------
+        delay=self.reserve(nbytes)
+        if (delay > 0):
+            time.sleep(delay)
+        return delay
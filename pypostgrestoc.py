@@ -0,0 +1,458 @@
+#------------------------------------------------
+# Script name: pypostgrestoc.py
+#
+# Description:
+# Archive table of contents (TOC) index for selective restores. The TOC is
+# read once from the toc.dat of a pg_dump tar or directory archive, parsed
+# directly so the dependencies between entries are known, and cached as a
+# JSON sidecar index next to the backup: <backup>.toc.json. Repository
+# backups keep the index next to their manifest. Object storage backups have
+# their TOC read from the object each time. Later restores use the
+# index instead of reading the archive again and write a pg_restore
+# --use-list file with only the selected entries.
+#
+# Selection:
+# Tables - Tables, views, sequences and other relations by name or
+#   schema.name, plus the entries that only belong to them: table data,
+#   indexes, constraints, triggers, defaults, comments, grants and owned
+#   sequences. Foreign keys to tables that are not selected are left out.
+# Schemas - Every entry in the schemas plus the schema itself.
+# Types - Only entries of these object types. Ex: TABLE DATA,FUNCTION
+#
+# toc.dat layout (pg_backup_archiver.c ReadHead and ReadToc):
+# "PGDMP", version major, minor, revision, int size, offset size, format,
+# compression, creation time, database name, server and pg_dump versions,
+# entry count, then each entry with its dump id, tag, object type, section,
+# SQL, namespace, owner, dependency dump ids and the data file name.
+# Integers are a sign byte and int size little endian bytes. Strings are an
+# integer length (-1=NULL) and the bytes.
+#
+# Pip packages needed:
+#------------------------------------------------
+
+#------------------------------------------------
+# Imports and Environment setup
+#------------------------------------------------
+import json
+import os
+import os.path
+import subprocess
+import tarfile
+import pypostgreschunkstore
+import pypostgresobjectstore
+import pypostgresstream
+
+# TOC index sidecar file extension
+INDEXEXTENSION=".toc.json"
+
+# TOC index layout version
+INDEXVERSION=1
+
+# Archive formats in the toc.dat header. Directory archives are written as tar.
+FORMATS={1:"custom",3:"tar",5:"directory"}
+
+# Archive versions the parser reads. 1.12=PostgreSQL 9.0, 1.16=PostgreSQL 17.
+# Newer archives are read with pg_restore -l.
+MINVERSION=(1,12)
+MAXVERSION=(1,16)
+
+# TOC entry sections
+SECTIONS={1:"none",2:"pre-data",3:"data",4:"post-data"}
+
+# Entries pg_restore always handles itself. Never part of a use list.
+SPECIALTYPES=("ENCODING","STDSTRINGS","SEARCHPATH","DATABASE","DATABASE PROPERTIES")
+
+# Entries that can be selected as tables
+RELATIONTYPES=("TABLE","VIEW","MATERIALIZED VIEW","SEQUENCE","FOREIGN TABLE")
+
+# Entries that only belong to the objects they depend on
+ATTACHEDTYPES=("TABLE DATA","MATERIALIZED VIEW DATA","SEQUENCE SET","SEQUENCE OWNED BY","SEQUENCE",
+               "INDEX","INDEX ATTACH","CONSTRAINT","CHECK CONSTRAINT","FK CONSTRAINT","TRIGGER",
+               "RULE","POLICY","ROW SECURITY","DEFAULT","COMMENT","ACL","SECURITY LABEL",
+               "STATISTICS","TABLE ATTACH")
+
+#------------------------------------------------
+# Define some useful functions
+#------------------------------------------------
+
+class TocReader:
+    #-------------------------------------------------------
+    # Class: TocReader
+    # Desc: Read the integers and strings of a toc.dat stream
+    #-------------------------------------------------------
+
+    def __init__(self,src):
+        self.src=src
+        self.intsize=4
+        self.offsize=8
+
+    def readbytes(self,size):
+        data=self.src.read(size)
+        if (len(data) != size):
+            raise Exception("Archive table of contents ended early")
+        return data
+
+    def readbyte(self):
+        return self.readbytes(1)[0]
+
+    def readint(self):
+        sign=self.readbyte()
+        value=int.from_bytes(self.readbytes(self.intsize),"little")
+        return -value if sign else value
+
+    def readstr(self):
+        length=self.readint()
+        if (length < 0):
+            return None
+        return self.readbytes(length).decode("utf-8",errors="replace")
+
+    def readoffset(self):
+        # Offset flag byte then offset size little endian bytes
+        self.readbyte()
+        return int.from_bytes(self.readbytes(self.offsize),"little")
+
+def readtoc(src):
+    #-------------------------------------------------------
+    # Function: readtoc
+    # Desc: Parse a toc.dat stream or the start of a custom
+    #       format archive
+    # :src: Readable binary stream positioned at "PGDMP"
+    # :return: TOC dictionary with the archive details and
+    #          the list of entries in archive order
+    #-------------------------------------------------------
+    reader=TocReader(src)
+    if (reader.readbytes(5) != b"PGDMP"):
+        raise Exception("Not a pg_dump archive table of contents")
+    version=(reader.readbyte(),reader.readbyte(),reader.readbyte())
+    if (version[0:2] < MINVERSION or version[0:2] > MAXVERSION):
+        raise Exception(f"Archive version {version[0]}.{version[1]} is not supported by the TOC parser")
+    reader.intsize=reader.readbyte()
+    reader.offsize=reader.readbyte()
+    archiveformat=reader.readbyte()
+    if (archiveformat not in FORMATS):
+        raise Exception(f"Archive format {archiveformat} is not supported")
+    # Compression algorithm byte from 1.15, compression level before
+    if (version[0:2] >= (1,15)):
+        reader.readbyte()
+    else:
+        reader.readint()
+    created=[reader.readint() for field in range(7)]
+    dbname=reader.readstr()
+    serverversion=reader.readstr()
+    dumpversion=reader.readstr()
+    entries=[]
+    for index in range(reader.readint()):
+        entry={"id":reader.readint()}
+        entry["hasdata"]=reader.readint()!=0
+        entry["tableoid"]=reader.readstr() or "0"
+        entry["oid"]=reader.readstr() or "0"
+        entry["tag"]=reader.readstr() or ""
+        entry["desc"]=reader.readstr() or ""
+        entry["section"]=SECTIONS.get(reader.readint(),"none")
+        # Create and drop SQL and COPY statement are not kept
+        reader.readstr()
+        reader.readstr()
+        reader.readstr()
+        entry["schema"]=reader.readstr() or ""
+        reader.readstr() # tablespace
+        if (version[0:2] >= (1,14)):
+            reader.readstr() # table access method
+        if (version[0:2] >= (1,16)):
+            reader.readint() # relkind
+        entry["owner"]=reader.readstr() or ""
+        reader.readstr() # with oids
+        deps=[]
+        while True:
+            dep=reader.readstr()
+            if dep is None:
+                break
+            deps.append(int(dep))
+        entry["deps"]=deps
+        # Data file name for tar and directory, data offset for custom
+        if (archiveformat==1):
+            reader.readoffset()
+        else:
+            reader.readstr()
+        entries.append(entry)
+    return {"dumpversion":f"{version[0]}.{version[1]}-{version[2]}","dbname":dbname,"serverversion":serverversion,"pgdumpversion":dumpversion,
+            "created":"{:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}".format(created[5]+1900,created[4]+1,created[3],created[2],created[1],created[0]),
+            "entries":entries}
+
+def readtartoc(src):
+    #-------------------------------------------------------
+    # Function: readtartoc
+    # Desc: Parse the toc.dat member at the start of a pg_dump
+    #       tar stream. Only the tar data up to toc.dat is read.
+    # :src: Readable binary stream of the uncompressed tar
+    # :return: TOC dictionary from readtoc
+    #-------------------------------------------------------
+    with tarfile.open(fileobj=src,mode="r|") as tar:
+        for member in tar:
+            if (os.path.basename(member.name)=="toc.dat"):
+                return readtoc(tar.extractfile(member))
+    raise Exception("No toc.dat found in the tar archive")
+
+def listtoc(archive):
+    #-------------------------------------------------------
+    # Function: listtoc
+    # Desc: Read the table of contents with pg_restore -l when
+    #       the archive version is newer than the parser. The
+    #       entries have no dependencies.
+    # :archive: Tar file or directory archive
+    # :return: TOC dictionary like readtoc
+    #-------------------------------------------------------
+    result=subprocess.run(["pg_restore","-l",archive],capture_output=True,text=True)
+    if (result.returncode != 0):
+        raise Exception(f"Error {result.returncode} occurred while running pg_restore -l. {result.stderr.strip()}")
+    descs=sorted(set(RELATIONTYPES + ATTACHEDTYPES + ("SCHEMA","FUNCTION","PROCEDURE","AGGREGATE","TYPE","DOMAIN",
+                                                       "EXTENSION","COLLATION","OPERATOR","PUBLICATION")),key=len,reverse=True)
+    entries=[]
+    for line in result.stdout.splitlines():
+        if (line.startswith(";") or ";" not in line):
+            continue
+        (dumpid,_,rest)=line.partition("; ")
+        fields=rest.split(" ",2)
+        entry={"id":int(dumpid),"hasdata":False,"tableoid":fields[0],"oid":fields[1],"section":"none","deps":[]}
+        rest=fields[2]
+        # Object types can have spaces so match the known ones first
+        entry["desc"]=next((desc for desc in descs if rest.startswith(desc + " ")),rest.split(" ")[0])
+        words=rest[len(entry["desc"]) + 1:].split(" ")
+        entry["schema"]="" if words[0]=="-" else words[0]
+        entry["owner"]=words[-1] if len(words) > 2 else ""
+        entry["tag"]=" ".join(words[1:-1] if len(words) > 2 else words[1:])
+        entries.append(entry)
+    return {"dumpversion":"","dbname":"","serverversion":"","pgdumpversion":"","created":"","entries":entries}
+
+def indexpath(inputfile,repository=""):
+    #-------------------------------------------------------
+    # Function: indexpath
+    # Desc: Get the TOC index sidecar file name for a backup
+    # :inputfile: Backup file or directory, or backup name
+    # :repository: Backup repository directory or blank
+    # :return: Index file name. Ex: /backup/mydb.tar.toc.json
+    #-------------------------------------------------------
+    if (repository!=""):
+        manifest=pypostgreschunkstore.ChunkStore(repository).manifestpath(inputfile)
+        return manifest[:-len(".json")] + INDEXEXTENSION
+    return inputfile.rstrip("/" + os.sep) + INDEXEXTENSION
+
+def sourcestamp(inputfile,repository=""):
+    #-------------------------------------------------------
+    # Function: sourcestamp
+    # Desc: Size and modified time of the file the TOC comes
+    #       from. A cached index is only used while it matches.
+    # :inputfile: Backup file or directory, or backup name
+    # :repository: Backup repository directory or blank
+    # :return: Dictionary with size and mtime
+    #-------------------------------------------------------
+    if (repository!=""):
+        path=pypostgreschunkstore.ChunkStore(repository).manifestpath(inputfile)
+    elif os.path.isdir(inputfile):
+        path=os.path.join(inputfile,"toc.dat")
+    else:
+        path=inputfile
+    stat=os.stat(path)
+    return {"size":stat.st_size,"mtime":int(stat.st_mtime)}
+
+def loadindex(inputfile,repository,openstream):
+    #-------------------------------------------------------
+    # Function: loadindex
+    # Desc: Load the TOC index of a backup. The index is built
+    #       from the archive and written next to the backup the
+    #       first time or when the backup changed.
+    # :inputfile: Backup file or directory, or backup name
+    # :repository: Backup repository directory or blank
+    # :openstream: Function returning the uncompressed tar
+    #              stream of a tar file or repository backup
+    # :return: TOC index dictionary
+    #-------------------------------------------------------
+    # Object storage backups have no local place for the index so
+    # the table of contents is read from the object every time
+    if pypostgresobjectstore.isobjecturl(inputfile):
+        src=openstream()
+        try:
+            index=readtartoc(src)
+        finally:
+            if hasattr(src,"close"):
+                src.close()
+        print(f"INFO: Read TOC of {inputfile} with {len(index['entries'])} entries",flush=True)
+        return index
+    indexfile=indexpath(inputfile,repository)
+    stamp=sourcestamp(inputfile,repository)
+    if os.path.isfile(indexfile):
+        try:
+            with open(indexfile,"r") as infile:
+                index=json.load(infile)
+            if (index.get("version")==INDEXVERSION and index.get("source")==stamp):
+                print(f"INFO: Using TOC index {indexfile} with {len(index['entries'])} entries",flush=True)
+                return index
+        except ValueError:
+            pass
+        print(f"INFO: TOC index {indexfile} is out of date and will be rebuilt",flush=True)
+    try:
+        if (repository=="" and os.path.isdir(inputfile)):
+            with open(os.path.join(inputfile,"toc.dat"),"rb") as infile:
+                index=readtoc(infile)
+        else:
+            src=openstream()
+            try:
+                index=readtartoc(src)
+            finally:
+                if hasattr(src,"close"):
+                    src.close()
+    except Exception as ex:
+        # pg_restore -l can only read uncompressed archive files
+        if (repository!="" or pypostgresstream.codecfromfilename(inputfile)!="none"):
+            raise
+        print(f"INFO: Reading TOC with pg_restore -l. {ex}",flush=True)
+        index=listtoc(inputfile)
+    index["version"]=INDEXVERSION
+    index["source"]=stamp
+    try:
+        with open(indexfile + ".tmp","w") as outfile:
+            json.dump(index,outfile)
+        os.replace(indexfile + ".tmp",indexfile)
+        print(f"INFO: Wrote TOC index {indexfile} with {len(index['entries'])} entries",flush=True)
+    except OSError as ex:
+        # A read only backup location still gets its selective restore
+        print(f"INFO: TOC index {indexfile} not written. {ex}",flush=True)
+    return index
+
+def splitlist(value):
+    #-------------------------------------------------------
+    # Function: splitlist
+    # Desc: Split a comma separated parameter
+    # :value: Comma separated values
+    # :return: List of stripped values without blanks
+    #-------------------------------------------------------
+    return [item.strip() for item in value.split(",") if item.strip()!=""]
+
+def selectentries(index,schemas=None,tables=None,types=None,tableschemas=False):
+    #-------------------------------------------------------
+    # Function: selectentries
+    # Desc: Select TOC entries by schema, table and type
+    # :index: TOC index from loadindex
+    # :schemas: List of schema names
+    # :tables: List of table or schema.table names
+    # :types: List of object types. Ex: TABLE DATA
+    # :tableschemas: True=Add the schemas of the selected tables
+    #                for a restore into a new database
+    # :return: List of selected entries in archive order
+    #-------------------------------------------------------
+    schemas=schemas or []
+    tables=tables or []
+    types=[objtype.upper() for objtype in (types or [])]
+    entries=[entry for entry in index["entries"] if entry["desc"] not in SPECIALTYPES]
+    byid={entry["id"]:entry for entry in entries}
+    selected=set()
+    if (len(schemas)==0 and len(tables)==0):
+        selected={entry["id"] for entry in entries}
+    for entry in entries:
+        if (entry["schema"] in schemas or (entry["desc"]=="SCHEMA" and entry["tag"] in schemas)):
+            selected.add(entry["id"])
+        elif (entry["desc"] in RELATIONTYPES and
+              (entry["tag"] in tables or f"{entry['schema']}.{entry['tag']}" in tables)):
+            selected.add(entry["id"])
+    if (tableschemas==True):
+        tableschemanames={byid[dumpid]["schema"] for dumpid in selected}
+        selected.update(entry["id"] for entry in entries if entry["desc"]=="SCHEMA" and entry["tag"] in tableschemanames)
+    # Add the entries that belong to what is selected until nothing changes
+    changed=True
+    while changed:
+        changed=False
+        for entry in entries:
+            if (entry["id"] in selected or entry["desc"] not in ATTACHEDTYPES):
+                continue
+            if belongsto(entry,selected,byid):
+                selected.add(entry["id"])
+                # Owned sequences come with their table
+                if (entry["desc"]=="SEQUENCE OWNED BY"):
+                    selected.update(dep for dep in entry["deps"] if dep in byid and byid[dep]["desc"]=="SEQUENCE")
+                changed=True
+    return [entry for entry in entries if entry["id"] in selected and (len(types)==0 or entry["desc"] in types)]
+
+def belongsto(entry,selected,byid):
+    #-------------------------------------------------------
+    # Function: belongsto
+    # Desc: Check if an entry belongs to the selected entries.
+    #       It has to depend on one of them and every relation
+    #       or attached entry it depends on must be selected.
+    #       Entries read with pg_restore -l have no dependencies
+    #       and are matched on schema and table name instead.
+    # :entry: TOC entry
+    # :selected: Set of selected dump ids
+    # :byid: Dictionary of dump id to entry
+    # :return: True if the entry belongs
+    #-------------------------------------------------------
+    if (len(entry["deps"])==0):
+        owners={(byid[dumpid]["schema"],byid[dumpid]["tag"]) for dumpid in selected if byid[dumpid]["desc"] in RELATIONTYPES}
+        words=entry["tag"].split(" ")
+        # Ex: CONSTRAINT sales orders orders_pkey or COMMENT sales TABLE orders
+        return ((entry["schema"],words[0]) in owners or
+                (len(words)==2 and (entry["schema"],words[1]) in owners) or
+                (entry["desc"] in ("TABLE DATA","SEQUENCE SET") and (entry["schema"],entry["tag"]) in owners))
+    if not any(dep in selected for dep in entry["deps"]):
+        return False
+    for dep in entry["deps"]:
+        if (dep in byid and dep not in selected and
+            (byid[dep]["desc"] in RELATIONTYPES or byid[dep]["desc"] in ATTACHEDTYPES)):
+            return False
+    return True
+
+def entryline(entry):
+    #-------------------------------------------------------
+    # Function: entryline
+    # Desc: Format an entry like a pg_restore -l line
+    # :entry: TOC entry
+    # :return: Ex: 219; 1259 16396 TABLE sales orders postgres
+    #-------------------------------------------------------
+    return f"{entry['id']}; {entry['tableoid']} {entry['oid']} {entry['desc']} {entry['schema'] or '-'} {entry['tag']} {entry['owner']}"
+
+def writelistfile(listfile,entries,title=""):
+    #-------------------------------------------------------
+    # Function: writelistfile
+    # Desc: Write a pg_restore --use-list file. pg_restore
+    #       restores the entries in the order of the file so
+    #       they are kept in archive order.
+    # :listfile: List file name
+    # :entries: Selected entries in archive order
+    # :title: Comment line at the top of the file
+    #-------------------------------------------------------
+    with open(listfile,"w") as outfile:
+        if (title!=""):
+            outfile.write(f"; {title}\n")
+        for entry in entries:
+            outfile.write(entryline(entry) + "\n")
+
+def dropobjects(archive,dbname,connargs,env,listfile=""):
+    #-------------------------------------------------------
+    # Function: dropobjects
+    # Desc: Drop the objects of an archive from an existing
+    #       database before a parallel overwrite restore.
+    #       pg_restore --clean only drops the sections of its
+    #       own run, so a pre-data run cannot drop tables the
+    #       post-data foreign keys and indexes depend on. The
+    #       DROP statements pg_restore writes for pre-data and
+    #       post-data come before the first CREATE and are run
+    #       by themselves in one transaction.
+    # :archive: Directory archive or custom format file
+    # :dbname: Database name
+    # :connargs: Connection arguments from pypostgresshards.connectionargs
+    # :env: Environment with PGPASSWORD
+    # :listfile: pg_restore --use-list file. Blank=All entries
+    # :return: (return code, output lines)
+    #-------------------------------------------------------
+    cmd=["pg_restore","--clean","--if-exists","--section=pre-data","--section=post-data","-f","-"]
+    if (listfile!=""):
+        cmd+=["-L",listfile]
+    result=subprocess.run(cmd + [archive],env=env,capture_output=True,text=True)
+    if (result.returncode != 0):
+        return (result.returncode,result.stderr.splitlines())
+    # Created objects start with a "-- Name:" comment block
+    lines=result.stdout.splitlines()
+    end=next((index for (index,line) in enumerate(lines) if line.startswith("-- Name: ")),len(lines))
+    if (end > 0 and lines[end - 1]=="--"):
+        end-=1
+    cmd=["psql","-X","-q","-v","ON_ERROR_STOP=1","--single-transaction","-o",os.devnull,"-d",dbname] + connargs
+    result=subprocess.run(cmd,input="\n".join(lines[:end]) + "\n",env=env,capture_output=True,text=True)
+    return (result.returncode,(result.stdout + result.stderr).splitlines())
@@ -0,0 +1,179 @@
+#------------------------------------------------
+# Script name: pypostgresverify.py
+#
+# Description:
+# Table stats for restore verification. The backup script captures a row
+# count and a checksum for every table from the same snapshot pg_dump reads,
+# and writes them to a JSON sidecar next to the backup: <backup>.stats.json.
+# The restore script verify action restores the backup into a scratch
+# database, captures the same stats there and compares them.
+#
+# Stats levels:
+# count - Exact row count per table.
+# sample - Row count plus a checksum of the first and last sample rows in
+#   primary key order. The samples are read by index scans so only the count
+#   scans the table. Tables without a primary key only get the row count.
+# full - Row count plus a checksum of every row, read in one scan.
+#
+# Checksums are sums of the first 64 bits of the md5 of each row text so row
+# order does not matter. Row text is formatted with fixed session settings so
+# the dump database and the scratch database produce the same text.
+#
+# Pip packages needed:
+#------------------------------------------------
+
+#------------------------------------------------
+# Imports and Environment setup
+#------------------------------------------------
+import json
+import os
+import os.path
+import time
+import pypostgresshards
+import pypostgreschunkstore
+import pypostgresobjectstore
+
+# Stats sidecar file extension
+STATSEXTENSION=".stats.json"
+
+# Stats levels
+STATSLEVELS=("none","count","sample","full")
+
+# Rows read from each end of a table for the sample level
+SAMPLEROWS=1000
+
+# Session settings that fix the row text format
+SESSIONSQL="""set datestyle='ISO, YMD'; set timezone='UTC'; set intervalstyle='postgres';
+set extra_float_digits=3; set bytea_output='hex'"""
+
+# Tables with their primary key columns in key order
+TABLESQL="""select n.nspname, c.relname,
+coalesce((select string_agg(quote_ident(a.attname),',' order by k.ord)
+  from pg_index i cross join unnest(i.indkey::int2[]) with ordinality k(attnum,ord)
+  join pg_attribute a on a.attrelid=i.indrelid and a.attnum=k.attnum
+  where i.indrelid=c.oid and i.indisprimary),''),
+pg_table_size(c.oid)
+from pg_class c join pg_namespace n on n.oid=c.relnamespace
+where c.relkind='r' and c.relpersistence<>'t'
+and n.nspname not in ('pg_catalog','information_schema') and n.nspname not like 'pg_toast%'
+order by 4 desc"""
+
+# Row hash summed for a checksum
+ROWHASH="('x'||substr(md5(t::text),1,16))::bit(64)::bigint"
+
+#------------------------------------------------
+# Define some useful functions
+#------------------------------------------------
+
+def statspath(inputfile,repository=""):
+    #-------------------------------------------------------
+    # Function: statspath
+    # Desc: Get the stats sidecar file name for a backup
+    # :inputfile: Backup file, directory or object URL, or backup name
+    # :repository: Backup repository directory or blank
+    # :return: Stats file name. Ex: /backup/mydb.tar.stats.json
+    #-------------------------------------------------------
+    if (repository!=""):
+        manifest=pypostgreschunkstore.ChunkStore(repository).manifestpath(inputfile)
+        return manifest[:-len(".json")] + STATSEXTENSION
+    return inputfile.rstrip("/" + os.sep) + STATSEXTENSION
+
+def statsquery(table,level,samplerows):
+    #-------------------------------------------------------
+    # Function: statsquery
+    # Desc: Build the stats query for one table
+    # :table: (schema,name,primary key columns)
+    # :level: count, sample or full
+    # :samplerows: Rows read from each end for the sample level
+    # :return: Query returning the row count and checksum
+    #-------------------------------------------------------
+    (schema,name,keycolumns)=table
+    relation=pypostgresshards.tablepattern(schema,name)
+    if (level=="full"):
+        return f"select count(*), coalesce(sum({ROWHASH}),0) from {relation} t"
+    if (level=="sample" and keycolumns!=""):
+        descending=",".join(f"{column} desc" for column in keycolumns.split(","))
+        return (f"select (select count(*) from {relation}), "
+                f"(select coalesce(sum({ROWHASH}),0) from (select * from {relation} order by {keycolumns} limit {samplerows}) t)"
+                f"||':'||(select coalesce(sum({ROWHASH}),0) from (select * from {relation} order by {descending} limit {samplerows}) t)")
+    return f"select count(*), '' from {relation}"
+
+def collectstats(dbname,connargs,env,level,samplerows,jobs,snapshot=""):
+    #-------------------------------------------------------
+    # Function: collectstats
+    # Desc: Capture the stats of every table on a worker pool,
+    #       largest table first
+    # :dbname: Database name
+    # :connargs: Connection arguments from pypostgresshards.connectionargs
+    # :env: Environment with PGPASSWORD
+    # :level: count, sample or full
+    # :samplerows: Rows read from each end for the sample level
+    # :jobs: Number of tables to read at the same time
+    # :snapshot: Exported snapshot id. Blank=No snapshot
+    # :return: Stats dictionary
+    #-------------------------------------------------------
+    tables=[(row[0],row[1],row[2]) for row in pypostgresshards.psqlquery(TABLESQL,dbname,connargs,env,snapshot)]
+    def tablestats(table):
+        row=pypostgresshards.psqlquery(f"{SESSIONSQL};\n{statsquery(table,level,samplerows)}",dbname,connargs,env,snapshot)[0]
+        return {"rows":int(row[0]),"checksum":row[1]}
+    results=pypostgresshards.runpool(tables,jobs,tablestats)
+    return {"dbname":dbname,"level":level,"samplerows":samplerows,"created":time.strftime('%Y-%m-%d %H:%M:%S'),
+            "tables":{f"{table[0]}.{table[1]}":result for (table,result) in sorted(results)}}
+
+def writestats(statsfile,stats,store=None):
+    #-------------------------------------------------------
+    # Function: writestats
+    # Desc: Write the stats sidecar
+    # :statsfile: Stats file name or object URL
+    # :stats: Stats dictionary from collectstats
+    # :store: Object store for an object URL
+    #-------------------------------------------------------
+    data=json.dumps(stats,indent=1)
+    if pypostgresobjectstore.isobjecturl(statsfile):
+        store.putobject(*pypostgresobjectstore.parseurl(statsfile),data.encode())
+        return
+    with open(statsfile + ".tmp","w") as outfile:
+        outfile.write(data)
+    os.replace(statsfile + ".tmp",statsfile)
+
+def readstats(statsfile,store=None):
+    #-------------------------------------------------------
+    # Function: readstats
+    # Desc: Read the stats sidecar if there is one
+    # :statsfile: Stats file name or object URL
+    # :store: Object store for an object URL
+    # :return: Stats dictionary or None
+    #-------------------------------------------------------
+    if pypostgresobjectstore.isobjecturl(statsfile):
+        (bucket,key)=pypostgresobjectstore.parseurl(statsfile)
+        size=store.headobject(bucket,key)
+        if size is None:
+            return None
+        return json.loads(store.getrange(bucket,key,0,size))
+    if (os.path.isfile(statsfile)==False):
+        return None
+    with open(statsfile,"r") as infile:
+        return json.load(infile)
+
+def comparestats(expected,actual):
+    #-------------------------------------------------------
+    # Function: comparestats
+    # Desc: Compare the stats of a restored database with the
+    #       stats captured at backup time
+    # :expected: Stats from the backup
+    # :actual: Stats from the restored database
+    # :return: List of mismatch messages. Empty if all match.
+    #-------------------------------------------------------
+    mismatches=[]
+    for (table,stats) in expected["tables"].items():
+        restored=actual["tables"].get(table)
+        if restored is None:
+            mismatches.append(f"Table {table} is missing")
+        elif (restored["rows"]!=stats["rows"]):
+            mismatches.append(f"Table {table} has {restored['rows']} rows. Expected {stats['rows']}")
+        elif (restored["checksum"]!=stats["checksum"]):
+            mismatches.append(f"Table {table} checksum {restored['checksum']} does not match {stats['checksum']}")
+    for table in actual["tables"]:
+        if table not in expected["tables"]:
+            mismatches.append(f"Table {table} is not in the backup stats")
+    return mismatches
@@ -0,0 +1,502 @@
+#------------------------------------------------
+# Script name: pypostgreswal.py
+#
+# Description:
+# Physical base backups and the WAL archive used for point-in-time recovery.
+# A physical backup is a pg_basebackup tar format directory with one tar per
+# tablespace compressed by pg_basebackup while it streams. The WAL archive
+# stores each segment compressed and records it in a SQLite index so restores
+# find segments by name and old segments can be pruned by backup.
+#
+# Physical backup layout:
+# <outputdir>/base.tar[.gz|.zst|.lz4] - Main data directory
+# <outputdir>/<oid>.tar[.gz|.zst|.lz4] - One per user tablespace
+# <outputdir>/pg_wal.tar[.gz|.zst|.lz4] - WAL needed to make the backup consistent
+# <outputdir>/backup_manifest - pg_basebackup manifest with the WAL range
+# <outputdir>/physical.json - Backup info with the start and end WAL positions
+#
+# WAL archive layout:
+# <archivedir>/walindex.db - SQLite index of archived files
+# <archivedir>/<timeline and log>/<segment>[.gz|.zst|.lz4] - WAL segments,
+#   256 per directory at the default 16 MB segment size
+# <archivedir>/<file>[.gz|.zst|.lz4] - Timeline history and backup history files
+#
+# Point-in-time recovery:
+# The backup tars are unpacked into a new data directory, tablespaces in
+# parallel into their own directories with tablespace_map pointing at them.
+# recovery.signal and a restore_command that reads the WAL archive start
+# recovery up to the target time when the server starts.
+#
+# Pip packages needed:
+#------------------------------------------------
+
+#------------------------------------------------
+# Imports and Environment setup
+#------------------------------------------------
+import hashlib
+import json
+import os
+import os.path
+import re
+import shlex
+import sqlite3
+import sys
+import time
+import pypostgresstream
+import pypostgresshards
+
+# Physical backup info and WAL index file names
+PHYSICALFILE="physical.json"
+INDEXFILE="walindex.db"
+
+# Seconds to wait for the WAL index lock
+BUSYTIMEOUT=60
+
+# WAL file names. Segments are timeline, log and segment in hex.
+SEGMENTPATTERN=re.compile(r"^[0-9A-F]{24}$")
+HISTORYPATTERN=re.compile(r"^[0-9A-F]{8}\.history$")
+BACKUPPATTERN=re.compile(r"^[0-9A-F]{24}\.[0-9A-F]{8}\.backup$")
+PARTIALPATTERN=re.compile(r"^[0-9A-F]{24}\.partial$")
+
+# Tar files written by pg_basebackup
+TARPATTERN=re.compile(r"^(base|pg_wal|[0-9]+)\.tar(\.gz|\.zst|\.lz4)?$")
+
+# Recovery target actions
+TARGETACTIONS=("promote","pause","shutdown")
+
+# Archive script used in restore_command
+ARCHIVESCRIPT=os.path.join(os.path.dirname(os.path.abspath(__file__)),"pyarchivewal.py")
+
+#------------------------------------------------
+# Define some useful functions
+#------------------------------------------------
+
+def walfiletype(walfile):
+    #-------------------------------------------------------
+    # Function: walfiletype
+    # Desc: Get the type of a file archive_command is called for
+    # :walfile: WAL file name without a directory. Ex: 000000010000000000000003
+    # :return: segment, history, backup, partial or blank if unknown
+    #-------------------------------------------------------
+    if SEGMENTPATTERN.match(walfile):
+        return "segment"
+    if HISTORYPATTERN.match(walfile):
+        return "history"
+    if BACKUPPATTERN.match(walfile):
+        return "backup"
+    if PARTIALPATTERN.match(walfile):
+        return "partial"
+    return ""
+
+def archivepath(archivedir,walfile,codec):
+    #-------------------------------------------------------
+    # Function: archivepath
+    # Desc: Get the archive file name of a WAL file
+    # :archivedir: WAL archive directory
+    # :walfile: WAL file name
+    # :codec: Compression codec. none, gzip, zstd or lz4
+    # :return: Archive file path
+    #-------------------------------------------------------
+    extension=pypostgresstream.CODECS[codec]["extension"] if codec!="none" else ""
+    if (walfiletype(walfile) in ("segment","partial")):
+        return os.path.join(archivedir,walfile[:16],walfile + extension)
+    return os.path.join(archivedir,walfile + extension)
+
+def syncdir(dirname):
+    #-------------------------------------------------------
+    # Function: syncdir
+    # Desc: Flush a directory entry to disk after a rename
+    # :dirname: Directory name
+    #-------------------------------------------------------
+    handle=os.open(dirname,os.O_RDONLY)
+    try:
+        os.fsync(handle)
+    finally:
+        os.close(handle)
+
+class WalIndex:
+    #-------------------------------------------------------
+    # Class: WalIndex
+    # Desc: SQLite index of the files in a WAL archive.
+    #       Creates the index on first use.
+    #-------------------------------------------------------
+
+    def __init__(self,archivedir):
+        self.archivedir=archivedir
+        self.db=sqlite3.connect(os.path.join(archivedir,INDEXFILE),timeout=BUSYTIMEOUT)
+        self.db.row_factory=sqlite3.Row
+        self.db.execute("""create table if not exists wal (file text primary key, type text not null,
+                           timeline integer, path text not null, codec text not null, bytes integer,
+                           archivedbytes integer, sha256 text, archived text)""")
+        self.db.commit()
+
+    def find(self,walfile):
+        return self.db.execute("select * from wal where file=?",(walfile,)).fetchone()
+
+    def add(self,walfile,path,codec,size,archivedsize,sha256):
+        self.db.execute("insert or replace into wal (file,type,timeline,path,codec,bytes,archivedbytes,sha256,archived) values (?,?,?,?,?,?,?,?,?)",
+                        (walfile,walfiletype(walfile),int(walfile[:8],16),os.path.relpath(path,self.archivedir),codec,
+                         size,archivedsize,sha256,time.strftime('%Y-%m-%d %H:%M:%S')))
+        self.db.commit()
+
+    def segmentsbefore(self,walfile):
+        #-------------------------------------------------------
+        # Function: segmentsbefore
+        # Desc: List the segments and backup history files older
+        #       than a segment on any timeline. History files are
+        #       tiny and always kept.
+        # :walfile: First segment to keep
+        # :return: List of index rows
+        #-------------------------------------------------------
+        return self.db.execute("select * from wal where type in ('segment','partial','backup') and substr(file,9,16)<? order by file",
+                               (walfile[8:24],)).fetchall()
+
+    def remove(self,walfile):
+        self.db.execute("delete from wal where file=?",(walfile,))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+def archivewal(walpath,walfile,archivedir,codec="none",level=0,compressmode="auto"):
+    #-------------------------------------------------------
+    # Function: archivewal
+    # Desc: Compress a WAL file into the archive for archive_command.
+    #       The file is written to a .tmp file, synced and renamed so
+    #       a crash never leaves a partial file under the final name.
+    #       A file archived again with the same contents succeeds and
+    #       with different contents fails, as archive_command must.
+    # :walpath: WAL file path (%p). Relative to the data directory
+    # :walfile: WAL file name (%f)
+    # :archivedir: WAL archive directory
+    # :codec: none, gzip, zstd or lz4
+    # :level: Compression level. 0=Codec default
+    # :compressmode: auto, inprocess or pipeline
+    # :return: Index row of the archived file
+    #-------------------------------------------------------
+    if (walfiletype(walfile)==""):
+        raise Exception(f"{walfile} is not a WAL file name")
+    index=WalIndex(archivedir)
+    try:
+        sha256=hashlib.sha256()
+        with open(walpath,"rb") as infile:
+            for data in iter(lambda: infile.read(pypostgresstream.BUFFERSIZE),b""):
+                sha256.update(data)
+        existing=index.find(walfile)
+        if existing is not None and os.path.isfile(os.path.join(archivedir,existing["path"])):
+            if (existing["sha256"]!=sha256.hexdigest()):
+                raise Exception(f"WAL file {walfile} is already archived with different contents")
+            print(f"INFO: WAL file {walfile} is already archived")
+            return existing
+        path=archivepath(archivedir,walfile,codec)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        with open(walpath,"rb") as infile, open(path + ".tmp","wb") as outfile:
+            if (codec=="none"):
+                pypostgresstream.copystream(infile,outfile)
+            else:
+                writer=pypostgresstream.opencompressor(codec,level,compressmode,outfile)
+                pypostgresstream.copystream(infile,writer)
+                writer.close()
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(path + ".tmp",path)
+        syncdir(os.path.dirname(path))
+        index.add(walfile,path,codec,os.path.getsize(walpath),os.path.getsize(path),sha256.hexdigest())
+        return index.find(walfile)
+    finally:
+        index.close()
+
+def restorewal(walfile,walpath,archivedir,compressmode="auto"):
+    #-------------------------------------------------------
+    # Function: restorewal
+    # Desc: Decompress an archived WAL file for restore_command
+    # :walfile: WAL file name (%f)
+    # :walpath: Path to write it to (%p)
+    # :archivedir: WAL archive directory
+    # :compressmode: auto, inprocess or pipeline
+    # :return: True if found. False tells recovery the archive has no more WAL.
+    #-------------------------------------------------------
+    index=WalIndex(archivedir)
+    try:
+        row=index.find(walfile)
+    finally:
+        index.close()
+    if row is None or os.path.isfile(os.path.join(archivedir,row["path"]))==False:
+        return False
+    with open(os.path.join(archivedir,row["path"]),"rb") as infile, open(walpath + ".tmp","wb") as outfile:
+        pypostgresstream.copystream(pypostgresstream.opendecompressor(row["codec"],compressmode,infile),outfile)
+    os.replace(walpath + ".tmp",walpath)
+    return True
+
+def prunewal(archivedir,walfile,dryrun=False):
+    #-------------------------------------------------------
+    # Function: prunewal
+    # Desc: Delete archived segments older than a segment. Pass
+    #       the start segment of the oldest backup to keep.
+    # :archivedir: WAL archive directory
+    # :walfile: First segment to keep
+    # :dryrun: True=Only list the files
+    # :return: List of (file,archived bytes) deleted
+    #-------------------------------------------------------
+    index=WalIndex(archivedir)
+    pruned=[]
+    try:
+        for row in index.segmentsbefore(walfile):
+            path=os.path.join(archivedir,row["path"])
+            if (dryrun==False):
+                if os.path.isfile(path):
+                    os.remove(path)
+                index.remove(row["file"])
+            pruned.append((row["file"],row["archivedbytes"] or 0))
+    finally:
+        index.close()
+    return pruned
+
+def lsnsegment(lsn,timeline,segmentsize=16*1024*1024):
+    #-------------------------------------------------------
+    # Function: lsnsegment
+    # Desc: Get the WAL segment file name holding a WAL position
+    # :lsn: WAL position. Ex: 0/3B000028
+    # :timeline: Timeline id
+    # :segmentsize: WAL segment size in bytes
+    # :return: Segment file name. Ex: 00000001000000000000003B
+    #-------------------------------------------------------
+    (high,low)=lsn.split("/")
+    segment=((int(high,16) << 32) + int(low,16)) // segmentsize
+    segmentsperlog=0x100000000 // segmentsize
+    return f"{timeline:08X}{segment // segmentsperlog:08X}{segment % segmentsperlog:08X}"
+
+def basebackupargs(codec,level,jobs,maxmbps=0):
+    #-------------------------------------------------------
+    # Function: basebackupargs
+    # Desc: Build pg_basebackup compression and rate arguments.
+    #       pg_basebackup compresses each tar as it streams.
+    #       zstd compresses with jobs threads. zstd and lz4 need
+    #       pg_basebackup 15 or later built with the codec.
+    # :codec: none, gzip, zstd or lz4
+    # :level: Compression level. 0=Codec default
+    # :jobs: zstd compression threads
+    # :maxmbps: Maximum MB/s to read from the server. 0=No limit
+    # :return: List of command line arguments
+    #-------------------------------------------------------
+    args=[]
+    if (codec=="gzip"):
+        args+=["-Z",str(level if level > 0 else pypostgresstream.CODECS["gzip"]["level"])]
+    elif (codec!="none"):
+        spec=f"client-{codec}:level={level if level > 0 else pypostgresstream.CODECS[codec]['level']}"
+        if (codec=="zstd" and jobs > 1):
+            spec+=f",workers={jobs}"
+        args+=[f"--compress={spec}"]
+    if (maxmbps > 0):
+        args+=["--max-rate",f"{max(int(maxmbps*1024),32)}k"]
+    return args
+
+def backupfiles(outputdir):
+    #-------------------------------------------------------
+    # Function: backupfiles
+    # Desc: List the tar files of a physical backup
+    # :outputdir: Physical backup directory
+    # :return: List of tar file names, base first
+    #-------------------------------------------------------
+    files=[name for name in os.listdir(outputdir) if TARPATTERN.match(name)]
+    return sorted(files,key=lambda name: (not name.startswith("base."),name))
+
+def writephysical(outputdir,info):
+    with open(os.path.join(outputdir,PHYSICALFILE) + ".tmp","w") as outfile:
+        json.dump(info,outfile,indent=1)
+    os.replace(os.path.join(outputdir,PHYSICALFILE) + ".tmp",os.path.join(outputdir,PHYSICALFILE))
+
+def readphysical(inputdir):
+    #-------------------------------------------------------
+    # Function: readphysical
+    # Desc: Read the backup info if the input is a physical backup
+    # :inputdir: Backup input file or directory
+    # :return: Backup info dictionary or None if not a physical backup
+    #-------------------------------------------------------
+    physicalfile=os.path.join(inputdir,PHYSICALFILE)
+    if (os.path.isfile(physicalfile)==False):
+        return None
+    with open(physicalfile,"r") as infile:
+        return json.load(infile)
+
+def physicalinfo(outputdir,dbname,connargs,env,codec,started):
+    #-------------------------------------------------------
+    # Function: physicalinfo
+    # Desc: Build the backup info of a completed physical backup.
+    #       The WAL range comes from the backup manifest and the
+    #       server time after the backup is the earliest recovery
+    #       target time.
+    # :outputdir: Physical backup directory
+    # :dbname: Database to query the server time in
+    # :connargs: Connection arguments from pypostgresshards.connectionargs
+    # :env: Environment with PGPASSWORD
+    # :codec: Compression codec of the tar files
+    # :started: Local start time
+    # :return: Backup info dictionary
+    #-------------------------------------------------------
+    walranges=[]
+    manifestfile=os.path.join(outputdir,"backup_manifest")
+    if os.path.isfile(manifestfile):
+        with open(manifestfile,"r") as infile:
+            walranges=json.load(infile).get("WAL-Ranges",[])
+    row=pypostgresshards.psqlquery("select now()::text, extract(epoch from now()), current_setting('server_version'), "
+                                   "current_setting('wal_segment_size')",dbname,connargs,env)[0]
+    info={"format":"physical","started":started,"completed":time.strftime('%Y-%m-%d %H:%M:%S'),
+          "consistent":row[0],"consistentepoch":float(row[1]),"serverversion":row[2],"codec":codec,
+          "files":backupfiles(outputdir)}
+    if (len(walranges) > 0):
+        info["timeline"]=walranges[-1]["Timeline"]
+        info["startlsn"]=walranges[0]["Start-LSN"]
+        info["endlsn"]=walranges[-1]["End-LSN"]
+        info["startsegment"]=lsnsegment(info["startlsn"],walranges[0]["Timeline"],walsegmentsize(row[3]))
+    return info
+
+def walsegmentsize(setting):
+    #-------------------------------------------------------
+    # Function: walsegmentsize
+    # Desc: Convert the wal_segment_size setting to bytes
+    # :setting: Setting text. Ex: 16MB
+    # :return: Bytes
+    #-------------------------------------------------------
+    match=re.match(r"^([0-9]+)\s*(B|kB|MB|GB)?$",setting.strip())
+    if match is None:
+        return 16*1024*1024
+    return int(match.group(1))*{"B":1,"kB":1024,"MB":1024*1024,"GB":1024*1024*1024,None:1}[match.group(2)]
+
+def readtablespacemap(mapfile):
+    #-------------------------------------------------------
+    # Function: readtablespacemap
+    # Desc: Read a tablespace_map file
+    # :mapfile: tablespace_map path
+    # :return: Dictionary of tablespace oid to location
+    #-------------------------------------------------------
+    tablespaces={}
+    if os.path.isfile(mapfile):
+        with open(mapfile,"r") as infile:
+            for line in infile:
+                if (line.strip()!=""):
+                    (oid,location)=line.rstrip("\n").split(" ",1)
+                    tablespaces[oid]=location
+    return tablespaces
+
+def unpacktar(tarfile,targetdir,compressmode):
+    #-------------------------------------------------------
+    # Function: unpacktar
+    # Desc: Decompress a backup tar straight into tar -x
+    # :tarfile: Tar file path. The codec comes from the extension.
+    # :targetdir: Directory to unpack into
+    # :compressmode: auto, inprocess or pipeline
+    # :return: tar return code
+    #-------------------------------------------------------
+    os.makedirs(targetdir,mode=0o700,exist_ok=True)
+    print(f"INFO: Starting unpack of {tarfile} to {targetdir} - {time.strftime('%H:%M:%S')}",flush=True)
+    with open(tarfile,"rb") as infile:
+        rtncmd=pypostgresstream.pipetocommand(f"tar -xf - -C {shlex.quote(targetdir)}",
+                                              pypostgresstream.opendecompressor(pypostgresstream.codecfromfilename(tarfile),compressmode,infile))
+    print(f"INFO: Completed unpack of {tarfile} with return code {rtncmd} - {time.strftime('%H:%M:%S')}",flush=True)
+    return rtncmd
+
+def verifytar(tarfile,compressmode):
+    #-------------------------------------------------------
+    # Function: verifytar
+    # Desc: Read a backup tar through tar -t to check it
+    # :tarfile: Tar file path
+    # :return: tar return code
+    #-------------------------------------------------------
+    with open(tarfile,"rb") as infile:
+        return pypostgresstream.pipetocommand("tar -tf - > /dev/null",
+                                              pypostgresstream.opendecompressor(pypostgresstream.codecfromfilename(tarfile),compressmode,infile))
+
+def serverhost(datadir):
+    #-------------------------------------------------------
+    # Function: serverhost
+    # Desc: Get the host to connect to a running server on from
+    #       its postmaster.pid. The socket directory can differ
+    #       from the server the backup was taken from.
+    # :datadir: Data directory of the running server
+    # :return: Socket directory, listen address or blank
+    #-------------------------------------------------------
+    with open(os.path.join(datadir,"postmaster.pid"),"r") as infile:
+        lines=infile.read().splitlines()
+    # Line 5 is the first socket directory and line 6 the first listen address
+    if (len(lines) > 4 and lines[4].strip()!=""):
+        return lines[4].strip()
+    if (len(lines) > 5 and lines[5].strip() not in ("","*")):
+        return lines[5].strip()
+    return ""
+
+def recoveryconf(archivedir,targettime,targetaction,compressmode="auto"):
+    #-------------------------------------------------------
+    # Function: recoveryconf
+    # Desc: Build the recovery settings for postgresql.auto.conf.
+    #       Archiving is turned off so the restored server does
+    #       not write into the archive of the original server.
+    # :archivedir: WAL archive directory. Blank=No restore_command
+    # :targettime: Recovery target time. latest=End of the archive
+    # :targetaction: promote, pause or shutdown
+    # :compressmode: Decompression mode for the restore_command
+    # :return: Settings text
+    #-------------------------------------------------------
+    settings=["archive_mode = 'off'"]
+    if (archivedir!=""):
+        restorecommand=shlex.join([sys.executable,ARCHIVESCRIPT,"--action=restore",f"--archivedir={os.path.abspath(archivedir)}",
+                                   f"--compressmode={compressmode}"]) + " --walfile=%f --walpath=%p"
+        settings+=[f"restore_command = '{restorecommand.replace(chr(39),chr(39)*2)}'",
+                   "recovery_target_timeline = 'latest'"]
+        if (targettime.lower()!="latest"):
+            settings+=[f"recovery_target_time = '{targettime}'",f"recovery_target_action = '{targetaction}'"]
+    return "\n# Point-in-time recovery added by pyrestorepostgres.py\n" + "\n".join(settings) + "\n"
+
+def restorephysical(inputdir,targetdir,tablespacedir,archivedir,targettime,targetaction,jobs,compressmode="auto"):
+    #-------------------------------------------------------
+    # Function: restorephysical
+    # Desc: Unpack a physical backup into a new data directory
+    #       set up for point-in-time recovery. base.tar goes
+    #       first for the tablespace_map, then the tablespace
+    #       and WAL tars run on the worker pool.
+    # :inputdir: Physical backup directory
+    # :targetdir: New data directory. Must not exist or be empty
+    # :tablespacedir: Directory for the tablespaces. Each one is
+    #                 unpacked into <tablespacedir>/<oid>
+    # :archivedir: WAL archive directory. Blank=Only the WAL in the backup
+    # :targettime: Recovery target time. latest=End of the archive
+    # :targetaction: promote, pause or shutdown
+    # :jobs: Number of tars to unpack at the same time
+    # :return: Return code. 0=Success
+    #-------------------------------------------------------
+    files=backupfiles(inputdir)
+    basefile=[name for name in files if name.startswith("base.")]
+    if (len(basefile)==0):
+        raise Exception(f"No base.tar found in physical backup {inputdir}")
+    rtncmd=unpacktar(os.path.join(inputdir,basefile[0]),targetdir,compressmode)
+    if (rtncmd!=0):
+        return rtncmd
+
+    # Tablespaces are unpacked to their own directory instead of their
+    # original location so a restore never writes over a live cluster
+    tablespaces=readtablespacemap(os.path.join(targetdir,"tablespace_map"))
+    units=[]
+    for name in files:
+        oid=name.split(".")[0]
+        if name.startswith("pg_wal."):
+            units.append((name,os.path.join(targetdir,"pg_wal")))
+        elif oid in tablespaces:
+            tablespaces[oid]=os.path.join(os.path.abspath(tablespacedir),oid)
+            units.append((name,tablespaces[oid]))
+    if (len(tablespaces) > 0):
+        with open(os.path.join(targetdir,"tablespace_map"),"w") as outfile:
+            for (oid,location) in tablespaces.items():
+                outfile.write(f"{oid} {location}\n")
+    results=pypostgresshards.runpool(units,jobs,lambda unit: unpacktar(os.path.join(inputdir,unit[0]),unit[1],compressmode))
+    failed=[result for result in results if result[1]!=0]
+    if (len(failed) > 0):
+        return failed[0][1]
+
+    # Recovery starts when the server starts on the new data directory.
+    # Without an archive the server only replays the WAL in the backup.
+    with open(os.path.join(targetdir,"postgresql.auto.conf"),"a") as outfile:
+        outfile.write(recoveryconf(archivedir,targettime,targetaction,compressmode))
+    if (archivedir!=""):
+        open(os.path.join(targetdir,"recovery.signal"),"w").close()
+    os.chmod(targetdir,0o700)
+    return 0
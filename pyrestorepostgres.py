@@ -19,13 +19,110 @@
 #    will get thrown on createdb.
 #   overwritedb=Clean and overwrite existing database. Database must already exist or error thrown.
 #   restoreasdb=Create new database name and restore backup to the new database.
+#   listtoc=List the archive table of contents entries selected by --schemas, --tables
+#    and --types without restoring. --dbname is not needed.
+#   verify=Restore the backup into a scratch database, compare the row count and checksum
+#    of every table with the stats captured by pybackuppostgres.py --stats and drop the
+#    scratch database. The tables are compared by --jobs workers at the stats level of the
+#    backup. Without stats only the restore itself is verified. --dbname is the scratch
+#    database name. It must not exist. Blank=pyverify_<process id>. Combine with --jobs and
+#    --fast=True --unlogged=keep for the fastest verify.
+#   pitr=Point-in-time recovery of a physical backup written by pybackuppostgres.py
+#    --format=physical into the new data directory --targetdir. The base tar is unpacked
+#    first and then the tablespace and WAL tars by --jobs workers. recovery.signal and a
+#    restore_command reading the --walarchive directory are written so the server replays
+#    the archived WAL up to --targettime when it starts. archive_mode is set off in
+#    postgresql.auto.conf so the restored server does not archive into the same WAL archive.
+#    Set it back after checking the restored server. With --catalog the newest physical
+#    backup of --fromdb that ended by --targettime is used. --dbname is not needed.
 # --dbname=New database name, existing database name or restore as database name
 #   depending on which action was selected.    
 # --dbhost=PostgreSQL host name to connect to. Leave blank or omit this parm to use local sockets.
 # --dbport=PostgreSQL TCP port connect to. Omit this parm to default to port: 5432.
 # --dbuser=PostgreSQL user to connect as. Omit this parm to use "postgres" user as default user.
 # --dbpass=PostgreSQL password to use. Omit this parm or pass empty parm if host is blank to use local socket connection.
-# --inputfile=Input pb_dump tar backup file to restore from. Ex: /tmp/mybackup.tar
+# --inputfile=Input pb_dump tar backup file or directory format backup to restore from. Ex: /tmp/mybackup.tar
+#   An s3://bucket/key tar backup in S3-compatible object storage is read with ranged GETs
+#   straight into pg_restore, or into tar when unpacking for a parallel restore. Credentials
+#   come from AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY. Ex: s3://backups/pg/mydb.tar.zst
+# --jobs=Number of parallel pg_restore jobs. Default=1 (single pg_restore, original behavior). 
+#   When greater than 1, pre-data is restored first by itself and then data and post-data 
+#   (indexes, constraints) are restored by --jobs workers. Tar files cannot be restored in
+#   parallel by pg_restore so they get unpacked into a work directory first.
+#   Packaged directory and shards backups (--package=true) are always unpacked.
+# --workdir=Work directory to unpack tar files into for a parallel restore. Must have room for 
+#   the unpacked backup. Default=temporary directory next to the input file, or the system temporary
+#   directory for object storage input. Removed after restore.
+# --compressmode=Decompression mode for compressed tar files (.gz, .zst, .lz4). auto=In-process 
+#   if the Python module is available otherwise pipeline (default). inprocess=Decompress in this
+#   Python process. pipeline=Pipe through the gzip/zstd/lz4 program. Compressed tar files are
+#   decompressed straight into pg_restore, or into tar when unpacking for a parallel restore.
+# --repository=Deduplicated backup repository directory written by pybackuppostgres.py --repository.
+#   Blank=Restore from a backup file (default). When set, --inputfile is the backup name or
+#   manifest file and the tar stream is rebuilt from the stored chunks straight into pg_restore.
+# Sharded backup sets written by pybackuppostgres.py --format=shards are restored by passing the
+#   backup set directory as --inputfile. Pre-data is restored from schema.dump, then the data
+#   shards are restored by --jobs workers and then post-data with pg_restore --jobs.
+# --metricsfile=JSON lines file to append timing and throughput metrics to for each phase
+#   (unpack, createdb, restore sections). Blank=No metrics file (default).
+# --promfile=Prometheus node_exporter textfile to write the phase metrics and exit code to.
+#   Blank=No Prometheus file (default). Ex: /var/lib/node_exporter/textfile/pgrestore_mydb.prom
+# --progress=Seconds between PROGRESS lines while pg_restore runs. pg_restore --verbose output is
+#   read line by line to track objects processed and the current table. The ETA is based on the
+#   bytes read for streamed input and on the table data file sizes for directory archives.
+#   0=Only a final PROGRESS line. Default=30
+# --fast=True=Fast restore for newdb, restoreasdb and verify. The pre-data, data and post-data sections are
+#   restored one after the other with bulk load session settings (synchronous_commit=off and a
+#   larger maintenance_work_mem) passed to pg_restore through PGOPTIONS. Indexes and constraints
+#   are built after the data is loaded by --jobs pg_restore workers and the restore ends with
+#   vacuumdb --analyze-only --jobs. Parallel post-data needs a directory backup or --jobs
+#   greater than 1 so tar files get unpacked. False=Normal restore (default).
+# --unlogged=Unlogged tables for a fast restore. none=Tables stay logged (default).
+#   load=Tables are set unlogged after pre-data so the data section writes no WAL, and set
+#   logged again before post-data. Only with wal_level=minimal on the server. At replica or
+#   logical SET LOGGED writes every table into the WAL so load is refused. keep=Tables stay unlogged. Only for throw away staging
+#   databases since unlogged tables are emptied after a crash and are not replicated.
+# --maintmem=maintenance_work_mem for a fast restore. Each --jobs worker can use this much
+#   memory for index builds. Default=1GB
+# --schemas=Comma separated schemas to restore. Blank=All schemas (default).
+# --tables=Comma separated tables, views or sequences to restore by name or schema.name. Their
+#   data, indexes, constraints, triggers, defaults, comments, grants and owned sequences come
+#   with them. Foreign keys to tables that are not restored are left out. Blank=All (default).
+# --types=Comma separated object types to restore. Ex: TABLE DATA or FUNCTION,VIEW
+#   Blank=All types (default).
+#   A selective restore reads the archive table of contents once and caches it as a sidecar
+#   index next to the backup (<inputfile>.toc.json). The selected entries are passed to
+#   pg_restore --use-list. pg_dump tar files are not unpacked for a selective restore. With
+#   overwritedb only the selected objects are dropped and restored. With newdb and
+#   restoreasdb the schemas of the selected tables are created too.
+# --catalog=SQLite backup catalog file written by pybackuppostgres.py --catalog. When --inputfile
+#   is blank the backup to restore is looked up in the catalog by --fromdb and --backuptime.
+#   Blank=No catalog (default).
+# --fromdb=Database name of the backup to look up in the catalog. Default=--dbname
+# --backuptime=Restore the newest complete backup started at or before this local time. A partial
+#   time covers the whole period. Ex: 2024-07-07 or 2024-07-07 13:00. latest=Newest backup (default).
+# --statsfile=Stats file to verify against. Blank=<inputfile>.stats.json (default).
+# --endpoint=Object storage endpoint for an s3:// input file. https://host[:port] or http://host[:port]
+#   for an S3-compatible server or file:///directory for the filesystem fake.
+#   Blank=AWS_ENDPOINT_URL environment variable or AWS S3 (default).
+# --partsize=Object storage ranged GET size in MB. Default=16
+# --downloads=Number of ranged GETs running ahead of pg_restore. The restore holds about
+#   downloads+1 parts in memory. Default=4
+# --targetdir=New data directory for pitr. Must not exist or be empty.
+# --walarchive=WAL archive directory written by pyarchivewal.py for pitr. Blank=Only recover to
+#   the end of the backup with the WAL inside it. Default=blank
+# --targettime=Recovery target time for pitr. Ex: 2024-07-07 13:05:00 or 2024-07-07 13:05:00+02
+#   A time without a time zone is in the server time zone. Add the time zone when the server time
+#   zone is not the local time zone. latest=Replay all archived WAL (default).
+#   The time must be after the end of the backup. It is in physical.json as consistent.
+# --targetaction=What the server does at the target time. promote=End recovery and accept writes
+#   (default). pause=Pause for checking with pg_wal_replay_resume() to promote. shutdown=Stop.
+# --tablespacedir=Directory to unpack the tablespaces into for pitr, one sub directory per tablespace
+#   oid. tablespace_map is rewritten to point at them so the original tablespace locations are
+#   never written to. Blank=<targetdir>.tablespaces (default).
+# --startport=Start the restored server on this port with pg_ctl and wait until recovery ends.
+#   Only with --targetaction=promote. Run as the operating system user that owns the server.
+#   0=Do not start the server (default). Start it later with pg_ctl -D <targetdir> start.
 #------------------------------------------------
 
 #------------------------------------------------
@@ -41,9 +138,23 @@ import time
 import traceback
 import argparse
 import re
+import shutil
+import tempfile
+import tarfile
 from pathlib import Path
 from datetime import date
 import datetime
+import pypostgresstream
+import pypostgreschunkstore
+import pypostgresshards
+import pypostgresmetrics
+import pypostgresprogress
+import pypostgresfast
+import pypostgrestoc
+import pypostgrescatalog
+import pypostgresobjectstore
+import pypostgresverify
+import pypostgreswal
 
 #------------------------------------------------
 # Script initialization
@@ -56,6 +167,12 @@ parmsexpected=5;
 dashes="-------------------------------------------------------------------------------"
 outputtype=""
 rtncmd=0
+workdir=""
+workdircreated=False
+metrics=None
+listfile=""
+objectstore=None
+scratchdb=""
 
 #Output messages to STDOUT for logging
 print(dashes)
@@ -103,6 +220,101 @@ def ltrim(strval):
     #-------------------------------------------------------
     return strval.lstrip()
 
+def findtocdir(dirname):
+    #-------------------------------------------------------
+    # Function: findtocdir
+    # Desc: Find the directory format archive inside an unpacked
+    #       tar file. pg_dump tar files unpack to toc.dat at the top 
+    #       level and packaged directory backups unpack to a subdirectory.
+    #       Packaged shard backup sets are found by their backupset.json.
+    # :dirname: Directory the tar file was unpacked into
+    # :return: Directory containing toc.dat or blank if not found
+    #-------------------------------------------------------
+    for root, dirs, files in os.walk(dirname):
+        if "toc.dat" in files or pypostgresshards.BACKUPSETFILE in files:
+            return root
+    return ""
+
+def openinputstream(inputfile,inputcodec,compressmode,repository,monitor=None):
+    #-------------------------------------------------------
+    # Function: openinputstream
+    # Desc: Open the backup as a readable tar stream
+    # :inputfile: Backup file, or backup name for a repository
+    # :inputcodec: Compression codec of the backup file
+    # :compressmode: auto, inprocess or pipeline
+    # :repository: Backup repository directory or blank
+    # :monitor: Progress monitor counting the backup bytes read. 
+    #           None=No progress
+    # :return: Readable binary stream of the uncompressed tar
+    #-------------------------------------------------------
+    if (repository!=""):
+        src=pypostgreschunkstore.ChunkReader(pypostgreschunkstore.ChunkStore(repository),inputfile)
+        return monitor.countreader(src) if monitor is not None else src
+    if pypostgresobjectstore.isobjecturl(inputfile):
+        src=pypostgresobjectstore.ObjectReader(objectstore,inputfile,int(parmpartsize*1024*1024),parmdownloads)
+    else:
+        src=open(inputfile,"rb")
+    if monitor is not None:
+        src=monitor.countreader(src)
+    return pypostgresstream.opendecompressor(inputcodec,compressmode,src)
+
+def packagedtar(inputfile,inputcodec,compressmode,repository):
+    #-------------------------------------------------------
+    # Function: packagedtar
+    # Desc: Check whether a tar backup is a packaged directory
+    #       or shards backup. pg_dump tar files start with toc.dat
+    #       and packaged backups start with their directory so
+    #       only the first tar header gets read.
+    # :inputfile: Backup file, or backup name for a repository
+    # :inputcodec: Compression codec of the backup file
+    # :compressmode: auto, inprocess or pipeline
+    # :repository: Backup repository directory or blank
+    # :return: True=Packaged backup that must be unpacked, False=pg_dump tar file
+    #-------------------------------------------------------
+    src=openinputstream(inputfile,inputcodec,compressmode,repository)
+    try:
+        with tarfile.open(fileobj=src,mode="r|") as tar:
+            member=tar.next()
+    except tarfile.TarError as ex:
+        raise Exception(f"Backup file {inputfile} is not a tar file. {ex}")
+    finally:
+        if hasattr(src,"close"):
+            src.close()
+    if (member is None):
+        raise Exception(f"Backup file {inputfile} is an empty tar file")
+    return member.name!="toc.dat"
+
+def streamsize(inputfile,repository):
+    #-------------------------------------------------------
+    # Function: streamsize
+    # Desc: Get the bytes openinputstream reads for the backup
+    # :inputfile: Backup file, or backup name for a repository
+    # :repository: Backup repository directory or blank
+    # :return: Backup file size or tar stream size for a repository
+    #-------------------------------------------------------
+    if (repository!=""):
+        return pypostgreschunkstore.ChunkReader(pypostgreschunkstore.ChunkStore(repository),inputfile).manifest["bytes"]
+    if pypostgresobjectstore.isobjecturl(inputfile):
+        return objectstore.headobject(*pypostgresobjectstore.parseurl(inputfile))
+    return os.path.getsize(inputfile)
+
+def runpersistence(logged):
+    #-------------------------------------------------------
+    # Function: runpersistence
+    # Desc: Set the restored tables logged or unlogged for a
+    #       fast restore with --jobs workers
+    # :logged: True=SET LOGGED. False=SET UNLOGGED
+    #-------------------------------------------------------
+    persistence="logged" if logged else "unlogged"
+    print("")
+    print(f"INFO: Starting set {persistence} of tables in database {parmdbname} - {time.strftime('%H:%M:%S')}")
+    phase=metrics.startphase(persistence)
+    rtncmd=pypostgresfast.setpersistence(parmdbname,connargs,restoreenv,logged,parmjobs)
+    metrics.endphase(phase,0,rtncmd)
+    print(f"INFO: Completed set {persistence} of tables in database {parmdbname} - {time.strftime('%H:%M:%S')}")
+    if (rtncmd != 0):
+        raise Exception(f"Error {rtncmd} occurred while setting tables {persistence}")
+
 #------------------------------------------------
 # Main script logic
 #------------------------------------------------
@@ -114,13 +326,39 @@ try: # Try to perform main logic
       # an argument to prevent an auto-exit
       # Each argument has a long and short version
       parser = argparse.ArgumentParser()
-      parser.add_argument('-a','--action', required=True,help="Restore action: newdb=database does not exist yet,overwritedb=clean and overwrite existing database,restoreasdb=restore as new name")
-      parser.add_argument('-d','--dbname', required=True,help="Database name")
+      parser.add_argument('-a','--action', required=True,help="Restore action: newdb=database does not exist yet,overwritedb=clean and overwrite existing database,restoreasdb=restore as new name,listtoc=list table of contents,verify=restore into a scratch database and compare table stats,pitr=point-in-time recovery of a physical backup")
+      parser.add_argument('-d','--dbname', required=False,default="",help="Database name")
       parser.add_argument('-H','--dbhost', required=False,default="",help="Database host. Blank=use local domain socket")
       parser.add_argument('-p','--dbport', required=False,default=5432,help="Database port")
       parser.add_argument('-U','--dbuser', required=False,default="postgres",help="Database user")
       parser.add_argument('-P','--dbpass', required=False,help="Database pass")
-      parser.add_argument('-i','--inputfile', required=True,help="Input pg_dump backup TAR file")
+      parser.add_argument('-i','--inputfile', required=False,default="",help="Input pg_dump backup TAR file or directory. Blank=Look up backup in --catalog")
+      parser.add_argument('-j','--jobs', required=False,default=1,help="Number of parallel pg_restore jobs. Default=1")
+      parser.add_argument('-M','--compressmode', required=False,default="auto",help="Decompression mode for compressed tar files: auto, inprocess or pipeline. Default=auto")
+      parser.add_argument('-R','--repository', required=False,default="",help="Deduplicated backup repository directory. Blank=restore from backup file. Default=blank")
+      parser.add_argument('-w','--workdir', required=False,default="",help="Work directory to unpack tar files into for parallel restore. Default=temporary directory next to input file")
+      parser.add_argument('-e','--metricsfile', required=False,default="",help="JSON lines file to append phase metrics to. Blank=No metrics file. Default=blank")
+      parser.add_argument('-x','--promfile', required=False,default="",help="Prometheus textfile to write phase metrics to. Blank=No Prometheus file. Default=blank")
+      parser.add_argument('-g','--progress', required=False,default=30,help="Seconds between progress lines. 0=Final progress line only. Default=30")
+      parser.add_argument('-f','--fast', required=False,default="False",help="True=Fast restore with bulk load settings, parallel post-data and analyze,False=Normal restore. Default=False")
+      parser.add_argument('-u','--unlogged', required=False,default="none",help="Unlogged tables for fast restore: none, load=unlogged during data load with wal_level=minimal, keep=stay unlogged. Default=none")
+      parser.add_argument('-W','--maintmem', required=False,default="1GB",help="maintenance_work_mem for fast restore. Default=1GB")
+      parser.add_argument('-s','--schemas', required=False,default="",help="Comma separated schemas to restore. Blank=All. Default=blank")
+      parser.add_argument('-t','--tables', required=False,default="",help="Comma separated tables to restore with their indexes and constraints. Blank=All. Default=blank")
+      parser.add_argument('-T','--types', required=False,default="",help="Comma separated object types to restore. Ex: TABLE DATA. Blank=All. Default=blank")
+      parser.add_argument('-C','--catalog', required=False,default="",help="SQLite backup catalog file to look up the backup in when --inputfile is blank. Default=blank")
+      parser.add_argument('-D','--fromdb', required=False,default="",help="Database name of the backup to look up in the catalog. Default=--dbname")
+      parser.add_argument('-B','--backuptime', required=False,default="latest",help="Newest backup started at or before this local time. Ex: 2024-07-07 13:00. latest=Newest backup. Default=latest")
+      parser.add_argument('-E','--endpoint', required=False,default="",help="Object storage endpoint for s3:// input. file:///dir=Filesystem fake. Blank=AWS_ENDPOINT_URL or AWS S3. Default=blank")
+      parser.add_argument('-z','--partsize', required=False,default=16,help="Object storage ranged GET size in MB. Default=16")
+      parser.add_argument('-S','--statsfile', required=False,default="",help="Stats file to verify against. Blank=<inputfile>.stats.json. Default=blank")
+      parser.add_argument('-y','--downloads', required=False,default=4,help="Number of object storage ranged GETs running ahead of pg_restore. Default=4")
+      parser.add_argument('-O','--targetdir', required=False,default="",help="New data directory for pitr. Default=blank")
+      parser.add_argument('-A','--walarchive', required=False,default="",help="WAL archive directory for pitr. Blank=Recover to the end of the backup. Default=blank")
+      parser.add_argument('-Q','--targettime', required=False,default="latest",help="Recovery target time for pitr. latest=All archived WAL. Default=latest")
+      parser.add_argument('-k','--targetaction', required=False,default="promote",help="Action at the recovery target for pitr: promote, pause or shutdown. Default=promote")
+      parser.add_argument('-K','--tablespacedir', required=False,default="",help="Directory for the tablespaces for pitr. Blank=<targetdir>.tablespaces. Default=blank")
+      parser.add_argument('-o','--startport', required=False,default=0,help="Start the restored server on this port and wait for recovery. 0=Do not start. Default=0")
       
       # Parse the command line arguments 
       args = parser.parse_args()
@@ -137,6 +375,39 @@ try: # Try to perform main logic
       # This is in case exclamation in password  
       parmdbpass=parmdbpass.replace("\!","!")   
       parminputfile = args.inputfile.strip()
+      parmjobs=int(args.jobs)
+      parmworkdir=args.workdir.strip()
+      parmcompressmode=args.compressmode.strip().lower()
+      parmrepository=args.repository.strip()
+      parmmetricsfile=args.metricsfile.strip()
+      parmpromfile=args.promfile.strip()
+      parmprogress=float(args.progress)
+      parmfast=str2bool(args.fast)
+      parmunlogged=args.unlogged.strip().lower()
+      parmmaintmem=args.maintmem.strip()
+      parmschemas=pypostgrestoc.splitlist(args.schemas)
+      parmtables=pypostgrestoc.splitlist(args.tables)
+      parmtypes=pypostgrestoc.splitlist(args.types)
+      parmcatalog=args.catalog.strip()
+      parmfromdb=args.fromdb.strip()
+      if (parmfromdb==""):
+         parmfromdb=parmdbname
+      parmbackuptime=args.backuptime.strip()
+      parmendpoint=args.endpoint.strip()
+      parmpartsize=float(args.partsize)
+      parmdownloads=int(args.downloads)
+      parmstatsfile=args.statsfile.strip()
+      parmtargetdir=args.targetdir.strip()
+      parmwalarchive=args.walarchive.strip()
+      parmtargettime=args.targettime.strip()
+      parmtargetaction=args.targetaction.strip().lower()
+      parmtablespacedir=args.tablespacedir.strip()
+      if (parmtablespacedir=="" and parmtargetdir!=""):
+         parmtablespacedir=parmtargetdir.rstrip("/") + ".tablespaces"
+      parmstartport=int(args.startport)
+      # Scratch database for a verify
+      if (parmaction=="verify" and parmdbname==""):
+         parmdbname=f"pyverify_{os.getpid()}"
       print(f"Python script: {parmscriptname}")
       print(f"Database action: {parmaction}")
       print(f"Database host: {parmdbhost}")
@@ -145,17 +416,181 @@ try: # Try to perform main logic
       print(f"Database user: {parmdbuser}")
       ##print(f"Database pass: {parmdbpass}")
       print(f"Output file: {parminputfile}")
+      print(f"Jobs: {parmjobs}")
+      print(f"Work dir: {parmworkdir}")
+      print(f"Compress mode: {parmcompressmode}")
+      print(f"Repository: {parmrepository}")
+      print(f"Metrics file: {parmmetricsfile}")
+      print(f"Prometheus file: {parmpromfile}")
+      print(f"Progress seconds: {parmprogress}")
+      print(f"Fast restore: {parmfast}")
+      print(f"Unlogged: {parmunlogged}")
+      print(f"Maintenance work mem: {parmmaintmem}")
+      print(f"Schemas: {','.join(parmschemas)}")
+      print(f"Tables: {','.join(parmtables)}")
+      print(f"Types: {','.join(parmtypes)}")
+      print(f"Catalog: {parmcatalog}")
+      print(f"From database: {parmfromdb}")
+      print(f"Backup time: {parmbackuptime}")
+      print(f"Object storage endpoint: {parmendpoint}")
+      print(f"Part size MB: {parmpartsize}")
+      print(f"Downloads: {parmdownloads}")
+      print(f"Stats file: {parmstatsfile}")
+      print(f"Target dir: {parmtargetdir}")
+      print(f"WAL archive: {parmwalarchive}")
+      print(f"Target time: {parmtargettime}")
+      print(f"Target action: {parmtargetaction}")
+      print(f"Tablespace dir: {parmtablespacedir}")
+      print(f"Start port: {parmstartport}")
+
+      # Collect phase timings from here on
+      metrics=pypostgresmetrics.Metrics("restore",parmdbname,parmmetricsfile,parmpromfile)
 
       # Bail if action is invalid
       if (parmaction != "newdb" and 
           parmaction != "overwritedb" and
-          parmaction != "restoreasdb"):
-            raise Exception("Action must be: newdb, overwritedb or restoreasdb")
+          parmaction != "restoreasdb" and
+          parmaction != "listtoc" and
+          parmaction != "verify" and
+          parmaction != "pitr"):
+            raise Exception("Action must be: newdb, overwritedb, restoreasdb, listtoc, verify or pitr")
 
-      # Make sure tar backup input file exists. otherwise bail out
-      if (os.path.isfile(parminputfile)==False):
+      # Bail if database name is missing
+      if (parmdbname=="" and parmaction!="listtoc" and parmaction!="pitr"):
+            raise Exception("Database name must be set with --dbname")
+
+      # Bail if point-in-time recovery options are invalid. The new data
+      # directory and tablespace directories must be new or empty.
+      if (parmaction=="pitr"):
+         if (parmtargetdir==""):
+            raise Exception("Target data directory must be set with --targetdir for pitr")
+         for dirname in (parmtargetdir,parmtablespacedir):
+            if (os.path.exists(dirname) and (os.path.isdir(dirname)==False or len(os.listdir(dirname)) > 0)):
+               raise Exception(f"Directory {dirname} already exists and is not empty. Restore cancelled.")
+         if (parmwalarchive!="" and os.path.isfile(os.path.join(parmwalarchive,pypostgreswal.INDEXFILE))==False):
+            raise Exception(f"WAL archive {parmwalarchive} has no {pypostgreswal.INDEXFILE} index. Restore cancelled.")
+         if (parmwalarchive=="" and parmtargettime.lower()!="latest"):
+            raise Exception("Recovery to a target time needs the WAL archive set with --walarchive")
+         if (parmtargetaction not in pypostgreswal.TARGETACTIONS):
+            raise Exception("Target action must be: promote, pause or shutdown")
+         if (parmstartport > 0 and parmtargetaction!="promote"):
+            raise Exception("Start port can only be used with target action promote")
+         if (len(parmschemas) > 0 or len(parmtables) > 0 or len(parmtypes) > 0 or parmfast==True or parmrepository!=""):
+            raise Exception("Point-in-time recovery restores the whole server. Schemas, tables, types, fast restore and repository cannot be used.")
+
+      # Bail if jobs is invalid
+      if (parmjobs < 1):
+            raise Exception("Jobs must be 1 or greater")
+
+      # Bail if compress mode is invalid
+      if (parmcompressmode != "auto" and 
+          parmcompressmode != "inprocess" and
+          parmcompressmode != "pipeline"):
+            raise Exception("Compress mode must be: auto, inprocess or pipeline")
+
+      # Bail if fast restore options are invalid
+      if (parmunlogged not in pypostgresfast.UNLOGGEDMODES):
+            raise Exception("Unlogged must be: none, load or keep")
+      if (parmfast==True and parmaction!="newdb" and parmaction!="restoreasdb" and parmaction!="verify"):
+            raise Exception("Fast restore is only for newdb, restoreasdb and verify actions")
+      if (parmfast==False and parmunlogged!="none"):
+            raise Exception("Unlogged needs fast restore. Use --fast=True")
+      unloggederror=pypostgresfast.checkunlogged(parmunlogged,pypostgresshards.connectionargs(parmdbhost,parmdbport,parmdbuser),
+                                                 dict(os.environ,PGPASSWORD=parmdbpass))
+      if (unloggederror!=""):
+            raise Exception(unloggederror)
+
+      # Look up the backup in the catalog when no input file is given
+      if (parminputfile==""):
+         if (parmcatalog==""):
+            raise Exception("Input file must be set with --inputfile or looked up with --catalog")
+         if (parmfromdb==""):
+            raise Exception("Database to look up in the catalog must be set with --fromdb or --dbname")
+         catalog=pypostgrescatalog.Catalog(parmcatalog)
+         # Point-in-time recovery starts from a physical backup that ended by the target time
+         if (parmaction=="pitr"):
+            parmbackuptime=parmtargettime
+         backuprecord=catalog.findbackup(parmfromdb,parmbackuptime,physical=(parmaction=="pitr"))
+         catalog.close()
+         if backuprecord is None:
+            raise Exception(f"INFO:No complete {'physical ' if parmaction=='pitr' else ''}backup of database {parmfromdb} at or before {parmbackuptime} found in catalog {parmcatalog}. Restore cancelled.")
+         parminputfile=backuprecord["path"]
+         parmrepository=backuprecord["repository"] or ""
+         print(f"INFO: Catalog backup id {backuprecord['id']} of database {parmfromdb} started {backuprecord['started']}")
+         print(f"INFO: Input file: {parminputfile}")
+         if (parmrepository!=""):
+            print(f"INFO: Repository: {parmrepository}")
+         print(f"INFO: SHA-256 {backuprecord['sha256']} for {backuprecord['bytes']} bytes")
+
+      # Make sure object storage backup exists. otherwise bail out
+      if pypostgresobjectstore.isobjecturl(parminputfile):
+         if (parmpartsize <= 0 or parmdownloads < 1):
+            raise Exception("Part size must be greater than 0 and downloads must be 1 or greater")
+         objectstore=pypostgresobjectstore.openstore(parmendpoint)
+         if (objectstore.headobject(*pypostgresobjectstore.parseurl(parminputfile)) is None):
+            raise Exception(f"INFO:Backup object {parminputfile} does not exist. Restore cancelled.")
+
+      # Make sure repository backup manifest exists. otherwise bail out
+      elif (parmrepository!=""):
+         if (os.path.isfile(pypostgreschunkstore.ChunkStore(parmrepository).manifestpath(parminputfile))==False):
+            raise Exception(f"INFO:Backup {parminputfile} does not exist in repository {parmrepository}. Restore cancelled.")
+
+      # Make sure tar backup input file or directory exists. otherwise bail out
+      elif (os.path.isfile(parminputfile)==False and os.path.isdir(parminputfile)==False):
             raise Exception(f"INFO:Backup file {parminputfile} does not exist. Restore cancelled.")
 
+      # Physical backups can only be restored by point-in-time recovery
+      physicalinfo=None
+      if (objectstore is None and parmrepository=="" and os.path.isdir(parminputfile)):
+         physicalinfo=pypostgreswal.readphysical(parminputfile)
+      if (physicalinfo is not None and parmaction!="pitr"):
+            raise Exception(f"{parminputfile} is a physical backup. Restore it with --action=pitr")
+      if (physicalinfo is None and parmaction=="pitr"):
+            raise Exception(f"{parminputfile} is not a physical backup written by pybackuppostgres.py --format=physical. Restore cancelled.")
+
+      # Compression codec from input file extension. Ex: .tar.zst=zstd
+      inputcodec="none"
+      if ((os.path.isfile(parminputfile) or objectstore is not None) and parmrepository==""):
+         inputcodec=pypostgresstream.codecfromfilename(parminputfile)
+      print(f"Input compression: {inputcodec}")
+
+      # Packaged directory and shards backups hold the archive in a sub directory
+      # that pg_restore cannot read from the tar file so they always get unpacked.
+      # Reading the first tar header also checks the input before createdb runs.
+      packaged=False
+      if (parmaction not in ("listtoc","pitr") and (os.path.isfile(parminputfile) or parmrepository!="" or objectstore is not None)):
+         packaged=packagedtar(parminputfile,inputcodec,parmcompressmode,parmrepository)
+         if (packaged==True):
+            print(f"INFO: {parminputfile} is a packaged backup and gets unpacked before the restore")
+
+      # Select archive entries from the table of contents index for a selective
+      # restore or a listing. The index is built on first use next to the backup.
+      selective=(len(parmschemas) > 0 or len(parmtables) > 0 or len(parmtypes) > 0)
+      if (selective==True or parmaction=="listtoc"):
+         if (parmrepository=="" and os.path.isdir(parminputfile) and pypostgresshards.readbackupset(parminputfile) is not None):
+            raise Exception("Sharded backup sets cannot be listed or restored selectively. Restore cancelled.")
+         tocindex=pypostgrestoc.loadindex(parminputfile,parmrepository,
+                                          lambda: openinputstream(parminputfile,inputcodec,parmcompressmode,parmrepository))
+         # A new database needs the schemas of the selected tables too
+         tocentries=pypostgrestoc.selectentries(tocindex,parmschemas,parmtables,parmtypes,
+                                                tableschemas=(parmaction=="newdb" or parmaction=="restoreasdb"))
+         if (parmaction=="verify"):
+            raise Exception("Verify restores the whole backup. Schemas, tables and types cannot be selected.")
+         if (len(tocentries)==0):
+            raise Exception("No archive entries match the selected schemas, tables and types. Restore cancelled.")
+         print(f"INFO: Selected {len(tocentries)} of {len(tocindex['entries'])} archive entries")
+         if (parmaction=="listtoc"):
+            for tocentry in tocentries:
+               print(pypostgrestoc.entryline(tocentry))
+         elif (selective==True):
+            (listhandle,listfile)=tempfile.mkstemp(prefix="pyrestore-",suffix=".list")
+            os.close(listhandle)
+            pypostgrestoc.writelistfile(listfile,tocentries,f"Selective restore of {parminputfile}")
+            # Only tar files can be read by one pg_restore so no unpack for parallel jobs
+            if (parmjobs > 1 and packaged==False and (os.path.isfile(parminputfile) or parmrepository!="" or objectstore is not None)):
+               print("INFO: Selective restore of a tar file runs with 1 job")
+               parmjobs=1
+
       # pg_restore example
       # Restore to original database if not found
       # pg_restore -C -d "postgres" -p 5432 -U postgres --verbose "/tmp/mydatabase.tar"
@@ -166,6 +601,21 @@ try: # Try to perform main logic
       if (trim(parmdbhost)!=""):
          hostswitch=f"-h '{parmdbhost}'"
 
+      # Input to hand to pg_restore. Replaced by the unpacked directory
+      # when a tar file gets restored in parallel. Compressed tar files
+      # get decompressed and streamed into pg_restore stdin instead.
+      # Repository backups get rebuilt from chunks into pg_restore stdin.
+      restoreinput=parminputfile
+      restorestream=(inputcodec!="none" or parmrepository!="" or objectstore is not None)
+      streamsource=f"{inputcodec} -dc {parminputfile}"
+      if (parmrepository!=""):
+         streamsource=f"chunk store {parmrepository} backup {parminputfile}"
+      elif (objectstore is not None):
+         # Object storage backups are read with ranged GETs and never stored locally
+         streamsource=f"ranged GET {parminputfile} with {parmdownloads} x {parmpartsize:g} MB parts"
+         if (inputcodec!="none"):
+            streamsource+=f" | {inputcodec} -dc"
+
       # Build restore command line based on parmaction
       
       # Restore as new database with original database name from backup tar file
@@ -174,19 +624,128 @@ try: # Try to perform main logic
       # since we're restoring
       cmd_pgrestore=""
       cmd_createdb=""
+      cleanswitch=""
       if (parmaction=="newdb"):
          cmd_createdb=f"createdb {hostswitch} -p {parmdbport} -U {parmdbuser} \"{parmdbname}\""
-         cmd_pgrestore=f"pg_restore -d \"{parmdbname}\" {hostswitch} -p {parmdbport} -U {parmdbuser} --verbose  \"{parminputfile}\""
          ## Removed create new empty
          ##cmd_pgrestore=f"pg_restore -C -d \"postgres\" {hostswitch} -p {parmdbport} -U {parmdbuser} --verbose  \"{parminputfile}\""                
       # Clean/clear the existing database and restore the database if it already exists
       elif (parmaction=="overwritedb"):
-         cmd_pgrestore=f"pg_restore -d \"{parmdbname}\" {hostswitch} -p {parmdbport} -U {parmdbuser} --clean --verbose  \"{parminputfile}\""
+         cleanswitch="--clean"
+         # Selected objects may have been dropped already
+         if (selective==True):
+            cleanswitch="--clean --if-exists"
       # Restore as new database name. We also attempt to create the database
       # if db already exists, you should use the "overwritedb" action instead.
-      elif (parmaction=="restoreasdb"):
+      # Verify restores into a new scratch database that gets dropped afterwards
+      elif (parmaction=="restoreasdb" or parmaction=="verify"):
          cmd_createdb=f"createdb {hostswitch} -p {parmdbport} -U {parmdbuser} \"{parmdbname}\""
-         cmd_pgrestore=f"pg_restore -d \"{parmdbname}\" {hostswitch} -p {parmdbport} -U {parmdbuser} --verbose  \"{parminputfile}\""
+
+      # Unpack tar file to a directory format archive for a parallel restore.
+      # pg_restore can only run --jobs against custom or directory format.
+      # A pg_dump tar file unpacks to a valid directory format archive.
+      # Packaged backups are unpacked for any number of jobs.
+      if ((parmjobs > 1 or packaged==True) and parmaction!="listtoc" and (os.path.isfile(parminputfile) or parmrepository!="" or objectstore is not None)):
+         if (parmworkdir=="" and objectstore is not None):
+            workdir=tempfile.mkdtemp(prefix="pyrestore-")
+            workdircreated=True
+         elif (parmworkdir==""):
+            workdir=tempfile.mkdtemp(prefix="pyrestore-",dir=os.path.dirname(os.path.abspath(parminputfile if parmrepository=="" else parmrepository)))
+            workdircreated=True
+         else:
+            workdir=parmworkdir
+            if (os.path.isdir(workdir)==False):
+               os.makedirs(workdir)
+               workdircreated=True
+         print("")
+         print(f"INFO: Starting unpack of {parminputfile} to {workdir} - {time.strftime('%H:%M:%S')}")
+         # Run the command
+         phase=metrics.startphase("unpack")
+         if (restorestream==True):
+            # Decompress straight into tar. No intermediate uncompressed tar file.
+            cmd_unpack=f"tar -xf - -C \"{workdir}\""
+            print(f"{streamsource} | {cmd_unpack}")
+            monitor=pypostgresprogress.ProgressMonitor("unpack",parmprogress,totalbytes=streamsize(parminputfile,parmrepository))
+            rtncmd=pypostgresstream.pipetocommand(cmd_unpack,openinputstream(parminputfile,inputcodec,parmcompressmode,parmrepository,monitor))
+            monitor.close()
+         else:
+            cmd_unpack=f"tar -xf \"{parminputfile}\" -C \"{workdir}\""
+            print(cmd_unpack)
+            rtncmd=os.system(cmd_unpack)
+         metrics.endphase(phase,pypostgresmetrics.pathsize(workdir),rtncmd)
+         print(f"INFO: Completed unpack of {parminputfile} to {workdir} - {time.strftime('%H:%M:%S')}")
+
+         # Check return code
+         if (rtncmd != 0):
+            raise Exception(f"Error {rtncmd} occurred while unpacking backup file {parminputfile}")
+
+         restoreinput=findtocdir(workdir)
+         restorestream=False
+         if (restoreinput==""):
+            raise Exception(f"No toc.dat found after unpacking backup file {parminputfile}. Restore cancelled.")
+
+      # pg_restore input switch. Streamed tar input comes in on stdin.
+      # pg_restore -F t -d "mydatabase" -p 5432 -U postgres --verbose < /tmp/mydatabase.tar
+      if (restorestream==True):
+         inputswitch="-F t"
+      else:
+         inputswitch=f"\"{restoreinput}\""
+      # Selective restore passes the selected entries as a list file
+      # pg_restore -L /tmp/pyrestore-1234.list -d "mydatabase" -p 5432 -U postgres --verbose "/tmp/mydatabase.tar"
+      if (listfile!=""):
+         inputswitch=f"-L \"{listfile}\" {inputswitch}"
+
+      # Build restore command lines. A single pg_restore is used for 1 job. 
+      # For parallel restore the pre-data section (schema) is restored first by 
+      # itself and then data and post-data (indexes, constraints) run with --jobs workers.
+      # An overwrite drops the archive objects first since --clean only covers one section.
+      # pg_restore --clean --if-exists --section=pre-data --section=post-data -f - "/tmp/mydatabase.dir" | psql --single-transaction -d "mydatabase"
+      # pg_restore --section=pre-data -d "mydatabase" -p 5432 -U postgres --verbose "/tmp/mydatabase.dir"
+      # pg_restore --section=data --section=post-data -j 8 -d "mydatabase" -p 5432 -U postgres --verbose "/tmp/mydatabase.dir"
+      # Sharded backup set. Schema from schema.dump and data from the shard dumps.
+      # pg_restore --section=pre-data -d "mydatabase" -p 5432 -U postgres --verbose "/tmp/mydatabase.set/schema.dump"
+      # pg_restore --data-only -d "mydatabase" -p 5432 -U postgres --verbose "/tmp/mydatabase.set/shards/0001.dump" (one per shard)
+      # pg_restore --section=post-data -j 8 -d "mydatabase" -p 5432 -U postgres --verbose "/tmp/mydatabase.set/schema.dump"
+      # Fast restore runs every section by itself. Data and post-data run with
+      # --jobs workers when pg_restore can run the archive in parallel.
+      # pg_restore --section=pre-data -d "mydatabase" -p 5432 -U postgres --verbose "/tmp/mydatabase.dir"
+      # pg_restore --section=data -j 8 -d "mydatabase" -p 5432 -U postgres --verbose "/tmp/mydatabase.dir"
+      # pg_restore --section=post-data -j 8 -d "mydatabase" -p 5432 -U postgres --verbose "/tmp/mydatabase.dir"
+      restorecmds=[]
+      droparchive=""
+      backupset=None
+      if (restorestream==False and os.path.isdir(restoreinput)):
+         backupset=pypostgresshards.readbackupset(restoreinput)
+      if (parmaction=="listtoc" or parmaction=="pitr"):
+         # Nothing to restore with pg_restore
+         pass
+      elif (backupset is not None):
+         if (backupset.get("status")!="complete"):
+            raise Exception(f"Backup set {restoreinput} status is {backupset.get('status')}. Restore cancelled.")
+         if (len(backupset.get("snapshots",[])) > 1):
+            print(f"INFO: Backup set {restoreinput} was resumed from {len(backupset['snapshots'])} snapshots. Shards from different snapshots are not consistent with each other.")
+         schemainput=f"\"{os.path.join(restoreinput,backupset['schema'])}\""
+         droparchive=os.path.join(restoreinput,backupset['schema'])
+         cmd_pgrestore=f"pg_restore --section=pre-data -d \"{parmdbname}\" {hostswitch} -p {parmdbport} -U {parmdbuser} --verbose  {schemainput}"
+         restorecmds.append(("pre-data",cmd_pgrestore))
+         # Data shards are run on the worker pool instead of by a command line
+         restorecmds.append((f"data from {len(backupset['shards'])} shards",""))
+         cmd_pgrestore=f"pg_restore --section=post-data -j {parmjobs} -d \"{parmdbname}\" {hostswitch} -p {parmdbport} -U {parmdbuser} --verbose  {schemainput}"
+         restorecmds.append(("post-data",cmd_pgrestore))
+      elif (parmfast==True):
+         jobsswitch=f"-j {parmjobs} " if (restorestream==False and os.path.isdir(restoreinput) and parmjobs > 1) else ""
+         for restoresection in ("pre-data","data","post-data"):
+            cmd_pgrestore=f"pg_restore --section={restoresection} {jobsswitch if restoresection!='pre-data' else ''}-d \"{parmdbname}\" {hostswitch} -p {parmdbport} -U {parmdbuser} --verbose  {inputswitch}"
+            restorecmds.append((restoresection,cmd_pgrestore))
+      elif (parmjobs == 1):
+         cmd_pgrestore=f"pg_restore -d \"{parmdbname}\" {hostswitch} -p {parmdbport} -U {parmdbuser} {cleanswitch} --verbose  {inputswitch}"
+         restorecmds.append(("all sections",cmd_pgrestore))
+      else:
+         droparchive=restoreinput
+         cmd_pgrestore=f"pg_restore --section=pre-data -d \"{parmdbname}\" {hostswitch} -p {parmdbport} -U {parmdbuser} --verbose  {inputswitch}"
+         restorecmds.append(("pre-data",cmd_pgrestore))
+         cmd_pgrestore=f"pg_restore --section=data --section=post-data -j {parmjobs} -d \"{parmdbname}\" {hostswitch} -p {parmdbport} -U {parmdbuser} --verbose  {inputswitch}"
+         restorecmds.append(("data and post-data",cmd_pgrestore))
 
       # Run the createdb command to create database if createdb command line specified
       if (cmd_createdb!=""):
@@ -195,29 +754,195 @@ try: # Try to perform main logic
          # Display command line
          print(cmd_createdb) 
          # Export the PostgreSQL environment variable for password and then Run the command
+         phase=metrics.startphase("createdb")
          rtncmd=os.system(f"export PGPASSWORD={parmdbpass};{cmd_createdb}")
+         metrics.endphase(phase,0,rtncmd)
          print(f"INFO: Completed createdb for database {parmdbname} - {time.strftime('%H:%M:%S')}")
 
          # Check return code
          if (rtncmd != 0):
             raise Exception(f"Error {rtncmd} occurred while running createdb command")
+         # Only a scratch database created here gets dropped
+         if (parmaction=="verify"):
+            scratchdb=parmdbname
+
+      # Backup bytes read by the data sections for the metrics. Repository
+      # backups count the tar stream bytes recorded in the manifest.
+      if (parmrepository!="" or objectstore is not None):
+         inputbytes=streamsize(parminputfile,parmrepository)
+      else:
+         inputbytes=pypostgresmetrics.pathsize(restoreinput)
+
+      # Table data sizes of a directory format archive for the progress ETA
+      tablesizes={}
+      if (parmprogress > 0 and len(restorecmds) > 0 and restorestream==False and backupset is None and os.path.isdir(restoreinput)):
+         tablesizes=pypostgresprogress.archivetablesizes(restoreinput)
 
-      # Run the pg_restore restore command
-      print("")
-      print(f"INFO: Starting pg_restore PostgreSQL restore from {parminputfile} - {time.strftime('%H:%M:%S')}")
-      # Display command line
-      print(cmd_pgrestore) 
-      # Export the PostgreSQL environment variable for password and then Run the command
-      rtncmd=os.system(f"export PGPASSWORD={parmdbpass};{cmd_pgrestore}")
-      print(f"INFO: Completed pg_restore PostgreSQL restore from {parminputfile} - {time.strftime('%H:%M:%S')}")
+      # pg_restore sessions get the bulk load settings for a fast restore
+      restoreenv=dict(os.environ,PGPASSWORD=parmdbpass)
+      if (parmfast==True):
+         restoreenv=pypostgresfast.sessionenv(restoreenv,parmmaintmem)
+         print(f"PGOPTIONS={restoreenv['PGOPTIONS']}")
+      connargs=pypostgresshards.connectionargs(parmdbhost,parmdbport,parmdbuser)
+
+      # Overwrite restores split into sections drop every object of the
+      # archive first. --clean on the pre-data run alone cannot drop tables
+      # that the foreign keys and indexes of post-data still depend on.
+      if (cleanswitch!="" and droparchive!=""):
+         print("")
+         print(f"INFO: Starting drop of existing objects in database {parmdbname} - {time.strftime('%H:%M:%S')}")
+         dropinput=f"-L \"{listfile}\" \"{droparchive}\"" if listfile!="" else f"\"{droparchive}\""
+         print(f"pg_restore --clean --if-exists --section=pre-data --section=post-data -f - {dropinput} | psql --single-transaction -d \"{parmdbname}\"")
+         phase=metrics.startphase("drop")
+         (rtncmd,droplines)=pypostgrestoc.dropobjects(droparchive,parmdbname,connargs,restoreenv,listfile)
+         metrics.endphase(phase,0,rtncmd)
+         for dropline in droplines:
+            print(dropline)
+         print(f"INFO: Completed drop of existing objects in database {parmdbname} - {time.strftime('%H:%M:%S')}")
+
+         # Check return code
+         if (rtncmd != 0):
+            raise Exception(f"Error {rtncmd} occurred while dropping existing objects in database {parmdbname}")
+
+      # Run the pg_restore restore commands in section order
+      for (restoresection,cmd_pgrestore) in restorecmds:
+         # Tables are logged again before the indexes get built
+         if (restoresection=="post-data" and parmunlogged=="load"):
+            runpersistence(True)
+         print("")
+         print(f"INFO: Starting pg_restore PostgreSQL restore of {restoresection} from {parminputfile} - {time.strftime('%H:%M:%S')}")
+         phase=metrics.startphase(f"restore:{restoresection}")
+         # Schema only sections have no table data to base an ETA on
+         datasection=restoresection not in ("pre-data","post-data")
+         # Export the PostgreSQL environment variable for password and then Run the command
+         if (cmd_pgrestore==""):
+            # Restore the data shards with --jobs workers, largest shard first.
+            # Progress counts the dump file size of each restored shard.
+            monitor=pypostgresprogress.ProgressMonitor(restoresection,parmprogress,
+                                                       totalbytes=sum(shard.get("size",0) for shard in backupset["shards"]),parallel=True)
+            results=pypostgresshards.runpool(backupset["shards"],parmjobs,
+                                             lambda shard: pypostgresshards.restoreshard(shard,parmdbname,connargs,
+                                                              restoreenv,restoreinput,monitor))
+            failed=[result for result in results if result[1]!=0]
+            rtncmd=failed[0][1] if len(failed) > 0 else 0
+         elif (restorestream==True):
+            # Decompress the input file or rebuild it from chunks straight into pg_restore stdin
+            print(f"{streamsource} | {cmd_pgrestore}") 
+            monitor=pypostgresprogress.ProgressMonitor(restoresection,parmprogress,
+                                                       totalbytes=streamsize(parminputfile,parmrepository) if datasection else 0)
+            rtncmd=pypostgresstream.pipetocommand(cmd_pgrestore,openinputstream(parminputfile,inputcodec,parmcompressmode,parmrepository,monitor),
+                                                  env=restoreenv,stderrfunction=monitor.watch)
+         else:
+            # Display command line
+            print(cmd_pgrestore) 
+            monitor=pypostgresprogress.ProgressMonitor(restoresection,parmprogress,tablesizes if datasection else {},parallel=(parmjobs > 1))
+            rtncmd=pypostgresprogress.runcommand(cmd_pgrestore,monitor,env=restoreenv)
+         monitor.close()
+         # Schema only sections read next to nothing so only data sections count the input size
+         metrics.endphase(phase,0 if restoresection in ("pre-data","post-data") else inputbytes,rtncmd)
+         print(f"INFO: Completed pg_restore PostgreSQL restore of {restoresection} from {parminputfile} - {time.strftime('%H:%M:%S')}")
    
-      # Check return code
-      if (rtncmd != 0):
-         raise Exception(f"Error {rtncmd} occurred while running pg_restore command")
+         # Check return code
+         if (rtncmd != 0):
+            raise Exception(f"Error {rtncmd} occurred while running pg_restore command for {restoresection}")
+
+         # Tables are unlogged once created so the data loads without WAL
+         if (restoresection=="pre-data" and parmunlogged!="none"):
+            runpersistence(False)
+
+      # Fresh statistics for the planner after a fast restore
+      if (parmfast==True):
+         print("")
+         print(f"INFO: Starting analyze of database {parmdbname} - {time.strftime('%H:%M:%S')}")
+         phase=metrics.startphase("analyze")
+         rtncmd=pypostgresfast.analyzedb(parmdbname,connargs,restoreenv,parmjobs)
+         metrics.endphase(phase,0,rtncmd)
+         print(f"INFO: Completed analyze of database {parmdbname} - {time.strftime('%H:%M:%S')}")
+         if (rtncmd != 0):
+            raise Exception(f"Error {rtncmd} occurred while running vacuumdb analyze")
+
+      # Unpack the physical backup into the new data directory set up to
+      # recover to the target time when the server starts
+      if (parmaction=="pitr"):
+         # The server cannot stop recovery before the backup is consistent
+         if (parmtargettime.lower()!="latest"):
+            try:
+               targetdatetime=datetime.datetime.fromisoformat(parmtargettime)
+               if (targetdatetime.timestamp() < physicalinfo["consistentepoch"]):
+                  raise Exception(f"Target time {parmtargettime} is before the end of backup {parminputfile} at {physicalinfo['consistent']}. Use an older backup.")
+            except ValueError:
+               print(f"INFO: Target time {parmtargettime} could not be checked against the end of the backup at {physicalinfo['consistent']}")
+         print("")
+         print(f"INFO: Physical backup WAL {physicalinfo.get('startlsn','')} to {physicalinfo.get('endlsn','')} on timeline {physicalinfo.get('timeline','')}. Consistent at {physicalinfo['consistent']}")
+         print(f"INFO: Starting unpack of physical backup {parminputfile} to {parmtargetdir} - {time.strftime('%H:%M:%S')}")
+         phase=metrics.startphase("unpack")
+         rtncmd=pypostgreswal.restorephysical(parminputfile,parmtargetdir,parmtablespacedir,parmwalarchive,
+                                              parmtargettime,parmtargetaction,parmjobs,parmcompressmode)
+         metrics.endphase(phase,pypostgresmetrics.pathsize(parminputfile),rtncmd)
+         print(f"INFO: Completed unpack of physical backup {parminputfile} to {parmtargetdir} - {time.strftime('%H:%M:%S')}")
+         if (rtncmd != 0):
+            raise Exception(f"Error {rtncmd} occurred while unpacking physical backup {parminputfile}")
+         if (parmwalarchive!=""):
+            print(f"INFO: Recovery to {parmtargettime} from WAL archive {parmwalarchive} written to {os.path.join(parmtargetdir,'postgresql.auto.conf')}")
+
+         # Start the server and wait for the end of recovery. pg_ctl -w
+         # returns once the server accepts read only connections.
+         if (parmstartport > 0):
+            cmd_start=f"pg_ctl -D \"{parmtargetdir}\" -o \"-p {parmstartport}\" -l \"{os.path.join(parmtargetdir,'pitr.log')}\" -w -t 3600 start"
+            print("")
+            print(f"INFO: Starting recovery of {parmtargetdir} - {time.strftime('%H:%M:%S')}")
+            print(cmd_start)
+            phase=metrics.startphase("recovery")
+            rtncmd=os.system(cmd_start)
+            if (rtncmd != 0):
+               raise Exception(f"Error {rtncmd} occurred while starting the server. See {os.path.join(parmtargetdir,'pitr.log')}")
+            recoveryargs=pypostgresshards.connectionargs(pypostgreswal.serverhost(parmtargetdir),parmstartport,parmdbuser)
+            # The server stops if the WAL runs out before the target time
+            try:
+               while (pypostgresshards.psqlquery("select pg_is_in_recovery()","postgres",recoveryargs,dict(os.environ,PGPASSWORD=parmdbpass))[0][0]=="t"):
+                  time.sleep(1)
+            except Exception as ex:
+               raise Exception(f"Server stopped before recovery ended. See {os.path.join(parmtargetdir,'pitr.log')}. {ex}")
+            metrics.endphase(phase,0,0)
+            print(f"INFO: Completed recovery of {parmtargetdir}. Server running on port {parmstartport} - {time.strftime('%H:%M:%S')}")
+
+      # Compare the table stats of the scratch database with the backup stats
+      if (parmaction=="verify"):
+         if (parmstatsfile==""):
+            parmstatsfile=pypostgresverify.statspath(parminputfile,parmrepository)
+         expectedstats=pypostgresverify.readstats(parmstatsfile,objectstore)
+         if expectedstats is None:
+            print(f"INFO: No stats file {parmstatsfile}. Only the restore was verified.")
+            verifymessage="restore only"
+         else:
+            print("")
+            print(f"INFO: Starting {expectedstats['level']} stats verify of database {parmdbname} - {time.strftime('%H:%M:%S')}")
+            phase=metrics.startphase("verify")
+            actualstats=pypostgresverify.collectstats(parmdbname,connargs,dict(os.environ,PGPASSWORD=parmdbpass),
+                                                      expectedstats["level"],expectedstats["samplerows"],parmjobs)
+            mismatches=pypostgresverify.comparestats(expectedstats,actualstats)
+            metrics.endphase(phase,0,len(mismatches))
+            for mismatch in mismatches:
+               print(f"VERIFY: {mismatch}")
+            print(f"INFO: Completed {expectedstats['level']} stats verify of database {parmdbname} - {time.strftime('%H:%M:%S')}")
+            if (len(mismatches) > 0):
+               raise Exception(f"Verify of backup {parminputfile} found {len(mismatches)} mismatches in {len(expectedstats['tables'])} tables")
+            verifymessage=f"{len(expectedstats['tables'])} tables match {expectedstats['level']} stats"
 
       # Set success info
       exitcode=0
       exitmessage=f"Restore completed successfully to database {parmdbname} from file {parminputfile}"
+      if (parmaction=="verify"):
+         exitmessage=f"Verify completed successfully for backup {parminputfile}. {verifymessage}"
+      if (parmaction=="listtoc"):
+         exitmessage=f"Listed {len(tocentries)} archive entries from file {parminputfile}"
+      if (parmaction=="pitr"):
+         recoverytarget=parmtargettime if parmwalarchive!="" else "the end of the backup"
+         exitmessage=f"Point-in-time restore of backup {parminputfile} to {parmtargetdir} completed successfully. "
+         if (parmstartport > 0):
+            exitmessage+=f"Recovered to {recoverytarget} and running on port {parmstartport}"
+         else:
+            exitmessage+=f"Recovery to {recoverytarget} runs when the server is started"
 
 #------------------------------------------------
 # Handle Exceptions
@@ -244,6 +969,24 @@ except Exception as ex: # Catch and handle exceptions
 # Always perform final processing
 #------------------------------------------------
 finally: # Final processing
+     # Remove work directory if we created one for unpacking
+     if (workdircreated==True and os.path.isdir(workdir)):
+        shutil.rmtree(workdir,ignore_errors=True)
+        print(f"INFO:Removed work directory {workdir} after processing.")
+
+     # Drop the scratch database of a verify
+     if (scratchdb!=""):
+        cmd_dropdb=f"dropdb {hostswitch} -p {parmdbport} -U {parmdbuser} \"{scratchdb}\""
+        print(cmd_dropdb)
+        if (os.system(f"export PGPASSWORD={parmdbpass};{cmd_dropdb}")==0):
+           print(f"INFO:Dropped scratch database {scratchdb} after processing.")
+        else:
+           print(f"INFO:Scratch database {scratchdb} could not be dropped. Drop it by hand.")
+
+     # Remove the selective restore list file
+     if (listfile!="" and os.path.isfile(listfile)):
+        os.remove(listfile)
+
      # Do any final code and exit now
      # We log as much relevent info to STDOUT as needed
      print("")
@@ -253,6 +996,14 @@ finally: # Final processing
      print(f"End of Main Processing -  {time.strftime('%H:%M:%S')}")
      print(dashes)
 
+     # Write the metrics files. Phases still open failed with the script.
+     # A failing metrics write must not replace the exit code and message.
+     if metrics is not None:
+        try:
+           metrics.finish(exitcode)
+        except Exception as ex:
+           print(f"INFO:Metrics files could not be written. {ex}")
+
      # Exit the script now
      sys.exit(exitcode) 
 
@@ -0,0 +1,244 @@
+#!/QOpenSys/pkgs/bin/python3
+######!/usr/bin/python3
+##### IBM i Specific
+#####!/QOpenSys/pkgs/bin/python3
+#------------------------------------------------
+# Script name: pyretainpostgres.py
+#
+# Description:
+# This script will delete expired PostgreSQL backups recorded in a backup
+# catalog by pybackuppostgres.py --catalog using a grandfather-father-son
+# retention policy. The backups to keep are found with indexed catalog
+# queries so the backup directories are never scanned. Logical and physical
+# backups of a database each get the whole policy.
+#
+# Links:
+# https://en.wikipedia.org/wiki/Backup_rotation_scheme
+#
+# Pip packages needed:
+#
+# Parameters:
+# --catalog=SQLite backup catalog file. Ex: /backup/catalog.db
+# --dbnames=Comma separated list of database names to apply the retention to. Use *ALL for
+#   every database in the catalog. Default=*ALL
+# --keeplast=Number of newest complete backups to always keep. Default=1
+# --daily=Number of days to keep the newest backup of. Default=7
+# --weekly=Number of ISO weeks to keep the newest backup of. Default=4
+# --monthly=Number of months to keep the newest backup of. Default=12
+# --yearly=Number of years to keep the newest backup of. Default=0
+#   Only days, weeks, months and years that have a backup are counted.
+# --faileddays=Delete failed backups, and backups still recorded as running, that started more
+#   than this many days ago. 0=Keep them. Default=7
+# --dryrun=True=List the backups that would be deleted without deleting anything.
+#   False=Delete expired backups (default).
+# Deleted backups stay in the catalog with status deleted. Repository backups only get their
+#   manifest deleted. Chunks are shared by other backups and stay in the repository.
+#   Physical backup directories are deleted but not the archived WAL. Prune it with
+#   pyarchivewal.py --action=prune --before=<oldest physical backup kept>.
+# --endpoint=Object storage endpoint for backups recorded as s3:// object URLs. The backup object
+#   and its .manifest.json object are deleted. Credentials come from AWS_ACCESS_KEY_ID and
+#   AWS_SECRET_ACCESS_KEY. Blank=AWS_ENDPOINT_URL environment variable or AWS S3 (default).
+#------------------------------------------------
+
+#------------------------------------------------
+# Imports and Environment setup
+#------------------------------------------------
+import sys
+from sys import platform
+import os
+import os.path
+import time
+import traceback
+import argparse
+import pypostgrescatalog
+
+#------------------------------------------------
+# Script initialization
+#------------------------------------------------
+
+# Initialize or set variables
+exitcode=0 #Init exitcode
+exitmessage=''
+dashes="-------------------------------------------------------------------------------"
+catalog=None
+
+#Output messages to STDOUT for logging
+print(dashes)
+print("PostgreSQL Backup Retention")
+print(f"Start of Main Processing -  {time.strftime('%H:%M:%S')}")
+print("OS:" + platform)
+
+#------------------------------------------------
+# Define some useful functions
+#------------------------------------------------
+
+def str2bool(strval):
+    #-------------------------------------------------------
+    # Function: str2bool
+    # Desc: Constructor
+    # :strval: String value for true or false
+    # :return: Return True if string value is" yes, true, t or 1
+    #-------------------------------------------------------
+    return strval.lower() in ("yes", "true", "t", "1")
+
+def trim(strval):
+    #-------------------------------------------------------
+    # Function: trim
+    # Desc: Alternate name for strip
+    # :strval: String value to trim.
+    # :return: Trimmed value
+    #-------------------------------------------------------
+    return strval.strip()
+
+def deletebackup(record,reason):
+    #-------------------------------------------------------
+    # Function: deletebackup
+    # Desc: Delete an expired backup and mark it deleted in
+    #       the catalog. Only listed for a dry run.
+    # :record: Catalog backup record
+    # :reason: Reason for the deletion to print
+    # :return: Backup bytes deleted
+    #-------------------------------------------------------
+    location=record["path"] if (record["repository"] or "")=="" else f"{record['repository']} backup {record['path']}"
+    print(f"{'Would delete' if parmdryrun else 'Deleting'} {reason} backup id {record['id']} started {record['started']}: {location}")
+    if (parmdryrun==False):
+        if (pypostgrescatalog.removebackup(record,parmendpoint)==False):
+            print(f"INFO: Backup id {record['id']} files were already gone")
+        catalog.markdeleted(record["id"])
+    return record["bytes"] or 0
+
+#------------------------------------------------
+# Main script logic
+#------------------------------------------------
+try: # Try to perform main logic
+
+      # Set up the command line argument parsing.
+      # If the parse_args function fails, the program will
+      # exit with an error 2. In Python 3.9, there is
+      # an argument to prevent an auto-exit
+      # Each argument has a long and short version
+      parser = argparse.ArgumentParser()
+      parser.add_argument('-C','--catalog', required=True,help="SQLite backup catalog file")
+      parser.add_argument('-d','--dbnames', required=False,default="*ALL",help="Comma separated database names or *ALL for every database in the catalog. Default=*ALL")
+      parser.add_argument('-l','--keeplast', required=False,default=1,help="Number of newest backups to always keep. Default=1")
+      parser.add_argument('-D','--daily', required=False,default=7,help="Number of days to keep the newest backup of. Default=7")
+      parser.add_argument('-W','--weekly', required=False,default=4,help="Number of ISO weeks to keep the newest backup of. Default=4")
+      parser.add_argument('-M','--monthly', required=False,default=12,help="Number of months to keep the newest backup of. Default=12")
+      parser.add_argument('-Y','--yearly', required=False,default=0,help="Number of years to keep the newest backup of. Default=0")
+      parser.add_argument('-f','--faileddays', required=False,default=7,help="Delete failed backups older than this many days. 0=Keep. Default=7")
+      parser.add_argument('-n','--dryrun', required=False,default="False",help="True=List expired backups without deleting,False=Delete expired backups. Default=False")
+      parser.add_argument('-E','--endpoint', required=False,default="",help="Object storage endpoint for s3:// backups. Blank=AWS_ENDPOINT_URL or AWS S3. Default=blank")
+
+      # Parse the command line arguments
+      args = parser.parse_args()
+
+      # Set parameter work variables from command line args
+      parmscriptname = sys.argv[0]
+      parmcatalog=args.catalog.strip()
+      parmdbnames=args.dbnames.strip()
+      parmkeeplast=int(args.keeplast)
+      parmdaily=int(args.daily)
+      parmweekly=int(args.weekly)
+      parmmonthly=int(args.monthly)
+      parmyearly=int(args.yearly)
+      parmfaileddays=float(args.faileddays)
+      parmdryrun=str2bool(args.dryrun)
+      parmendpoint=args.endpoint.strip()
+      print(f"Python script: {parmscriptname}")
+      print(f"Catalog: {parmcatalog}")
+      print(f"Database names: {parmdbnames}")
+      print(f"Keep last: {parmkeeplast}")
+      print(f"Daily: {parmdaily}")
+      print(f"Weekly: {parmweekly}")
+      print(f"Monthly: {parmmonthly}")
+      print(f"Yearly: {parmyearly}")
+      print(f"Failed days: {parmfaileddays}")
+      print(f"Dry run: {parmdryrun}")
+      print(f"Object storage endpoint: {parmendpoint}")
+
+      # Bail if counts are invalid
+      if (min(parmkeeplast,parmdaily,parmweekly,parmmonthly,parmyearly) < 0 or parmfaileddays < 0):
+            raise Exception("Keep last, daily, weekly, monthly, yearly and failed days must be 0 or greater")
+
+      # Bail if the policy would delete every backup
+      if (parmkeeplast + parmdaily + parmweekly + parmmonthly + parmyearly==0):
+            raise Exception("Retention must keep at least one backup. Set --keeplast or a period count")
+
+      # Make sure catalog exists. otherwise bail out
+      if (os.path.isfile(parmcatalog)==False):
+            raise Exception(f"Catalog {parmcatalog} does not exist. Retention cancelled.")
+      catalog=pypostgrescatalog.Catalog(parmcatalog)
+
+      # Build list of databases to apply the retention to
+      if (parmdbnames.upper()=="*ALL"):
+         dblist=catalog.dbnames()
+      else:
+         dblist=[trim(name) for name in parmdbnames.split(",") if trim(name)!=""]
+      print(f"INFO: {len(dblist)} databases in retention: {','.join(dblist)}")
+
+      # Apply the retention to each database
+      totalkept=0
+      totaldeleted=0
+      totalbytes=0
+      for dbname in dblist:
+         print("")
+         print(f"INFO: Starting retention of database {dbname} backups - {time.strftime('%H:%M:%S')}")
+         (keep,expired)=catalog.retention(dbname,parmkeeplast,parmdaily,parmweekly,parmmonthly,parmyearly)
+         for backupid in sorted(keep):
+            record=catalog.getbackup(backupid)
+            print(f"Keeping {record['format']} backup id {backupid} started {record['started']} ({','.join(keep[backupid])}): {record['path']}")
+         for record in expired:
+            totalbytes+=deletebackup(record,"expired")
+         stale=[]
+         if (parmfaileddays > 0):
+            stale=catalog.stalebackups(dbname,parmfaileddays)
+            for record in stale:
+               totalbytes+=deletebackup(record,record["status"])
+         totalkept+=len(keep)
+         totaldeleted+=len(expired) + len(stale)
+         print(f"INFO: Completed retention of database {dbname} backups. {len(keep)} kept. {len(expired) + len(stale)} deleted - {time.strftime('%H:%M:%S')}")
+
+      # Set success info
+      exitcode=0
+      exitmessage=f"Retention of {len(dblist)} databases completed successfully. {totalkept} backups kept. {totaldeleted} backups {'would be ' if parmdryrun else ''}deleted with {totalbytes/1024/1024:.1f} MB"
+
+#------------------------------------------------
+# Handle Exceptions
+#------------------------------------------------
+# System Exit occurred. Most likely from argument parser
+except SystemExit as ex:
+     exitcode=ex.code # set return code for stdout
+     exitmessage=str(ex) # set exit message for stdout
+
+except argparse.ArgumentError as exc:
+     exitcode=99 # set return code for stdout
+     exitmessage=str(exc) # set exit message for stdout
+     print('Traceback Info') # output traceback info for stdout
+     traceback.print_exc()
+     sys.exit(99)
+
+except Exception as ex: # Catch and handle exceptions
+     exitcode=99 # set return code for stdout
+     exitmessage=str(ex) # set exit message for stdout
+     print('Traceback Info') # output traceback info for stdout
+     traceback.print_exc()
+     sys.exit(99)
+#------------------------------------------------
+# Always perform final processing
+#------------------------------------------------
+finally: # Final processing
+     # Close the catalog
+     if catalog is not None:
+        catalog.close()
+
+     # Do any final code and exit now
+     # We log as much relevent info to STDOUT as needed
+     print("")
+     print(dashes)
+     print('ExitCode:' + str(exitcode))
+     print('ExitMessage:' + exitmessage)
+     print(f"End of Main Processing -  {time.strftime('%H:%M:%S')}")
+     print(dashes)
+
+     # Exit the script now
+     sys.exit(exitcode)
@@ -0,0 +1,442 @@
+#!/QOpenSys/pkgs/bin/python3
+######!/usr/bin/python3
+##### IBM i Specific
+#####!/QOpenSys/pkgs/bin/python3
+#------------------------------------------------
+# Script name: pyschedulepostgres.py
+#
+# Description:
+# Long running scheduler daemon for PostgreSQL backups and restores. Jobs are
+# read from a JSON config file and run on a cron like schedule through the
+# pypostgresapi.py asyncio API, so one process coordinates all of the jobs
+# without starting a Python interpreter for each one. The number of jobs
+# running at the same time is limited in total and per database host.
+# A job that is still running when it is due again is skipped.
+#
+# The config file is read again when it changes. SIGTERM or SIGINT stops
+# starting new jobs and the daemon exits when the running jobs have ended.
+#
+# Config file example:
+# {
+#   "hostlimits": {"db1.example.com": 1},
+#   "defaults": {"dbhost": "db1.example.com", "dbuser": "postgres", "dbpassenv": "PGPASS_DB1"},
+#   "jobs": [
+#     {"name": "sales-nightly", "schedule": "30 1 * * *", "action": "backup",
+#      "dbname": "sales", "outputfile": "/backup/@@dbdatetime.tar", "compress": "zstd"},
+#     {"name": "hr-hourly", "schedule": "0 */4 * * 1-5", "action": "backup", "dbhost": "",
+#      "dbname": "hr", "outputfile": "/backup/hr", "format": "directory", "jobs": 4, "replace": true},
+#     {"name": "sales-test-refresh", "schedule": "0 6 * * 0", "action": "restoreasdb",
+#      "dbname": "salestest", "inputfile": "/backup/sales-latest.tar.zst", "jobs": 4}
+#   ]
+# }
+#
+# Job settings:
+# name=Unique job name.
+# schedule=Cron schedule: minute hour day-of-month month day-of-week. Each field can be
+#   * or a list of values and ranges with an optional step. Ex: */15, 1-5, 0,30, 8-18/2
+#   Day of week 0 or 7=Sunday. Blank=Only run with --runnow.
+# action=backup, newdb, overwritedb or restoreasdb.
+# dbpassenv=Environment variable holding the database password. Used if dbpass is not set.
+# Any other setting is passed to pypostgresapi.backup or pypostgresapi.restore.
+# Ex: dbname, dbhost, dbport, dbuser, dbpass, outputfile, inputfile, format, jobs, compress,
+#   compresslevel, compressmode, verify, replace, maxmbps, maxload, maxlag, workdir
+# maxmbps can be a MB/s schedule. Ex: "50,01:00-05:00=300"
+# "defaults" settings apply to every job that does not set them.
+# "hostlimits" sets the concurrent job limit for a host instead of --hostlimit.
+#
+# Pip packages needed:
+#
+# Parameters:
+# --config=JSON config file with the jobs to schedule.
+# --maxjobs=Maximum jobs running at the same time across all hosts. Default=4
+# --hostlimit=Maximum jobs running at the same time against one database host. Blank host
+#   (local socket) counts as one host. Default=2
+# --statusfile=JSON lines file to append each job result to. Blank=No status file (default).
+# --runnow=Comma separated job names to run once now. The daemon exits after they end.
+#   Blank=Run the schedule until stopped (default). Ex: --runnow=sales-nightly,hr-hourly
+#------------------------------------------------
+
+#------------------------------------------------
+# Imports and Environment setup
+#------------------------------------------------
+import sys
+from sys import platform
+import os
+import os.path
+import time
+import traceback
+import argparse
+import asyncio
+import json
+import signal
+import pypostgresapi
+
+#------------------------------------------------
+# Script initialization
+#------------------------------------------------
+
+# Initialize or set variables
+exitcode=0 #Init exitcode
+exitmessage=''
+dashes="-------------------------------------------------------------------------------"
+
+# Cron field ranges: minute, hour, day of month, month, day of week
+CRONFIELDS=[(0,59),(0,23),(1,31),(1,12),(0,7)]
+
+# Actions run with pypostgresapi.restore
+RESTOREACTIONS=("newdb","overwritedb","restoreasdb")
+
+# Job settings used by the scheduler and not passed on to the API
+SCHEDULERSETTINGS=("name","schedule","action","dbpassenv")
+
+#Output messages to STDOUT for logging
+print(dashes)
+print("PostgreSQL Backup Scheduler")
+print(f"Start of Main Processing -  {time.strftime('%H:%M:%S')}")
+print("OS:" + platform)
+
+#------------------------------------------------
+# Define some useful functions
+#------------------------------------------------
+
+def parsecronfield(field,low,high):
+    #-------------------------------------------------------
+    # Function: parsecronfield
+    # Desc: Expand one cron schedule field into its values
+    # :field: Cron field. Ex: */15 or 1-5 or 0,30
+    # :low: Lowest value of the field
+    # :high: Highest value of the field
+    # :return: Set of values
+    #-------------------------------------------------------
+    values=set()
+    for part in field.split(","):
+        (valuerange,_,step)=part.partition("/")
+        step=int(step) if step!="" else 1
+        if (valuerange=="*"):
+            (first,last)=(low,high)
+        elif ("-" in valuerange):
+            (first,last)=[int(value) for value in valuerange.split("-",1)]
+        else:
+            first=int(valuerange)
+            # A single value with a step runs from the value to the end of the range
+            last=high if step > 1 else first
+        if (first < low or last > high or first > last or step < 1):
+            raise Exception(f"Cron field {field} must be within {low}-{high}")
+        values.update(range(first,last + 1,step))
+    return values
+
+def parseschedule(schedule):
+    #-------------------------------------------------------
+    # Function: parseschedule
+    # Desc: Parse a five field cron schedule
+    # :schedule: Cron schedule. Ex: 30 1 * * 1-5
+    # :return: List of five value sets
+    #-------------------------------------------------------
+    fields=schedule.split()
+    if (len(fields) != 5):
+        raise Exception(f"Schedule {schedule} must have five fields: minute hour day-of-month month day-of-week")
+    values=[parsecronfield(field,low,high) for (field,(low,high)) in zip(fields,CRONFIELDS)]
+    # Day of week 7 is Sunday like 0
+    if 7 in values[4]:
+        values[4].add(0)
+    return values
+
+def scheduledue(schedule,fields,when):
+    #-------------------------------------------------------
+    # Function: scheduledue
+    # Desc: Check if a schedule is due at a minute. Day of month
+    #       and day of week match either one when both are
+    #       restricted, the same as cron.
+    # :schedule: Cron schedule
+    # :fields: Value sets from parseschedule
+    # :when: time.struct_time of the minute
+    # :return: True if the job is due
+    #-------------------------------------------------------
+    (minutes,hours,monthdays,months,weekdays)=fields
+    if (when.tm_min not in minutes or when.tm_hour not in hours or when.tm_mon not in months):
+        return False
+    # tm_wday is 0=Monday. Cron is 0=Sunday.
+    monthdaymatch=when.tm_mday in monthdays
+    weekdaymatch=(when.tm_wday + 1) % 7 in weekdays
+    (monthdayfield,weekdayfield)=schedule.split()[2:5:2]
+    if (monthdayfield!="*" and weekdayfield!="*"):
+        return monthdaymatch or weekdaymatch
+    return monthdaymatch and weekdaymatch
+
+def loadconfig(configfile):
+    #-------------------------------------------------------
+    # Function: loadconfig
+    # Desc: Read and check the scheduler config file
+    # :configfile: JSON config file
+    # :return: Dictionary of job name to job settings with the
+    #          defaults applied, and the host limits dictionary
+    #-------------------------------------------------------
+    with open(configfile,"r") as infile:
+        config=json.load(infile)
+    defaults=config.get("defaults",{})
+    jobs={}
+    for jobsettings in config.get("jobs",[]):
+        job=dict(defaults,**jobsettings)
+        name=job.get("name","")
+        if (name==""):
+            raise Exception(f"Job in {configfile} has no name")
+        if name in jobs:
+            raise Exception(f"Job name {name} is used more than once in {configfile}")
+        if (job.get("action","") != "backup" and job.get("action","") not in RESTOREACTIONS):
+            raise Exception(f"Job {name} action must be: backup, newdb, overwritedb or restoreasdb")
+        job["schedulefields"]=parseschedule(job["schedule"]) if job.get("schedule","")!="" else None
+        jobs[name]=job
+    return (jobs,config.get("hostlimits",{}))
+
+class Scheduler:
+    #-------------------------------------------------------
+    # Class: Scheduler
+    # Desc: Start due jobs once a minute on the event loop with
+    #       global and per host concurrency limits
+    #-------------------------------------------------------
+
+    def __init__(self,configfile,maxjobs,hostlimit,statusfile=""):
+        self.configfile=configfile
+        self.maxjobs=maxjobs
+        self.hostlimit=hostlimit
+        self.statusfile=statusfile
+        self.configmtime=0
+        self.jobs={}
+        self.hostlimits={}
+        self.globallimit=asyncio.Semaphore(maxjobs)
+        self.hostsemaphores={}
+        self.running={}
+        self.stopping=asyncio.Event()
+        self.failedjobs=0
+
+    def reloadconfig(self):
+        #-------------------------------------------------------
+        # Function: reloadconfig
+        # Desc: Read the config file again if it changed. A bad
+        #       config file keeps the previous jobs.
+        #-------------------------------------------------------
+        mtime=os.path.getmtime(self.configfile)
+        if (mtime==self.configmtime):
+            return
+        try:
+            (self.jobs,self.hostlimits)=loadconfig(self.configfile)
+            # Running jobs keep the semaphore they were started with
+            self.hostsemaphores={}
+            print(f"INFO: Loaded {len(self.jobs)} jobs from {self.configfile} - {time.strftime('%H:%M:%S')}",flush=True)
+        except Exception as ex:
+            if (self.configmtime==0):
+                raise
+            print(f"ERROR: Config file {self.configfile} not loaded. Previous jobs are kept. {ex}",flush=True)
+        self.configmtime=mtime
+
+    def hostsemaphore(self,dbhost):
+        #-------------------------------------------------------
+        # Function: hostsemaphore
+        # Desc: Get the concurrency limit for a database host
+        # :dbhost: Database host. Blank=Local socket
+        # :return: asyncio.Semaphore
+        #-------------------------------------------------------
+        if dbhost not in self.hostsemaphores:
+            self.hostsemaphores[dbhost]=asyncio.Semaphore(int(self.hostlimits.get(dbhost,self.hostlimit)))
+        return self.hostsemaphores[dbhost]
+
+    def startjob(self,name):
+        #-------------------------------------------------------
+        # Function: startjob
+        # Desc: Start a job as a task unless it is still running
+        # :name: Job name
+        #-------------------------------------------------------
+        if name in self.running:
+            print(f"WARNING: Job {name} is still running and was skipped - {time.strftime('%H:%M:%S')}",flush=True)
+            return
+        self.running[name]=asyncio.get_running_loop().create_task(self.runjob(self.jobs[name]))
+
+    async def runjob(self,job):
+        #-------------------------------------------------------
+        # Function: runjob
+        # Desc: Run one job through the API once there is room
+        #       under the host and global limits
+        # :job: Job settings
+        #-------------------------------------------------------
+        name=job["name"]
+        kwargs={key:value for (key,value) in job.items() if key not in SCHEDULERSETTINGS and key!="schedulefields"}
+        if ("dbpass" not in kwargs and job.get("dbpassenv","")!=""):
+            kwargs["dbpass"]=os.environ.get(job["dbpassenv"],"")
+        dbhost=kwargs.get("dbhost","")
+        try:
+            async with self.hostsemaphore(dbhost):
+                async with self.globallimit:
+                    print(f"INFO: Starting job {name} {job['action']} of database {kwargs.get('dbname','')} on host {dbhost if dbhost!='' else 'local'} - {time.strftime('%H:%M:%S')}",flush=True)
+                    if (job["action"]=="backup"):
+                        result=await pypostgresapi.backup(**kwargs)
+                    else:
+                        result=await pypostgresapi.restore(job["action"],**kwargs)
+        except Exception as ex:
+            # Bad job settings such as an unknown parameter
+            result={"action":job["action"],"dbname":kwargs.get("dbname",""),"dbhost":dbhost,"exitcode":99,"exitmessage":str(ex)}
+        finally:
+            del self.running[name]
+        result["job"]=name
+        result["time"]=time.strftime('%Y-%m-%d %H:%M:%S')
+        if (result["exitcode"] != 0):
+            self.failedjobs+=1
+        print(f"INFO: Completed job {name} exitcode {result['exitcode']}. {result['exitmessage']} - {time.strftime('%H:%M:%S')}",flush=True)
+        if (self.statusfile!=""):
+            with open(self.statusfile,"a") as outfile:
+                outfile.write(json.dumps(result) + "\n")
+
+    async def runnow(self,names):
+        #-------------------------------------------------------
+        # Function: runnow
+        # Desc: Run jobs once now and wait for them to end
+        # :names: List of job names
+        #-------------------------------------------------------
+        self.reloadconfig()
+        for name in names:
+            if name not in self.jobs:
+                raise Exception(f"Job {name} not found in {self.configfile}")
+        for name in names:
+            self.startjob(name)
+        await asyncio.gather(*self.running.values())
+
+    async def run(self):
+        #-------------------------------------------------------
+        # Function: run
+        # Desc: Start due jobs at the start of each minute until
+        #       stopped, then wait for the running jobs
+        #-------------------------------------------------------
+        self.reloadconfig()
+        while (self.stopping.is_set()==False):
+            # Sleep to the start of the next minute or until stopped
+            try:
+                await asyncio.wait_for(self.stopping.wait(),timeout=60 - time.time() % 60)
+                break
+            except asyncio.TimeoutError:
+                pass
+            when=time.localtime(round(time.time() / 60) * 60)
+            self.reloadconfig()
+            for (name,job) in self.jobs.items():
+                if (job["schedulefields"] is not None and scheduledue(job["schedule"],job["schedulefields"],when)):
+                    self.startjob(name)
+        if (len(self.running) > 0):
+            print(f"INFO: Stopping. Waiting for {len(self.running)} running jobs: {', '.join(self.running)}",flush=True)
+            await asyncio.gather(*self.running.values())
+
+    def stop(self):
+        #-------------------------------------------------------
+        # Function: stop
+        # Desc: Stop starting new jobs. Called from a signal.
+        #-------------------------------------------------------
+        if (self.stopping.is_set()==False):
+            print(f"INFO: Stop requested - {time.strftime('%H:%M:%S')}",flush=True)
+        self.stopping.set()
+
+async def schedulermain(configfile,maxjobs,hostlimit,statusfile,runnow):
+    #-------------------------------------------------------
+    # Function: schedulermain
+    # Desc: Run the scheduler on the event loop
+    # :runnow: List of job names to run once. Empty=Run schedule
+    # :return: Number of failed jobs
+    #-------------------------------------------------------
+    scheduler=Scheduler(configfile,maxjobs,hostlimit,statusfile)
+    loop=asyncio.get_running_loop()
+    for signum in (signal.SIGTERM,signal.SIGINT):
+        try:
+            loop.add_signal_handler(signum,scheduler.stop)
+        except NotImplementedError:
+            # Windows event loops have no signal handlers
+            pass
+    if (len(runnow) > 0):
+        await scheduler.runnow(runnow)
+    else:
+        await scheduler.run()
+    return scheduler.failedjobs
+
+#------------------------------------------------
+# Main script logic
+#------------------------------------------------
+try: # Try to perform main logic
+
+      # Set up the command line argument parsing.
+      # If the parse_args function fails, the program will
+      # exit with an error 2. In Python 3.9, there is
+      # an argument to prevent an auto-exit
+      # Each argument has a long and short version
+      parser = argparse.ArgumentParser()
+      parser.add_argument('-c','--config', required=True,help="JSON config file with the jobs to schedule")
+      parser.add_argument('-m','--maxjobs', required=False,default=4,help="Maximum jobs running at the same time. Default=4")
+      parser.add_argument('-l','--hostlimit', required=False,default=2,help="Maximum jobs running at the same time against one host. Default=2")
+      parser.add_argument('-s','--statusfile', required=False,default="",help="JSON lines file to append job results to. Blank=No status file. Default=blank")
+      parser.add_argument('-n','--runnow', required=False,default="",help="Comma separated job names to run once now. Blank=Run the schedule. Default=blank")
+
+      # Parse the command line arguments
+      args = parser.parse_args()
+
+      # Set parameter work variables from command line args
+      parmscriptname = sys.argv[0]
+      parmconfig = args.config.strip()
+      parmmaxjobs=int(args.maxjobs)
+      parmhostlimit=int(args.hostlimit)
+      parmstatusfile=args.statusfile.strip()
+      parmrunnow=[name.strip() for name in args.runnow.split(",") if name.strip()!=""]
+
+      print(f"Python script: {parmscriptname}")
+      print(f"Config file: {parmconfig}")
+      print(f"Max jobs: {parmmaxjobs}")
+      print(f"Host limit: {parmhostlimit}")
+      print(f"Status file: {parmstatusfile}")
+      print(f"Run now: {','.join(parmrunnow)}")
+      print(dashes,flush=True)
+
+      if (os.path.isfile(parmconfig)==False):
+         raise Exception(f"Config file {parmconfig} not found. Process cancelled.")
+      if (parmmaxjobs < 1 or parmhostlimit < 1):
+         raise Exception("Max jobs and host limit must be 1 or more. Process cancelled.")
+
+      failedjobs=asyncio.run(schedulermain(parmconfig,parmmaxjobs,parmhostlimit,parmstatusfile,parmrunnow))
+
+      # Set success info
+      if (failedjobs > 0):
+         exitcode=99
+         exitmessage=f"Scheduler ended with {failedjobs} failed jobs"
+      else:
+         exitcode=0
+         exitmessage="Scheduler ended successfully"
+
+#------------------------------------------------
+# Handle Exceptions
+#------------------------------------------------
+# System Exit occurred. Most likely from argument parser
+except SystemExit as ex:
+     exitcode=ex.code # set return code for stdout
+     exitmessage=str(ex) # set exit message for stdout
+
+except argparse.ArgumentError as exc:
+     exitcode=99 # set return code for stdout
+     exitmessage=str(exc) # set exit message for stdout
+     print('Traceback Info') # output traceback info for stdout
+     traceback.print_exc()
+     sys.exit(99)
+
+except Exception as ex: # Catch and handle exceptions
+     exitcode=99 # set return code for stdout
+     exitmessage=str(ex) # set exit message for stdout
+     print('Traceback Info') # output traceback info for stdout
+     traceback.print_exc()
+     sys.exit(99)
+#------------------------------------------------
+# Always perform final processing
+#------------------------------------------------
+finally: # Final processing
+     # Do any final code and exit now
+     # We log as much relevent info to STDOUT as needed
+     print("")
+     print(dashes)
+     print('ExitCode:' + str(exitcode))
+     print('ExitMessage:' + exitmessage)
+     print(f"End of Main Processing -  {time.strftime('%H:%M:%S')}")
+     print(dashes)
+     print("")
+
+     # Exit the script
+     sys.exit(exitcode)